@@ -20,6 +20,58 @@ from .async_request_pool import get_request_pool
 
 logger = logging.getLogger(__name__)
 
+# Метрики бюджета запросов и гонки провайдеров
+try:
+    from prometheus_client import Counter
+    AI_DEADLINE_EXHAUSTED = Counter(
+        'ai_provider_deadline_exhausted_total', 'AI requests whose shared time budget ran out', ['provider']
+    )
+    AI_RACE_HEDGES = Counter(
+        'ai_provider_race_hedges_total', 'Fallback providers started because primary exceeded TTFB threshold', ['primary']
+    )
+    AI_RACE_WINS = Counter(
+        'ai_provider_race_wins_total', 'Raced AI requests won by provider', ['provider']
+    )
+    METRICS_ENABLED = True
+except ImportError:
+    METRICS_ENABLED = False
+
+
+class AIDeadlineExceeded(Exception):
+    """Общий бюджет времени запроса исчерпан"""
+
+
+class RequestDeadline:
+    """Общий бюджет времени на один AI запрос, разделяемый ретраями и fallback"""
+
+    def __init__(self, budget_seconds: float) -> None:
+        self.budget_seconds = float(budget_seconds)
+        self.expires_at = time.monotonic() + self.budget_seconds
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def timeout_for(self, cap: float) -> float:
+        """Таймаут очередной операции: не больше cap и не больше остатка бюджета"""
+        return min(float(cap), self.remaining())
+
+    def clip_httpx_timeout(self, timeout) -> httpx.Timeout:
+        """httpx.Timeout (или число), каждая фаза которого не длиннее остатка бюджета"""
+        remaining = max(self.remaining(), 0.001)
+        timeout = timeout if isinstance(timeout, httpx.Timeout) else httpx.Timeout(timeout)
+
+        def clip(value):
+            return remaining if value is None else min(value, remaining)
+
+        return httpx.Timeout(
+            connect=clip(timeout.connect), read=clip(timeout.read),
+            write=clip(timeout.write), pool=clip(timeout.pool)
+        )
+
+
 class CircuitBreakerState(Enum):
     CLOSED = "closed"
     OPEN = "open"
@@ -77,6 +129,7 @@ class AIProvidersManager:
     def __init__(self):
         self.providers = {}
         self.breakers: Dict[AIProvider, CircuitBreaker] = {}
+        self.deadline_exhausted: Dict[str, int] = {}
         self.initialize_providers()
     
     def initialize_providers(self):
@@ -122,11 +175,19 @@ class AIProvidersManager:
                 reset_timeout_seconds=reset_timeout_seconds,
             )
     
-    async def get_completion(self, messages: List[Dict], model: str = None, **kwargs) -> Dict:
+    async def get_completion(self, messages: List[Dict], model: str = None,
+                             deadline: Optional["RequestDeadline"] = None, **kwargs) -> Dict:
         """
         Получение ответа с автоматическим fallback между провайдерами
         Приоритет: OpenAI -> Claude -> Local
+
+        Все ретраи и fallback делят один общий бюджет времени (deadline).
+        Бюджет можно передать готовым объектом или через deadline_seconds,
+        по умолчанию берется AI_REQUEST_DEADLINE.
         """
+        deadline_seconds = kwargs.pop('deadline_seconds', None)
+        if deadline is None:
+            deadline = RequestDeadline(deadline_seconds or float(os.getenv('AI_REQUEST_DEADLINE', '90')))
         
         # Определяем приоритет провайдеров (OpenAI первым)
         priority_order = [
@@ -134,84 +195,184 @@ class AIProvidersManager:
             AIProvider.CLAUDE,    # Приоритет 2: Claude (fallback)
             AIProvider.LOCAL_LLM  # Приоритет 3: Локальная модель (fallback)
         ]
+        candidates = [p for p in priority_order if p in self.providers]
+        
+        race_enabled = os.getenv('AI_RACE_ENABLED', 'false').lower() in ('true', '1', 'yes')
+        if race_enabled and len(candidates) > 1 and not kwargs.get('stream', False):
+            return await self._race_completion(candidates, messages, model, deadline, **kwargs)
         
+        return await self._run_chain(candidates, messages, model, deadline, **kwargs)
+    
+    async def _run_chain(self, candidates: List[AIProvider], messages: List[Dict], model: Optional[str],
+                         deadline: "RequestDeadline", **kwargs) -> Dict:
+        """Последовательный обход провайдеров в пределах общего бюджета"""
         last_error = None
         
-        for provider_type in priority_order:
-            if provider_type not in self.providers:
-                continue
-                
-            provider = self.providers[provider_type]
+        for provider_type in candidates:
+            if deadline.expired():
+                self._record_deadline_exhausted(provider_type)
+                last_error = AIDeadlineExceeded(
+                    f"Бюджет {deadline.budget_seconds:.0f}s исчерпан до обращения к {provider_type.value}"
+                )
+                break
+            
             breaker = self.breakers.get(provider_type)
-
+            
             # Circuit breaker
             if breaker and not breaker.allow_request():
                 logger.warning(f"⛔ Circuit open для {provider_type.value}, пропускаем провайдера")
                 continue
             
             try:
-                logger.info(f"🔄 Попытка использовать {provider_type.value}")
+                return await self._try_provider(provider_type, messages, model, deadline, **kwargs)
+            except AIDeadlineExceeded as e:
+                last_error = e
+                break
+            except Exception as e:
+                last_error = e
+                logger.warning(f"⚠️ Ошибка {provider_type.value}: {str(e)}")
+                continue
+        
+        # Если все провайдеры недоступны
+        raise Exception(f"Все AI провайдеры недоступны. Последняя ошибка: {last_error}")
+    
+    async def _try_provider(self, provider_type: AIProvider, messages: List[Dict], model: Optional[str],
+                            deadline: "RequestDeadline", **kwargs) -> Dict:
+        """Запрос к одному провайдеру с ретраями, ограниченными общим бюджетом"""
+        import random
+        
+        provider = self.providers[provider_type]
+        breaker = self.breakers.get(provider_type)
+        
+        logger.info(f"🔄 Попытка использовать {provider_type.value}")
+        
+        # Адаптируем модель под провайдера  
+        adapted_model = self._adapt_model_for_provider(model, provider_type)
+        
+        # Ретраи с экспоненциальным бэкоффом и джиттером
+        max_retries = max(1, int(os.getenv('AI_RETRY_MAX_ATTEMPTS', '3')))
+        base_delay = float(os.getenv('AI_RETRY_BASE_DELAY', '0.5'))
+        request_timeout = int(os.getenv('AI_REQUEST_TIMEOUT', '120'))  # 2 минуты на попытку
+        last_error = None
+        
+        for attempt in range(max_retries):
+            # Таймаут попытки не может превышать остаток общего бюджета
+            attempt_timeout = deadline.timeout_for(request_timeout)
+            if attempt_timeout <= 0:
+                self._record_deadline_exhausted(provider_type)
+                raise AIDeadlineExceeded(
+                    f"Бюджет {deadline.budget_seconds:.0f}s исчерпан на {provider_type.value} "
+                    f"(попытка {attempt+1}/{max_retries}). Последняя ошибка: {last_error}"
+                )
+            
+            try:
+                # Оборачиваем вызов в таймаут для предотвращения зависания;
+                # провайдер получает deadline, чтобы не начинать внутренние ретраи сверх бюджета
+                result = await asyncio.wait_for(
+                    provider.get_completion(
+                        messages=messages,
+                        model=adapted_model,
+                        deadline=deadline,
+                        **kwargs
+                    ),
+                    timeout=attempt_timeout
+                )
                 
-                # Адаптируем модель под провайдера  
-                adapted_model = self._adapt_model_for_provider(model, provider_type)
+                if breaker:
+                    breaker.on_success()
+                logger.info(f"✅ Успешный ответ от {provider_type.value} (попытка {attempt+1}/{max_retries})")
+                result['provider_used'] = provider_type.value
+                return result
                 
-                # Ретраи с экспоненциальным бэкоффом и джиттером
-                max_retries = int(os.getenv('AI_RETRY_MAX_ATTEMPTS', '3'))
-                base_delay = float(os.getenv('AI_RETRY_BASE_DELAY', '0.5'))
-                import random
+            except asyncio.TimeoutError:
+                last_error = Exception(f"Таймаут запроса к {provider_type.value} ({attempt_timeout:.1f}s)")
+                if breaker:
+                    breaker.on_failure()
+                logger.warning(f"⚠️ Таймаут {provider_type.value} на попытке {attempt+1}/{max_retries}")
+                if deadline.expired():
+                    self._record_deadline_exhausted(provider_type)
+                    raise AIDeadlineExceeded(
+                        f"Бюджет {deadline.budget_seconds:.0f}s исчерпан ожиданием {provider_type.value}"
+                    )
+
+            except AIDeadlineExceeded:
+                # Бюджет кончился внутри провайдера (например, в цикле прокси OpenAI)
+                self._record_deadline_exhausted(provider_type)
+                raise
                 
-                for attempt in range(max_retries):
+            except Exception as e:
+                last_error = e
+                if breaker:
+                    breaker.on_failure()
+                logger.warning(f"⚠️ Ошибка {provider_type.value} на попытке {attempt+1}/{max_retries}: {str(e)}")
+            
+            if attempt < max_retries - 1:
+                delay = base_delay * (2 ** attempt) + random.uniform(0, 0.2)
+                if delay >= deadline.remaining():
+                    # Бэкофф не помещается в бюджет — отдаем остаток следующему провайдеру
+                    logger.warning(f"⏱️ Бюджет не позволяет повтор {provider_type.value}, переходим к fallback")
+                    break
+                logger.info(f"🔁 Повтор {provider_type.value} через {delay:.2f}s")
+                await asyncio.sleep(delay)
+        
+        logger.warning(f"❌ Провайдер {provider_type.value} не дал ответ после {attempt+1} попыток")
+        raise last_error or Exception(f"Провайдер {provider_type.value} не дал ответ")
+    
+    async def _race_completion(self, candidates: List[AIProvider], messages: List[Dict], model: Optional[str],
+                               deadline: "RequestDeadline", **kwargs) -> Dict:
+        """
+        Гонка провайдеров: если основной провайдер не ответил за AI_RACE_TTFB_THRESHOLD,
+        параллельно запускается fallback-цепочка. Побеждает первый успешный ответ.
+        Для нестриминговых запросов time-to-first-byte совпадает со временем ответа.
+        """
+        threshold = float(os.getenv('AI_RACE_TTFB_THRESHOLD', '8'))
+        primary, fallbacks = candidates[0], candidates[1:]
+        
+        primary_task = asyncio.create_task(self._run_chain([primary], messages, model, deadline, **kwargs))
+        done, _ = await asyncio.wait({primary_task}, timeout=min(threshold, max(deadline.remaining(), 0)))
+        
+        if done:
+            try:
+                return primary_task.result()
+            except Exception as e:
+                logger.warning(f"⚠️ Основной провайдер {primary.value} упал до порога гонки: {e}")
+                return await self._run_chain(fallbacks, messages, model, deadline, **kwargs)
+        
+        logger.info(f"🏁 {primary.value} не ответил за {threshold:.1f}s — запускаем гонку с fallback")
+        if METRICS_ENABLED:
+            AI_RACE_HEDGES.labels(primary=primary.value).inc()
+        fallback_task = asyncio.create_task(self._run_chain(fallbacks, messages, model, deadline, **kwargs))
+        
+        pending = {primary_task, fallback_task}
+        last_error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
                     try:
-                        # Оборачиваем вызов в таск с таймаутом для предотвращения зависания
-                        task = asyncio.create_task(provider.get_completion(
-                            messages=messages,
-                            model=adapted_model,
-                            **kwargs
-                        ))
-                        
-                        # Добавляем общий таймаут для запроса
-                        request_timeout = int(os.getenv('AI_REQUEST_TIMEOUT', '120'))  # 2 минуты
-                        result = await asyncio.wait_for(task, timeout=request_timeout)
-                        
-                        if breaker:
-                            breaker.on_success()
-                        logger.info(f"✅ Успешный ответ от {provider_type.value} (попытка {attempt+1}/{max_retries})")
-                        result['provider_used'] = provider_type.value
-                        return result
-                        
-                    except asyncio.TimeoutError:
-                        last_error = Exception(f"Таймаут запроса к {provider_type.value} ({request_timeout}s)")
-                        if breaker:
-                            breaker.on_failure()
-                        logger.warning(f"⚠️ Таймаут {provider_type.value} на попытке {attempt+1}/{max_retries}")
-                        
-                        if attempt < max_retries - 1:
-                            delay = base_delay * (2 ** attempt) + random.uniform(0, 0.2)
-                            await asyncio.sleep(delay)
-                        else:
-                            logger.warning(f"❌ Провайдер {provider_type.value} не дал ответ после {max_retries} попыток (таймаут)")
-                        continue
-                        
+                        result = task.result()
                     except Exception as e:
                         last_error = e
-                        if breaker:
-                            breaker.on_failure()
-                        if attempt < max_retries - 1:
-                            delay = base_delay * (2 ** attempt) + random.uniform(0, 0.2)
-                            logger.warning(f"⚠️ Ошибка {provider_type.value} на попытке {attempt+1}/{max_retries}: {str(e)}; повтор через {delay:.2f}s")
-                            await asyncio.sleep(delay)
-                        else:
-                            logger.warning(f"❌ Провайдер {provider_type.value} не дал ответ после {max_retries} попыток")
                         continue
-                
-            except Exception as e:
-                last_error = e
-                logger.warning(f"⚠️ Ошибка {provider_type.value}: {str(e)}")
-                continue
+                    winner = result.get('provider_used', 'unknown')
+                    logger.info(f"🏆 Гонку выиграл {winner}")
+                    if METRICS_ENABLED:
+                        AI_RACE_WINS.labels(provider=winner).inc()
+                    return result
+        finally:
+            for task in pending:
+                task.cancel()
         
-        # Если все провайдеры недоступны
         raise Exception(f"Все AI провайдеры недоступны. Последняя ошибка: {last_error}")
     
+    def _record_deadline_exhausted(self, provider_type: AIProvider) -> None:
+        """Учет исчерпания общего бюджета на конкретном провайдере"""
+        name = provider_type.value
+        self.deadline_exhausted[name] = self.deadline_exhausted.get(name, 0) + 1
+        logger.warning(f"⏱️ Общий бюджет запроса исчерпан на провайдере {name}")
+        if METRICS_ENABLED:
+            AI_DEADLINE_EXHAUSTED.labels(provider=name).inc()
+    
     def _adapt_model_for_provider(self, model: str, provider_type: AIProvider) -> str:
         """Адаптация названия модели под конкретного провайдера"""
         
@@ -266,7 +427,8 @@ class OpenAIProvider(BaseAIProvider):
         logger.info(f"🔗 OpenAI инициализирован с {metrics['total_proxies']} прокси, "
                    f"{metrics['available_proxies']} доступны")
     
-    async def get_completion(self, messages: List[Dict], model: str = "gpt-4o-mini", is_widget: bool = False, **kwargs) -> Dict:
+    async def get_completion(self, messages: List[Dict], model: str = "gpt-4o-mini", is_widget: bool = False,
+                             deadline: Optional[RequestDeadline] = None, **kwargs) -> Dict:
         """Получение ответа с отказоустойчивым прокси и идемпотентностью"""
         
         # Получаем токен из пула или используем фиксированный
@@ -303,6 +465,10 @@ class OpenAIProvider(BaseAIProvider):
         last_error = None
         
         for attempt in range(max_attempts):
+            # Не начинаем новую попытку через прокси, если общий бюджет запроса исчерпан
+            if deadline and deadline.expired():
+                raise AIDeadlineExceeded(f"Бюджет запроса исчерпан после {attempt} попыток OpenAI. Последняя ошибка: {last_error}")
+            
             # Получаем доступный прокси для запроса (асинхронный клиент)
             proxy_url, client_kwargs = self.proxy_manager.get_proxy_for_request(is_stream=is_stream, is_async=True, is_widget=is_widget)
             
@@ -314,6 +480,10 @@ class OpenAIProvider(BaseAIProvider):
                 else:
                     raise Exception("Все прокси недоступны и запрос без прокси неуспешен")
             
+            # Таймауты httpx не длиннее остатка общего бюджета
+            if deadline:
+                client_kwargs = {**client_kwargs, "timeout": deadline.clip_httpx_timeout(client_kwargs.get("timeout"))}
+            
             # Находим текущий прокси для метрик
             current_proxy = None
             if proxy_url:
@@ -663,8 +833,11 @@ def get_provider_status() -> Dict:
     """Получить статус всех провайдеров"""
     status = {}
     for provider_type, provider in ai_providers_manager.providers.items():
+        breaker = ai_providers_manager.breakers.get(provider_type)
         status[provider_type.value] = {
             "available": True,
-            "name": provider.name
+            "name": provider.name,
+            "circuit_state": breaker.state.value if breaker else None,
+            "deadline_exhausted": ai_providers_manager.deadline_exhausted.get(provider_type.value, 0)
         }
     return status
\ No newline at end of file
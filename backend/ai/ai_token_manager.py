@@ -19,6 +19,9 @@ except ImportError:
     AI_PROVIDERS_AVAILABLE = False
     print("⚠️ AI Providers не доступны, используется только OpenAI")
 
+# Общий бюджет синхронного вызова провайдеров (ретраи + fallback)
+SYNC_PROVIDER_DEADLINE_SECONDS = float(os.getenv('AI_SYNC_REQUEST_DEADLINE', '30'))
+
 class AITokenManager:
     """Менеджер пула AI токенов с умным распределением + поддержка российских провайдеров"""
     
@@ -290,7 +293,9 @@ class AITokenManager:
                     # Создаем mock объект response в формате OpenAI
                     class MockEmbeddingResponse:
                         def __init__(self, data):
-                            self.data = [MockEmbeddingData(item) for item in data.get('data', [])]
+                            # Для input-массива порядок задает index, а не позиция в ответе
+                            items = sorted(data.get('data', []), key=lambda item: item.get('index', 0))
+                            self.data = [MockEmbeddingData(item) for item in items]
                             self.usage = MockUsage(data.get('usage', {}))
                     
                     class MockEmbeddingData:
@@ -419,14 +424,16 @@ class AITokenManager:
                                 model=model,
                                 temperature=temperature,
                                 max_tokens=max_tokens,
-                                is_widget=is_widget
+                                is_widget=is_widget,
+                                deadline_seconds=SYNC_PROVIDER_DEADLINE_SECONDS
                             ))
                         finally:
                             new_loop.close()
                     
                     with concurrent.futures.ThreadPoolExecutor() as executor:
                         future = executor.submit(run_async_in_thread)
-                        result = future.result(timeout=30)  # 30 секунд таймаут
+                        # Небольшой запас сверх бюджета провайдеров на завершение event loop
+                        result = future.result(timeout=SYNC_PROVIDER_DEADLINE_SECONDS + 2)
                 else:
                     # Если event loop не запущен, используем asyncio.run
                     # Импортируем для правильного scope
@@ -436,7 +443,8 @@ class AITokenManager:
                         model=model,
                         temperature=temperature,
                         max_tokens=max_tokens,
-                        is_widget=is_widget
+                        is_widget=is_widget,
+                        deadline_seconds=SYNC_PROVIDER_DEADLINE_SECONDS
                     ))
                 
                 response_time = time.time() - start_time
@@ -1,9 +1,13 @@
 from fastapi import APIRouter, Depends, HTTPException, Body
 from sqlalchemy.orm import Session
-from sqlalchemy import func, text
-from typing import List, Optional
+from sqlalchemy import func, text, bindparam
+from typing import List, Optional, Dict, Tuple
+from collections import Counter
 import json
+import os
 import re
+import threading
+import time
 from datetime import datetime, timedelta
 from database import models, get_db
 from core import auth
@@ -390,6 +394,7 @@ def create_conversation_pattern(
     }).fetchone()[0]
     
     db.commit()
+    invalidate_pattern_index(current_user.id)
     
     return {"id": pattern_id, "message": "Паттерн создан успешно"}
 
@@ -522,33 +527,162 @@ def get_training_analytics(
         ]
     }
 
+# ============================
+# Индекс паттернов разговоров
+# ============================
+
+PATTERN_INDEX_TTL_SECONDS = int(os.getenv('PATTERN_INDEX_TTL_SECONDS', '300'))
+PATTERN_INDEX_VERSION_CHECK_SECONDS = int(os.getenv('PATTERN_INDEX_VERSION_CHECK_SECONDS', '5'))
+PATTERN_USAGE_FLUSH_SECONDS = int(os.getenv('PATTERN_USAGE_FLUSH_SECONDS', '30'))
+PATTERN_USAGE_FLUSH_SIZE = int(os.getenv('PATTERN_USAGE_FLUSH_SIZE', '100'))
+
+_WORD_RE = re.compile(r'\w+')
+
+
+def _tokenize(value: str) -> List[str]:
+    return _WORD_RE.findall(value.lower())
+
+
+class PatternIndex:
+    """
+    Инвертированный индекс слово -> паттерны для одного пользователя.
+    Ранг паттерна повторяет прежний порядок обхода (confidence_score, success_rate),
+    поэтому из всех совпавших выбирается тот же паттерн, что и при линейном переборе.
+    """
+
+    def __init__(self, rows, version: Optional[int] = None):
+        self.version = version
+        self.loaded_at = time.monotonic()
+        self.checked_at = self.loaded_at
+        # rank -> (pattern_id, recommended_response)
+        self.patterns: List[Tuple[int, str]] = []
+        self.postings: Dict[str, List[int]] = {}
+        for rank, (user_input_pattern, recommended_response, pattern_id) in enumerate(rows):
+            self.patterns.append((pattern_id, recommended_response))
+            for word in set(_tokenize(user_input_pattern or '')):
+                self.postings.setdefault(word, []).append(rank)
+
+    def match(self, user_message: str) -> Optional[Tuple[int, str]]:
+        best_rank = None
+        for word in set(_tokenize(user_message)):
+            ranks = self.postings.get(word)
+            # Списки отсортированы по рангу, достаточно первого элемента
+            if ranks and (best_rank is None or ranks[0] < best_rank):
+                best_rank = ranks[0]
+        if best_rank is None:
+            return None
+        return self.patterns[best_rank]
+
+
+_pattern_indexes: Dict[int, PatternIndex] = {}
+_pattern_usage: Counter = Counter()
+_pattern_lock = threading.Lock()
+_usage_flushed_at = time.monotonic()
+
+
+def _pattern_version(user_id: int) -> Optional[int]:
+    """Версия паттернов пользователя в Redis — общая для всех воркеров"""
+    from cache.redis_cache import cache
+    value = cache.get("conversation_patterns_version", user_id=user_id)
+    return int(value) if value is not None else None
+
+
+def invalidate_pattern_index(user_id: int) -> None:
+    """Сбрасывает индекс паттернов пользователя после создания или изменения паттерна"""
+    with _pattern_lock:
+        _pattern_indexes.pop(user_id, None)
+    try:
+        from cache.redis_cache import cache
+        cache.set("conversation_patterns_version", int(time.time() * 1000), ttl=0, user_id=user_id)
+    except Exception as e:
+        print(f"Error bumping pattern version: {e}")
+
+
+def _get_pattern_index(user_id: int, db: Session) -> PatternIndex:
+    now = time.monotonic()
+    index = _pattern_indexes.get(user_id)
+    
+    if index and now - index.loaded_at < PATTERN_INDEX_TTL_SECONDS:
+        if now - index.checked_at < PATTERN_INDEX_VERSION_CHECK_SECONDS:
+            return index
+        # Периодически сверяем версию, чтобы подхватить изменения из других воркеров
+        index.checked_at = now
+        if _pattern_version(user_id) == index.version:
+            return index
+    
+    version = _pattern_version(user_id)
+    rows = db.execute(text("""
+        SELECT user_input_pattern, recommended_response, id
+        FROM conversation_patterns
+        WHERE user_id = :user_id AND is_active = TRUE
+        ORDER BY confidence_score DESC, success_rate DESC
+    """), {"user_id": user_id}).fetchall()
+    
+    index = PatternIndex(rows, version=version)
+    with _pattern_lock:
+        _pattern_indexes[user_id] = index
+    return index
+
+
+def _record_pattern_usage(pattern_id: int) -> None:
+    with _pattern_lock:
+        _pattern_usage[pattern_id] += 1
+        pending = sum(_pattern_usage.values())
+    if pending >= PATTERN_USAGE_FLUSH_SIZE or time.monotonic() - _usage_flushed_at >= PATTERN_USAGE_FLUSH_SECONDS:
+        flush_pattern_usage()
+
+
+def flush_pattern_usage() -> int:
+    """Пакетно записывает накопленные счетчики использования паттернов"""
+    global _usage_flushed_at
+    with _pattern_lock:
+        pending = dict(_pattern_usage)
+        _pattern_usage.clear()
+        _usage_flushed_at = time.monotonic()
+    if not pending:
+        return 0
+    
+    # Одно UPDATE на каждое различное значение приращения (обычно одно-два)
+    by_increment: Dict[int, List[int]] = {}
+    for pattern_id, count in pending.items():
+        by_increment.setdefault(count, []).append(pattern_id)
+    
+    from database.connection import SessionLocal
+    db = SessionLocal()
+    try:
+        statement = text("""
+            UPDATE conversation_patterns 
+            SET usage_count = usage_count + :increment,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE id IN :ids
+        """).bindparams(bindparam("ids", expanding=True))
+        for increment, ids in by_increment.items():
+            db.execute(statement, {"increment": increment, "ids": ids})
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        print(f"Error flushing pattern usage: {e}")
+        # Возвращаем счетчики, чтобы не потерять их при следующей попытке
+        with _pattern_lock:
+            _pattern_usage.update(pending)
+        return 0
+    finally:
+        db.close()
+    
+    return sum(pending.values())
+
+
 def find_matching_pattern(user_message: str, user_id: int, db: Session) -> Optional[str]:
     """Находит подходящий паттерн для сообщения пользователя"""
     try:
-        patterns = db.execute(text("""
-            SELECT user_input_pattern, recommended_response, id
-            FROM conversation_patterns
-            WHERE user_id = :user_id AND is_active = TRUE
-            ORDER BY confidence_score DESC, success_rate DESC
-        """), {"user_id": user_id}).fetchall()
-        
-        for pattern in patterns:
-            pattern_text = pattern[0].lower()
-            user_text = user_message.lower()
-            
-            # Простое сопоставление по ключевым словам
-            if pattern_text in user_text or any(word in user_text for word in pattern_text.split()):
-                # Обновляем статистику использования
-                db.execute(text("""
-                    UPDATE conversation_patterns 
-                    SET usage_count = usage_count + 1,
-                        updated_at = CURRENT_TIMESTAMP
-                    WHERE id = :id
-                """), {"id": pattern[2]})
-                
-                return pattern[1]  # recommended_response
+        matched = _get_pattern_index(user_id, db).match(user_message)
+        if matched:
+            pattern_id, recommended_response = matched
+            # Статистика использования пишется пакетно
+            _record_pattern_usage(pattern_id)
+            return recommended_response
                 
     except Exception as e:
         print(f"Error finding pattern: {e}")
     
-    return None
\ No newline at end of file
+    return None
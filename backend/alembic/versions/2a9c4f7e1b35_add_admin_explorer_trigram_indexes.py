@@ -0,0 +1,50 @@
+"""add_admin_explorer_trigram_indexes
+
+Revision ID: 2a9c4f7e1b35
+Revises: 7d4b2e9f1a06
+Create Date: 2026-10-19 20:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = '2a9c4f7e1b35'
+down_revision: Union[str, Sequence[str], None] = '7d4b2e9f1a06'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Колонки поиска обозревателя таблиц (services.table_explorer.SEARCH_COLUMNS)
+SEARCH_COLUMNS = {
+    'users': ('email', 'first_name'),
+    'assistants': ('name',),
+    'dialogs': ('telegram_username', 'first_name', 'last_name', 'guest_id'),
+    'dialog_messages': ('text',),
+    'documents': ('filename',),
+    'qa_knowledge': ('question', 'answer'),
+    'balance_transactions': ('description',),
+    'training_examples': ('user_message',),
+}
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+    # выполняем вне транзакции Alembic, чтобы не блокировать запись в большие таблицы
+    with op.get_context().autocommit_block():
+        for table, columns in SEARCH_COLUMNS.items():
+            for column in columns:
+                op.execute(
+                    f"CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_{table}_{column}_trgm "
+                    f"ON {table} USING gin ({column} gin_trgm_ops);"
+                )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        for table, columns in SEARCH_COLUMNS.items():
+            for column in columns:
+                op.execute(f"DROP INDEX CONCURRENTLY IF EXISTS ix_{table}_{column}_trgm;")
@@ -0,0 +1,56 @@
+"""add_response_latency_sketches
+
+Revision ID: 3f6a1c8e5b27
+Revises: 9b7e3d2a4c18
+Create Date: 2026-10-19 18:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3f6a1c8e5b27'
+down_revision: Union[str, Sequence[str], None] = '9b7e3d2a4c18'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('dialog_messages', sa.Column('response_time_ms', sa.Integer(), nullable=True))
+    op.create_table(
+        'response_latency_sketches',
+        sa.Column('source', sa.String(length=16), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('hour', sa.DateTime(), nullable=False),
+        sa.Column('bucket', sa.Integer(), nullable=False),
+        sa.Column('count', sa.Integer(), server_default='0', nullable=False),
+        sa.Column('total_ms', sa.BigInteger(), server_default='0', nullable=False),
+        sa.PrimaryKeyConstraint('source', 'user_id', 'hour', 'bucket', name=op.f('pk_response_latency_sketches')),
+    )
+    op.create_index('ix_response_latency_sketches_source_hour', 'response_latency_sketches', ['source', 'hour'])
+    # Время ответа для истории: последнее сообщение пользователя до ответа ассистента.
+    # Скетчи по истории строит scripts/rebuild_response_latency.py
+    op.execute("""
+        WITH answers AS (
+            SELECT id, sender, timestamp,
+                   max(CASE WHEN sender = 'user' THEN timestamp END)
+                       OVER (PARTITION BY dialog_id ORDER BY timestamp, id ROWS UNBOUNDED PRECEDING) AS question_at
+            FROM dialog_messages
+        )
+        UPDATE dialog_messages m
+        SET response_time_ms = round(extract(epoch FROM a.timestamp - a.question_at) * 1000)
+        FROM answers a
+        WHERE m.id = a.id AND a.sender = 'assistant' AND a.question_at IS NOT NULL
+          AND a.timestamp - a.question_at <= interval '1 hour'
+    """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_response_latency_sketches_source_hour', table_name='response_latency_sketches')
+    op.drop_table('response_latency_sketches')
+    op.drop_column('dialog_messages', 'response_time_ms')
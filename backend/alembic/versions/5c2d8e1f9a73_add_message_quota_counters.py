@@ -0,0 +1,50 @@
+"""add_message_quota_counters
+
+Revision ID: 5c2d8e1f9a73
+Revises: e41f7a9c2b60
+Create Date: 2026-10-19 14:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5c2d8e1f9a73'
+down_revision: Union[str, Sequence[str], None] = 'e41f7a9c2b60'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'message_quota_counters',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('period', sa.String(length=16), nullable=False),
+        sa.Column('count', sa.Integer(), server_default='0', nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE',
+                                name=op.f('fk_message_quota_counters_user_id_users')),
+        sa.PrimaryKeyConstraint('user_id', 'period', name=op.f('pk_message_quota_counters')),
+    )
+    # Начальное заполнение из истории (дальше счетчики ведет приложение)
+    op.execute("""
+        INSERT INTO message_quota_counters (user_id, period, count, updated_at)
+        SELECT d.user_id, to_char(m.timestamp, 'YYYY-MM'), count(*), now()
+        FROM dialog_messages m JOIN dialogs d ON d.id = m.dialog_id
+        WHERE m.sender = 'assistant' AND d.user_id IS NOT NULL AND m.timestamp IS NOT NULL
+        GROUP BY d.user_id, to_char(m.timestamp, 'YYYY-MM')
+        UNION ALL
+        SELECT d.user_id, 'all', count(*), now()
+        FROM dialog_messages m JOIN dialogs d ON d.id = m.dialog_id
+        WHERE m.sender = 'assistant' AND d.user_id IS NOT NULL
+        GROUP BY d.user_id
+    """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('message_quota_counters')
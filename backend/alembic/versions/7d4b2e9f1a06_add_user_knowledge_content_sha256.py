@@ -0,0 +1,40 @@
+"""add_user_knowledge_content_sha256
+
+Revision ID: 7d4b2e9f1a06
+Revises: 3f6a1c8e5b27
+Create Date: 2026-10-19 19:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7d4b2e9f1a06'
+down_revision: Union[str, Sequence[str], None] = '3f6a1c8e5b27'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('user_knowledge', sa.Column('content_sha256', sa.String(length=64), nullable=True))
+    # Хэш из заголовка валидации KnowledgeControlService, иначе SHA-256 всего текста
+    # (то же, что database.models.knowledge_content_hash)
+    op.execute(r"""
+        UPDATE user_knowledge
+        SET content_sha256 = COALESCE(
+            substring(content from '^\s*# МЕТАДАННЫЕ ВАЛИДАЦИИ\s*# Хэш: ([0-9a-f]{64})'),
+            encode(sha256(convert_to(content, 'UTF8')), 'hex')
+        )
+    """)
+    op.create_index('ix_user_knowledge_owner_content_sha256', 'user_knowledge',
+                    ['user_id', 'assistant_id', 'content_sha256'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_user_knowledge_owner_content_sha256', table_name='user_knowledge')
+    op.drop_column('user_knowledge', 'content_sha256')
@@ -0,0 +1,77 @@
+"""add_qa_import_jobs
+
+Revision ID: 8e1d5b3c7f42
+Revises: 2a9c4f7e1b35
+Create Date: 2026-10-19 21:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8e1d5b3c7f42'
+down_revision: Union[str, Sequence[str], None] = '2a9c4f7e1b35'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'qa_import_jobs',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('assistant_id', sa.Integer(), nullable=True),
+        sa.Column('kind', sa.String(length=16), server_default='file', nullable=False),
+        sa.Column('filename', sa.String(), nullable=True),
+        sa.Column('status', sa.String(length=16), server_default='pending', nullable=False),
+        sa.Column('total_rows', sa.Integer(), server_default='0', nullable=False),
+        sa.Column('inserted', sa.Integer(), server_default='0', nullable=False),
+        sa.Column('duplicates', sa.Integer(), server_default='0', nullable=False),
+        sa.Column('invalid', sa.Integer(), server_default='0', nullable=False),
+        sa.Column('to_embed', sa.Integer(), server_default='0', nullable=False),
+        sa.Column('embedded', sa.Integer(), server_default='0', nullable=False),
+        sa.Column('embed_failed', sa.Integer(), server_default='0', nullable=False),
+        sa.Column('cursor_qa_id', sa.Integer(), server_default='0', nullable=False),
+        sa.Column('attempts', sa.Integer(), server_default='0', nullable=False),
+        sa.Column('row_errors', sa.Text(), nullable=True),
+        sa.Column('last_error', sa.Text(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('available_at', sa.DateTime(), nullable=False),
+        sa.Column('heartbeat_at', sa.DateTime(), nullable=True),
+        sa.Column('finished_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['assistant_id'], ['assistants.id'], ondelete='SET NULL'),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_qa_import_jobs_status_available_at', 'qa_import_jobs', ['status', 'available_at'], unique=False)
+    op.create_index('ix_qa_import_jobs_user_id_created_at', 'qa_import_jobs', ['user_id', 'created_at'], unique=False)
+
+    op.add_column('qa_knowledge', sa.Column('question_hash', sa.String(length=64), nullable=True))
+    op.add_column('qa_knowledge', sa.Column('index_job_id', sa.Integer(), nullable=True))
+    op.create_foreign_key('fk_qa_knowledge_index_job_id', 'qa_knowledge', 'qa_import_jobs',
+                          ['index_job_id'], ['id'], ondelete='SET NULL')
+    # То же, что database.models.qa_question_hash: пробелы схлопнуты, регистр нижний
+    op.execute(r"""
+        UPDATE qa_knowledge
+        SET question_hash = encode(sha256(convert_to(
+            lower(btrim(regexp_replace(question, '\s+', ' ', 'g'))), 'UTF8')), 'hex')
+    """)
+    op.create_index('ix_qa_knowledge_owner_question_hash', 'qa_knowledge',
+                    ['user_id', 'assistant_id', 'question_hash'], unique=False)
+    op.create_index('ix_qa_knowledge_index_job_id', 'qa_knowledge', ['index_job_id', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_qa_knowledge_index_job_id', table_name='qa_knowledge')
+    op.drop_index('ix_qa_knowledge_owner_question_hash', table_name='qa_knowledge')
+    op.drop_constraint('fk_qa_knowledge_index_job_id', 'qa_knowledge', type_='foreignkey')
+    op.drop_column('qa_knowledge', 'index_job_id')
+    op.drop_column('qa_knowledge', 'question_hash')
+    op.drop_index('ix_qa_import_jobs_user_id_created_at', table_name='qa_import_jobs')
+    op.drop_index('ix_qa_import_jobs_status_available_at', table_name='qa_import_jobs')
+    op.drop_table('qa_import_jobs')
@@ -0,0 +1,61 @@
+"""add_assistant_daily_stats
+
+Revision ID: 9b7e3d2a4c18
+Revises: 5c2d8e1f9a73
+Create Date: 2026-10-19 16:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9b7e3d2a4c18'
+down_revision: Union[str, Sequence[str], None] = '5c2d8e1f9a73'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'assistant_daily_stats',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('assistant_id', sa.Integer(), nullable=False),
+        sa.Column('day', sa.Date(), nullable=False),
+        sa.Column('messages', sa.Integer(), server_default='0', nullable=False),
+        sa.Column('dialogs', sa.Integer(), server_default='0', nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE',
+                                name=op.f('fk_assistant_daily_stats_user_id_users')),
+        sa.ForeignKeyConstraint(['assistant_id'], ['assistants.id'], ondelete='CASCADE',
+                                name=op.f('fk_assistant_daily_stats_assistant_id_assistants')),
+        sa.PrimaryKeyConstraint('user_id', 'assistant_id', 'day', name=op.f('pk_assistant_daily_stats')),
+    )
+    op.create_index('ix_assistant_daily_stats_user_id_day', 'assistant_daily_stats', ['user_id', 'day'])
+    # Начальное заполнение из истории (дальше итоги ведет приложение)
+    op.execute("""
+        INSERT INTO assistant_daily_stats (user_id, assistant_id, day, messages, dialogs)
+        SELECT user_id, assistant_id, day, sum(messages), sum(dialogs)
+        FROM (
+            SELECT d.user_id, d.assistant_id, m.timestamp::date AS day, count(*) AS messages, 0 AS dialogs
+            FROM dialog_messages m JOIN dialogs d ON d.id = m.dialog_id
+            WHERE m.sender = 'assistant' AND m.timestamp IS NOT NULL
+              AND d.user_id IS NOT NULL AND d.assistant_id IS NOT NULL
+            GROUP BY d.user_id, d.assistant_id, m.timestamp::date
+            UNION ALL
+            SELECT user_id, assistant_id, started_at::date, 0, count(*)
+            FROM dialogs
+            WHERE started_at IS NOT NULL AND user_id IS NOT NULL AND assistant_id IS NOT NULL
+            GROUP BY user_id, assistant_id, started_at::date
+        ) AS history
+        WHERE assistant_id IN (SELECT id FROM assistants)
+        GROUP BY user_id, assistant_id, day
+    """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_assistant_daily_stats_user_id_day', table_name='assistant_daily_stats')
+    op.drop_table('assistant_daily_stats')
@@ -0,0 +1,47 @@
+"""add_guest_message_counters
+
+Revision ID: c73a1f9e5d28
+Revises: 8e1d5b3c7f42
+Create Date: 2026-10-19 22:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c73a1f9e5d28'
+down_revision: Union[str, Sequence[str], None] = '8e1d5b3c7f42'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'guest_message_counters',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('guest_id', sa.String(), nullable=False),
+        sa.Column('period', sa.String(length=16), nullable=False),
+        sa.Column('count', sa.Integer(), server_default='0', nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE',
+                                name=op.f('fk_guest_message_counters_user_id_users')),
+        sa.PrimaryKeyConstraint('user_id', 'guest_id', 'period', name=op.f('pk_guest_message_counters')),
+    )
+    # Начальное заполнение из истории (дальше счетчики ведет приложение)
+    op.execute("""
+        INSERT INTO guest_message_counters (user_id, guest_id, period, count, updated_at)
+        SELECT d.user_id, d.guest_id, to_char(m.timestamp, 'YYYY-MM'), count(*), now()
+        FROM dialog_messages m JOIN dialogs d ON d.id = m.dialog_id
+        WHERE m.sender = 'assistant' AND d.user_id IS NOT NULL AND d.guest_id IS NOT NULL
+          AND m.timestamp IS NOT NULL
+        GROUP BY d.user_id, d.guest_id, to_char(m.timestamp, 'YYYY-MM')
+    """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('guest_message_counters')
@@ -0,0 +1,52 @@
+"""add_payment_webhook_events
+
+Revision ID: e41f7a9c2b60
+Revises: d8ed002bc152
+Create Date: 2026-10-19 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e41f7a9c2b60'
+down_revision: Union[str, Sequence[str], None] = 'd8ed002bc152'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'payment_webhook_events',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('payment_id', sa.String(), nullable=False),
+        sa.Column('event', sa.String(), nullable=False),
+        sa.Column('payload', sa.Text(), nullable=False),
+        sa.Column('source_ip', sa.String(), nullable=True),
+        sa.Column('status', sa.String(), server_default='pending', nullable=False),
+        sa.Column('attempts', sa.Integer(), server_default='0', nullable=False),
+        sa.Column('last_error', sa.Text(), nullable=True),
+        sa.Column('received_at', sa.DateTime(), nullable=False),
+        sa.Column('available_at', sa.DateTime(), nullable=False),
+        sa.Column('processed_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id', name=op.f('pk_payment_webhook_events')),
+        sa.UniqueConstraint('payment_id', 'event', name='uq_payment_webhook_events_payment_id_event'),
+    )
+    op.create_index(
+        'ix_payment_webhook_events_status_available_at',
+        'payment_webhook_events',
+        ['status', 'available_at'],
+    )
+    # Поиск платежа обработчиком по ID ЮKassa
+    op.create_index('ix_payments_yookassa_payment_id', 'payments', ['yookassa_payment_id'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_payments_yookassa_payment_id', table_name='payments')
+    op.drop_index('ix_payment_webhook_events_status_available_at', table_name='payment_webhook_events')
+    op.drop_table('payment_webhook_events')
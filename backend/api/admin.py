@@ -13,6 +13,7 @@ from functools import lru_cache
 from database.connection import get_db
 from database import models, schemas, crud
 from core import auth
+from database.utils.query_sampler import query_budget
 from pydantic import BaseModel
 
 logger = logging.getLogger(__name__)
@@ -332,6 +333,21 @@ def get_system_stats(db: Session = Depends(get_db), current_user: models.User =
             "timestamp": datetime.utcnow().isoformat()
         }
 
+@router.get("/admin/db-query-performance")
+def get_db_query_performance(
+    window_minutes: int = Query(60, ge=1, le=1440),
+    limit: int = Query(10, ge=1, le=100),
+    current_user: models.User = Depends(auth.get_current_admin)
+):
+    """Топ маршрутов по времени БД, медленные запросы за окно, N+1 и регрессии после деплоя"""
+    from database.utils.query_sampler import query_sampler
+
+    try:
+        return query_sampler.get_report(window_minutes=window_minutes, limit=limit)
+    except Exception as e:
+        logger.error(f"Ошибка в db-query-performance: {e}")
+        raise HTTPException(status_code=500, detail="Ошибка при получении статистики запросов")
+
 @router.get("/admin/realtime-stats")
 def get_realtime_stats(db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_admin)):
     """Получение статистики в реальном времени"""
@@ -1347,6 +1363,7 @@ async def get_revenue_analytics(
 # === BOTS MONITORING ENDPOINTS ===
 
 @router.get("/admin/bots-monitoring")
+@query_budget(8)
 def get_bots_monitoring_data(
     status: str = Query('all', enum=['all', 'online', 'offline', 'error', 'starting']),
     search: str = Query('', description="Search by bot name or ID"),
@@ -1359,14 +1376,15 @@ def get_bots_monitoring_data(
         import requests
         import json
         
-        # Получаем все bot instances из базы
-        query = db.query(models.BotInstance).join(
+        # Получаем все bot instances из базы вместе с ассистентом и владельцем одним запросом
+        query = db.query(models.BotInstance, models.Assistant, models.User).join(
             models.Assistant, models.BotInstance.assistant_id == models.Assistant.id
         ).join(
             models.User, models.BotInstance.user_id == models.User.id
         )
         
-        bot_instances = query.all()
+        bot_rows = query.all()
+        bot_instances = [bot for bot, _, _ in bot_rows]
         
         # Получаем статусы ботов from Scalable Bot Manager
         bot_statuses = {}
@@ -1472,17 +1490,20 @@ def get_bots_monitoring_data(
                 for msg in debug_messages:
                     logger.info(f"  - {msg.timestamp} | sender: {msg.sender} | text: {msg.text[:50]}...")
 
+            # Fallback для ботов без сообщений: время последнего диалога, тоже одним запросом
+            missing_ids = [assistant_id for assistant_id in set(assistant_ids) if assistant_id not in last_activities]
+            last_dialogs = {}
+            if missing_ids:
+                last_dialogs = dict(db.query(
+                    models.Dialog.assistant_id,
+                    func.max(models.Dialog.started_at)
+                ).filter(
+                    models.Dialog.assistant_id.in_(missing_ids)
+                ).group_by(models.Dialog.assistant_id).all())
+
         # Формируем результат
         result_bots = []
-        for bot in bot_instances:
-            assistant = db.query(models.Assistant).filter(
-                models.Assistant.id == bot.assistant_id
-            ).first()
-            
-            user = db.query(models.User).filter(
-                models.User.id == bot.user_id  
-            ).first()
-            
+        for bot, assistant, user in bot_rows:
             # Получаем реальный статус из bot manager
             bot_status_info = bot_statuses.get(bot.id, {})
             real_status = bot_status_info.get('status', 'offline' if not bot.is_active else 'starting')
@@ -1494,13 +1515,8 @@ def get_bots_monitoring_data(
             real_last_activity = last_activities.get(bot.assistant_id)
             
             # Fallback: если не нашли последние сообщения, используем время последнего диалога
-            if not real_last_activity:
-                last_dialog = db.query(models.Dialog).filter(
-                    models.Dialog.assistant_id == bot.assistant_id
-                ).order_by(models.Dialog.started_at.desc()).first()
-                
-                if last_dialog and last_dialog.started_at:
-                    real_last_activity = last_dialog.started_at.isoformat()
+            if not real_last_activity and last_dialogs.get(bot.assistant_id):
+                real_last_activity = last_dialogs[bot.assistant_id].isoformat()
             
             # Вычисляем uptime
             uptime_seconds = bot_status_info.get('uptime', 0)
@@ -1724,6 +1740,11 @@ def execute_bot_action(
 
 # === ADMIN SETTINGS ENDPOINTS ===
 
+def _invalidate_settings_caches():
+    """Сбрасывает кэши, зависящие от SystemSettings, чтобы изменения применились сразу"""
+    from services.improved_handoff_detector import invalidate_handoff_detector
+    invalidate_handoff_detector()
+
 @router.get("/admin/settings", response_model=schemas.AdminSettingsResponse)
 def get_admin_settings(
     category: Optional[str] = Query(None, description="Filter by category"),
@@ -1828,6 +1849,7 @@ def create_admin_setting(
         db.refresh(new_setting)
         
         logger.info(f"Admin {current_user.email} created setting {category}.{key}")
+        _invalidate_settings_caches()
         
         # Маскируем чувствительные данные в ответе
         result = schemas.SystemSettingRead.from_orm(new_setting)
@@ -1879,6 +1901,7 @@ def update_admin_setting(
         db.refresh(setting)
         
         logger.info(f"Admin {current_user.email} updated setting {category}.{key}")
+        _invalidate_settings_caches()
         
         # Маскируем чувствительные данные в ответе
         result = schemas.SystemSettingRead.from_orm(setting)
@@ -1918,6 +1941,7 @@ def delete_admin_setting(
         db.commit()
         
         logger.info(f"Admin {current_user.email} deleted setting {category}.{key}")
+        _invalidate_settings_caches()
         
         return {"message": f"Setting {category}.{key} deleted successfully"}
         
@@ -1967,6 +1991,7 @@ def bulk_update_settings(
         db.commit()
         
         logger.info(f"Admin {current_user.email} bulk updated {updated_count} settings")
+        _invalidate_settings_caches()
         
         return {
             "message": f"Bulk update completed",
@@ -3,6 +3,7 @@ from sqlalchemy.orm import Session, joinedload, selectinload
 from sqlalchemy import func
 from typing import List as TypingList, Optional
 from datetime import datetime, timedelta
+import asyncio
 import json
 import os
 import logging
@@ -14,6 +15,8 @@ from fastapi import BackgroundTasks
 from pydantic import BaseModel
 from validators.file_validator import FileValidator
 from ai.ai_token_manager import ai_token_manager
+from cache.widget_auth_cache import widget_auth_cache
+from services import assistant_stats
 
 logger = logging.getLogger(__name__)
 
@@ -211,18 +214,11 @@ def delete_my_assistant(assistant_id: int, db: Session = Depends(get_db), curren
         models.BotInstance.user_id == current_user.id
     ).all()]
 
-    # Остановить боты через мульти-бот менеджер одним запросом
+    # Остановить боты через канал управления (без ожидания менеджера)
     if bot_ids:
-        try:
-            import requests
-            response = requests.post(
-                "http://127.0.0.1:3001/stop-bots",
-                json={"bot_ids": bot_ids},
-                timeout=5
-            )
-            print(f"[DELETE_ASSISTANT] Остановлены боты {bot_ids}: {response.status_code}")
-        except Exception as e:
-            print(f"[DELETE_ASSISTANT] Ошибка остановки ботов {bot_ids}: {e}")
+        from services.bot_control import STOP, bot_control
+        bot_control.publish(bot_ids, STOP, {"reason": "assistant_deleted"})
+        print(f"[DELETE_ASSISTANT] Запрошена остановка ботов {bot_ids}")
 
     # Перед удалением ассистента удаляем физические файлы его документов
     try:
@@ -353,12 +349,12 @@ def validate_widget_token(token_data: dict, db: Session = Depends(get_db)):
         if not token:
             return {"valid": False, "reason": "No token provided"}
             
-        from core.app_config import SITE_SECRET, is_development
+        from core.app_config import is_development
         
-        # Декодируем токен
+        # Декодируем токен (claims кэшируются по хэшу токена)
         try:
             # Бессрочный токен: отключаем проверку exp
-            payload = jwt.decode(token, SITE_SECRET, algorithms=['HS256'], options={"verify_exp": False})
+            payload = widget_auth_cache.decode(token)
         except jwt.InvalidTokenError as e:
             # В development режиме для localhost тестирования пропускаем ошибки токена
             if is_development and ('localhost' in str(e) or 'Signature verification failed' in str(e)):
@@ -378,17 +374,17 @@ def validate_widget_token(token_data: dict, db: Session = Depends(get_db)):
         if not assistant_id:
             return {"valid": False, "reason": "No assistant_id in token"}
             
-        # Получаем текущие настройки ассистента из БД
-        assistant = db.query(models.Assistant).filter(models.Assistant.id == assistant_id).first()
+        # Текущие настройки ассистента (снимок из кэша, БД только при промахе)
+        assistant = widget_auth_cache.get_assistant(assistant_id, db)
         if not assistant:
             return {"valid": False, "reason": "Assistant not found"}
         
         # Проверяем активность ассистента
-        if not getattr(assistant, 'is_active', True):
+        if not assistant.is_active:
             return {"valid": False, "reason": "Assistant disabled"}
             
         # Проверяем актуальность доменов и domains_hash (стабильный sha256 от нормализованного списка)
-        raw_current = assistant.allowed_domains or ""
+        raw_current = assistant.allowed_domains
         current_domains_list = [
             d.strip().lower().replace('https://', '').replace('http://', '').replace('www.', '').rstrip('/')
             for d in raw_current.split(',') if d.strip()
@@ -420,7 +416,7 @@ def validate_widget_token(token_data: dict, db: Session = Depends(get_db)):
             return {"valid": False, "reason": "domains changed", "allowed_domains": current_domains_str}
 
         # Проверяем версию виджета (точечный отзыв)
-        current_widget_version = int(getattr(assistant, 'widget_version', 1) or 1)
+        current_widget_version = assistant.widget_version
         if token_widget_version != current_widget_version:
             return {"valid": False, "reason": "version changed", "allowed_domains": current_domains_str}
             
@@ -511,21 +507,16 @@ def create_widget_token(data: dict, current_user: models.User = Depends(auth.get
 def get_widget_config_by_token(token_data: dict, db: Session = Depends(get_db)):
     """Получить настройки виджета по токену для виджета"""
     try:
-        print(f"[WIDGET_CONFIG] 📥 Запрос конфигурации виджета: {token_data}")
-        
         token = token_data.get('token')
         
         if not token:
             print("[WIDGET_CONFIG] ❌ Токен не предоставлен")
             return {"success": False, "reason": "No token provided"}
             
-        from core.app_config import SITE_SECRET
-        
-        # Декодируем токен
+        # Декодируем токен (claims кэшируются по хэшу токена)
         try:
             # Бессрочный токен: отключаем проверку exp
-            payload = jwt.decode(token, SITE_SECRET, algorithms=['HS256'], options={"verify_exp": False})
-            print(f"[WIDGET_CONFIG] 🔓 Токен декодирован: assistant_id={payload.get('assistant_id')}")
+            payload = widget_auth_cache.decode(token)
         except jwt.InvalidTokenError as e:
             print(f"[WIDGET_CONFIG] ❌ Неверный токен: {e}")
             return {"success": False, "reason": f"Invalid token: {str(e)}"}
@@ -535,33 +526,26 @@ def get_widget_config_by_token(token_data: dict, db: Session = Depends(get_db)):
             print("[WIDGET_CONFIG] ❌ В токене отсутствует assistant_id")
             return {"success": False, "reason": "No assistant_id in token"}
             
-        # Получаем настройки ассистента из БД
-        assistant = db.query(models.Assistant).filter(models.Assistant.id == assistant_id).first()
+        # Настройки ассистента из снимка (БД только при промахе кэша)
+        assistant = widget_auth_cache.get_assistant(assistant_id, db)
         if not assistant:
             print(f"[WIDGET_CONFIG] ❌ Ассистент с ID {assistant_id} не найден")
             return {"success": False, "reason": "Assistant not found"}
             
-        print(f"[WIDGET_CONFIG] 📋 Ассистент найден: {assistant.name}")
-        print(f"[WIDGET_CONFIG] 👤 Оператор: {getattr(assistant, 'operator_name', 'НЕ ЗАДАНО')}")
-        print(f"[WIDGET_CONFIG] 🏢 Компания: {getattr(assistant, 'business_name', 'НЕ ЗАДАНО')}")
-        print(f"[WIDGET_CONFIG] 🎨 Тема: {getattr(assistant, 'widget_theme', 'НЕ ЗАДАНО')}")
-        print(f"[WIDGET_CONFIG] 🖼️ Аватар: {getattr(assistant, 'avatar_url', 'НЕ ЗАДАНО')}")
-        print(f"[WIDGET_CONFIG] ⚙️ Настройки: {getattr(assistant, 'widget_settings', {})}")
-            
         # Возвращаем настройки виджета с fallback значениями
         config = {
             "success": True,
             "config": {
-                "operator_name": getattr(assistant, 'operator_name', None) or 'Поддержка',
-                "business_name": getattr(assistant, 'business_name', None) or 'Наша компания',
-                "avatar_url": getattr(assistant, 'avatar_url', None),
-                "widget_theme": getattr(assistant, 'widget_theme', None) or 'blue',
-                "widget_settings": getattr(assistant, 'widget_settings', {}) or {},
-                "assistant_id": assistant_id
+                "operator_name": assistant.operator_name or 'Поддержка',
+                "business_name": assistant.business_name or 'Наша компания',
+                "avatar_url": assistant.avatar_url,
+                "widget_theme": assistant.widget_theme or 'blue',
+                "widget_settings": assistant.widget_settings or {},
+                "assistant_id": assistant_id,
+                "settings_version": assistant.settings_version
             }
         }
         
-        print(f"[WIDGET_CONFIG] ✅ Конфигурация возвращена: {config['config']}")
         return config
         
     except Exception as e:
@@ -641,11 +625,10 @@ async def upload_avatar(
     current_user: models.User = Depends(auth.get_current_user),
     db: Session = Depends(get_db)
 ):
-    """Загрузка аватара для виджета в S3"""
+    """Загрузка аватара для виджета: производные WebP/PNG по ключу от содержимого"""
     from services.s3_storage_service import get_s3_service
-    import os
-    from pathlib import Path
-    
+    from services.image_pipeline import ImageProcessingUnavailable, ImageValidationError, store_image
+
     # Получаем S3 сервис
     s3_service = get_s3_service()
     if not s3_service:
@@ -653,76 +636,44 @@ async def upload_avatar(
             status_code=503,
             detail="Файловое хранилище временно недоступно"
         )
-    
+
+    # Дешевые проверки до чтения и декодирования
+    allowed_types = ['image/jpeg', 'image/jpg', 'image/png', 'image/webp']
+    if file.content_type not in allowed_types:
+        raise HTTPException(status_code=400, detail="Поддерживаются только JPEG, PNG и WebP изображения")
+
+    # Читаем не больше лимита + 1 байт: больше 5MB в память не попадет
+    max_size = 5 * 1024 * 1024
+    content = await file.read(max_size + 1)
+    if len(content) > max_size:
+        raise HTTPException(status_code=400, detail="Размер файла не должен превышать 5MB")
+
     try:
-        # Читаем содержимое файла
-        content = await file.read()
-        await file.seek(0)  # Возвращаем указатель в начало
-        
-        # Проверяем что это изображение
-        if not file.content_type or not file.content_type.startswith('image/'):
-            raise HTTPException(status_code=400, detail="Файл должен быть изображением")
-        
-        # Проверяем размер файла (максимум 5MB)
-        if len(content) > 5 * 1024 * 1024:
-            raise HTTPException(status_code=400, detail="Размер файла не должен превышать 5MB")
-        
-        # Разрешенные типы изображений
-        allowed_types = ['image/jpeg', 'image/jpg', 'image/png', 'image/webp']
-        if file.content_type not in allowed_types:
-            raise HTTPException(status_code=400, detail="Поддерживаются только JPEG, PNG и WebP изображения")
-        
-        # Генерируем безопасное имя файла для аватара
-        secure_filename = s3_service.generate_widget_icon_filename(
-            user_id=current_user.id,
-            original_filename=file.filename,
-            content=content
-        )
-        
-        # Загружаем в S3 в папку avatars
-        object_key = s3_service.get_user_object_key(
-            current_user.id,
-            secure_filename,
-            "avatars"
-        )
-        
-        # Добавляем метаданные (используем дефисы вместо подчеркиваний для Timeweb Cloud)
-        metadata = {
-            'user-id': str(current_user.id),
-            'original-filename': file.filename,
-            'file-type': 'avatar'
-        }
-        
-        upload_result = s3_service.upload_file(
-            file_content=content,
-            object_key=object_key,
-            content_type=file.content_type,
-            metadata=metadata
-        )
-        
-        if not upload_result.get('success'):
-            raise Exception(f"S3 upload failed: {upload_result.get('error')}")
-        
-        logger.info(f"Avatar uploaded successfully: {object_key} by user {current_user.id}")
-        
-        # Возвращаем URL через наш proxy endpoint вместо прямой ссылки на S3
-        proxy_url = f"/api/files/avatars/{current_user.id}/{secure_filename}"
-        
-        return {
-            "success": True,
-            "url": proxy_url,
-            "s3_url": upload_result.get('url'),  # Оригинальный S3 URL для отладки
-            "message": "Аватар успешно загружен",
-            "filename": secure_filename,
-            "object_key": object_key
-        }
-        
-    except HTTPException:
-        raise
+        # Проверка, декодирование, ресайз и загрузка в S3 — вне event loop
+        stored = await asyncio.to_thread(store_image, s3_service, content, 'avatar')
+    except ImageValidationError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except ImageProcessingUnavailable as e:
+        logger.error(f"Avatar upload error: {e}")
+        raise HTTPException(status_code=503, detail="Обработка изображений временно недоступна")
     except Exception as e:
         logger.error(f"Avatar upload error: {e}")
         raise HTTPException(status_code=500, detail="Ошибка загрузки аватара")
 
+    logger.info(f"Avatar stored: {stored['object_key']} by user {current_user.id} "
+                f"(deduplicated={stored['deduplicated']})")
+
+    return {
+        "success": True,
+        "url": stored['url'],
+        "variants": stored['variants'],
+        "digest": stored['digest'],
+        "deduplicated": stored['deduplicated'],
+        "message": "Аватар успешно загружен",
+        "filename": stored['filename'],
+        "object_key": stored['object_key']
+    }
+
 @router.post("/assistants/{assistant_id}/website-integration")
 def toggle_website_integration(
     assistant_id: int,
@@ -1031,37 +982,22 @@ def get_assistants_stats(db: Session = Depends(get_db), current_user: models.Use
     total_assistants = len(assistants)
     active_assistants = len([a for a in assistants if a.is_active])
     
-    # Статистика по сообщениям за последний месяц
-    from datetime import datetime, timedelta
-    now = datetime.utcnow()
-    month_ago = now - timedelta(days=30)
+    # Статистика за последние 30 дней из дневных итогов — один запрос на всех ассистентов
+    totals = assistant_stats.get_totals_by_assistant(db, effective_user_id, assistant_stats.days_back(30))
     
     total_messages = 0
     total_dialogs = 0
-    assistant_stats = []
+    assistant_stats_list = []
     
     for assistant in assistants:
-        # Подсчет сообщений для каждого ассистента
-        messages_count = db.query(func.count(models.DialogMessage.id)).join(
-            models.Dialog
-        ).filter(
-            models.Dialog.user_id == effective_user_id,
-            models.Dialog.assistant_id == assistant.id,
-            models.DialogMessage.sender == 'assistant',
-            models.DialogMessage.timestamp >= month_ago
-        ).scalar() or 0
-        
-        # Подсчет диалогов для каждого ассистента
-        dialogs_count = db.query(func.count(models.Dialog.id)).filter(
-            models.Dialog.user_id == effective_user_id,
-            models.Dialog.assistant_id == assistant.id,
-            models.Dialog.started_at >= month_ago
-        ).scalar() or 0
+        counts = totals.get(assistant.id, {})
+        messages_count = counts.get('messages', 0)
+        dialogs_count = counts.get('dialogs', 0)
         
         total_messages += messages_count
         total_dialogs += dialogs_count
         
-        assistant_stats.append({
+        assistant_stats_list.append({
             "id": assistant.id,
             "name": assistant.name,
             "messages": messages_count,
@@ -1076,7 +1012,7 @@ def get_assistants_stats(db: Session = Depends(get_db), current_user: models.Use
             "totalMessages": total_messages,
             "totalDialogs": total_dialogs
         },
-        "byAssistant": assistant_stats
+        "byAssistant": assistant_stats_list
     }
 
 
@@ -1098,57 +1034,13 @@ def get_assistant_stats(
     if not assistant:
         raise HTTPException(status_code=404, detail="Assistant not found")
     
-    # Статистика по сообщениям за последний месяц
-    from datetime import datetime, timedelta
+    # Общие счетчики, месяц и неделя — одна сумма по дневным итогам ассистента
     now = datetime.utcnow()
-    month_ago = now - timedelta(days=30)
-    week_ago = now - timedelta(days=7)
-    
-    # Общие счетчики
-    total_messages = db.query(func.count(models.DialogMessage.id)).join(
-        models.Dialog
-    ).filter(
-        models.Dialog.user_id == effective_user_id,
-        models.Dialog.assistant_id == assistant_id,
-        models.DialogMessage.sender == 'assistant'
-    ).scalar() or 0
-    
-    total_dialogs = db.query(func.count(models.Dialog.id)).filter(
-        models.Dialog.user_id == effective_user_id,
-        models.Dialog.assistant_id == assistant_id
-    ).scalar() or 0
-    
-    # Статистика за месяц
-    monthly_messages = db.query(func.count(models.DialogMessage.id)).join(
-        models.Dialog
-    ).filter(
-        models.Dialog.user_id == effective_user_id,
-        models.Dialog.assistant_id == assistant_id,
-        models.DialogMessage.sender == 'assistant',
-        models.DialogMessage.timestamp >= month_ago
-    ).scalar() or 0
-    
-    monthly_dialogs = db.query(func.count(models.Dialog.id)).filter(
-        models.Dialog.user_id == effective_user_id,
-        models.Dialog.assistant_id == assistant_id,
-        models.Dialog.started_at >= month_ago
-    ).scalar() or 0
-    
-    # Статистика за неделю
-    weekly_messages = db.query(func.count(models.DialogMessage.id)).join(
-        models.Dialog
-    ).filter(
-        models.Dialog.user_id == effective_user_id,
-        models.Dialog.assistant_id == assistant_id,
-        models.DialogMessage.sender == 'assistant',
-        models.DialogMessage.timestamp >= week_ago
-    ).scalar() or 0
-    
-    weekly_dialogs = db.query(func.count(models.Dialog.id)).filter(
-        models.Dialog.user_id == effective_user_id,
-        models.Dialog.assistant_id == assistant_id,
-        models.Dialog.started_at >= week_ago
-    ).scalar() or 0
+    totals = assistant_stats.get_assistant_totals(
+        db, effective_user_id, assistant_id,
+        month_since=assistant_stats.days_back(30, now),
+        week_since=assistant_stats.days_back(7, now)
+    )
     
     # Статистика по документам
     documents_count = db.query(func.count(models.Document.id.distinct())).join(
@@ -1166,16 +1058,16 @@ def get_assistant_stats(
             "created_at": assistant.created_at.isoformat() if assistant.created_at else None
         },
         "stats": {
-            "total_messages": total_messages,
-            "total_dialogs": total_dialogs,
+            "total_messages": totals["total_messages"],
+            "total_dialogs": totals["total_dialogs"],
             "total_documents": documents_count,
             "monthly": {
-                "messages": monthly_messages,
-                "dialogs": monthly_dialogs
+                "messages": totals["monthly_messages"],
+                "dialogs": totals["monthly_dialogs"]
             },
             "weekly": {
-                "messages": weekly_messages,
-                "dialogs": weekly_dialogs
+                "messages": totals["weekly_messages"],
+                "dialogs": totals["weekly_dialogs"]
             }
         }
     }
\ No newline at end of file
@@ -10,12 +10,26 @@ from jose import jwt, JWTError
 from database import get_db, models, schemas, auth
 from validators.rate_limiter import rate_limit_api
 from integrations.email_service import email_service
+from core.password_hashing import PasswordHasherBusy
+from core.principal_cache import mark_password_rehash
 import secrets
 from datetime import datetime, timedelta
 
 # Настройка логгера
 logger = logging.getLogger(__name__)
 
+try:
+    from prometheus_client import Counter
+    LOGIN_ATTEMPTS = Counter('auth_login_attempts_total', 'Login attempts', ['result'])
+    METRICS_ENABLED = True
+except ImportError:
+    METRICS_ENABLED = False
+
+
+def _record_login(result: str) -> None:
+    if METRICS_ENABLED:
+        LOGIN_ATTEMPTS.labels(result=result).inc()
+
 router = APIRouter()
 
 FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:3000")
@@ -136,6 +150,7 @@ def login(form_data: OAuth2PasswordRequestForm = Depends(), request: Request = N
     user = db.query(models.User).filter(models.User.email == form_data.username.lower()).first()
     if not user:
         logger.warning(f"User not found: {form_data.username}")
+        _record_login("user_not_found")
         # Логируем неудачную попытку
         audit_log(
             operation='user_login',
@@ -152,17 +167,33 @@ def login(form_data: OAuth2PasswordRequestForm = Depends(), request: Request = N
     
     logger.debug(f"User found: {user.email}, role: {user.role}")
     
-    # Проверяем пользователя и пароль
-    password_valid = auth.verify_password(form_data.password, user.hashed_password)
+    # Проверяем пользователя и пароль (bcrypt в отдельном пуле, при перегрузке - 503)
+    try:
+        password_valid, new_hash = auth.verify_password_and_update(form_data.password, user.hashed_password)
+    except PasswordHasherBusy:
+        _record_login("overloaded")
+        raise
     
     if not password_valid:
         logger.warning(f"Invalid password for user: {form_data.username}")
+        _record_login("invalid_password")
         raise HTTPException(status_code=401, detail="Неверный email или пароль")
     
+    if new_hash:
+        # Хеш со слабым cost - прозрачно перехешируем с текущими параметрами
+        # (пароль тот же - сессии пользователя не отзываем)
+        user.hashed_password = new_hash
+        mark_password_rehash(db, user.id)
+        db.commit()
+        logger.info(f"Password hash upgraded for user: {user.id}")
+    
     if not user.is_email_confirmed and getattr(user, 'role', None) != 'admin':
         logger.warning(f"Email not confirmed for user: {form_data.username}")
+        _record_login("email_not_confirmed")
         raise HTTPException(status_code=403, detail="Email не подтверждён. Проверьте почту.")
     
+    _record_login("success")
+    
     logger.info(f"Successful login for user: {form_data.username}")
     
     # Логируем успешный вход
@@ -257,6 +288,9 @@ def change_password(
         
         return {"message": "Пароль успешно изменён"}
         
+    except PasswordHasherBusy:
+        db.rollback()
+        raise
     except Exception as e:
         logger.error(f"Ошибка при смене пароля для пользователя {current_user.id}: {e}")
         db.rollback()
@@ -281,11 +315,15 @@ def change_password(
 def logout(
     request: Request = None,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: models.User = Depends(auth.get_current_user),
+    token: str = Depends(auth.oauth2_scheme)
 ):
     """Выход пользователя из системы"""
     from monitoring.audit_logger import audit_log
     
+    # Отзываем текущий access token
+    auth.revoke_token(token)
+    
     # Получаем IP и User-Agent
     ip_address = request.client.host if request and request.client else None
     user_agent = request.headers.get('user-agent') if request else None
@@ -1,6 +1,10 @@
 from fastapi import APIRouter, Depends, HTTPException, status
+from sqlalchemy import desc, select
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from database.connection import get_db
+from database.async_connection import get_async_db
+from database.utils.query_sampler import query_budget
 from database.schemas import (
     BalanceStatsResponse, 
     TopUpBalanceRequest, 
@@ -11,7 +15,7 @@ from database.schemas import (
 )
 from services.balance_service import BalanceService
 from core.auth import get_current_user
-from database.models import User
+from database.models import User, UserBalance, BalanceTransaction, ServicePrice
 from typing import List, Optional
 import logging
 from datetime import datetime, timedelta
@@ -20,8 +24,43 @@ from integrations.email_service import email_service
 logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/api/balance", tags=["balance"])
 
+MESSAGE_TRANSACTION_TYPES = ['ai_message', 'bot_message', 'widget_message']
+
+
+async def _load_related_entities(db: AsyncSession, transactions):
+    """Сообщения, диалоги и документы для страницы транзакций - тремя запросами вместо 2 на транзакцию"""
+    from database.models import DialogMessage, Dialog, Document
+
+    message_ids = {t.related_id for t in transactions
+                   if t.related_id and t.transaction_type in MESSAGE_TRANSACTION_TYPES}
+    document_ids = {t.related_id for t in transactions
+                    if t.related_id and t.transaction_type == 'document_upload'}
+
+    async def by_id(model, ids):
+        if not ids:
+            return {}
+        rows = (await db.execute(select(model).where(model.id.in_(ids)))).scalars().all()
+        return {row.id: row for row in rows}
+
+    messages = await by_id(DialogMessage, message_ids)
+    dialogs = await by_id(Dialog, {m.dialog_id for m in messages.values()})
+    documents = await by_id(Document, document_ids)
+    return messages, dialogs, documents
+
+
+async def _get_transactions(db: AsyncSession, user_id: int, limit: int):
+    """Async-аналог BalanceService.get_transactions"""
+    result = await db.execute(
+        select(BalanceTransaction)
+        .where(BalanceTransaction.user_id == user_id)
+        .order_by(desc(BalanceTransaction.created_at))
+        .limit(limit)
+    )
+    return result.scalars().all()
+
+
 @router.get("/welcome-bonus-status")
-async def get_welcome_bonus_status(
+def get_welcome_bonus_status(
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
@@ -32,7 +71,7 @@ async def get_welcome_bonus_status(
     }
 
 @router.post("/claim-welcome-bonus")
-async def claim_welcome_bonus(
+def claim_welcome_bonus(
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
@@ -61,7 +100,7 @@ async def claim_welcome_bonus(
         )
 
 @router.get("/stats", response_model=BalanceStatsResponse)
-async def get_balance_stats(
+def get_balance_stats(
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
@@ -95,12 +134,18 @@ async def get_balance_stats(
 @router.get("/current")
 async def get_current_balance(
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Получить текущий баланс пользователя"""
     try:
-        balance_service = BalanceService(db)
-        balance = balance_service.get_balance(current_user.id)
+        balance = (await db.execute(
+            select(UserBalance.balance).where(UserBalance.user_id == current_user.id)
+        )).scalar_one_or_none()
+        if balance is None:
+            # Как BalanceService.get_or_create_balance: создаём пустой баланс
+            db.add(UserBalance(user_id=current_user.id, balance=0.0))
+            await db.commit()
+            balance = 0.0
         return {"balance": balance}
     except Exception as e:
         logger.error(f"Ошибка получения баланса для пользователя {current_user.id}: {e}")
@@ -110,7 +155,7 @@ async def get_current_balance(
         )
 
 @router.post("/topup")
-async def top_up_balance(
+def top_up_balance(
     request: dict,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
@@ -200,15 +245,14 @@ async def top_up_balance(
 async def get_transactions(
     limit: int = 50,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Получить историю транзакций пользователя"""
     try:
         if limit > 100:
             limit = 100  # Максимум 100 транзакций за раз
         
-        balance_service = BalanceService(db)
-        transactions = balance_service.get_transactions(current_user.id, limit)
+        transactions = await _get_transactions(db, current_user.id, limit)
         
         return [BalanceTransactionRead.from_orm(t) for t in transactions]
     except Exception as e:
@@ -219,18 +263,19 @@ async def get_transactions(
         )
 
 @router.get("/transactions/detailed", response_model=List[BalanceTransactionDetailRead])
+@query_budget(6)
 async def get_detailed_transactions(
     limit: int = 50,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Получить детализированную историю транзакций пользователя с информацией о связанных сущностях"""
     try:
         if limit > 100:
             limit = 100  # Максимум 100 транзакций за раз
         
-        balance_service = BalanceService(db)
-        transactions = balance_service.get_transactions(current_user.id, limit)
+        transactions = await _get_transactions(db, current_user.id, limit)
+        messages, dialogs, documents = await _load_related_entities(db, transactions)
         
         detailed_transactions = []
         for transaction in transactions:
@@ -249,12 +294,11 @@ async def get_detailed_transactions(
             }
             
             # Получаем дополнительную информацию о связанной сущности
-            if transaction.related_id and transaction.transaction_type in ['ai_message', 'bot_message', 'widget_message']:
+            if transaction.related_id and transaction.transaction_type in MESSAGE_TRANSACTION_TYPES:
                 # Получаем информацию о сообщении
-                from database.models import DialogMessage, Dialog
-                message = db.query(DialogMessage).filter(DialogMessage.id == transaction.related_id).first()
+                message = messages.get(transaction.related_id)
                 if message:
-                    dialog = db.query(Dialog).filter(Dialog.id == message.dialog_id).first()
+                    dialog = dialogs.get(message.dialog_id)
                     transaction_data['related_info'] = {
                         'type': 'message',
                         'message_id': message.id,
@@ -271,14 +315,13 @@ async def get_detailed_transactions(
             
             elif transaction.related_id and transaction.transaction_type == 'document_upload':
                 # Получаем информацию о документе
-                from database.models import Document
-                document = db.query(Document).filter(Document.id == transaction.related_id).first()
+                document = documents.get(transaction.related_id)
                 if document:
                     transaction_data['related_info'] = {
                         'type': 'document',
                         'document_id': document.id,
                         'filename': document.filename,
-                        'upload_timestamp': document.upload_time.isoformat() if document.upload_time else None
+                        'upload_timestamp': document.upload_date.isoformat() if document.upload_date else None
                     }
             
             detailed_transactions.append(BalanceTransactionDetailRead(**transaction_data))
@@ -293,11 +336,12 @@ async def get_detailed_transactions(
         )
 
 @router.get("/prices", response_model=List[ServicePriceRead])
-async def get_service_prices(db: Session = Depends(get_db)):
+async def get_service_prices(db: AsyncSession = Depends(get_async_db)):
     """Получить цены на услуги"""
     try:
-        balance_service = BalanceService(db)
-        prices = balance_service.get_service_prices()
+        prices = (await db.execute(
+            select(ServicePrice).where(ServicePrice.is_active == True)
+        )).scalars().all()
         return [ServicePriceRead.from_orm(p) for p in prices]
     except Exception as e:
         logger.error(f"Ошибка получения цен на услуги: {e}")
@@ -307,7 +351,7 @@ async def get_service_prices(db: Session = Depends(get_db)):
         )
 
 @router.get("/check/{service_type}")
-async def check_balance_for_service(
+def check_balance_for_service(
     service_type: str,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
@@ -332,7 +376,7 @@ async def check_balance_for_service(
 
 # Административные эндпоинты
 @router.put("/admin/prices/{service_type}", response_model=ServicePriceRead)
-async def update_service_price(
+def update_service_price(
     service_type: str,
     price_update: ServicePriceUpdate,
     current_user: User = Depends(get_current_user),
@@ -370,7 +414,7 @@ async def update_service_price(
         )
 
 @router.get("/usage-stats")
-async def get_usage_stats(
+def get_usage_stats(
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
@@ -421,6 +465,7 @@ async def get_usage_stats(
         )
 
 @router.get("/transactions/detailed/paged")
+@query_budget(7)
 async def get_detailed_transactions_paged(
     page: int = 1,
     limit: int = 50,
@@ -430,7 +475,7 @@ async def get_detailed_transactions_paged(
     sort_by: str = "date",
     sort_order: str = "desc",
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Пагинированная детализированная история транзакций пользователя.
     Возвращает объекты и общее количество для построения пагинации на фронтенде.
@@ -442,24 +487,24 @@ async def get_detailed_transactions_paged(
         if page < 1:
             page = 1
 
-        from database.models import BalanceTransaction, DialogMessage, Dialog, Document
+        from database.models import DialogMessage, Document
         from sqlalchemy import or_, and_, func
 
         # Строим базовый запрос
-        base_query = db.query(BalanceTransaction).filter(
+        base_query = select(BalanceTransaction).where(
             BalanceTransaction.user_id == current_user.id
         )
 
         # Применяем фильтрацию по типу операции
         if transaction_type and transaction_type != 'all':
-            base_query = base_query.filter(BalanceTransaction.transaction_type == transaction_type)
+            base_query = base_query.where(BalanceTransaction.transaction_type == transaction_type)
 
         # Применяем фильтрацию по периоду
         if period_days and period_days != 'all':
             try:
                 days = int(period_days)
                 cutoff_date = datetime.now() - timedelta(days=days)
-                base_query = base_query.filter(BalanceTransaction.created_at >= cutoff_date)
+                base_query = base_query.where(BalanceTransaction.created_at >= cutoff_date)
             except (ValueError, TypeError):
                 pass  # Игнорируем некорректные значения
 
@@ -468,11 +513,11 @@ async def get_detailed_transactions_paged(
             search_term = f"%{search.strip().lower()}%"
             
             # Создаем подзапросы для поиска в связанных данных
-            message_subquery = db.query(DialogMessage.id).filter(
+            message_subquery = select(DialogMessage.id).where(
                 func.lower(DialogMessage.text).like(search_term)
             )
             
-            document_subquery = db.query(Document.id).filter(
+            document_subquery = select(Document.id).where(
                 func.lower(Document.filename).like(search_term)
             )
             
@@ -489,10 +534,12 @@ async def get_detailed_transactions_paged(
                 )
             )
             
-            base_query = base_query.filter(search_filter)
+            base_query = base_query.where(search_filter)
 
         # Подсчитываем общее количество после применения фильтров
-        total = base_query.count()
+        total = (await db.execute(
+            select(func.count()).select_from(base_query.subquery())
+        )).scalar_one()
 
         # Применяем сортировку
         if sort_by == "amount":
@@ -513,9 +560,10 @@ async def get_detailed_transactions_paged(
 
         # Применяем пагинацию
         offset = (page - 1) * limit
-        transactions = base_query.limit(limit).offset(offset).all()
+        transactions = (await db.execute(base_query.limit(limit).offset(offset))).scalars().all()
 
         # Сборка детальной информации (логика как в /transactions/detailed)
+        messages, dialogs, documents = await _load_related_entities(db, transactions)
         detailed_transactions = []
         for transaction in transactions:
             transaction_data = {
@@ -531,10 +579,10 @@ async def get_detailed_transactions_paged(
                 'related_info': None
             }
 
-            if transaction.related_id and transaction.transaction_type in ['ai_message', 'bot_message', 'widget_message']:
-                message = db.query(DialogMessage).filter(DialogMessage.id == transaction.related_id).first()
+            if transaction.related_id and transaction.transaction_type in MESSAGE_TRANSACTION_TYPES:
+                message = messages.get(transaction.related_id)
                 if message:
-                    dialog = db.query(Dialog).filter(Dialog.id == message.dialog_id).first()
+                    dialog = dialogs.get(message.dialog_id)
                     transaction_data['related_info'] = {
                         'type': 'message',
                         'message_id': message.id,
@@ -550,13 +598,13 @@ async def get_detailed_transactions_paged(
                     }
 
             elif transaction.related_id and transaction.transaction_type == 'document_upload':
-                document = db.query(Document).filter(Document.id == transaction.related_id).first()
+                document = documents.get(transaction.related_id)
                 if document:
                     transaction_data['related_info'] = {
                         'type': 'document',
                         'document_id': document.id,
                         'filename': document.filename,
-                        'upload_timestamp': document.upload_time.isoformat() if document.upload_time else None
+                        'upload_timestamp': document.upload_date.isoformat() if document.upload_date else None
                     }
 
             detailed_transactions.append(BalanceTransactionDetailRead(**transaction_data))
@@ -2,9 +2,7 @@ from fastapi import APIRouter, Depends, HTTPException, Query, BackgroundTasks
 from sqlalchemy.orm import Session
 from typing import Optional
 import logging
-import requests
 import json
-import subprocess
 import asyncio
 from datetime import datetime
 
@@ -14,6 +12,8 @@ from database import models, schemas, auth
 from pydantic import BaseModel, field_validator
 from ai import prompt_variations
 from ai.ai_token_manager import ai_token_manager
+from services import response_latency
+from services.bot_control import START, STOP, bot_control
 
 logger = logging.getLogger(__name__)
 
@@ -44,31 +44,8 @@ class ReloadBotRequest(BaseModel):
 # Helper functions for bot reload (avoid circular imports)
 def reload_specific_bot(bot_id: int, db: Session):
     """Перезагружает конкретный бот по ID"""
-    try:
-        # Проверяем что бот существует и активен
-        bot_instance = db.query(models.BotInstance).filter(
-            models.BotInstance.id == bot_id,
-            models.BotInstance.is_active == True
-        ).first()
-        
-        if not bot_instance:
-            print(f"[RELOAD_SPECIFIC_BOT] Бот {bot_id} не найден или неактивен")
-            return
-        
-        # Отправляем сигнал multi bot manager для перезагрузки конкретного бота
-        response = requests.post(
-            "http://localhost:3001/reload-bots", 
-            json={"bot_ids": [bot_id]}, 
-            timeout=5
-        )
-        
-        if response.status_code == 200:
-            print(f"[RELOAD_SPECIFIC_BOT] Перезагружен бот {bot_id}")
-        else:
-            print(f"[RELOAD_SPECIFIC_BOT] Ошибка ответа multi bot manager: {response.status_code}")
-            
-    except Exception as e:
-        print(f"[RELOAD_SPECIFIC_BOT] Ошибка перезагрузки бота {bot_id}: {e}")
+    from services.bot_manager import reload_specific_bot as _reload
+    _reload(bot_id, db)
 
 # === Bot Management Endpoints ===
 
@@ -259,10 +236,24 @@ def delete_bot_instance(bot_id: int, current_user: models.User = Depends(auth.ge
     db.commit()
     
     # Останавливаем конкретный бот после удаления
-    reload_specific_bot(bot_id, db)
+    bot_control.publish([bot_id], STOP, {"reason": "bot_deleted"})
     
     return {"message": "Bot deleted successfully"}
 
+@router.get("/bot-instances/{bot_id}/control")
+def get_bot_control_state(bot_id: int, current_user: models.User = Depends(auth.get_current_user), db: Session = Depends(get_db)):
+    """Состояние команд управления ботом: выданные, примененные и ожидающие применения"""
+    if current_user.role != 'admin':
+        effective_user_id = auth.get_effective_user_id(current_user, db)
+        owned = db.query(models.BotInstance.id).filter(
+            models.BotInstance.id == bot_id,
+            models.BotInstance.user_id == effective_user_id
+        ).first()
+        if not owned:
+            raise HTTPException(status_code=404, detail="Bot instance not found")
+    
+    return bot_control.state(bot_id)
+
 @router.get("/bot-instances/{bot_id}/assistant")
 def get_bot_assistant(bot_id: int, db: Session = Depends(get_db)):
     """Получить ассистента для конкретного бота (используется ботами)"""
@@ -304,8 +295,7 @@ def start_bot(bot_id: int, current_user: models.User = Depends(auth.get_current_
     bot_instance.is_active = True
     db.commit()
     
-    # Здесь будем запускать бот (пока заглушка)
-    # TODO: Интеграция с bot managers
+    bot_control.publish([bot_id], START)
     
     return {"success": True, "message": f"Bot {bot_id} started"}
 
@@ -324,8 +314,7 @@ def stop_bot(bot_id: int, current_user: models.User = Depends(auth.get_current_u
     bot_instance.is_active = False
     db.commit()
     
-    # Здесь будем останавливать бот (пока заглушка)
-    # TODO: Интеграция с bot managers
+    bot_control.publish([bot_id], STOP)
     
     return {"success": True, "message": f"Bot {bot_id} stopped"}
 
@@ -471,6 +460,11 @@ async def add_bot_dialog_message(dialog_id: int, data: dict, db: Session = Depen
     
     # Создаем сообщение
     msg = models.DialogMessage(dialog_id=dialog_id, sender=sender, text=text)
+    # Бот сам измеряет время от получения вопроса до готового ответа
+    response_time_ms = data.get('response_time_ms')
+    if (sender == 'assistant' and isinstance(response_time_ms, (int, float))
+            and 0 <= response_time_ms <= response_latency.MAX_RESPONSE_TIME_MS):
+        msg.response_time_ms = int(response_time_ms)
     db.add(msg)
     db.commit()
     db.refresh(msg)
@@ -691,8 +685,8 @@ async def get_bot_ai_response(data: dict, db: Session = Depends(get_db)):
         # Используем улучшенную систему определения handoff
         handoff_triggered = False
         try:
-            from services.improved_handoff_detector import ImprovedHandoffDetector
-            detector = ImprovedHandoffDetector()
+            from services.improved_handoff_detector import get_handoff_detector
+            detector = get_handoff_detector()
             
             should_trigger, reason, details = detector.should_request_handoff(
                 user_text=message,
@@ -771,7 +765,8 @@ async def get_bot_ai_response(data: dict, db: Session = Depends(get_db)):
 def reload_bot_helper(user_id: int):
     """Перезапускает Telegram бота для пользователя"""
     try:
-        subprocess.run(["node", "scripts/reload_telegram_bot.js", str(user_id)])
+        from services.bot_manager import reload_user_bots
+        reload_user_bots(user_id)
     except Exception as e:
         print(f"Error reloading bot: {e}")
 
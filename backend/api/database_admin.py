@@ -1,6 +1,6 @@
 from fastapi import APIRouter, Depends, HTTPException, Query
 from sqlalchemy.orm import Session
-from sqlalchemy import inspect, text, and_, or_, desc, asc
+from sqlalchemy import inspect, text
 from sqlalchemy.exc import SQLAlchemyError, IntegrityError
 from typing import List, Dict, Any, Optional, Union
 from datetime import datetime
@@ -11,6 +11,7 @@ from database.connection import get_db
 from database import models
 from core import auth
 from pydantic import BaseModel
+from services import table_explorer
 
 logger = logging.getLogger(__name__)
 
@@ -52,6 +53,7 @@ TABLE_MODELS = {
 class TableDataRequest(BaseModel):
     page: int = 1
     limit: int = 20
+    cursor: Optional[str] = None  # next_cursor предыдущей страницы (keyset-пагинация)
     search: Optional[str] = None
     filter_field: Optional[str] = None
     filter_value: Optional[str] = None
@@ -148,80 +150,45 @@ def get_table_data(
     current_user: models.User = Depends(auth.get_current_admin),
     db: Session = Depends(get_db)
 ):
-    """Получение данных таблицы с пагинацией, поиском и фильтрацией"""
+    """Получение данных таблицы: keyset-пагинация, поиск по объявленным колонкам, оценка количества"""
     try:
         model_class = get_table_model(table_name)
-        query = db.query(model_class)
-        
-        # Поиск по тексту
-        if request.search:
-            search_conditions = []
-            inspector = inspect(model_class)
-            
-            for column in inspector.columns:
-                if str(column.type).lower() in ['text', 'string', 'varchar']:
-                    search_conditions.append(getattr(model_class, column.name).ilike(f"%{request.search}%"))
-            
-            if search_conditions:
-                query = query.filter(or_(*search_conditions))
-        
-        # Фильтрация по полю
-        if request.filter_field and request.filter_value:
-            if hasattr(model_class, request.filter_field):
-                column = getattr(model_class, request.filter_field)
-                column_type = str(column.type).lower()
-                
-                # Для числовых полей используем точное соответствие
-                if 'integer' in column_type or 'bigint' in column_type:
-                    try:
-                        numeric_value = int(request.filter_value)
-                        query = query.filter(column == numeric_value)
-                    except ValueError:
-                        # Если не удается преобразовать в число, пропускаем фильтр
-                        pass
-                elif 'float' in column_type or 'numeric' in column_type or 'decimal' in column_type:
-                    try:
-                        numeric_value = float(request.filter_value)
-                        query = query.filter(column == numeric_value)
-                    except ValueError:
-                        # Если не удается преобразовать в число, пропускаем фильтр
-                        pass
-                else:
-                    # Для строковых полей используем ILIKE
-                    query = query.filter(column.ilike(f"%{request.filter_value}%"))
-        
-        # Сортировка
-        if request.sort_field and hasattr(model_class, request.sort_field):
-            column = getattr(model_class, request.sort_field)
-            if request.sort_order == "desc":
-                query = query.order_by(desc(column))
-            else:
-                query = query.order_by(asc(column))
-        
-        # Подсчет общего количества записей
-        total_count = query.count()
-        
-        # Пагинация
-        offset = (request.page - 1) * request.limit
-        records = query.offset(offset).limit(request.limit).all()
+        records, pagination = table_explorer.fetch_page(
+            db, table_name, model_class,
+            limit=request.limit,
+            cursor=request.cursor,
+            page=request.page,
+            search=request.search,
+            filter_field=request.filter_field,
+            filter_value=request.filter_value,
+            sort_field=request.sort_field,
+            sort_order=request.sort_order,
+        )
         
         # Сериализация данных
         data = [serialize_record(record, model_class) for record in records]
         
         return {
             "data": data,
-            "pagination": {
-                "page": request.page,
-                "limit": request.limit,
-                "total": total_count,
-                "pages": (total_count + request.limit - 1) // request.limit
-            }
+            "pagination": pagination
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
+        if table_explorer.is_statement_timeout(e):
+            logger.warning(f"Запрос к таблице {table_name} отменен по statement_timeout")
+            raise table_explorer.timeout_error()
         logger.error(f"Ошибка получения данных таблицы {table_name}: {e}")
         raise HTTPException(status_code=500, detail=f"Ошибка получения данных: {str(e)}")
 
+def _invalidate_record_caches(model_class, record) -> None:
+    """Сбрасывает процессные кеши, построенные по измененной таблице"""
+    if model_class is models.ConversationPattern and record.user_id:
+        from ai.training_system import invalidate_pattern_index
+        invalidate_pattern_index(record.user_id)
+
+
 @router.post("/admin/database/tables/{table_name}/records")
 def create_record(
     table_name: str,
@@ -261,6 +228,7 @@ def create_record(
         db.add(new_record)
         db.commit()
         db.refresh(new_record)
+        _invalidate_record_caches(model_class, new_record)
         
         # Получение созданной записи
         serialized_record = serialize_record(new_record, model_class)
@@ -327,6 +295,7 @@ def update_record(
         
         db.commit()
         db.refresh(record)
+        _invalidate_record_caches(model_class, record)
         
         # Получение обновленной записи
         serialized_record = serialize_record(record, model_class)
@@ -371,6 +340,7 @@ def delete_record(
         # Удаляем запись
         db.delete(record)
         db.commit()
+        _invalidate_record_caches(model_class, record)
         
         logger.info(f"Администратор {current_user.email} удалил запись {record_id} из таблицы {table_name}")
         
@@ -420,21 +390,22 @@ def get_record(
 
 @router.get("/admin/database/stats")
 def get_database_stats(current_user: models.User = Depends(auth.get_current_admin), db: Session = Depends(get_db)):
-    """Получение общей статистики базы данных"""
+    """Получение общей статистики базы данных (оценки из статистики Postgres, без COUNT по таблицам)"""
     try:
+        table_explorer.apply_statement_timeout(db)
+        counts = table_explorer.estimate_row_counts(
+            db, [model_class.__tablename__ for model_class in TABLE_MODELS.values()]
+        )
         stats = {}
-        
+        details = {}
         for table_name, model_class in TABLE_MODELS.items():
-            try:
-                count = db.query(model_class).count()
-                stats[table_name] = count
-            except Exception as e:
-                logger.error(f"Ошибка получения статистики для таблицы {table_name}: {e}")
-                stats[table_name] = 0
+            details[table_name] = counts[model_class.__tablename__]
+            stats[table_name] = details[table_name]["rows"]
         
         return {
             "success": True,
             "stats": stats,
+            "details": details,
             "total_tables": len(TABLE_MODELS)
         }
         
@@ -461,7 +432,8 @@ def execute_custom_query(
             if keyword in query_text:
                 raise HTTPException(status_code=400, detail=f"Запрос содержит запрещенное ключевое слово: {keyword}")
         
-        # Выполняем запрос
+        # Выполняем запрос (с тем же statement_timeout, что и обозреватель таблиц)
+        table_explorer.apply_statement_timeout(db)
         result = db.execute(text(query_text))
         
         # Получаем результаты
@@ -498,5 +470,7 @@ def execute_custom_query(
     except HTTPException:
         raise
     except Exception as e:
+        if table_explorer.is_statement_timeout(e):
+            raise table_explorer.timeout_error()
         logger.error(f"Ошибка выполнения SQL запроса: {e}")
         raise HTTPException(status_code=500, detail=f"Ошибка выполнения запроса: {str(e)}")
\ No newline at end of file
@@ -10,6 +10,7 @@ import asyncio
 
 from database import SessionLocal, models, schemas, crud, auth
 from database.connection import get_db
+from database.utils.query_sampler import query_budget
 # from services.handoff_service import HandoffService  # Temporarily commented
 
 logger = logging.getLogger(__name__)
@@ -39,6 +40,7 @@ def is_user_blocked(user):
 # from services.websocket_manager import (...) - REMOVED
 from services.sse_manager import push_sse_event
 from services.events_pubsub import publish_dialog_event
+from services import response_latency
 
 # SSE compatibility functions
 async def push_dialog_message(dialog_id: int, message: dict):
@@ -104,6 +106,7 @@ def _extract_user_name(text: str) -> Optional[str]:
 # --- Main Dialog Endpoints ---
 
 @router.get("/dialogs")
+@query_budget(8)
 def get_dialogs(
     user_id: int = Query(None),
     all: bool = Query(False),
@@ -201,13 +204,27 @@ def get_dialogs(
     offset = (page - 1) * limit
     dialogs = q.order_by(models.Dialog.id.desc()).offset(offset).limit(limit).all()
     
+    # Последние сообщения и владельцы диалогов страницы - по одному запросу на всю страницу
+    dialog_ids = [d.id for d in dialogs]
+    last_messages = {}
+    if dialog_ids:
+        last_messages = {
+            m.dialog_id: m for m in db.query(models.DialogMessage).filter(
+                models.DialogMessage.dialog_id.in_(dialog_ids)
+            ).distinct(models.DialogMessage.dialog_id).order_by(
+                models.DialogMessage.dialog_id, models.DialogMessage.timestamp.desc()
+            ).all()
+        }
+    owner_ids = {d.user_id for d in dialogs if d.user_id}
+    dialog_users = {}
+    if owner_ids:
+        dialog_users = {u.id: u for u in db.query(models.User).filter(models.User.id.in_(owner_ids)).all()}
+    
     # Формируем удобный для фронта ответ
     items = []
     for d in dialogs:
         # Получаем время последнего сообщения в диалоге
-        last_message = db.query(models.DialogMessage).filter(
-            models.DialogMessage.dialog_id == d.id
-        ).order_by(models.DialogMessage.timestamp.desc()).first()
+        last_message = last_messages.get(d.id)
         
         last_message_at = None
         last_message_text = None
@@ -217,7 +234,7 @@ def get_dialogs(
         # Убираем elif - логика перенесена в строку where используется last_message
         
         # Получаем информацию о пользователе диалога
-        dialog_user = db.query(models.User).filter(models.User.id == d.user_id).first()
+        dialog_user = dialog_users.get(d.user_id)
         user_email = dialog_user.email if dialog_user else None
         
         # Используем исходные значения без "очистки", так как clean_field удалял легитимные нули
@@ -695,7 +712,9 @@ async def add_dialog_message(dialog_id: int, data: dict, db: Session = Depends(g
                         print(f"🚀 CACHE HIT: AI ответ для пользователя {current_user.id}")
                         
                         # Сохраняем кэшированный ответ как сообщение
-                        cached_msg = models.DialogMessage(dialog_id=dialog_id, sender='assistant', text=cached_response)
+                        cached_msg = models.DialogMessage(dialog_id=dialog_id, sender='assistant', text=cached_response,
+                                                         timestamp=datetime.utcnow())
+                        cached_msg.response_time_ms = response_latency.response_time_ms(cached_msg.timestamp, msg.timestamp)
                         db.add(cached_msg)
                         db.commit()
                         
@@ -880,8 +899,10 @@ async def add_dialog_message(dialog_id: int, data: dict, db: Session = Depends(g
                     assistant_msg = models.DialogMessage(
                     dialog_id=dialog_id, 
                     sender='assistant', 
-                    text=ai_response
+                    text=ai_response,
+                    timestamp=datetime.utcnow()
                     )
+                    assistant_msg.response_time_ms = response_latency.response_time_ms(assistant_msg.timestamp, msg.timestamp)
                     db.add(assistant_msg)
                     db.commit()
                     db.refresh(assistant_msg)
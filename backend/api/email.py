@@ -524,7 +524,7 @@ def submit_contact_form(data: ContactFormCreate):
         """
 
         # Отправляем email на указанный адрес
-        success = email_service._send_email(
+        success = email_service.queue_email(
             to_email="dlutsok13@ya.ru",
             subject=f"Новая заявка от {data.name} - ReplyX",
             html_content=html_content,
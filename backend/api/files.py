@@ -2,10 +2,11 @@
 API для работы с файлами - проксирование S3 файлов
 """
 
-from fastapi import APIRouter, HTTPException, Response
+from fastapi import APIRouter, HTTPException, Request, Response
 from fastapi.responses import StreamingResponse
 import logging
 from services.s3_storage_service import get_s3_service
+from services.image_pipeline import IMMUTABLE_CACHE_CONTROL, asset_content_type, asset_key, is_asset_name
 import io
 
 logger = logging.getLogger(__name__)
@@ -28,6 +29,41 @@ async def files_health():
         "bucket": s3_service.bucket_name if s3_service else None
     }
 
+@router.get("/files/assets/{digest}/{name}")
+def get_image_asset(digest: str, name: str, request: Request):
+    """
+    Отдает производную изображения по хэшу содержимого (services.image_pipeline).
+
+    Содержимое по такому URL никогда не меняется: кешируется навсегда (immutable),
+    ETag — сам хэш. Обычная def-функция: чтение из S3 идет в пуле потоков.
+    """
+    if not is_asset_name(digest, name):
+        raise HTTPException(status_code=404, detail="Файл не найден")
+
+    etag = f'"{digest}-{name}"'
+    headers = {
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL,
+        "ETag": etag,
+        "Access-Control-Allow-Origin": "*",  # Разрешаем CORS
+        "X-Content-Type-Options": "nosniff",
+    }
+    if name.endswith('.svg'):
+        # SVG открывается браузером как документ: запрещаем скрипты и внешние ресурсы
+        headers["Content-Security-Policy"] = "default-src 'none'; style-src 'unsafe-inline'; sandbox"
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    s3_service = get_s3_service()
+    if not s3_service:
+        raise HTTPException(status_code=503, detail="Файловое хранилище недоступно")
+
+    # download_file возвращает None и для отсутствующего объекта — без лишнего HEAD
+    file_content = s3_service.download_file(asset_key(digest, name))
+    if not file_content:
+        raise HTTPException(status_code=404, detail="Файл не найден")
+
+    return Response(content=file_content, media_type=asset_content_type(name), headers=headers)
+
 @router.get("/files/avatars/{user_id}/{filename}")
 async def get_avatar_file(user_id: int, filename: str):
     """Проксирует файл аватара из S3"""
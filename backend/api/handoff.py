@@ -1,12 +1,15 @@
 """API endpoints for handoff system."""
 
+import json
 import logging
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, status
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
 from typing import List
 
-from database.connection import get_db
-from core.auth import get_current_user
+from database.connection import SessionLocal, get_db
+from database.utils.query_sampler import query_budget
+from core.auth import get_current_user, get_user_from_token
 from database import models
 from schemas.handoff import (
     HandoffRequestIn, HandoffStatusOut, HandoffTakeoverIn, 
@@ -14,11 +17,16 @@ from schemas.handoff import (
     HandoffQueueItem, HandoffDetectionRequest, HandoffDetectionResponse
 )
 from pydantic import BaseModel
+from services.events_pubsub import iter_handoff_queue_events
 from services.handoff_service import HandoffService
+from services.handoff_queue import HandoffQueue
+from services.operator_presence import OperatorPresenceService
 
 
 logger = logging.getLogger(__name__)
 
+QUEUE_EVENTS_KEEPALIVE_SECONDS = 15
+
 
 # Router for dialog-specific handoff endpoints
 router = APIRouter(prefix="/dialogs/{dialog_id}/handoff", tags=["handoff"])
@@ -184,7 +192,6 @@ def operator_heartbeat(
     - Operators are auto-marked offline if no heartbeat for 90+ seconds
     """
     try:
-        from backend.services.operator_presence import OperatorPresenceService
         service = OperatorPresenceService(db)
         return service.update_heartbeat(
             user_id=user.id,
@@ -198,6 +205,7 @@ def operator_heartbeat(
 
 
 @operator_router.get("/queue", response_model=List[HandoffQueueItem])
+@query_budget(6)
 def get_handoff_queue(
     user: models.User = Depends(get_current_user),
     db: Session = Depends(get_db)
@@ -217,6 +225,46 @@ def get_handoff_queue(
         raise HTTPException(status_code=500, detail="Произошла ошибка. Попробуйте позже.")
 
 
+@operator_router.get("/queue/events")
+async def handoff_queue_events(request: Request, token: str = Query(...)):
+    """
+    SSE stream of handoff queue changes (queue:added / queue:updated / queue:removed).
+
+    Events are published by HandoffService to Redis channel ws:handoff:queue.
+    EventSource cannot send headers, so the JWT comes as a query parameter.
+    """
+    db = SessionLocal()
+    try:
+        user = get_user_from_token(token, db)
+    finally:
+        db.close()
+    if not user:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Не удалось проверить учетные данные")
+
+    async def event_stream():
+        yield "retry: 5000\n\n"
+        events = iter_handoff_queue_events(idle_timeout=QUEUE_EVENTS_KEEPALIVE_SECONDS)
+        try:
+            async for event in events:
+                if await request.is_disconnected():
+                    break
+                if event is None:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: {event.get('type', 'queue')}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+        except Exception as e:
+            logger.error(f"Handoff queue event stream error for user {user.id}: {e}")
+            yield "event: error\ndata: {\"error\": \"Stream error\"}\n\n"
+        finally:
+            await events.aclose()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 @operator_router.get("/my-dialogs", response_model=List[dict])
 def get_my_active_dialogs(
     user: models.User = Depends(get_current_user),
@@ -308,6 +356,7 @@ def force_reset_handoff(
         db.add(audit)
         
         db.commit()
+        HandoffQueue(db).remove(dialog_id)
         
         logger.info(f"Admin {user.id} force reset handoff for dialog {dialog_id} from {old_status} to none")
         
@@ -343,8 +392,8 @@ def should_request_handoff_api(
     - Подробная диагностика решений
     """
     try:
-        from services.improved_handoff_detector import ImprovedHandoffDetector
-        detector = ImprovedHandoffDetector()
+        from services.improved_handoff_detector import get_handoff_detector
+        detector = get_handoff_detector()
         
         # Получаем диалог если передан dialog_id
         dialog = None
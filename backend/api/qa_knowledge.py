@@ -1,16 +1,22 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, File, Form, HTTPException, Query, UploadFile
 from sqlalchemy.orm import Session
-from sqlalchemy import and_
+from sqlalchemy import and_, func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List, Optional
 from datetime import datetime
 
 from database.connection import get_db
+from database.async_connection import get_async_db
 from database.models import QAKnowledge, User
 from database.schemas import QAKnowledgeCreate, QAKnowledgeUpdate, QAKnowledgeResponse
 from core.auth import get_current_user
+from services.qa_import import MAX_FILE_BYTES, job_progress, qa_import_processor
 
 router = APIRouter(tags=["qa-knowledge"])
 
+# Поля, от которых зависят эмбеддинги записи
+INDEXED_FIELDS = {'question', 'answer', 'importance', 'assistant_id', 'is_active'}
+
 
 @router.get("/qa-knowledge", response_model=List[QAKnowledgeResponse])
 async def get_qa_knowledge(
@@ -19,21 +25,21 @@ async def get_qa_knowledge(
     search: Optional[str] = Query(None, description="Поиск по вопросу или ответу"),
     skip: int = Query(0, ge=0),
     limit: int = Query(100, ge=1, le=100),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_user)
 ):
     """Получить Q&A записи пользователя"""
-    query = db.query(QAKnowledge).filter(QAKnowledge.user_id == current_user.id)
+    query = select(QAKnowledge).where(QAKnowledge.user_id == current_user.id)
     
     if assistant_id is not None:
-        query = query.filter(QAKnowledge.assistant_id == assistant_id)
+        query = query.where(QAKnowledge.assistant_id == assistant_id)
     
     if category:
-        query = query.filter(QAKnowledge.category == category)
+        query = query.where(QAKnowledge.category == category)
     
     if search:
         search_pattern = f"%{search.lower()}%"
-        query = query.filter(
+        query = query.where(
             and_(
                 QAKnowledge.question.ilike(search_pattern) | 
                 QAKnowledge.answer.ilike(search_pattern) |
@@ -41,14 +47,15 @@ async def get_qa_knowledge(
             )
         )
     
-    query = query.filter(QAKnowledge.is_active == True)
+    query = query.where(QAKnowledge.is_active == True)
     query = query.order_by(QAKnowledge.importance.desc(), QAKnowledge.created_at.desc())
     
-    return query.offset(skip).limit(limit).all()
+    result = await db.execute(query.offset(skip).limit(limit))
+    return result.scalars().all()
 
 
 @router.post("/qa-knowledge", response_model=QAKnowledgeResponse)
-async def create_qa_knowledge(
+def create_qa_knowledge(
     qa_data: QAKnowledgeCreate,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user)
@@ -73,55 +80,81 @@ async def create_qa_knowledge(
     )
     
     db.add(qa_knowledge)
-    db.commit()
+    # Эмбеддинги посчитает фоновый обработчик задач индексации (запись и задача — один коммит)
+    qa_import_processor.enqueue_reindex(db, qa_knowledge)
     db.refresh(qa_knowledge)
     
-    # Автоматически индексируем Q&A в векторную базу данных
+    return qa_knowledge
+
+
+@router.post("/qa-knowledge/import", status_code=202)
+def import_qa_knowledge(
+    file: UploadFile = File(..., description="CSV, JSONL или XLSX с колонками question/answer (вопрос/ответ)"),
+    assistant_id: Optional[int] = Form(None),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """Массовый импорт Q&A: записи вставляются сразу, эмбеддинги считаются в фоне"""
+    if assistant_id:
+        from database.models import Assistant
+        assistant = db.query(Assistant).filter(
+            and_(
+                Assistant.id == assistant_id,
+                Assistant.user_id == current_user.id
+            )
+        ).first()
+        if not assistant:
+            raise HTTPException(status_code=404, detail="Ассистент не найден")
+    
+    content = file.file.read(MAX_FILE_BYTES + 1)
+    if len(content) > MAX_FILE_BYTES:
+        raise HTTPException(status_code=413, detail=f"Файл больше {MAX_FILE_BYTES // (1024 * 1024)} МБ")
+    
     try:
-        from services.embeddings_service import embeddings_service
-        text_to_index = f"Q: {qa_knowledge.question}\nA: {qa_knowledge.answer}"
-        if qa_knowledge.keywords:
-            text_to_index += f"\nКлючевые слова: {qa_knowledge.keywords}"
-        
-        embeddings_service.index_qa_knowledge(
-            qa_id=qa_knowledge.id,
-            user_id=qa_knowledge.user_id,
-            assistant_id=qa_knowledge.assistant_id,
-            question=qa_knowledge.question,
-            answer=qa_knowledge.answer,
-            importance=qa_knowledge.importance or 10,
-            db=db
-        )
-        
-        # Инкрементируем версию знаний ассистента
-        if qa_knowledge.assistant_id:
-            from database.models import Assistant
-            assistant = db.query(Assistant).filter(Assistant.id == qa_knowledge.assistant_id).first()
-            if assistant:
-                assistant.knowledge_version = (assistant.knowledge_version or 0) + 1
-                db.commit()
-    except Exception as e:
-        # Не прерываем выполнение, если индексация не удалась
-        import logging
-        logger = logging.getLogger(__name__)
-        logger.error(f"Failed to index Q&A knowledge: {e}")
+        job = qa_import_processor.create_import(db, current_user.id, assistant_id, file.filename, content)
+    except ValueError as e:
+        db.rollback()
+        raise HTTPException(status_code=400, detail=str(e))
     
-    return qa_knowledge
+    return job_progress(job)
+
+
+@router.get("/qa-knowledge/import/jobs")
+def list_qa_import_jobs(
+    limit: int = Query(20, ge=1, le=100),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """Последние импорты Q&A пользователя"""
+    return [job_progress(job) for job in qa_import_processor.list_jobs(db, current_user.id, limit)]
+
+
+@router.get("/qa-knowledge/import/{job_id}")
+def get_qa_import_job(
+    job_id: int,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """Прогресс импорта или переиндексации Q&A"""
+    job = qa_import_processor.get_job(db, job_id, current_user.id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Задача импорта не найдена")
+    return job_progress(job)
 
 
 @router.get("/qa-knowledge/{qa_id}", response_model=QAKnowledgeResponse)
 async def get_qa_knowledge_item(
     qa_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_user)
 ):
     """Получить конкретную Q&A запись"""
-    qa_knowledge = db.query(QAKnowledge).filter(
+    qa_knowledge = (await db.execute(select(QAKnowledge).where(
         and_(
             QAKnowledge.id == qa_id,
             QAKnowledge.user_id == current_user.id
         )
-    ).first()
+    ))).scalars().first()
     
     if not qa_knowledge:
         raise HTTPException(status_code=404, detail="Q&A запись не найдена")
@@ -130,7 +163,7 @@ async def get_qa_knowledge_item(
 
 
 @router.put("/qa-knowledge/{qa_id}", response_model=QAKnowledgeResponse)
-async def update_qa_knowledge(
+def update_qa_knowledge(
     qa_id: int,
     qa_data: QAKnowledgeUpdate,
     db: Session = Depends(get_db),
@@ -166,48 +199,18 @@ async def update_qa_knowledge(
     
     qa_knowledge.updated_at = datetime.utcnow()
     
-    db.commit()
+    if INDEXED_FIELDS & update_data.keys():
+        # Переиндексация в фоне: старые эмбеддинги заменяются в одной транзакции с новыми
+        qa_import_processor.enqueue_reindex(db, qa_knowledge)
+    else:
+        db.commit()
     db.refresh(qa_knowledge)
     
-    # Переиндексируем Q&A в векторную базу данных
-    try:
-        from services.embeddings_service import embeddings_service
-        text_to_index = f"Q: {qa_knowledge.question}\nA: {qa_knowledge.answer}"
-        if qa_knowledge.keywords:
-            text_to_index += f"\nКлючевые слова: {qa_knowledge.keywords}"
-        
-        # Сначала удаляем старые embeddings
-        embeddings_service.delete_qa_embeddings(qa_knowledge.id, db)
-        
-        # Затем создаем новые
-        embeddings_service.index_qa_knowledge(
-            qa_id=qa_knowledge.id,
-            user_id=qa_knowledge.user_id,
-            assistant_id=qa_knowledge.assistant_id,
-            question=qa_knowledge.question,
-            answer=qa_knowledge.answer,
-            importance=qa_knowledge.importance or 10,
-            db=db
-        )
-        
-        # Инкрементируем версию знаний ассистента
-        if qa_knowledge.assistant_id:
-            from database.models import Assistant
-            assistant = db.query(Assistant).filter(Assistant.id == qa_knowledge.assistant_id).first()
-            if assistant:
-                assistant.knowledge_version = (assistant.knowledge_version or 0) + 1
-                db.commit()
-    except Exception as e:
-        # Не прерываем выполнение, если индексация не удалась
-        import logging
-        logger = logging.getLogger(__name__)
-        logger.error(f"Failed to reindex Q&A knowledge: {e}")
-    
     return qa_knowledge
 
 
 @router.delete("/qa-knowledge/{qa_id}")
-async def delete_qa_knowledge(
+def delete_qa_knowledge(
     qa_id: int,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user)
@@ -252,11 +255,11 @@ async def delete_qa_knowledge(
 @router.get("/qa-knowledge/categories/list")
 async def get_qa_categories(
     assistant_id: Optional[int] = Query(None, description="ID ассистента для фильтрации"),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_user)
 ):
     """Получить список всех категорий Q&A"""
-    query = db.query(QAKnowledge.category).filter(
+    query = select(QAKnowledge.category).where(
         and_(
             QAKnowledge.user_id == current_user.id,
             QAKnowledge.is_active == True,
@@ -265,32 +268,38 @@ async def get_qa_categories(
     )
     
     if assistant_id is not None:
-        query = query.filter(QAKnowledge.assistant_id == assistant_id)
+        query = query.where(QAKnowledge.assistant_id == assistant_id)
     
-    categories = query.distinct().all()
-    return [cat[0] for cat in categories if cat[0]]
+    categories = (await db.execute(query.distinct())).scalars().all()
+    return [cat for cat in categories if cat]
 
 
 @router.post("/qa-knowledge/{qa_id}/increment-usage")
 async def increment_usage(
     qa_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: User = Depends(get_current_user)
 ):
     """Увеличить счетчик использования Q&A записи"""
-    qa_knowledge = db.query(QAKnowledge).filter(
-        and_(
-            QAKnowledge.id == qa_id,
-            QAKnowledge.user_id == current_user.id
+    # Атомарный UPDATE вместо чтения и записи: без гонки при параллельных вызовах
+    result = await db.execute(
+        update(QAKnowledge)
+        .where(
+            and_(
+                QAKnowledge.id == qa_id,
+                QAKnowledge.user_id == current_user.id
+            )
         )
-    ).first()
+        .values(
+            usage_count=func.coalesce(QAKnowledge.usage_count, 0) + 1,
+            last_used=datetime.utcnow()
+        )
+        .returning(QAKnowledge.id)
+    )
     
-    if not qa_knowledge:
+    if result.scalar_one_or_none() is None:
         raise HTTPException(status_code=404, detail="Q&A запись не найдена")
     
-    qa_knowledge.usage_count += 1
-    qa_knowledge.last_used = datetime.utcnow()
-    
-    db.commit()
+    await db.commit()
     
-    return {"message": "Счетчик использования обновлен"}
\ No newline at end of file
+    return {"message": "Счетчик использования обновлен"}
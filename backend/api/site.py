@@ -17,6 +17,7 @@ from ai.ai_token_manager import ai_token_manager
 from services.sse_manager import push_sse_event
 from services.handoff_service import HandoffService
 from services.balance_service import BalanceService
+from services import message_quota, response_latency
 from api.dialogs import broadcast_dialog_message
 
 # Настройка логгера
@@ -195,13 +196,7 @@ async def site_add_dialog_message(
 
     # Лимит по тарифу
     limit = get_user_message_limit(current_user)
-    month_ago = datetime.utcnow().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    msg_count = db.query(models.DialogMessage).join(models.Dialog).filter(
-        models.Dialog.user_id == current_user.id,
-        models.Dialog.guest_id == guest_id,
-        models.DialogMessage.timestamp >= month_ago,
-        models.DialogMessage.sender == 'assistant'
-    ).count()
+    msg_count = message_quota.get_guest_monthly_count(db, current_user.id, guest_id)
     
     if msg_count > limit:
         raise HTTPException(
@@ -215,6 +210,11 @@ async def site_add_dialog_message(
     db.commit()
     db.refresh(msg)
     
+    # Обновляем превью карточки в очереди операторов
+    if msg.sender == 'user' and dialog.handoff_status == 'requested':
+        from services.handoff_queue import HandoffQueue
+        HandoffQueue(db).update_last_user_text(dialog_id, msg.text)
+    
     # 🔥 ПУБЛИКАЦИЯ СОБЫТИЯ В REDIS PUB/SUB ДЛЯ РЕАЛ-ТАЙМ ДОСТАВКИ
     message_data = {
         "id": msg.id,
@@ -296,9 +296,9 @@ async def site_add_dialog_message(
     response_msg = None
     if sender == 'user' and not is_taken_over:
         # АВТОТРИГГЕР: Улучшенная система определения handoff с контекстным анализом
-        from services.improved_handoff_detector import ImprovedHandoffDetector
+        from services.improved_handoff_detector import get_handoff_detector
         handoff_service = HandoffService(db)
-        detector = ImprovedHandoffDetector()
+        detector = get_handoff_detector()
         
         # Проверяем не был ли недавно освобожден диалог (избегаем ложных срабатываний)
         recent_release = db.query(models.HandoffAudit).filter(
@@ -650,6 +650,11 @@ async def widget_add_dialog_message(
     db.commit()
     db.refresh(msg)
     
+    # Обновляем превью карточки в очереди операторов
+    if msg.sender == 'user' and dialog.handoff_status == 'requested':
+        from services.handoff_queue import HandoffQueue
+        HandoffQueue(db).update_last_user_text(dialog_id, msg.text)
+    
     # Для сообщений пользователя отправляем только в админ панель
     # ИСПРАВЛЕНО: Отправляем в виджет тоже через SSE для консистентности
     if msg.sender == 'user':
@@ -703,9 +708,9 @@ async def widget_add_dialog_message(
     response_msg = None
     if sender == 'user' and not is_taken_over:
         # АВТОТРИГГЕР для widget: Улучшенная система определения handoff
-        from services.improved_handoff_detector import ImprovedHandoffDetector
+        from services.improved_handoff_detector import get_handoff_detector
         handoff_service = HandoffService(db)
-        detector = ImprovedHandoffDetector()
+        detector = get_handoff_detector()
         
         # Проверяем не был ли недавно освобожден диалог (избегаем ложных срабатываний)
         recent_release = db.query(models.HandoffAudit).filter(
@@ -926,6 +931,9 @@ async def generate_ai_response(dialog_id: int, current_user: models.User, db: Se
             models.DialogMessage.dialog_id == dialog_id
         ).order_by(models.DialogMessage.timestamp).all()
         
+        # Время вопроса для response_time_ms ответа
+        question_at = next((m.timestamp for m in reversed(messages) if m.sender == 'user'), None)
+        
         prompt_messages = []
         for m in messages:
             role = 'assistant' if m.sender == 'assistant' else 'user'
@@ -1071,8 +1079,10 @@ async def generate_ai_response(dialog_id: int, current_user: models.User, db: Se
         response_msg = models.DialogMessage(
             dialog_id=dialog_id, 
             sender='assistant', 
-            text=response
+            text=response,
+            timestamp=datetime.utcnow()
         )
+        response_msg.response_time_ms = response_latency.response_time_ms(response_msg.timestamp, question_at)
         db.add(response_msg)
         db.commit()
         db.refresh(response_msg)
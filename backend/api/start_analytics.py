@@ -9,9 +9,11 @@ from datetime import datetime, timedelta
 from typing import Dict, Any, List, Optional
 from fastapi import APIRouter, Depends, HTTPException, Request
 from sqlalchemy.orm import Session
-from sqlalchemy import func, desc, and_
+from sqlalchemy import func, desc, and_, select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from database.connection import get_db
+from database.async_connection import get_async_db
 from database import models, schemas
 from core.auth import get_current_user, get_current_user_optional
 
@@ -31,7 +33,7 @@ def get_client_ip(request: Request) -> str:
 async def track_start_page_event(
     event: schemas.StartPageEventCreate,
     request: Request,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: Optional[models.User] = Depends(get_current_user_optional)
 ):
     """
@@ -55,8 +57,7 @@ async def track_start_page_event(
         )
         
         db.add(db_event)
-        db.commit()
-        db.refresh(db_event)
+        await db.commit()
         
         logger.info(f"Start page event tracked: {event.event_type} for session {event.session_id}")
         
@@ -68,7 +69,7 @@ async def track_start_page_event(
         
     except Exception as e:
         logger.error(f"Error tracking start page event: {e}")
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail="Failed to track event")
 
 
@@ -282,7 +283,7 @@ async def get_start_page_funnel(
 @router.get("/progress/status")
 async def get_user_progress_status(
     request: Request,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: Optional[models.User] = Depends(get_current_user_optional)
 ):
     """
@@ -301,39 +302,37 @@ async def get_user_progress_status(
                 "user_authenticated": False
             }
         
-        # Проверяем реальный прогресс для авторизованного пользователя
+        # Проверяем реальный прогресс для авторизованного пользователя одним запросом
+        def count_for(model, *criteria):
+            return (
+                select(func.count())
+                .select_from(model)
+                .where(model.user_id == current_user.id, *criteria)
+                .scalar_subquery()
+            )
+
+        counts = (await db.execute(select(
+            count_for(models.Assistant).label("assistants"),
+            count_for(models.Document).label("documents"),
+            count_for(models.Dialog).label("dialogs"),
+            count_for(
+                models.StartPageEvent,
+                models.StartPageEvent.event_type == 'widget_code_copied'
+            ).label("widget_events"),
+        ))).one()
         
         # Шаг 1: Проверяем, есть ли у пользователя хотя бы один ассистент
-        has_assistant = db.query(models.Assistant).filter(
-            models.Assistant.user_id == current_user.id
-        ).count() > 0
+        has_assistant = counts.assistants > 0
         
         # Шаг 2: Проверяем, загружены ли документы
-        has_documents = db.query(models.Document).filter(
-            models.Document.user_id == current_user.id
-        ).count() > 0
-        
-        # Шаг 3: Проверяем, скопирован ли код виджета (по событиям аналитики)
-        # Это проверим по наличию событий копирования или активности с виджетом
-        widget_copied = False
+        has_documents = counts.documents > 0
         
-        # Проверяем события аналитики на копирование кода виджета
-        widget_events = db.query(models.StartPageEvent).filter(
-            models.StartPageEvent.user_id == current_user.id,
-            models.StartPageEvent.event_type == 'widget_code_copied'
-        ).count() > 0
-        
-        # Альтернативно: проверяем активность диалогов (означает, что виджет работает)
-        active_dialogs = db.query(models.Dialog).filter(
-            models.Dialog.user_id == current_user.id
-        ).count() > 0
-        
-        widget_copied = widget_events or active_dialogs
+        # Шаг 3: Код виджета скопирован (событие аналитики) или
+        # есть активность диалогов (означает, что виджет работает)
+        widget_copied = counts.widget_events > 0 or counts.dialogs > 0
         
         # Шаг 4: Проверяем тестирование (наличие диалогов/сообщений)
-        has_tested = db.query(models.Dialog).filter(
-            models.Dialog.user_id == current_user.id
-        ).count() > 0
+        has_tested = counts.dialogs > 0
         
         # Подсчитываем общий прогресс
         completed_steps = sum([
@@ -353,13 +352,10 @@ async def get_user_progress_status(
             "user_authenticated": True,
             "user_id": current_user.id,
             "details": {
-                "assistants_count": db.query(models.Assistant).filter(models.Assistant.user_id == current_user.id).count(),
-                "documents_count": db.query(models.Document).filter(models.Document.user_id == current_user.id).count(),
-                "dialogs_count": db.query(models.Dialog).filter(models.Dialog.user_id == current_user.id).count(),
-                "widget_events_count": db.query(models.StartPageEvent).filter(
-                    models.StartPageEvent.user_id == current_user.id,
-                    models.StartPageEvent.event_type == 'widget_code_copied'
-                ).count()
+                "assistants_count": counts.assistants,
+                "documents_count": counts.documents,
+                "dialogs_count": counts.dialogs,
+                "widget_events_count": counts.widget_events
             }
         }
         
@@ -371,7 +367,7 @@ async def get_user_progress_status(
 @router.post("/progress/mark-widget-copied")
 async def mark_widget_code_copied(
     request: Request,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: Optional[models.User] = Depends(get_current_user_optional)
 ):
     """
@@ -401,8 +397,7 @@ async def mark_widget_code_copied(
         )
         
         db.add(db_event)
-        db.commit()
-        db.refresh(db_event)
+        await db.commit()
         
         logger.info(f"Widget code copied event tracked for user {current_user.id if current_user else 'anonymous'}")
         
@@ -414,7 +409,7 @@ async def mark_widget_code_copied(
         
     except Exception as e:
         logger.error(f"Error marking widget code copied: {e}")
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail="Failed to mark widget copied")
 
 
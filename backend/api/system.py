@@ -13,6 +13,7 @@ from database.schemas import (
     DiskMetrics, ProcessesResponse, ProcessInfo
 )
 from database.connection import get_db
+from services import message_quota, response_latency
 from validators.rate_limiter import rate_limit_metrics
 
 logger = logging.getLogger(__name__)
@@ -130,44 +131,16 @@ async def health_check():
     }
 
 def calculate_real_time_response_time(db: Session, target_user, start_time, end_time, period: str, date: str):
-    """Вычисляет время ответа в реальном времени без кэширования"""
-    from datetime import datetime
-    from sqlalchemy import func
-    
+    """Среднее время ответа (сек) за период из почасовых скетчей"""
     try:
-        # Получаем все сообщения ассистента за период
-        if period == 'custom' and date:
-            assistant_messages = db.query(models.DialogMessage).join(models.Dialog).filter(
-                models.Dialog.user_id == target_user.id,
-                models.Dialog.started_at >= start_time,
-                models.Dialog.started_at < end_time,
-                models.DialogMessage.sender == 'assistant'
-            ).order_by(models.DialogMessage.timestamp).all()
-        else:
-            assistant_messages = db.query(models.DialogMessage).join(models.Dialog).filter(
-                models.Dialog.user_id == target_user.id,
-                models.Dialog.started_at >= start_time,
-                models.DialogMessage.sender == 'assistant'
-            ).order_by(models.DialogMessage.timestamp).all()
-        
-        response_times = []
-        
-        for assistant_msg in assistant_messages:
-            # Для каждого ответа ассистента ищем предыдущее сообщение пользователя
-            previous_user_msg = db.query(models.DialogMessage).filter(
-                models.DialogMessage.dialog_id == assistant_msg.dialog_id,
-                models.DialogMessage.sender == 'user',
-                models.DialogMessage.timestamp < assistant_msg.timestamp
-            ).order_by(models.DialogMessage.timestamp.desc()).first()
-            
-            if previous_user_msg:
-                response_time = (assistant_msg.timestamp - previous_user_msg.timestamp).total_seconds()
-                response_times.append(response_time)
-        
-        # Рассчитываем среднее время ответа
-        avg_response_time = sum(response_times) / len(response_times) if response_times else 0
+        sketch = response_latency.get_sketch(
+            db, response_latency.SOURCE_DIALOG, start_time,
+            until=end_time if period == 'custom' and date else None,
+            user_id=target_user.id,
+        )
+        avg_response_time = sketch.mean() / 1000
         return round(float(avg_response_time), 1) if avg_response_time else 0
-        
+
     except Exception as e:
         print(f"Error calculating real-time response time: {e}")
         return 0
@@ -334,13 +307,7 @@ def get_metrics(
     
     # Подсчёт использованных сообщений в trial
     if is_trial_active:
-        trial_messages_used = db.query(func.count(models.DialogMessage.id)).join(
-            models.Dialog
-        ).filter(
-            models.Dialog.user_id == target_user.id,
-            models.DialogMessage.sender == 'assistant',
-            models.DialogMessage.timestamp >= target_user.created_at
-        ).scalar() or 0
+        trial_messages_used = message_quota.get_total_count(db, target_user.id)
     else:
         trial_messages_used = 0
     
@@ -353,12 +320,7 @@ def get_metrics(
             return {"level": "full", "description": "Полный доступ ко всем функциям"}
     
     # Подсчитываем общее количество сообщений пользователя
-    total_messages = db.query(func.count(models.DialogMessage.id)).join(
-        models.Dialog
-    ).filter(
-        models.Dialog.user_id == target_user.id,
-        models.DialogMessage.sender == 'assistant'
-    ).scalar() or 0
+    total_messages = message_quota.get_total_count(db, target_user.id)
     
     # Подсчитываем автоответы (предполагаем что все сообщения ассистента - автоответы)
     auto_response_rate = 100 if period_messages > 0 else 0
@@ -697,58 +659,12 @@ async def clear_cache(
 
 @router.get("/performance", response_model=PerformanceMetricsResponse)
 async def get_performance_metrics(current_user: models.User = Depends(auth.get_current_admin)):
-    """Получение метрик производительности системы"""
-    import psutil
-    import os
+    """Получение метрик производительности системы (последний снимок фонового сэмплера)"""
+    from monitoring.host_metrics import host_metrics_sampler
     
     try:
-        # CPU метрики
-        cpu_percent = psutil.cpu_percent(interval=1)
-        cpu_count = psutil.cpu_count()
-        load_avg = os.getloadavg() if hasattr(os, 'getloadavg') else (0, 0, 0)
-        
-        # Memory метрики  
-        memory = psutil.virtual_memory()
-        
-        # Disk метрики
-        disk = psutil.disk_usage('/')
-        
-        # Network метрики (если доступны)
-        try:
-            network = psutil.net_io_counters()
-            network_stats = {
-                "bytes_sent": network.bytes_sent,
-                "bytes_recv": network.bytes_recv,
-                "packets_sent": network.packets_sent,
-                "packets_recv": network.packets_recv
-            }
-        except:
-            network_stats = {}
-        
-        return {
-            "cpu": {
-                "usage_percent": cpu_percent,
-                "cores": cpu_count,
-                "load_avg_1m": load_avg[0],
-                "load_avg_5m": load_avg[1], 
-                "load_avg_15m": load_avg[2]
-            },
-            "memory": {
-                "total": memory.total,
-                "available": memory.available,
-                "used": memory.used,
-                "usage_percent": memory.percent,
-                "free": memory.free
-            },
-            "disk": {
-                "total": disk.total,
-                "used": disk.used,
-                "free": disk.free, 
-                "usage_percent": (disk.used / disk.total) * 100
-            },
-            "network": network_stats,
-            "timestamp": datetime.utcnow().isoformat()
-        }
+        sample = await host_metrics_sampler.get_latest()
+        return {key: value for key, value in sample.items() if key not in ("processes", "total_processes")}
         
     except Exception as e:
         return {
@@ -756,35 +672,30 @@ async def get_performance_metrics(current_user: models.User = Depends(auth.get_c
             "timestamp": datetime.utcnow().isoformat()
         }
 
+@router.get("/performance/history")
+async def get_performance_history(
+    limit: int = Query(60, ge=1, le=1000),
+    current_user: models.User = Depends(auth.get_current_admin)
+):
+    """История снимков метрик хоста (от старых к новым)"""
+    from monitoring.host_metrics import host_metrics_sampler
+    
+    samples = host_metrics_sampler.history(limit)
+    return {
+        "interval_seconds": host_metrics_sampler.interval,
+        "samples": samples
+    }
+
 @router.get("/processes", response_model=ProcessesResponse)
 async def get_system_processes(current_user: models.User = Depends(auth.get_current_admin)):
-    """Получение информации о системных процессах"""
-    import psutil
+    """Получение информации о системных процессах (из последнего снимка сэмплера)"""
+    from monitoring.host_metrics import host_metrics_sampler
     
     try:
-        processes = []
-        
-        for proc in psutil.process_iter(['pid', 'name', 'cpu_percent', 'memory_percent', 'status']):
-            try:
-                pinfo = proc.info
-                # Показываем только процессы связанные с приложением или системные
-                if any(keyword in pinfo['name'].lower() for keyword in ['python', 'postgres', 'redis', 'nginx', 'gunicorn', 'uvicorn']):
-                    processes.append({
-                        "pid": pinfo['pid'],
-                        "name": pinfo['name'], 
-                        "cpu_percent": pinfo['cpu_percent'] or 0,
-                        "memory_percent": pinfo['memory_percent'] or 0,
-                        "status": pinfo['status']
-                    })
-            except (psutil.NoSuchProcess, psutil.AccessDenied):
-                pass
-        
-        # Сортируем по использованию CPU
-        processes.sort(key=lambda x: x['cpu_percent'], reverse=True)
-        
+        sample = await host_metrics_sampler.get_latest()
         return {
-            "processes": processes[:20],  # Топ-20 процессов
-            "total_processes": len(processes)
+            "processes": sample["processes"],  # Топ-20 процессов по CPU
+            "total_processes": sample["total_processes"]
         }
         
     except Exception as e:
@@ -1,7 +1,6 @@
 from fastapi import APIRouter, HTTPException, Depends, BackgroundTasks
 from sqlalchemy.orm import Session
 from typing import Optional
-import subprocess
 
 from database import models, schemas, auth
 from database import get_db
@@ -12,7 +11,8 @@ router = APIRouter()
 def reload_bot(user_id: int):
     """Перезапускает Telegram бота для пользователя"""
     try:
-        subprocess.run(["node", "scripts/reload_telegram_bot.js", str(user_id)])
+        from services.bot_manager import reload_user_bots
+        reload_user_bots(user_id)
     except Exception as e:
         print(f"Error reloading bot: {e}")
 
@@ -5,12 +5,17 @@ API для работы с иконками виджетов пользоват
 from fastapi import APIRouter, Depends, HTTPException, UploadFile, File
 from sqlalchemy.orm import Session
 from typing import Optional
+import asyncio
+import json
 import logging
 
 from database import models, auth
 from database.connection import get_db
 from validators.rate_limiter import rate_limit_api
 from services.s3_storage_service import get_s3_service
+from services.image_pipeline import (
+    ImageProcessingUnavailable, ImageValidationError, asset_url, is_asset_name, store_image
+)
 
 logger = logging.getLogger(__name__)
 
@@ -29,6 +34,20 @@ ALLOWED_ICON_TYPES = {
 MAX_ICON_SIZE = 1024 * 1024
 
 
+def icon_reference_name(digest: str, asset_name: str) -> str:
+    """Имя ссылки пользователя на общую иконку: {sha256}--{производная}.json"""
+    return f"{digest}--{asset_name}.json"
+
+
+def icon_url(filename: str, user_id: int) -> str:
+    """URL иконки из списка: ссылка на общую производную или старый файл пользователя"""
+    digest, _, rest = filename.partition('--')
+    asset_name = rest[:-len('.json')] if rest.endswith('.json') else ''
+    if is_asset_name(digest, asset_name):
+        return asset_url(digest, asset_name)
+    return f"/api/files/widget-icons/{user_id}/{filename}"
+
+
 @router.post("/widget-icons/upload")
 @rate_limit_api(limit=5, window=300)  # 5 иконок за 5 минут
 async def upload_widget_icon(
@@ -47,9 +66,8 @@ async def upload_widget_icon(
             detail="Файловое хранилище временно недоступно"
         )
 
-    # Читаем содержимое файла
-    content = await file.read()
-    await file.seek(0)
+    # Читаем не больше лимита + 1 байт: больший файл целиком в память не попадет
+    content = await file.read(MAX_ICON_SIZE + 1)
 
     # Валидация размера
     if len(content) > MAX_ICON_SIZE:
@@ -86,58 +104,59 @@ async def upload_widget_icon(
         )
 
     try:
-        # Генерируем безопасное имя файла для иконки
-        secure_filename = s3_service.generate_widget_icon_filename(
-            user_id=current_user.id,
-            original_filename=file.filename,
-            content=content
-        )
-
-        # Загружаем в S3 в папку widget-icons
-        object_key = s3_service.get_user_object_key(
-            current_user.id,
-            secure_filename,
-            "widget-icons"
+        # Декодирование, производные и загрузка в S3 — вне event loop
+        stored = await asyncio.to_thread(
+            store_image, s3_service, content, 'widget-icon', ext == '.svg'
         )
+    except ImageValidationError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except ImageProcessingUnavailable as e:
+        logger.error(f"Widget icon upload failed for user {current_user.id}: {e}")
+        raise HTTPException(status_code=503, detail="Обработка изображений временно недоступна")
+    except Exception as e:
+        logger.error(f"Widget icon upload failed for user {current_user.id}: {e}")
+        raise HTTPException(status_code=500, detail="Ошибка загрузки иконки")
 
-        # Добавляем метаданные (используем дефисы вместо подчеркиваний для Timeweb Cloud)
-        metadata = {
-            'user-id': str(current_user.id),
-            'original-filename': file.filename,
-            'widget-id': str(widget_id) if widget_id else 'default',
-            'file-type': 'widget-icon'
-        }
-
-        upload_result = s3_service.upload_file(
-            file_content=content,
+    try:
+        # Сами изображения общие для всех пользователей; у пользователя — ссылка
+        # на них, по которой работают список и удаление иконок
+        reference_name = icon_reference_name(stored['digest'], stored['filename'])
+        object_key = s3_service.get_user_object_key(current_user.id, reference_name, "widget-icons")
+        reference_result = await asyncio.to_thread(
+            s3_service.upload_file,
+            file_content=json.dumps({'digest': stored['digest'], 'variants': stored['variants']}).encode(),
             object_key=object_key,
-            content_type=mime_type,
-            metadata=metadata
+            content_type='application/json',
+            # Используем дефисы вместо подчеркиваний для Timeweb Cloud
+            metadata={
+                'user-id': str(current_user.id),
+                'original-filename': file.filename,
+                'widget-id': str(widget_id) if widget_id else 'default',
+                'file-type': 'widget-icon'
+            }
         )
-
-        if not upload_result.get('success'):
-            raise Exception(f"S3 upload failed: {upload_result.get('error')}")
-
-        logger.info(f"Widget icon uploaded: {object_key} by user {current_user.id}")
-
-        # Возвращаем URL через наш proxy endpoint вместо прямой ссылки на S3
-        proxy_url = f"/api/files/widget-icons/{current_user.id}/{secure_filename}"
-
-        # Возвращаем информацию о загруженной иконке
-        return {
-            "success": True,
-            "filename": secure_filename,
-            "url": proxy_url,
-            "s3_url": upload_result.get('url'),  # Оригинальный S3 URL для отладки
-            "size": len(content),
-            "content_type": mime_type,
-            "object_key": object_key
-        }
-
+        if not reference_result.get('success'):
+            raise Exception(f"S3 upload failed: {reference_result.get('error')}")
     except Exception as e:
         logger.error(f"Widget icon upload failed for user {current_user.id}: {e}")
         raise HTTPException(status_code=500, detail="Ошибка загрузки иконки")
 
+    logger.info(f"Widget icon stored: {stored['object_key']} by user {current_user.id} "
+                f"(deduplicated={stored['deduplicated']})")
+
+    # Возвращаем информацию о загруженной иконке
+    return {
+        "success": True,
+        "filename": reference_name,
+        "url": stored['url'],
+        "variants": stored['variants'],
+        "digest": stored['digest'],
+        "deduplicated": stored['deduplicated'],
+        "size": len(content),
+        "content_type": mime_type,
+        "object_key": stored['object_key']
+    }
+
 
 @router.get("/widget-icons/list")
 def list_widget_icons(
@@ -159,7 +178,7 @@ def list_widget_icons(
         for icon in icons:
             result.append({
                 "filename": icon['filename'],
-                "url": icon['url'],
+                "url": icon_url(icon['filename'], current_user.id),
                 "size": icon['size'],
                 "last_modified": icon['last_modified'].isoformat(),
                 "object_key": icon['object_key']
@@ -236,6 +255,11 @@ def get_widget_icon_url(
         if not s3_service.file_exists(object_key):
             raise HTTPException(status_code=404, detail="Иконка не найдена")
 
+        # Общая производная по хэшу содержимого: постоянный URL, срок не нужен
+        url = icon_url(filename, current_user.id)
+        if url != f"/api/files/widget-icons/{current_user.id}/{filename}":
+            return {"url": url, "filename": filename, "expires_in": None}
+
         # Генерируем временную ссылку на 1 час
         presigned_url = s3_service.generate_presigned_url(
             object_key,
@@ -1,8 +1,11 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Form, Request
 from fastapi.responses import HTMLResponse, JSONResponse
+from sqlalchemy import select
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from database.connection import get_db
-from database.models import User, Payment, UserBalance, BalanceTransaction
+from database.async_connection import get_async_db
+from database.models import Payment
 from database import models
 from core.auth import get_current_user
 from validators.rate_limiter import rate_limit_api, rate_limit_by_ip
@@ -15,7 +18,7 @@ import requests
 import json
 import base64
 from typing import List, Optional
-from integrations.email_service import email_service
+from services.payment_webhooks import event_key, payment_webhook_processor
 
 
 logger = logging.getLogger(__name__)
@@ -260,140 +263,44 @@ async def create_payment(
 @rate_limit_by_ip(limit=100, window=3600)  # 100 webhook в час с одного IP
 async def yookassa_webhook(
     request: Request,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Обработка webhook уведомлений от ЮKassa
     
-    ЮKassa отправляет уведомления о смене статуса платежа
+    ЮKassa отправляет уведомления о смене статуса платежа. Событие только
+    сохраняется и сразу подтверждается; статус платежа и баланс обновляет
+    фоновый обработчик (services/payment_webhooks.py) ровно один раз.
     """
+    # Получаем IP клиента  
+    client_ip = request.client.host
+    forwarded_for = request.headers.get('X-Forwarded-For')
+    if forwarded_for:
+        client_ip = forwarded_for.split(',')[0].strip()
+    
     try:
-        # Получаем IP клиента  
-        client_ip = request.client.host
-        forwarded_for = request.headers.get('X-Forwarded-For')
-        if forwarded_for:
-            client_ip = forwarded_for.split(',')[0].strip()
-            
-        logger.info(f"📨 ПОЛУЧЕН WEBHOOK ОТ ЮKASSA с IP: {client_ip}")
-        
-        # Читаем JSON данные
         webhook_data = await request.json()
-        
-        logger.info(f"🔍 WEBHOOK ДАННЫЕ от ЮKassa:")
-        logger.info(f"   Тип события: {webhook_data.get('event')}")
-        logger.info(f"   Все поля: {list(webhook_data.keys())}")
-        
-        # Извлекаем данные платежа
-        payment_data = webhook_data.get('object', {})
-        yookassa_payment_id = payment_data.get('id')
-        payment_status = payment_data.get('status')
-        paid = payment_data.get('paid', False)
-        
-        logger.info(f"   Payment ID: {yookassa_payment_id}")
-        logger.info(f"   Status: {payment_status}")
-        logger.info(f"   Paid: {paid}")
-        
-        if not yookassa_payment_id:
-            logger.error("Отсутствует ID платежа в webhook")
-            return JSONResponse(status_code=400, content={"error": "Missing payment ID"})
-        
-        # Ищем платеж в БД
-        payment = db.query(Payment).filter(
-            Payment.yookassa_payment_id == yookassa_payment_id
-        ).first()
-        
-        if not payment:
-            logger.error(f"Платеж с ЮKassa ID {yookassa_payment_id} не найден в БД")
-            return JSONResponse(status_code=404, content={"error": "Payment not found"})
-            
-        logger.info(f"✅ Найден платеж: {payment.order_id} (сумма: {payment.amount} руб.)")
-        
-        # Обновляем статус платежа
-        old_status = payment.status
-        payment.yookassa_status = payment_status
-        
-        # Маппинг статусов ЮKassa в наши статусы
-        status_mapping = {
-            'pending': 'pending',
-            'waiting_for_capture': 'processing', 
-            'succeeded': 'completed',
-            'canceled': 'cancelled'
-        }
-        
-        new_status = status_mapping.get(payment_status, payment_status)
-        payment.status = new_status
-        
-        # Если платеж успешен - пополняем баланс
-        if payment_status == 'succeeded' and paid and old_status != 'completed':
-            user = db.query(User).filter(User.id == payment.user_id).first()
-            if user:
-                # Получаем или создаем запись баланса
-                user_balance = db.query(UserBalance).filter(UserBalance.user_id == user.id).first()
-                if not user_balance:
-                    user_balance = UserBalance(user_id=user.id, balance=0.00)
-                    db.add(user_balance)
-                    db.flush()
-                
-                old_balance = float(user_balance.balance or 0)
-                new_balance = old_balance + float(payment.amount)
-                
-                # Обновляем баланс
-                user_balance.balance = new_balance
-                user_balance.total_topped_up = float(user_balance.total_topped_up or 0) + float(payment.amount)
-                user_balance.updated_at = datetime.utcnow()
-                
-                # Создаем транзакцию
-                transaction = BalanceTransaction(
-                    user_id=user.id,
-                    amount=float(payment.amount),
-                    transaction_type='topup',
-                    description=f"Пополнение через ЮKassa: {payment.order_id}",
-                    balance_before=old_balance,
-                    balance_after=new_balance,
-                    related_id=payment.id,
-                    created_at=datetime.utcnow()
-                )
-                db.add(transaction)
-                
-                logger.info(f"💰 Пополнен баланс пользователя {user.id}: {old_balance} + {payment.amount} = {new_balance} руб.")
-
-                # Отправляем email подтверждения пополнения
-                try:
-                    messages_count = int(float(payment.amount) / 5)
-
-                    logger.info(f"📧 Отправляем email подтверждение пополнения на {user.email}")
-                    success = email_service.send_payment_confirmation_email(
-                        to_email=user.email,
-                        amount=float(payment.amount),
-                        messages_count=messages_count,
-                        current_balance=int(new_balance / 5),
-                        bonus_amount=None
-                    )
-
-                    if success:
-                        logger.info(f"✅ Email подтверждение пополнения отправлено на {user.email} на сумму {payment.amount} руб.")
-                    else:
-                        logger.warning(f"⚠️ Не удалось отправить email подтверждение на {user.email}")
-
-                except Exception as e:
-                    logger.error(f"❌ Ошибка отправки email подтверждения на {user.email}: {e}")
-                    # Не прерываем процесс - письмо не критично для пополнения баланса
-            else:
-                logger.error(f"Пользователь {payment.user_id} не найден для пополнения баланса")
-        
-        payment.updated_at = datetime.utcnow()
-        db.commit()
-        
-        logger.info(f"✅ Платеж {payment.order_id} обновлен: {old_status} → {new_status}")
-        
-        return JSONResponse(
-            status_code=200, 
-            content={"status": "ok", "message": "Webhook processed successfully"}
-        )
-        
+    except ValueError:
+        logger.error(f"Некорректный JSON в webhook ЮKassa с IP: {client_ip}")
+        return JSONResponse(status_code=400, content={"error": "Invalid JSON"})
+    
+    payment_id, event = event_key(webhook_data) if isinstance(webhook_data, dict) else (None, None)
+    if not payment_id:
+        logger.error("Отсутствует ID платежа в webhook")
+        return JSONResponse(status_code=400, content={"error": "Missing payment ID"})
+    
+    try:
+        stored = await payment_webhook_processor.store(db, webhook_data, client_ip)
     except Exception as e:
-        logger.error(f"Ошибка обработки ЮKassa webhook: {str(e)}", exc_info=True)
+        # 500 — ЮKassa повторит доставку
+        logger.error(f"Ошибка сохранения ЮKassa webhook {event} для {payment_id}: {str(e)}", exc_info=True)
         return JSONResponse(status_code=500, content={"error": "Internal server error"})
+    
+    logger.info(f"📨 Webhook ЮKassa {event} для {payment_id} с IP {client_ip}: {'принят' if stored else 'повтор'}")
+    return JSONResponse(
+        status_code=200,
+        content={"status": "ok", "message": "Webhook accepted" if stored else "Duplicate webhook ignored"}
+    )
 
 
 @router.get("/payment-status/{order_id}")
@@ -401,14 +308,14 @@ async def yookassa_webhook(
 async def get_payment_status(
     order_id: str,
     current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Получение статуса платежа по order_id"""
     try:
-        payment = db.query(Payment).filter(
+        payment = (await db.execute(select(Payment).where(
             Payment.order_id == order_id,
             Payment.user_id == current_user.id
-        ).first()
+        ))).scalars().first()
         
         if not payment:
             raise HTTPException(status_code=404, detail="Платеж не найден")
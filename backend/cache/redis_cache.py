@@ -350,6 +350,10 @@ class ChatAICache:
         for pattern in patterns:
             total_deleted += cache.delete_pattern(pattern)
         
+        # Снимок ассистента для проверки токенов виджета (домены, активность, оформление)
+        from cache.widget_auth_cache import widget_auth_cache
+        widget_auth_cache.invalidate_assistant(assistant_id)
+        
         logger.info(f"Инвалидирован кэш ассистента {assistant_id}, удалено ключей: {total_deleted}")
         return total_deleted
     
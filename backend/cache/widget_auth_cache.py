@@ -0,0 +1,178 @@
+"""
+Кэш авторизации виджета
+
+Один и тот же site token проверяют CSP iframe, /validate-widget-token,
+/widget-config и SSE. Здесь:
+
+- декодированные claims хранятся в памяти процесса по sha256 токена
+  (токен неизменяем, поэтому инвалидировать их не нужно);
+- снимок ассистента (домены, активность, версии, оформление виджета)
+  хранится в Redis по assistant_id и сбрасывается при изменении настроек
+  ассистента (ChatAICache.invalidate_assistant_cache).
+
+На прогретом пути проверка токена не ходит в БД. Без Redis снимок читается
+из БД, как раньше.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, asdict, field
+from typing import Optional, Dict, Any, Tuple
+
+import jwt
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_TTL_SECONDS = int(os.getenv('WIDGET_AUTH_CACHE_TTL', '600'))
+CLAIMS_CACHE_SIZE = int(os.getenv('WIDGET_CLAIMS_CACHE_SIZE', '10000'))
+SNAPSHOT_KEY = "widget:assistant:{assistant_id}"
+
+
+def token_hash(token: str) -> str:
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+@dataclass
+class AssistantSnapshot:
+    """То, что нужно виджету от ассистента"""
+    id: int
+    user_id: Optional[int]
+    name: Optional[str]
+    allowed_domains: str
+    is_active: bool
+    widget_version: int
+    settings_version: int
+    operator_name: Optional[str] = None
+    business_name: Optional[str] = None
+    avatar_url: Optional[str] = None
+    widget_theme: Optional[str] = None
+    widget_settings: Dict[str, Any] = field(default_factory=dict)
+
+    @classmethod
+    def from_model(cls, assistant) -> "AssistantSnapshot":
+        updated_at = getattr(assistant, 'updated_at', None)
+        return cls(
+            id=assistant.id,
+            user_id=assistant.user_id,
+            name=assistant.name,
+            allowed_domains=assistant.allowed_domains or "",
+            is_active=bool(getattr(assistant, 'is_active', True)),
+            widget_version=int(getattr(assistant, 'widget_version', 1) or 1),
+            settings_version=int(updated_at.timestamp()) if updated_at else 0,
+            operator_name=getattr(assistant, 'operator_name', None),
+            business_name=getattr(assistant, 'business_name', None),
+            avatar_url=getattr(assistant, 'avatar_url', None),
+            widget_theme=getattr(assistant, 'widget_theme', None),
+            widget_settings=getattr(assistant, 'widget_settings', None) or {},
+        )
+
+
+class WidgetAuthCache:
+    """Кэш claims site token и снимков ассистентов"""
+
+    def __init__(self, redis_client=None):
+        self._redis = redis_client
+        self._redis_resolved = redis_client is not None
+        self._claims: "OrderedDict[str, dict]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def redis(self):
+        if not self._redis_resolved:
+            from cache.redis_cache import cache
+            self._redis = cache.redis_client
+            self._redis_resolved = True
+        return self._redis
+
+    # === Claims ===
+
+    def decode(self, token: str, verify_exp: bool = False) -> dict:
+        """
+        Декодировать site token (подпись проверяется один раз на токен)
+
+        Raises:
+            jwt.InvalidTokenError: токен невалиден или истек (при verify_exp)
+        """
+        key = token_hash(token)
+        with self._lock:
+            claims = self._claims.get(key)
+            if claims is not None:
+                self._claims.move_to_end(key)
+
+        if claims is None:
+            from core.app_config import SITE_SECRET
+            claims = jwt.decode(token, SITE_SECRET, algorithms=['HS256'], options={"verify_exp": False})
+            with self._lock:
+                self._claims[key] = claims
+                if len(self._claims) > CLAIMS_CACHE_SIZE:
+                    self._claims.popitem(last=False)
+
+        exp = claims.get('exp')
+        if verify_exp and exp is not None and float(exp) < time.time():
+            raise jwt.ExpiredSignatureError("Signature has expired")
+        # Копия: вызывающий код может дополнять payload, кэш должен остаться неизменным
+        # (claims site token — плоские скалярные значения, поверхностной копии достаточно)
+        return dict(claims)
+
+    # === Снимок ассистента ===
+
+    def get_assistant(self, assistant_id: int, db=None) -> Optional[AssistantSnapshot]:
+        """Снимок ассистента из Redis; при промахе - из БД (сессия открывается только при промахе)"""
+        key = SNAPSHOT_KEY.format(assistant_id=assistant_id)
+        redis_client = self.redis
+        if redis_client:
+            try:
+                raw = redis_client.get(key)
+                if raw:
+                    return AssistantSnapshot(**json.loads(raw))
+            except Exception as e:
+                logger.debug(f"Кэш виджета недоступен: {e}")
+
+        snapshot = self._load_assistant(assistant_id, db)
+        if snapshot and redis_client:
+            try:
+                redis_client.setex(key, SNAPSHOT_TTL_SECONDS, json.dumps(asdict(snapshot), ensure_ascii=False, default=str))
+            except Exception as e:
+                logger.debug(f"Не удалось сохранить снимок ассистента {assistant_id}: {e}")
+        return snapshot
+
+    @staticmethod
+    def _load_assistant(assistant_id: int, db=None) -> Optional[AssistantSnapshot]:
+        from database import models
+
+        own_session = db is None
+        if own_session:
+            from database.connection import SessionLocal
+            db = SessionLocal()
+        try:
+            assistant = db.query(models.Assistant).filter(models.Assistant.id == assistant_id).first()
+            return AssistantSnapshot.from_model(assistant) if assistant else None
+        finally:
+            if own_session:
+                db.close()
+
+    def resolve(self, token: str, db=None, verify_exp: bool = False) -> Tuple[dict, Optional[AssistantSnapshot]]:
+        """Claims токена и снимок его ассистента (None, если assistant_id нет или ассистент не найден)"""
+        claims = self.decode(token, verify_exp=verify_exp)
+        assistant_id = claims.get('assistant_id')
+        if not assistant_id:
+            return claims, None
+        return claims, self.get_assistant(assistant_id, db)
+
+    def invalidate_assistant(self, assistant_id: int) -> None:
+        redis_client = self.redis
+        if not redis_client:
+            return
+        try:
+            redis_client.delete(SNAPSHOT_KEY.format(assistant_id=assistant_id))
+        except Exception as e:
+            logger.warning(f"Не удалось сбросить кэш виджета ассистента {assistant_id}: {e}")
+
+
+# Глобальный экземпляр
+widget_auth_cache = WidgetAuthCache()
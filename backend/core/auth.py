@@ -1,12 +1,15 @@
 from datetime import datetime, timedelta, timezone
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status, Request
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.orm import Session
 from sqlalchemy import and_
 from database import models, crud
 from database.connection import get_db
+from core.password_hashing import password_hasher
+from core.principal_cache import (
+    load_principal, get_security_version, blacklist_jti, is_jti_blacklisted
+)
 import os
 import secrets
 import re
@@ -18,14 +21,19 @@ ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("JWT_ACCESS_TOKEN_EXPIRE_MINUTES", "60"))
 REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("JWT_REFRESH_TOKEN_EXPIRE_DAYS", "30"))  # Refresh token живёт 30 дней
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# bcrypt выполняется в отдельном ограниченном пуле (core/password_hashing.py)
+pwd_context = password_hasher.context
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/login")
 
 def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    return password_hasher.verify(plain_password, hashed_password)
+
+def verify_password_and_update(plain_password, hashed_password):
+    """Проверка пароля; второй элемент - новый хеш, если текущий нужно перехешировать"""
+    return password_hasher.verify_and_update(plain_password, hashed_password)
 
 def get_password_hash(password):
-    return pwd_context.hash(password)
+    return password_hasher.hash(password)
 
 def validate_password_strength(password: str) -> dict:
     """
@@ -76,13 +84,22 @@ def sanitize_input(input_string: str, max_length: int = 255) -> str:
     
     return sanitized
 
+def _security_version_claim(data: dict) -> int:
+    """Версия безопасности пользователя на момент выдачи токена"""
+    try:
+        return get_security_version(int(data.get("sub")))
+    except (TypeError, ValueError):
+        return 0
+
 def create_access_token(data: dict, expires_delta: timedelta = None):
     """Создаёт access token с коротким сроком жизни"""
     to_encode = data.copy()
     expire = datetime.now(timezone.utc) + (expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
     to_encode.update({
         "exp": expire,
-        "type": "access"  # Тип токена для различения
+        "type": "access",  # Тип токена для различения
+        "jti": secrets.token_urlsafe(16),  # Уникальный ID токена (для отзыва)
+        "sv": _security_version_claim(data)  # Версия безопасности пользователя
     })
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
@@ -94,7 +111,8 @@ def create_refresh_token(data: dict, expires_delta: timedelta = None):
     to_encode.update({
         "exp": expire,
         "type": "refresh",  # Тип токена для различения
-        "jti": secrets.token_urlsafe(16)  # Уникальный ID токена
+        "jti": secrets.token_urlsafe(16),  # Уникальный ID токена
+        "sv": _security_version_claim(data)  # Версия безопасности пользователя
     })
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
@@ -116,6 +134,15 @@ def verify_refresh_token(token: str) -> dict:
         current_timestamp = datetime.now(timezone.utc).timestamp()
         if current_timestamp > exp:
             raise JWTError("Token has expired")
+        
+        # Проверяем отзыв: logout/ротация и смена пароля/статуса/роли
+        if is_token_blacklisted(payload.get("jti")):
+            raise JWTError("Token has been revoked")
+        try:
+            if int(payload.get("sv") or 0) < get_security_version(int(payload.get("sub"))):
+                raise JWTError("Token has been revoked")
+        except (TypeError, ValueError):
+            pass
             
         return payload
         
@@ -155,6 +182,13 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
                 headers={"WWW-Authenticate": "Bearer"},
             )
         
+        if is_token_blacklisted(payload.get("jti")):
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Токен отозван",
+                headers={"WWW-Authenticate": "Bearer"},
+            )
+        
     except JWTError as e:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -165,12 +199,15 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
     # Поиск пользователя с дополнительными проверками
     user = None
     try:
-        # Сначала пробуем как ID
+        # Сначала пробуем как ID (пользователь из кэша, БД только при промахе)
         user_id = int(user_identifier)
-        user = db.query(models.User).filter(
-            models.User.id == user_id,
-            models.User.status == "active"  # Проверяем, что пользователь активен
-        ).first()
+        user, revoked = load_principal(db, user_id, int(payload.get("sv") or 0))
+        if revoked:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Токен отозван",
+                headers={"WWW-Authenticate": "Bearer"},
+            )
         
         # Дополнительная проверка email если он есть в токене
         if user and email and user.email != email:
@@ -218,6 +255,9 @@ def get_user_from_token(token: str, db: Session):
         current_timestamp = datetime.now(timezone.utc).timestamp()
         if current_timestamp > exp:
             return None
+        
+        if is_token_blacklisted(payload.get("jti")):
+            return None
             
     except JWTError:
         return None
@@ -227,10 +267,9 @@ def get_user_from_token(token: str, db: Session):
     try:
         # Сначала пробуем как ID
         user_id = int(user_identifier)
-        user = db.query(models.User).filter(
-            models.User.id == user_id,
-            models.User.status == "active"
-        ).first()
+        user, revoked = load_principal(db, user_id, int(payload.get("sv") or 0))
+        if revoked:
+            return None
         
         # Дополнительная проверка email если он есть в токене
         if user and email and user.email != email:
@@ -373,20 +412,24 @@ def get_organization_owner_user(current_user: models.User, db: Session) -> model
     else:
         return db.query(models.User).filter(models.User.id == effective_user_id).first()
 
+def revoke_token(token: str) -> bool:
+    """
+    Отзыв access или refresh token (добавление jti в blacklist в Redis до истечения токена)
+    """
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM], options={"verify_exp": False})
+    except JWTError:
+        return False
+    return blacklist_jti(payload.get("jti"), payload.get("exp"))
+
 def revoke_refresh_token(token: str):
     """
     Отзыв refresh token (добавление в blacklist)
-    В production можно хранить отозванные токены в Redis или БД
     """
-    # TODO: Реализация blacklist для отозванных токенов
-    # Пока что возвращаем True как заглушку
-    return True
+    return revoke_token(token)
 
 def is_token_blacklisted(jti: str) -> bool:
     """
-    Проверяет, находится ли токен в чёрном списке
-    В production можно проверять в Redis или БД
+    Проверяет, находится ли токен в чёрном списке (Redis)
     """
-    # TODO: Реализация проверки blacklist
-    # Пока что возвращаем False как заглушку
-    return False
\ No newline at end of file
+    return is_jti_blacklisted(jti)
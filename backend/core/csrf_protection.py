@@ -9,7 +9,10 @@ import hmac
 import time
 from typing import Optional, Set
 from fastapi import HTTPException, Request, Response, status
+from fastapi.responses import JSONResponse
 from fastapi.security.utils import get_authorization_scheme_param
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from core.middleware_timing import add_layer_time
 import logging
 
 logger = logging.getLogger(__name__)
@@ -221,30 +224,24 @@ class CSRFProtection:
         exempt_prefixes = ["/docs", "/static", "/favicon"]
         return any(path.startswith(prefix) for prefix in exempt_prefixes)
         
-    async def __call__(self, request: Request, call_next):
-        """CSRF Middleware для FastAPI"""
-        # Пропускаем безопасные методы
-        if request.method in self.safe_methods:
-            response = await call_next(request)
-            
-            # Добавляем CSRF токен в cookie для GET запросов
-            if request.method == "GET" and not request.url.path.startswith("/api/"):
-                csrf_token = self.generate_csrf_token(self.get_session_id(request))
-                response.set_cookie(
-                    key=self.cookie_name,
-                    value=csrf_token,
-                    max_age=self.token_lifetime,
-                    httponly=False,  # Frontend должен иметь доступ к токену
-                    secure=self.require_https,
-                    samesite=self.same_site
-                )
-            
-            return response
-            
-        # Пропускаем освобожденные пути
-        if self.is_exempt_path(request.url.path):
-            return await call_next(request)
-            
+    def needs_cookie(self, method: str, path: str) -> bool:
+        """Нужно ли выдать CSRF токен в cookie (GET запросы к страницам, не к API)"""
+        return method == "GET" and not path.startswith("/api/")
+        
+    def set_csrf_cookie(self, response: Response, request: Request) -> None:
+        """Добавляет CSRF токен в cookie ответа"""
+        csrf_token = self.generate_csrf_token(self.get_session_id(request))
+        response.set_cookie(
+            key=self.cookie_name,
+            value=csrf_token,
+            max_age=self.token_lifetime,
+            httponly=False,  # Frontend должен иметь доступ к токену
+            secure=self.require_https,
+            samesite=self.same_site
+        )
+        
+    def validate_request(self, request: Request) -> None:
+        """Проверяет небезопасный запрос, при нарушении выбрасывает HTTPException"""
         # Проверяем HTTPS в продакшене
         if self.require_https and request.headers.get("X-Forwarded-Proto") != "https" and not request.url.scheme == "https":
             if request.headers.get("Host", "").startswith("localhost"):
@@ -289,11 +286,85 @@ class CSRFProtection:
             
         logger.debug(f"🛡️ CSRF проверка пройдена для {request.method} {request.url.path}")
         
+    async def __call__(self, request: Request, call_next):
+        """CSRF Middleware для FastAPI"""
+        # Пропускаем безопасные методы
+        if request.method in self.safe_methods:
+            response = await call_next(request)
+            
+            # Добавляем CSRF токен в cookie для GET запросов
+            if self.needs_cookie(request.method, request.url.path):
+                self.set_csrf_cookie(response, request)
+            
+            return response
+            
+        # Пропускаем освобожденные пути
+        if not self.is_exempt_path(request.url.path):
+            self.validate_request(request)
+        
         # Обрабатываем запрос
         response = await call_next(request)
         
         return response
 
+
+class CSRFMiddleware:
+    """
+    Чистый ASGI обертка над CSRFProtection
+
+    Request создается только для небезопасных методов и для выдачи cookie;
+    ответ не буферизуется, cookie добавляется в http.response.start.
+    """
+
+    LAYER = "csrf"
+
+    def __init__(self, app: ASGIApp, protection: Optional[CSRFProtection] = None):
+        self.app = app
+        self.protection = protection or get_csrf_protection()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        protection = self.protection
+        method = scope["method"]
+        path = scope["path"]
+
+        if method in protection.safe_methods:
+            if not protection.needs_cookie(method, path):
+                add_layer_time(scope, self.LAYER, time.perf_counter() - started)
+                await self.app(scope, receive, send)
+                return
+
+            # Добавляем CSRF токен в cookie для GET запросов
+            cookie_holder = Response()
+            protection.set_csrf_cookie(cookie_holder, Request(scope))
+            cookie_headers = [(k, v) for k, v in cookie_holder.raw_headers if k == b"set-cookie"]
+            add_layer_time(scope, self.LAYER, time.perf_counter() - started)
+
+            async def send_with_cookie(message: Message) -> None:
+                if message["type"] == "http.response.start":
+                    message["headers"] = list(message.get("headers", [])) + cookie_headers
+                await send(message)
+
+            await self.app(scope, receive, send_with_cookie)
+            return
+
+        # Пропускаем освобожденные пути
+        if not protection.is_exempt_path(path):
+            try:
+                protection.validate_request(Request(scope, receive))
+            except HTTPException as e:
+                add_layer_time(scope, self.LAYER, time.perf_counter() - started)
+                response = JSONResponse(status_code=e.status_code, content={"detail": e.detail})
+                await response(scope, receive, send)
+                return
+
+        add_layer_time(scope, self.LAYER, time.perf_counter() - started)
+        await self.app(scope, receive, send)
+
 # Глобальный экземпляр CSRF защиты
 csrf_protection = None
 
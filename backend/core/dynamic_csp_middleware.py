@@ -1,31 +1,37 @@
 """
-Динамический CSP Middleware для iframe страниц виджета
+Динамический CSP для iframe страниц виджета
 Генерирует frame-ancestors заголовки на основе валидных JWT токенов
+
+Сам по себе не является middleware: политику применяет SecurityHeadersMiddleware
+(core/security_headers.py), чтобы заголовки безопасности и CSP выставлялись
+одним проходом по ответу.
 """
 
+import asyncio
 import logging
 import jwt
 from typing import Optional, List
-from fastapi import Request, Response
-from starlette.middleware.base import BaseHTTPMiddleware
 from urllib.parse import urlparse, parse_qs
-from core.app_config import SITE_SECRET
+from cache.widget_auth_cache import widget_auth_cache
 
 logger = logging.getLogger(__name__)
 
-class DynamicCSPMiddleware(BaseHTTPMiddleware):
-    def __init__(self, app, iframe_path: str = '/chat-iframe'):
+class DynamicCSPPolicy:
+    def __init__(self, iframe_path: str = '/chat-iframe'):
         """
-        Инициализация динамического CSP middleware для iframe страниц
+        Инициализация динамической CSP политики для iframe страниц
         
         Args:
-            app: FastAPI приложение
             iframe_path: Путь iframe страницы (обычно /chat-iframe)
         """
-        super().__init__(app)
         self.iframe_path = iframe_path
+        self._restrictive_csp = self.generate_restrictive_csp()
         
-        logger.info(f"🛡️ DynamicCSPMiddleware инициализирован для {iframe_path}")
+        logger.info(f"🛡️ DynamicCSPPolicy инициализирована для {iframe_path}")
+
+    def applies_to(self, path: str) -> bool:
+        """Является ли запрос запросом к iframe странице"""
+        return path.startswith(self.iframe_path)
 
     def normalize_domain(self, domain: str) -> str:
         """Нормализует домен для сравнения"""
@@ -61,13 +67,16 @@ class DynamicCSPMiddleware(BaseHTTPMiddleware):
         
         return domains
 
-    def validate_widget_token(self, token: str, db_session) -> Optional[dict]:
+    def validate_widget_token(self, token: str, db_session=None) -> Optional[dict]:
         """
         Валидирует JWT токен виджета и возвращает allowed_domains
         
+        Claims и снимок ассистента берутся из widget_auth_cache, в БД идем
+        только при промахе кэша.
+        
         Args:
             token: JWT токен
-            db_session: Сессия базы данных
+            db_session: Сессия базы данных (необязательно, открывается при промахе)
             
         Returns:
             dict с информацией о токене или None если невалидный
@@ -79,7 +88,7 @@ class DynamicCSPMiddleware(BaseHTTPMiddleware):
 
             # Декодируем токен
             try:
-                payload = jwt.decode(token, SITE_SECRET, algorithms=['HS256'])
+                payload = widget_auth_cache.decode(token, verify_exp=True)
                 logger.debug(f"CSP: Токен декодирован, assistant_id={payload.get('assistant_id')}")
             except jwt.InvalidTokenError as e:
                 logger.warning(f"CSP: Неверный токен: {e}")
@@ -90,20 +99,15 @@ class DynamicCSPMiddleware(BaseHTTPMiddleware):
                 logger.warning("CSP: assistant_id отсутствует в токене")
                 return None
                 
-            # Импортируем модели динамически для избежания циклических импортов
-            from database import models
-            
-            # Получаем ассистента из БД для проверки актуальности
-            assistant = db_session.query(models.Assistant).filter(
-                models.Assistant.id == assistant_id
-            ).first()
+            # Снимок ассистента для проверки актуальности
+            assistant = widget_auth_cache.get_assistant(assistant_id, db_session)
             
             if not assistant:
                 logger.warning(f"CSP: Ассистент {assistant_id} не найден в БД")
                 return None
                 
             # Проверяем актуальность доменов (защита от устаревших токенов)
-            current_domains = assistant.allowed_domains or ""
+            current_domains = assistant.allowed_domains
             token_domains = payload.get('allowed_domains', "")
             
             if current_domains != token_domains:
@@ -181,78 +185,38 @@ class DynamicCSPMiddleware(BaseHTTPMiddleware):
             "connect-src 'self';"
         )
 
-    async def dispatch(self, request: Request, call_next):
-        """Основная логика обработки CSP заголовков"""
-        
-        # Проверяем, является ли это запросом к iframe странице
-        if not request.url.path.startswith(self.iframe_path):
-            # Не iframe запрос - пропускаем без изменений
-            return await call_next(request)
-        
-        logger.info(f"🛡️ CSP: Обрабатываю iframe запрос: {request.url}")
-        
-        # Получаем токен из query параметров
-        site_token = request.query_params.get('site_token')
+    async def resolve(self, query_string: bytes) -> str:
+        """
+        Возвращает CSP заголовок для iframe запроса по site_token из query string
+
+        Проверка токена может пойти в Redis/БД, поэтому выполняется в пуле
+        потоков, не блокируя event loop.
+        """
+        site_token = parse_qs(query_string.decode('latin-1')).get('site_token', [None])[0]
         
         if not site_token:
-            logger.warning("CSP: site_token отсутствует в query параметрах")
-            # Применяем ограничительный CSP
-            response = await call_next(request)
-            response.headers['Content-Security-Policy'] = self.generate_restrictive_csp()
-            return response
+            logger.debug("CSP: site_token отсутствует в query параметрах")
+            return self._restrictive_csp
         
-        # Получаем сессию БД для валидации токена
         try:
-            from database.connection import get_db
-            db_generator = get_db()
-            db_session = next(db_generator)
-            
-            try:
-                # Валидируем токен и получаем разрешенные домены
-                token_info = self.validate_widget_token(site_token, db_session)
-                
-                if not token_info or not token_info.get('valid'):
-                    logger.warning("CSP: Токен невалидный, применяю ограничительный CSP")
-                    response = await call_next(request)
-                    response.headers['Content-Security-Policy'] = self.generate_restrictive_csp()
-                    return response
-                
-                # Парсим разрешенные домены
-                allowed_domains = self.parse_allowed_domains(token_info['allowed_domains'])
-                
-                if not allowed_domains:
-                    logger.warning("CSP: Нет разрешенных доменов, применяю ограничительный CSP")
-                    response = await call_next(request)
-                    response.headers['Content-Security-Policy'] = self.generate_restrictive_csp()
-                    return response
-                
-                # Генерируем динамический CSP
-                dynamic_csp = self.generate_csp_header(allowed_domains)
-                
-                logger.info(f"✅ CSP: Разрешенные домены для assistant_id={token_info['assistant_id']}: {allowed_domains}")
-                logger.debug(f"CSP заголовок: {dynamic_csp}")
-                
-                # Выполняем запрос и добавляем CSP заголовок
-                response = await call_next(request)
-                response.headers['Content-Security-Policy'] = dynamic_csp
-                
-                # X-Frame-Options убран - используем только современный CSP frame-ancestors
-                
-                return response
-                
-            finally:
-                # Закрываем сессию БД
-                try:
-                    db_session.close()
-                except:
-                    pass
-        
+            token_info = await asyncio.to_thread(self.validate_widget_token, site_token)
         except Exception as e:
-            logger.error(f"CSP: Ошибка получения сессии БД: {e}")
+            logger.error(f"CSP: Ошибка проверки токена: {e}")
             # Fallback на ограничительный CSP при ошибке
-            response = await call_next(request)
-            response.headers['Content-Security-Policy'] = self.generate_restrictive_csp()
-            return response
-
-# Глобальный экземпляр
-dynamic_csp_middleware = DynamicCSPMiddleware
\ No newline at end of file
+            return self._restrictive_csp
+        
+        if not token_info or not token_info.get('valid'):
+            logger.debug("CSP: Токен невалидный, применяю ограничительный CSP")
+            return self._restrictive_csp
+        
+        # Парсим разрешенные домены
+        allowed_domains = self.parse_allowed_domains(token_info['allowed_domains'])
+        
+        if not allowed_domains:
+            logger.debug("CSP: Нет разрешенных доменов, применяю ограничительный CSP")
+            return self._restrictive_csp
+        
+        logger.debug(f"✅ CSP: Разрешенные домены для assistant_id={token_info['assistant_id']}: {allowed_domains}")
+        
+        # X-Frame-Options не используем - только современный CSP frame-ancestors
+        return self.generate_csp_header(allowed_domains)
@@ -0,0 +1,138 @@
+"""
+Стек HTTP middleware приложения
+
+Все слои — чистые ASGI middleware: без BaseHTTPMiddleware нет лишней задачи и
+очереди на каждый запрос, а стриминговые ответы (SSE) не буферизуются.
+Порядок (снаружи внутрь): метрики -> security headers + CSP -> CSRF -> CORS ->
+учет SQL-запросов по маршрутам (database/utils/query_sampler.py).
+
+RequestMetricsMiddleware собирает время каждого слоя (core/middleware_timing.py)
+в гистограмму http_middleware_overhead_seconds{layer, path}. При
+MIDDLEWARE_SERVER_TIMING=true те же значения отдаются в заголовке Server-Timing.
+"""
+
+import logging
+import time
+from typing import Any, Dict, List
+
+from fastapi.responses import JSONResponse
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from core.csrf_protection import CSRFMiddleware, get_csrf_protection
+from core.dynamic_cors_middleware import DynamicCORSMiddleware
+from core.dynamic_csp_middleware import DynamicCSPPolicy
+from core.middleware_timing import SERVER_TIMING_ENABLED, TIMINGS_SCOPE_KEY
+from core.security_headers import SecurityHeadersMiddleware
+
+logger = logging.getLogger(__name__)
+
+try:
+    from prometheus_client import Counter, Histogram
+    HTTP_REQUEST_LATENCY = Histogram(
+        'http_request_duration_seconds', 'HTTP request latency', ['method', 'path', 'status']
+    )
+    HTTP_REQUEST_COUNT = Counter(
+        'http_requests_total', 'Total HTTP requests', ['method', 'path', 'status']
+    )
+    MIDDLEWARE_OVERHEAD = Histogram(
+        'http_middleware_overhead_seconds', 'Time spent in own middleware layers', ['layer', 'path'],
+        buckets=(0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+    )
+    METRICS_ENABLED = True
+except ImportError:
+    METRICS_ENABLED = False
+
+
+class RequestMetricsMiddleware:
+    """Внешний слой: латентность запросов, время middleware и перехват необработанных ошибок"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        timings: Dict[str, float] = {}
+        scope[TIMINGS_SCOPE_KEY] = timings
+        status_code = "500"  # Дефолтное значение на случай ошибки
+        response_started = False
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code, response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+                status_code = str(message["status"])
+                if SERVER_TIMING_ENABLED and timings:
+                    MutableHeaders(scope=message).append("Server-Timing", ", ".join(
+                        f"mw-{layer};dur={seconds * 1000:.3f}" for layer, seconds in timings.items()
+                    ))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception as e:
+            if response_started:
+                # Заголовки уже отправлены (например, оборвался стрим) - ответить 500 нельзя
+                raise
+            logger.error(f"❌ Необработанная ошибка {scope['method']} {scope['path']}: {e}")
+            response = JSONResponse(
+                status_code=500,
+                content={"error": f"Internal server error: {str(e)}"}
+            )
+            await response(scope, receive, send_wrapper)
+        finally:
+            self._observe(scope, status_code, time.perf_counter() - start, timings)
+
+    @staticmethod
+    def _observe(scope: Scope, status_code: str, duration: float, timings: Dict[str, float]) -> None:
+        if not METRICS_ENABLED:
+            return
+        # Шаблон пути вместо фактического, чтобы снизить кардинальность
+        route = scope.get('route')
+        path = getattr(route, 'path', scope['path'])
+        try:
+            HTTP_REQUEST_LATENCY.labels(method=scope['method'], path=path, status=status_code).observe(duration)
+            HTTP_REQUEST_COUNT.labels(method=scope['method'], path=path, status=status_code).inc()
+            for layer, seconds in timings.items():
+                MIDDLEWARE_OVERHEAD.labels(layer=layer, path=path).observe(seconds)
+        except Exception:
+            pass
+
+
+def install_middleware_stack(
+    app: Any,
+    cors_options: Dict[str, Any],
+    iframe_path: str = '/chat-iframe',
+    enable_csrf: bool = False,
+) -> List[str]:
+    """
+    Подключает middleware к приложению
+
+    add_middleware оборачивает приложение снаружи, поэтому слои добавляются
+    от внутреннего к внешнему.
+
+    Returns:
+        Имена подключенных слоев снаружи внутрь (для логов старта)
+    """
+    from database.utils.query_sampler import QueryTrackingMiddleware
+    app.add_middleware(QueryTrackingMiddleware)
+    layers = ["query_tracking"]
+
+    app.add_middleware(DynamicCORSMiddleware, **cors_options)
+    layers.append("cors")
+
+    if enable_csrf:
+        app.add_middleware(CSRFMiddleware, protection=get_csrf_protection())
+        layers.append("csrf")
+
+    app.add_middleware(SecurityHeadersMiddleware, csp_policy=DynamicCSPPolicy(iframe_path=iframe_path))
+    layers.append("security_headers")
+
+    app.add_middleware(RequestMetricsMiddleware)
+    layers.append("metrics")
+
+    return list(reversed(layers))
@@ -0,0 +1,32 @@
+"""
+Учет времени, которое запрос проводит в собственных middleware
+
+Каждый слой добавляет свое время (без времени вложенного приложения) в
+scope["middleware_timings"], а RequestMetricsMiddleware в конце запроса
+выгружает накопленное в Prometheus.
+"""
+
+import os
+from typing import Optional
+
+from starlette.types import Scope
+
+TIMINGS_SCOPE_KEY = "middleware_timings"
+
+# Отдавать ли время слоев и БД клиенту в заголовке Server-Timing
+SERVER_TIMING_ENABLED = os.getenv('MIDDLEWARE_SERVER_TIMING', 'false').lower() in ('true', '1', 'yes')
+
+
+def add_layer_time(scope: Scope, layer: str, seconds: float) -> None:
+    """Добавить время работы слоя к текущему запросу"""
+    timings = scope.get(TIMINGS_SCOPE_KEY)
+    if timings is not None:
+        timings[layer] = timings.get(layer, 0.0) + seconds
+
+
+def get_header(scope: Scope, name: bytes) -> Optional[str]:
+    """Значение заголовка запроса из сырого scope (name в нижнем регистре)"""
+    for key, value in scope["headers"]:
+        if key == name:
+            return value.decode("latin-1")
+    return None
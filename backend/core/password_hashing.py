@@ -0,0 +1,159 @@
+"""
+Хеширование паролей в отдельном ограниченном пуле потоков
+
+bcrypt - это 100-300 мс CPU на одну проверку. Раньше он выполнялся прямо в
+потоке, обслуживающем /api/login, и всплеск логинов (или перебор паролей)
+занимал весь threadpool API. Теперь:
+
+- хеширование идет в собственном пуле из PASSWORD_HASH_WORKERS потоков
+  (bcrypt отпускает GIL, так что потоков достаточно);
+- одновременно в пуле и очереди не больше PASSWORD_HASH_WORKERS +
+  PASSWORD_HASH_MAX_QUEUE задач, остальные сразу получают 503 - ожидать
+  bcrypt могут не больше этого числа потоков API, чат их не лишится;
+- cost фактор задается PASSWORD_BCRYPT_ROUNDS; хеши со слабым cost
+  прозрачно перехешируются при успешном входе (verify_and_update).
+"""
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout
+from typing import Optional, Tuple
+
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+
+logger = logging.getLogger(__name__)
+
+try:
+    from prometheus_client import Counter, Gauge, Histogram
+    PASSWORD_HASH_SECONDS = Histogram(
+        'password_hash_duration_seconds', 'Password hashing time in worker pool', ['operation'],
+        buckets=(0.05, 0.1, 0.2, 0.3, 0.5, 1.0, 2.0, 5.0)
+    )
+    PASSWORD_HASH_WAIT_SECONDS = Histogram(
+        'password_hash_queue_wait_seconds', 'Time a password hash waited for a worker', ['operation'],
+        buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0)
+    )
+    PASSWORD_HASH_IN_FLIGHT = Gauge('password_hash_in_flight', 'Password hashes running or queued')
+    PASSWORD_HASH_REJECTED = Counter('password_hash_rejected_total', 'Password hashes rejected on full queue', ['operation'])
+    PASSWORD_REHASHED = Counter('password_rehashed_total', 'Password hashes upgraded on login')
+    METRICS_ENABLED = True
+except ImportError:
+    METRICS_ENABLED = False
+
+HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', '4'))
+HASH_MAX_QUEUE = int(os.getenv('PASSWORD_HASH_MAX_QUEUE', '12'))
+HASH_TIMEOUT_SECONDS = float(os.getenv('PASSWORD_HASH_TIMEOUT_SECONDS', '10'))
+BCRYPT_ROUNDS = int(os.getenv('PASSWORD_BCRYPT_ROUNDS', '12'))
+
+
+class PasswordHasherBusy(HTTPException):
+    """Пул хеширования переполнен - запрос отклоняется сразу, а не ждет"""
+
+    def __init__(self):
+        super().__init__(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Сервис авторизации перегружен, попробуйте через несколько секунд",
+            headers={"Retry-After": "5"},
+        )
+
+
+def build_context(rounds: int = BCRYPT_ROUNDS) -> CryptContext:
+    # min_rounds = rounds: хеши со слабым cost помечаются для перехеширования
+    return CryptContext(
+        schemes=["bcrypt"],
+        deprecated="auto",
+        bcrypt__rounds=rounds,
+        bcrypt__min_rounds=rounds,
+    )
+
+
+class PasswordHasher:
+    """Ограниченный пул для bcrypt"""
+
+    def __init__(self, context: Optional[CryptContext] = None,
+                 workers: int = HASH_WORKERS, max_queue: int = HASH_MAX_QUEUE):
+        self.context = context or build_context()
+        self._workers = workers
+        self._capacity = workers + max_queue
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="pwd-hash")
+        return self._executor
+
+    def _run(self, operation: str, func, *args):
+        with self._lock:
+            if self._in_flight >= self._capacity:
+                if METRICS_ENABLED:
+                    PASSWORD_HASH_REJECTED.labels(operation=operation).inc()
+                logger.warning(f"🔐 Пул хеширования паролей переполнен ({self._in_flight}), {operation} отклонен")
+                raise PasswordHasherBusy()
+            self._in_flight += 1
+            if METRICS_ENABLED:
+                PASSWORD_HASH_IN_FLIGHT.set(self._in_flight)
+
+        submitted = time.perf_counter()
+
+        def task():
+            started = time.perf_counter()
+            try:
+                return func(*args)
+            finally:
+                # Слот освобождается, когда bcrypt реально закончил, даже если вызывающий уже не ждет
+                self._release()
+                if METRICS_ENABLED:
+                    PASSWORD_HASH_WAIT_SECONDS.labels(operation=operation).observe(started - submitted)
+                    PASSWORD_HASH_SECONDS.labels(operation=operation).observe(time.perf_counter() - started)
+
+        try:
+            future = self.executor.submit(task)
+        except Exception:
+            self._release()
+            raise
+
+        try:
+            return future.result(timeout=HASH_TIMEOUT_SECONDS)
+        except FuturesTimeout:
+            logger.warning(f"🔐 {operation} пароля не дождался воркера за {HASH_TIMEOUT_SECONDS}с")
+            raise PasswordHasherBusy()
+
+    def _release(self) -> None:
+        with self._lock:
+            self._in_flight -= 1
+            if METRICS_ENABLED:
+                PASSWORD_HASH_IN_FLIGHT.set(self._in_flight)
+
+    def hash(self, password: str) -> str:
+        return self._run("hash", self.context.hash, password)
+
+    def verify(self, password: str, hashed_password: str) -> bool:
+        return self._run("verify", self.context.verify, password, hashed_password)
+
+    def verify_and_update(self, password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+        """
+        Проверка пароля с перехешированием
+
+        Returns:
+            (valid, new_hash): new_hash не None, если хеш нужно заменить (устаревший cost)
+        """
+        valid, new_hash = self._run("verify", self.context.verify_and_update, password, hashed_password)
+        if new_hash and METRICS_ENABLED:
+            PASSWORD_REHASHED.inc()
+        return valid, new_hash
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+# Глобальный экземпляр
+password_hasher = PasswordHasher()
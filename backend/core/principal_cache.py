@@ -0,0 +1,232 @@
+"""
+Кэш аутентифицированного пользователя и отзыв токенов
+
+get_current_user вызывается на каждый запрос ЛК, а админ-панель шлет их
+десятками параллельно. Здесь:
+
+- строка users кэшируется в Redis на AUTH_USER_CACHE_TTL секунд и
+  подставляется в сессию запроса как persistent-объект без SELECT;
+- у каждого пользователя есть версия безопасности (auth:secver:{id}). Она
+  увеличивается при смене пароля, статуса или роли; access token несет
+  версию на момент выдачи (claim "sv") и со старой версией отклоняется;
+- отозванные токены (logout, refresh) хранятся в Redis по jti до истечения.
+
+Изменения пользователя отслеживаются событиями сессии SQLAlchemy, поэтому
+кэш сбрасывается при любом коммите, а не только в отдельных эндпоинтах.
+Без Redis все работает как раньше: пользователь читается из БД, отзыв
+невозможен.
+"""
+
+import logging
+import os
+import pickle
+import time
+from typing import Optional, Dict, Any
+
+from sqlalchemy import event, inspect as sa_inspect
+from sqlalchemy.orm import Session, make_transient_to_detached
+
+from database import models
+
+logger = logging.getLogger(__name__)
+
+try:
+    from prometheus_client import Counter
+    AUTH_PRINCIPAL_LOOKUPS = Counter('auth_principal_lookups_total', 'Authenticated user lookups', ['source'])
+    METRICS_ENABLED = True
+except ImportError:
+    METRICS_ENABLED = False
+
+USER_CACHE_TTL_SECONDS = int(os.getenv('AUTH_USER_CACHE_TTL', '30'))
+# Версию безопасности держим дольше любого токена
+SECURITY_VERSION_TTL_SECONDS = (int(os.getenv("JWT_REFRESH_TOKEN_EXPIRE_DAYS", "30")) + 1) * 86400
+
+PRINCIPAL_KEY = "auth:principal:{user_id}"
+SECURITY_VERSION_KEY = "auth:secver:{user_id}"
+BLACKLIST_KEY = "auth:blacklist:{jti}"
+
+# Изменение этих полей отзывает все ранее выданные токены
+SECURITY_FIELDS = ("hashed_password", "status", "role")
+
+_USER_COLUMNS = [attr.key for attr in sa_inspect(models.User).column_attrs]
+
+
+def _redis():
+    from cache.redis_cache import cache
+    return cache.redis_client
+
+
+def _record(source: str) -> None:
+    if METRICS_ENABLED:
+        AUTH_PRINCIPAL_LOOKUPS.labels(source=source).inc()
+
+
+# === Версия безопасности ===
+
+def get_security_version(user_id: int) -> int:
+    redis_client = _redis()
+    if not redis_client:
+        return 0
+    try:
+        value = redis_client.get(SECURITY_VERSION_KEY.format(user_id=user_id))
+        return int(value) if value else 0
+    except Exception as e:
+        logger.debug(f"Не удалось прочитать версию безопасности пользователя {user_id}: {e}")
+        return 0
+
+
+def bump_security_version(user_id: int) -> None:
+    """Отозвать все выданные пользователю токены и сбросить кэш"""
+    redis_client = _redis()
+    if not redis_client:
+        return
+    try:
+        key = SECURITY_VERSION_KEY.format(user_id=user_id)
+        pipe = redis_client.pipeline()
+        pipe.incr(key)
+        pipe.expire(key, SECURITY_VERSION_TTL_SECONDS)
+        pipe.delete(PRINCIPAL_KEY.format(user_id=user_id))
+        pipe.execute()
+        logger.info(f"🔐 Токены пользователя {user_id} отозваны (смена пароля/статуса/роли)")
+    except Exception as e:
+        logger.error(f"❌ Не удалось отозвать токены пользователя {user_id}: {e}")
+
+
+# === Blacklist по jti ===
+
+def blacklist_jti(jti: str, expires_at: Optional[float]) -> bool:
+    """Добавить токен в blacklist до момента его истечения"""
+    redis_client = _redis()
+    if not redis_client or not jti:
+        return False
+    ttl = int((expires_at or time.time() + SECURITY_VERSION_TTL_SECONDS) - time.time())
+    if ttl <= 0:
+        return True  # Токен уже истек
+    try:
+        redis_client.setex(BLACKLIST_KEY.format(jti=jti), ttl, 1)
+        return True
+    except Exception as e:
+        logger.error(f"❌ Не удалось отозвать токен {jti}: {e}")
+        return False
+
+
+def is_jti_blacklisted(jti: str) -> bool:
+    redis_client = _redis()
+    if not redis_client or not jti:
+        return False
+    try:
+        return bool(redis_client.exists(BLACKLIST_KEY.format(jti=jti)))
+    except Exception as e:
+        logger.debug(f"Не удалось проверить blacklist: {e}")
+        return False
+
+
+# === Кэш пользователя ===
+
+def invalidate_principal(user_id: int) -> None:
+    redis_client = _redis()
+    if not redis_client:
+        return
+    try:
+        redis_client.delete(PRINCIPAL_KEY.format(user_id=user_id))
+    except Exception as e:
+        logger.debug(f"Не удалось сбросить кэш пользователя {user_id}: {e}")
+
+
+def _attach(db: Session, columns: Dict[str, Any]) -> models.User:
+    """Сделать пользователя из кэша persistent-объектом сессии запроса без SELECT"""
+    existing = db.identity_map.get(db.identity_key(models.User, columns["id"]))
+    if existing is not None:
+        return existing
+    user = models.User(**columns)
+    make_transient_to_detached(user)
+    db.add(user)
+    return user
+
+
+def load_principal(db: Session, user_id: int, token_version: int = 0):
+    """
+    Пользователь для access token
+
+    Returns:
+        (user, revoked): user - активный пользователь или None; revoked - токен
+        выдан до последней смены пароля/статуса/роли
+    """
+    redis_client = _redis()
+    cached = None
+    current_version = 0
+    if redis_client:
+        try:
+            raw, version = redis_client.mget(
+                PRINCIPAL_KEY.format(user_id=user_id), SECURITY_VERSION_KEY.format(user_id=user_id)
+            )
+            current_version = int(version) if version else 0
+            cached = pickle.loads(raw) if raw else None
+        except Exception as e:
+            logger.debug(f"Кэш пользователей недоступен: {e}")
+
+    if token_version < current_version:
+        return None, True
+
+    if cached is not None:
+        _record("cache")
+        return (_attach(db, cached) if cached.get("status") == "active" else None), False
+
+    _record("db")
+    user = db.query(models.User).filter(
+        models.User.id == user_id,
+        models.User.status == "active"  # Проверяем, что пользователь активен
+    ).first()
+
+    if user is not None and redis_client:
+        try:
+            columns = {key: getattr(user, key) for key in _USER_COLUMNS}
+            redis_client.setex(PRINCIPAL_KEY.format(user_id=user_id), USER_CACHE_TTL_SECONDS, pickle.dumps(columns))
+        except Exception as e:
+            logger.debug(f"Не удалось закэшировать пользователя {user_id}: {e}")
+    return user, False
+
+
+# === Отслеживание изменений пользователей ===
+
+def mark_password_rehash(session: Session, user_id: int) -> None:
+    """
+    Новый hashed_password пользователя в этой транзакции — перехеширование того же
+    пароля (апгрейд cost при входе). Такое изменение сбрасывает кэш пользователя,
+    но не повышает версию безопасности: выданные токены остаются действительными.
+    """
+    session.info.setdefault("principal_rehash", set()).add(user_id)
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_user_changes(session, flush_context):
+    changed = session.info.setdefault("principal_changes", {})
+    rehashed = session.info.get("principal_rehash", ())
+    for obj in list(session.dirty) + list(session.deleted):
+        if not isinstance(obj, models.User) or obj.id is None:
+            continue
+        state = sa_inspect(obj)
+        fields = [name for name in SECURITY_FIELDS if state.attrs[name].history.has_changes()]
+        if obj.id in rehashed:
+            fields = [name for name in fields if name != "hashed_password"]
+        security_changed = obj in session.deleted or bool(fields)
+        changed[obj.id] = changed.get(obj.id, False) or security_changed
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_user_changes(session):
+    session.info.pop("principal_rehash", None)
+    changed = session.info.pop("principal_changes", None)
+    if not changed:
+        return
+    for user_id, security_changed in changed.items():
+        if security_changed:
+            bump_security_version(user_id)
+        else:
+            invalidate_principal(user_id)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_user_changes(session):
+    session.info.pop("principal_rehash", None)
+    session.info.pop("principal_changes", None)
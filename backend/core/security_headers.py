@@ -3,13 +3,32 @@
 Добавляет security headers и настраивает secure cookies
 """
 
-from fastapi import Request, Response
 import logging
+import time
+from typing import Optional
+
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from core.dynamic_csp_middleware import DynamicCSPPolicy
+from core.middleware_timing import add_layer_time, get_header
 
 logger = logging.getLogger(__name__)
 
+LAYER = "security_headers"
+HSTS_VALUE = "max-age=31536000; includeSubDomains; preload"
+
+
 class SecurityHeadersMiddleware:
-    def __init__(self):
+    """
+    Чистый ASGI middleware: security headers, динамический CSP для iframe
+    виджета и secure cookies. Заголовки правятся в http.response.start,
+    тело ответа (в том числе SSE) проходит без буферизации.
+    """
+
+    def __init__(self, app: ASGIApp, csp_policy: Optional[DynamicCSPPolicy] = None):
+        self.app = app
+        self.csp_policy = csp_policy
         self.security_headers = {
             # Предотвращение XSS атак
             "X-Content-Type-Options": "nosniff",
@@ -41,77 +60,89 @@ class SecurityHeadersMiddleware:
             # "Strict-Transport-Security": "max-age=31536000; includeSubDomains; preload"
         }
         
-        logger.info("🛡️ Security Headers Middleware инициализирован")
+        # Сырые заголовки считаем один раз при старте
+        self._raw_headers = [
+            (name.lower().encode("latin-1"), value.encode("latin-1"))
+            for name, value in self.security_headers.items()
+        ]
         
-    def add_hsts_header(self, response: Response, request: Request):
-        """Добавляет HSTS header только для HTTPS соединений"""
-        # Проверяем что соединение HTTPS
-        is_https = (
-            request.url.scheme == "https" or
-            request.headers.get("X-Forwarded-Proto") == "https" or
-            request.headers.get("X-Forwarded-Ssl") == "on"
-        )
+        logger.info("🛡️ Security Headers Middleware инициализирован")
         
-        if is_https:
-            response.headers["Strict-Transport-Security"] = "max-age=31536000; includeSubDomains; preload"
-            logger.debug("🛡️ HSTS header добавлен")
+    @staticmethod
+    def is_https(scope: Scope, check_forwarded_ssl: bool = True) -> bool:
+        """Проверяет, пришел ли запрос по HTTPS (напрямую или через прокси)"""
+        if scope.get("scheme") == "https" or get_header(scope, b"x-forwarded-proto") == "https":
+            return True
+        return check_forwarded_ssl and get_header(scope, b"x-forwarded-ssl") == "on"
             
-    def configure_secure_cookies(self, response: Response, request: Request):
+    def configure_secure_cookies(self, headers: MutableHeaders, is_https: bool):
         """Настраивает secure cookies"""
-        is_https = (
-            request.url.scheme == "https" or
-            request.headers.get("X-Forwarded-Proto") == "https"
-        )
-        
         # Обновляем Set-Cookie headers для безопасности
-        set_cookie_headers = response.headers.getlist("set-cookie")
-        if set_cookie_headers:
-            updated_cookies = []
+        set_cookie_headers = headers.getlist("set-cookie")
+        if not set_cookie_headers:
+            return
             
-            for cookie in set_cookie_headers:
-                # Добавляем Secure flag для HTTPS
-                if is_https and "Secure" not in cookie:
-                    cookie += "; Secure"
-                
-                # Добавляем SameSite=Strict если не указан
-                if "SameSite" not in cookie:
-                    cookie += "; SameSite=Strict"
-                
-                # Добавляем HttpOnly для session cookies (но не для CSRF токенов)
-                if "csrftoken" not in cookie and "HttpOnly" not in cookie:
-                    cookie += "; HttpOnly"
-                    
-                updated_cookies.append(cookie)
+        updated_cookies = []
+        for cookie in set_cookie_headers:
+            # Добавляем Secure flag для HTTPS
+            if is_https and "Secure" not in cookie:
+                cookie += "; Secure"
             
-            # Обновляем headers
-            response.headers.pop("set-cookie")
-            for cookie in updated_cookies:
-                response.headers.append("set-cookie", cookie)
+            # Добавляем SameSite=Strict если не указан
+            if "SameSite" not in cookie:
+                cookie += "; SameSite=Strict"
+            
+            # Добавляем HttpOnly для session cookies (но не для CSRF токенов)
+            if "csrftoken" not in cookie and "HttpOnly" not in cookie:
+                cookie += "; HttpOnly"
                 
-            logger.debug(f"🛡️ Настроены secure cookies: {len(updated_cookies)} cookies")
+            updated_cookies.append(cookie)
+        
+        # Обновляем headers
+        del headers["set-cookie"]
+        for cookie in updated_cookies:
+            headers.append("set-cookie", cookie)
+            
+        logger.debug(f"🛡️ Настроены secure cookies: {len(updated_cookies)} cookies")
             
-    async def __call__(self, request: Request, call_next):
-        """Security Headers Middleware для FastAPI"""
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        """Security Headers Middleware"""
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
         
-        # Обрабатываем запрос
-        response = await call_next(request)
+        started = time.perf_counter()
         
-        # Добавляем security headers
-        for header_name, header_value in self.security_headers.items():
-            # Не перезаписываем существующие headers
-            if header_name not in response.headers:
-                response.headers[header_name] = header_value
-                
-        # Добавляем HSTS для HTTPS
-        self.add_hsts_header(response, request)
+        # Для iframe страницы виджета CSP зависит от site_token
+        csp_override = None
+        if self.csp_policy and self.csp_policy.applies_to(scope["path"]):
+            csp_override = await self.csp_policy.resolve(scope.get("query_string", b""))
         
-        # Настраиваем secure cookies
-        self.configure_secure_cookies(response, request)
+        add_layer_time(scope, LAYER, time.perf_counter() - started)
         
-        # Логируем для отладки
-        logger.debug(f"🛡️ Security headers добавлены для {request.url.path}")
+        async def send_with_headers(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                hook_started = time.perf_counter()
+                headers = MutableHeaders(scope=message)
+                
+                if csp_override is not None:
+                    headers["Content-Security-Policy"] = csp_override
+                
+                # Не перезаписываем существующие headers
+                present = {key for key, _ in headers.raw}
+                for name, value in self._raw_headers:
+                    if name not in present:
+                        headers.raw.append((name, value))
+                
+                # Добавляем HSTS для HTTPS
+                if self.is_https(scope):
+                    headers["Strict-Transport-Security"] = HSTS_VALUE
+                
+                # Настраиваем secure cookies
+                if b"set-cookie" in present:
+                    self.configure_secure_cookies(headers, self.is_https(scope, check_forwarded_ssl=False))
+                
+                add_layer_time(scope, LAYER, time.perf_counter() - hook_started)
+            await send(message)
         
-        return response
-
-# Глобальный экземпляр
-security_headers_middleware = SecurityHeadersMiddleware()
\ No newline at end of file
+        await self.app(scope, receive, send_with_headers)
@@ -0,0 +1,152 @@
+"""
+Асинхронный движок БД (asyncpg) для горячих async-эндпоинтов.
+
+Синхронный движок из database.connection остаётся основным для всего
+остального кода; здесь — отдельный пул, который не блокирует event loop.
+Настройки подключения (DB_*) общие, размер пула считается с учётом
+PgBouncer в режиме transaction (config/pgbouncer.ini).
+"""
+import os
+import logging
+from uuid import uuid4
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from .connection import (
+    DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD, DB_SSL_MODE,
+    POOL_SIZE, MAX_OVERFLOW, POOL_TIMEOUT, POOL_RECYCLE, ECHO_SQL,
+)
+
+logger = logging.getLogger(__name__)
+
+try:
+    import asyncpg  # noqa: F401
+    ASYNCPG_AVAILABLE = True
+except ImportError:
+    ASYNCPG_AVAILABLE = False
+
+# 🔧 PGBOUNCER (pool_mode = transaction)
+# В transaction-режиме серверное соединение меняется между транзакциями, поэтому
+# именованные prepared statements asyncpg использовать нельзя, а параметры старта
+# (кроме application_name) PgBouncer отвергает.
+PGBOUNCER_ENABLED = os.getenv('DB_PGBOUNCER', 'false').lower() == 'true'
+PGBOUNCER_MAX_CLIENT_CONN = int(os.getenv('PGBOUNCER_MAX_CLIENT_CONN', '200'))
+WEB_CONCURRENCY = max(1, int(os.getenv('WEB_CONCURRENCY', '1')))
+
+ASYNC_DB_HOST = os.getenv('DB_ASYNC_HOST', '127.0.0.1' if PGBOUNCER_ENABLED else DB_HOST)
+ASYNC_DB_PORT = os.getenv('DB_ASYNC_PORT', '6432' if PGBOUNCER_ENABLED else DB_PORT)
+
+
+def _default_async_pool():
+    """Размер пула asyncpg на один воркер.
+
+    Без PgBouncer каждое соединение — отдельный backend Postgres, поэтому пул
+    небольшой: sync-пул уже держит POOL_SIZE + MAX_OVERFLOW соединений.
+    С PgBouncer клиентские соединения дешёвые, ограничение — max_client_conn
+    на все воркеры (включая sync-пул, если он тоже ходит через PgBouncer).
+    """
+    if not PGBOUNCER_ENABLED:
+        return 5, 5
+    per_worker = PGBOUNCER_MAX_CLIENT_CONN // WEB_CONCURRENCY - (POOL_SIZE + MAX_OVERFLOW)
+    per_worker = max(4, min(per_worker, 40))
+    return per_worker // 2, per_worker - per_worker // 2
+
+
+_default_size, _default_overflow = _default_async_pool()
+ASYNC_POOL_SIZE = int(os.getenv('DB_ASYNC_POOL_SIZE', str(_default_size)))
+ASYNC_MAX_OVERFLOW = int(os.getenv('DB_ASYNC_MAX_OVERFLOW', str(_default_overflow)))
+
+if DB_PASSWORD:
+    ASYNC_DATABASE_URL = f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{ASYNC_DB_HOST}:{ASYNC_DB_PORT}/{DB_NAME}"
+else:
+    ASYNC_DATABASE_URL = f"postgresql+asyncpg://{DB_USER}@{ASYNC_DB_HOST}:{ASYNC_DB_PORT}/{DB_NAME}"
+
+
+def _connect_args():
+    """Параметры asyncpg.connect с учётом PgBouncer"""
+    args = {
+        "timeout": 10,
+        # asyncpg понимает те же значения, что и libpq sslmode
+        "ssl": DB_SSL_MODE,
+        "server_settings": {"application_name": "ChatAI_Backend_async"},
+    }
+    if PGBOUNCER_ENABLED:
+        args.update({
+            "statement_cache_size": 0,
+            "prepared_statement_cache_size": 0,
+            # Уникальные имена, чтобы не пересечься с чужим statement на общем серверном соединении
+            "prepared_statement_name_func": lambda: f"__asyncpg_{uuid4()}__",
+        })
+    else:
+        args["server_settings"]["timezone"] = "UTC"
+    return args
+
+
+_async_engine = None
+AsyncSessionLocal = async_sessionmaker(class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+
+def get_async_engine():
+    """Ленивое создание async-движка (первый вызов — внутри event loop)"""
+    global _async_engine
+    if _async_engine is None:
+        if not ASYNCPG_AVAILABLE:
+            raise RuntimeError("asyncpg не установлен: pip install asyncpg")
+
+        _async_engine = create_async_engine(
+            ASYNC_DATABASE_URL,
+            pool_size=ASYNC_POOL_SIZE,
+            max_overflow=ASYNC_MAX_OVERFLOW,
+            pool_timeout=POOL_TIMEOUT,
+            pool_pre_ping=True,
+            pool_recycle=POOL_RECYCLE,
+            echo=ECHO_SQL,
+            connect_args=_connect_args(),
+        )
+        AsyncSessionLocal.configure(bind=_async_engine)
+
+        # Профилирование запросов по маршрутам работает и для async-сессий
+        from database.utils.query_sampler import install_query_tracking
+        install_query_tracking(_async_engine.sync_engine)
+
+        logger.info(
+            f"🔗 Async БД: {DB_USER}@{ASYNC_DB_HOST}:{ASYNC_DB_PORT}/{DB_NAME}, "
+            f"пул={ASYNC_POOL_SIZE}, overflow={ASYNC_MAX_OVERFLOW}, pgbouncer={PGBOUNCER_ENABLED}"
+        )
+    return _async_engine
+
+
+async def get_async_db():
+    """Получение AsyncSession с обработкой ошибок"""
+    get_async_engine()
+    async with AsyncSessionLocal() as db:
+        try:
+            yield db
+        except Exception as e:
+            logger.error(f"Ошибка работы с БД (async): {e}")
+            await db.rollback()
+            raise
+
+
+async def dispose_async_engine():
+    """Закрытие пула asyncpg при остановке приложения"""
+    global _async_engine
+    if _async_engine is not None:
+        await _async_engine.dispose()
+        _async_engine = None
+        logger.info("🔌 Async пул БД закрыт")
+
+
+def get_async_db_stats():
+    """Статистика async-пула (аналог get_db_stats)"""
+    if _async_engine is None:
+        return {"initialized": False}
+    pool = _async_engine.pool
+    return {
+        "initialized": True,
+        "pool_size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+        "total_connections": pool.size() + pool.overflow(),
+    }
@@ -170,6 +170,11 @@ def delete_user(db: Session, user_id: int):
             return False
             
         db.commit()
+
+        # Индекс паттернов диалогов держится в памяти процесса и по версии в Redis
+        from ai.training_system import invalidate_pattern_index
+        invalidate_pattern_index(user_id)
+
         print(f"[CRUD] Пользователь {user_id} успешно удален со всеми связанными записями")
         return True
         
@@ -334,6 +339,10 @@ def delete_assistant(db: Session, assistant_id: int):
         ).delete(synchronize_session=False)
 
         db.commit()
+
+        # Кэш счетчиков сообщений помнит старый assistant_id отвязанных диалогов
+        from services.message_quota import forget_dialogs
+        forget_dialogs()
     except Exception:
         db.rollback()
         raise
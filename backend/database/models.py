@@ -1,9 +1,11 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text, Float, Boolean, func, Index, NUMERIC, UniqueConstraint
-from sqlalchemy.orm import relationship
+from sqlalchemy import BigInteger, Column, Integer, String, Date, DateTime, ForeignKey, Text, Float, Boolean, func, Index, NUMERIC, UniqueConstraint
+from sqlalchemy.orm import relationship, validates
 from sqlalchemy.dialects import postgresql
 from datetime import datetime
 from .connection import Base
+import hashlib
 import importlib
+import re
 Vector = None
 try:
     _pgv = importlib.import_module('pgvector.sqlalchemy')  # type: ignore
@@ -11,6 +13,23 @@ try:
 except Exception:
     Vector = None  # Тип будет задан в миграции; для рантайма без pgvector может использоваться Text
 
+# Заголовок, который KnowledgeControlService дописывает перед содержимым
+_KNOWLEDGE_META_HASH = re.compile(r'\s*# МЕТАДАННЫЕ ВАЛИДАЦИИ\s*# Хэш: ([0-9a-f]{64})')
+
+
+def knowledge_content_hash(content: str) -> str:
+    """SHA-256 содержимого знаний: из заголовка валидации, если он есть, иначе по тексту"""
+    meta = _KNOWLEDGE_META_HASH.match(content)
+    if meta:
+        return meta.group(1)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def qa_question_hash(question: str) -> str:
+    """SHA-256 нормализованного вопроса (регистр и пробелы не важны) — ключ дедупликации Q&A"""
+    return hashlib.sha256(' '.join(question.split()).lower().encode()).hexdigest()
+
+
 class User(Base):
     __tablename__ = 'users'
     id = Column(Integer, primary_key=True, index=True)
@@ -93,12 +112,22 @@ class UserKnowledge(Base):
     importance = Column(Integer, default=10)  # важность документа от 1 до 10
     last_used = Column(DateTime, nullable=True)  # когда последний раз использовался в ответе
     usage_count = Column(Integer, default=0)  # сколько раз использовался в ответах
+    content_sha256 = Column(String(64), nullable=True)  # Хэш содержимого без метаданных валидации
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     user = relationship('User', backref='knowledge')
     assistant = relationship('Assistant', backref='knowledge')
     document = relationship('Document', backref='knowledge')
 
+    __table_args__ = (
+        Index('ix_user_knowledge_owner_content_sha256', 'user_id', 'assistant_id', 'content_sha256'),
+    )
+
+    @validates('content')
+    def _hash_content(self, key, value):
+        self.content_sha256 = knowledge_content_hash(value) if value is not None else None
+        return value
+
 
 class KnowledgeEmbedding(Base):
     """Embeddings для быстрого поиска релевантных фрагментов знаний"""
@@ -205,9 +234,63 @@ class DialogMessage(Base):
     # Handoff message fields
     message_kind = Column(String, nullable=False, default='user')  # 'user'|'assistant'|'operator'|'system'
     system_type = Column(String, nullable=True)  # 'handoff_requested'|'handoff_started'|'handoff_released'
+    response_time_ms = Column(Integer, nullable=True)  # Для ответа ассистента: мс от последнего сообщения пользователя
 
     dialog = relationship('Dialog', backref='messages')
 
+
+class MessageQuotaCounter(Base):
+    """Счетчик сообщений ассистента пользователя за период ('all' или 'YYYY-MM')"""
+    __tablename__ = 'message_quota_counters'
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    period = Column(String(16), primary_key=True)
+    count = Column(Integer, nullable=False, default=0, server_default='0')
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class GuestMessageCounter(Base):
+    """Счетчик сообщений ассистента гостю сайта за месяц ('YYYY-MM')"""
+    __tablename__ = 'guest_message_counters'
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    guest_id = Column(String, primary_key=True)
+    period = Column(String(16), primary_key=True)
+    count = Column(Integer, nullable=False, default=0, server_default='0')
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class AssistantDailyStat(Base):
+    """Дневные итоги по ассистенту: сообщения ассистента и новые диалоги (UTC)"""
+    __tablename__ = 'assistant_daily_stats'
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    assistant_id = Column(Integer, ForeignKey('assistants.id', ondelete='CASCADE'), primary_key=True)
+    day = Column(Date, primary_key=True)
+    messages = Column(Integer, nullable=False, default=0, server_default='0')
+    dialogs = Column(Integer, nullable=False, default=0, server_default='0')
+
+    __table_args__ = (
+        Index('ix_assistant_daily_stats_user_id_day', 'user_id', 'day'),
+    )
+
+
+class ResponseLatencySketch(Base):
+    """Почасовой лог-гистограммный скетч времени ответа: одна строка на корзину.
+
+    source: 'dialog' — ответ ассистента пользователю, 'ai' — запрос к AI-провайдеру.
+    user_id = 0 — запросы без пользователя.
+    """
+    __tablename__ = 'response_latency_sketches'
+    source = Column(String(16), primary_key=True)
+    user_id = Column(Integer, primary_key=True)
+    hour = Column(DateTime, primary_key=True)
+    bucket = Column(Integer, primary_key=True)
+    count = Column(Integer, nullable=False, default=0, server_default='0')
+    total_ms = Column(BigInteger, nullable=False, default=0, server_default='0')
+
+    __table_args__ = (
+        Index('ix_response_latency_sketches_source_hour', 'source', 'hour'),
+    )
+
+
 # Broadcast models removed - no longer needed
 
 class Assistant(Base):
@@ -456,7 +539,7 @@ class Payment(Base):
     status = Column(String, default='pending')  # Наши статусы: pending, processing, completed, cancelled, failed
     
     # ЮKassa поля (новые)
-    yookassa_payment_id = Column(String, nullable=True)  # ID платежа от ЮKassa
+    yookassa_payment_id = Column(String, nullable=True, index=True)  # ID платежа от ЮKassa
     yookassa_status = Column(String, nullable=True)  # Оригинальный статус от ЮKassa: pending, waiting_for_capture, succeeded, canceled
     
     # T-Bank поля (deprecated, оставлены для совместимости с продакшн БД)
@@ -491,6 +574,28 @@ class Payment(Base):
     user = relationship('User', backref='payments')
 
 
+class PaymentWebhookEvent(Base):
+    """Сырые webhook-события ЮKassa (применяются фоновым обработчиком ровно один раз)"""
+    __tablename__ = 'payment_webhook_events'
+    
+    id = Column(Integer, primary_key=True)
+    payment_id = Column(String, nullable=False)  # ID платежа ЮKassa (object.id)
+    event = Column(String, nullable=False)  # payment.succeeded, payment.canceled, ...
+    payload = Column(Text, nullable=False)  # JSON в том виде, в каком пришел от ЮKassa
+    source_ip = Column(String, nullable=True)
+    status = Column(String, nullable=False, default='pending', server_default='pending')  # pending, applied, ignored, failed
+    attempts = Column(Integer, nullable=False, default=0, server_default='0')
+    last_error = Column(Text, nullable=True)
+    received_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    available_at = Column(DateTime, nullable=False, default=datetime.utcnow)  # Не раньше этого времени (backoff повторов)
+    processed_at = Column(DateTime, nullable=True)
+    
+    __table_args__ = (
+        UniqueConstraint('payment_id', 'event', name='uq_payment_webhook_events_payment_id_event'),
+        Index('ix_payment_webhook_events_status_available_at', 'status', 'available_at'),
+    )
+
+
 class OperatorPresence(Base):
     """Operator presence and availability tracking."""
     __tablename__ = 'operator_presence'
@@ -574,10 +679,54 @@ class QAKnowledge(Base):
     is_active = Column(Boolean, default=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    question_hash = Column(String(64), nullable=True)  # qa_question_hash(question) для дедупликации
+    index_job_id = Column(Integer, ForeignKey('qa_import_jobs.id', ondelete='SET NULL'), nullable=True)  # Последняя задача индексации
     
     # Relationships
     user = relationship('User', backref='qa_knowledge')
     assistant = relationship('Assistant', backref='qa_knowledge')
+    
+    __table_args__ = (
+        Index('ix_qa_knowledge_owner_question_hash', 'user_id', 'assistant_id', 'question_hash'),
+        Index('ix_qa_knowledge_index_job_id', 'index_job_id', 'id'),
+    )
+    
+    @validates('question')
+    def _set_question_hash(self, key, value):
+        self.question_hash = qa_question_hash(value) if value is not None else None
+        return value
+
+
+class QAImportJob(Base):
+    """Задача индексации Q&A: импорт файла или правка записей (эмбеддинги считает фоновый обработчик)"""
+    __tablename__ = 'qa_import_jobs'
+    
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    assistant_id = Column(Integer, ForeignKey('assistants.id', ondelete='SET NULL'), nullable=True)
+    kind = Column(String(16), nullable=False, default='file', server_default='file')  # file, edit
+    filename = Column(String, nullable=True)
+    status = Column(String(16), nullable=False, default='pending', server_default='pending')  # pending, running, completed, failed
+    total_rows = Column(Integer, nullable=False, default=0, server_default='0')
+    inserted = Column(Integer, nullable=False, default=0, server_default='0')
+    duplicates = Column(Integer, nullable=False, default=0, server_default='0')
+    invalid = Column(Integer, nullable=False, default=0, server_default='0')
+    to_embed = Column(Integer, nullable=False, default=0, server_default='0')
+    embedded = Column(Integer, nullable=False, default=0, server_default='0')
+    embed_failed = Column(Integer, nullable=False, default=0, server_default='0')
+    cursor_qa_id = Column(Integer, nullable=False, default=0, server_default='0')  # Записи с id <= уже обработаны
+    attempts = Column(Integer, nullable=False, default=0, server_default='0')
+    row_errors = Column(Text, nullable=True)  # JSON: первые ошибки разбора строк
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    available_at = Column(DateTime, nullable=False, default=datetime.utcnow)  # Не раньше этого времени (backoff повторов)
+    heartbeat_at = Column(DateTime, nullable=True)  # Обработчик жив; зависшая задача забирается повторно
+    finished_at = Column(DateTime, nullable=True)
+    
+    __table_args__ = (
+        Index('ix_qa_import_jobs_status_available_at', 'status', 'available_at'),
+        Index('ix_qa_import_jobs_user_id_created_at', 'user_id', 'created_at'),
+    )
 
 
 class BlogPost(Base):
@@ -1,369 +1,640 @@
 """
 🗄️ СИСТЕМА БЭКАПОВ БАЗЫ ДАННЫХ ChatAI
 Автоматические и ручные бэкапы с ротацией и сжатием
+
+Бэкап идет потоком, без промежуточных несжатых файлов:
+
+- custom (по умолчанию): pg_dump --format=custom → zstd -T0 → multipart
+  upload в S3 (или файл .dump.zst). Диск нужен только под итоговый архив,
+  а при S3 - вообще не нужен; zstd сжимает во всех ядрах параллельно с дампом.
+- directory: pg_dump --format=directory --jobs N со сжатием самого pg_dump
+  (каждая таблица в своем сжатом файле) → tar → S3. Для больших БД, где
+  однопоточный pg_dump не успевает.
+- plain: прежний SQL-дамп + gzip (для совместимости).
+
+Восстановление - pg_restore --jobs N: архив из S3 распаковывается потоком
+в локальный файл/каталог (pg_restore -j требует файл с произвольным доступом).
 """
 
 import os
 import subprocess
-import gzip
 import shutil
 import logging
-from datetime import datetime, timedelta
+import tempfile
+import threading
+import time
+from datetime import datetime
 from pathlib import Path
-from typing import List, Dict, Optional
+from typing import Callable, List, Dict, Optional, BinaryIO
 import json
-import boto3
-from botocore.exceptions import ClientError
 
 logger = logging.getLogger(__name__)
 
+try:
+    from prometheus_client import Counter, Gauge, Histogram
+    BACKUP_DURATION = Histogram(
+        'db_backup_duration_seconds', 'Database backup/restore duration', ['operation', 'format'],
+        buckets=(10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)
+    )
+    BACKUP_BYTES = Counter('db_backup_bytes_total', 'Database backup bytes', ['stage'])
+    BACKUP_THROUGHPUT = Gauge(
+        'db_backup_throughput_bytes_per_second', 'Throughput of the last backup/restore', ['operation']
+    )
+    BACKUP_LAST_SUCCESS = Gauge('db_backup_last_success_timestamp', 'Unix time of the last successful backup')
+    METRICS_ENABLED = True
+except ImportError:
+    METRICS_ENABLED = False
+
+BACKUP_FORMATS = ('custom', 'directory', 'plain')
+
+# Суффиксы архивов по формату
+ARCHIVE_SUFFIXES = {
+    'custom': '.dump.zst',
+    'directory': '.dir.tar',
+    'plain': '.sql.gz',
+}
+
+PIPE_CHUNK_SIZE = 1024 * 1024
+
+
 class DatabaseBackup:
     """Система бэкапов PostgreSQL с поддержкой локального и облачного хранения"""
-    
+
     def __init__(self):
-        # ОТКЛЮЧЕНО: Система бэкапов временно отключена для исправления проблем с регистрацией
-        # Проблема: Permission denied при попытке создания бэкапов в /var/backups/replyx
-        self.enabled = False
-        logger.info("🚫 Система автоматических бэкапов ОТКЛЮЧЕНА")
-        
-        if self.enabled:
-            # Конфигурация из переменных окружения
-            self.db_host = os.getenv('DB_HOST', 'localhost')
-            self.db_port = os.getenv('DB_PORT', '5432')
-            self.db_name = os.getenv('DB_NAME', 'chat_ai')
-            self.db_user = os.getenv('DB_USER', 'dan')
-            self.db_password = os.getenv('DB_PASSWORD', '')
-            
-            # Настройки бэкапов
-            self.backup_dir = Path(os.getenv('BACKUP_DIR', './data/backups'))
-            self.max_local_backups = int(os.getenv('MAX_LOCAL_BACKUPS', '7'))  # 7 дней
-            self.max_weekly_backups = int(os.getenv('MAX_WEEKLY_BACKUPS', '4'))  # 4 недели
-            self.max_monthly_backups = int(os.getenv('MAX_MONTHLY_BACKUPS', '12'))  # 12 месяцев
-            
-            # S3 конфигурация (опционально)
-            self.s3_enabled = os.getenv('S3_BACKUP_ENABLED', 'false').lower() == 'true'
-            self.s3_bucket = os.getenv('S3_BACKUP_BUCKET')
-            self.s3_region = os.getenv('S3_BACKUP_REGION', 'us-east-1')
-            self.aws_access_key = os.getenv('AWS_ACCESS_KEY_ID')
-            self.aws_secret_key = os.getenv('AWS_SECRET_ACCESS_KEY')
-            
-            # Создаем директории
-            self.backup_dir.mkdir(parents=True, exist_ok=True)
-            (self.backup_dir / 'daily').mkdir(exist_ok=True)
-            (self.backup_dir / 'weekly').mkdir(exist_ok=True)
+        # По умолчанию ОТКЛЮЧЕНО: раньше бэкапы падали с Permission denied в /var/backups/replyx
+        # и мешали регистрации. Включается явно через BACKUP_ENABLED=true.
+        self.enabled = os.getenv('BACKUP_ENABLED', 'false').lower() == 'true'
+        if not self.enabled:
+            logger.info("🚫 Система автоматических бэкапов ОТКЛЮЧЕНА")
+            return
+
+        # Конфигурация из переменных окружения
+        self.db_host = os.getenv('DB_HOST', 'localhost')
+        self.db_port = os.getenv('DB_PORT', '5432')
+        self.db_name = os.getenv('DB_NAME', 'chat_ai')
+        self.db_user = os.getenv('DB_USER', 'dan')
+        self.db_password = os.getenv('DB_PASSWORD', '')
+
+        # Настройки бэкапов
+        self.backup_dir = Path(os.getenv('BACKUP_DIR', './data/backups'))
+        self.max_local_backups = int(os.getenv('MAX_LOCAL_BACKUPS', '7'))  # 7 дней
+        self.max_weekly_backups = int(os.getenv('MAX_WEEKLY_BACKUPS', '4'))  # 4 недели
+        self.max_monthly_backups = int(os.getenv('MAX_MONTHLY_BACKUPS', '12'))  # 12 месяцев
+
+        # Формат и параллелизм
+        self.format = os.getenv('BACKUP_FORMAT', 'custom').lower()
+        if self.format not in BACKUP_FORMATS:
+            logger.warning(f"Неизвестный BACKUP_FORMAT={self.format}, используется custom")
+            self.format = 'custom'
+        self.jobs = int(os.getenv('BACKUP_JOBS', str(min(4, os.cpu_count() or 1))))
+        self.zstd_level = int(os.getenv('BACKUP_ZSTD_LEVEL', '3'))
+        self.zstd_threads = int(os.getenv('BACKUP_ZSTD_THREADS', '0'))  # 0 - все ядра
+        # Сжатие pg_dump в формате directory: '6' (gzip) или 'zstd' (PostgreSQL 16+)
+        self.directory_compression = os.getenv('BACKUP_DIRECTORY_COMPRESSION', '6')
+        self.timeout = int(os.getenv('BACKUP_TIMEOUT_SECONDS', '3600'))
+
+        # S3 конфигурация (опционально) - через общий S3StorageService
+        self.s3_enabled = os.getenv('S3_BACKUP_ENABLED', 'false').lower() == 'true'
+        self.s3_bucket = os.getenv('S3_BACKUP_BUCKET')
+        self.s3_storage_class = os.getenv('S3_BACKUP_STORAGE_CLASS', 'STANDARD_IA')  # Дешевое хранение
+        self.s3_part_size = int(os.getenv('S3_BACKUP_PART_SIZE_MB', '64')) * 1024 * 1024
+
+        # Создаем директории
+        self.backup_dir.mkdir(parents=True, exist_ok=True)
+        (self.backup_dir / 'daily').mkdir(exist_ok=True)
+        (self.backup_dir / 'weekly').mkdir(exist_ok=True)
         (self.backup_dir / 'monthly').mkdir(exist_ok=True)
-        
-        # S3 клиент
-        self.s3_client = None
-        if self.s3_enabled and self.s3_bucket:
-            try:
-                self.s3_client = boto3.client(
-                    's3',
-                    region_name=self.s3_region,
-                    aws_access_key_id=self.aws_access_key,
-                    aws_secret_access_key=self.aws_secret_key
-                )
+
+        # S3 сервис
+        self.s3_service = None
+        if self.s3_enabled:
+            from services.s3_storage_service import get_s3_service
+            self.s3_service = get_s3_service()
+            if self.s3_service:
+                self.s3_bucket = self.s3_bucket or self.s3_service.bucket_name
                 logger.info(f"S3 бэкапы включены: {self.s3_bucket}")
-            except Exception as e:
-                logger.error(f"Ошибка инициализации S3: {e}")
+            else:
+                logger.error("Ошибка инициализации S3: бэкапы будут сохраняться локально")
                 self.s3_enabled = False
-    
+
+    # === Вспомогательное ===
+
+    def _pg_env(self) -> Dict[str, str]:
+        env = os.environ.copy()
+        if self.db_password:
+            env['PGPASSWORD'] = self.db_password
+        return env
+
+    def _connection_args(self, dbname: Optional[str] = None) -> List[str]:
+        return [
+            '--host', self.db_host,
+            '--port', self.db_port,
+            '--username', self.db_user,
+            '--dbname', dbname or self.db_name,
+            '--no-password',  # Используем .pgpass или переменные окружения
+        ]
+
+    def _zstd_cmd(self, decompress: bool = False) -> List[str]:
+        if decompress:
+            return ['zstd', '-d', '-q', '-c']
+        return ['zstd', f'-{self.zstd_level}', f'-T{self.zstd_threads}', '-q', '-c']
+
+    def _s3_key(self, backup_type: str, filename: str) -> str:
+        return f"chatai-backups/{backup_type}/{filename}"
+
+    def _store(self, stream: BinaryIO, backup_type: str, filename: str,
+               verify: Callable[[], None]) -> Dict:
+        """
+        Записать поток архива в S3 (multipart) или в локальный файл
+
+        verify вызывается, когда поток прочитан до конца, но архив еще не
+        зафиксирован: если он бросает исключение, multipart upload отменяется,
+        а незаконченный локальный файл удаляется.
+        """
+        if self.s3_enabled:
+            extra_args = {'ServerSideEncryption': 'AES256'}
+            if self.s3_storage_class:
+                extra_args['StorageClass'] = self.s3_storage_class
+            object_key = self._s3_key(backup_type, filename)
+            result = self.s3_service.upload_stream(
+                stream,
+                object_key,
+                part_size=self.s3_part_size,
+                bucket_name=self.s3_bucket,
+                extra_args=extra_args,
+                before_complete=verify
+            )
+            if not result.get('success'):
+                raise RuntimeError(f"Ошибка загрузки в S3: {result.get('error')}")
+            logger.info(f"Бэкап загружен в S3: s3://{self.s3_bucket}/{object_key}")
+            return {'location': 's3', 'object_key': object_key, 'path': None, 'size': result['size']}
+
+        path = self.backup_dir / backup_type / filename
+        partial_path = path.with_name(f"{filename}.partial")
+        try:
+            with open(partial_path, 'wb') as f_out:
+                shutil.copyfileobj(stream, f_out, PIPE_CHUNK_SIZE)
+            verify()
+            os.replace(partial_path, path)
+        except BaseException:
+            partial_path.unlink(missing_ok=True)
+            raise
+        return {'location': 'local', 'object_key': None, 'path': str(path), 'size': path.stat().st_size}
+
+    @staticmethod
+    def _pump(source: BinaryIO, target: BinaryIO, counter: Dict[str, int]):
+        """Перекачка pipe → pipe с подсчетом байт (размер несжатого дампа)"""
+        try:
+            while True:
+                chunk = source.read(PIPE_CHUNK_SIZE)
+                if not chunk:
+                    break
+                target.write(chunk)
+                counter['bytes'] += len(chunk)
+        except (BrokenPipeError, ValueError):
+            pass  # Приемник завершился - ошибку покажет его код возврата
+        finally:
+            try:
+                target.close()
+            except BrokenPipeError:
+                pass
+
+    def _run_pipeline(self, commands: List[List[str]], backup_type: str, filename: str,
+                      count_first_stage: bool = False) -> Dict:
+        """
+        Запуск конвейера процессов, последний stdout которого уходит в хранилище
+
+        Returns:
+            Информация о сохраненном архиве + 'size_original' (байты первого процесса,
+            если count_first_stage)
+        """
+        env = self._pg_env()
+        processes = []
+        stderr_files = []
+        pump_thread = None
+        counter = {'bytes': 0}
+
+        def wait_all():
+            deadline = time.monotonic() + self.timeout
+            for process in processes:
+                try:
+                    process.wait(timeout=max(1, deadline - time.monotonic()))
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                    process.wait()
+            if pump_thread:
+                pump_thread.join()
+
+        def check_exit_codes():
+            """Проверка кодов возврата до фиксации архива: дамп с ошибкой не должен стать бэкапом"""
+            wait_all()
+            errors = []
+            for cmd, process, stderr_file in zip(commands, processes, stderr_files):
+                if process.returncode != 0:
+                    stderr_file.seek(0)
+                    stderr = stderr_file.read().decode(errors='replace').strip()
+                    errors.append(f"{cmd[0]} (код {process.returncode}): {stderr}")
+            if errors:
+                raise RuntimeError("; ".join(errors))
+
+        try:
+            previous_stdout = None
+            for index, cmd in enumerate(commands):
+                stderr_file = tempfile.TemporaryFile()
+                stderr_files.append(stderr_file)
+                stdin = previous_stdout
+                if count_first_stage and index == 1:
+                    stdin = subprocess.PIPE
+                process = subprocess.Popen(
+                    cmd, stdin=stdin, stdout=subprocess.PIPE, stderr=stderr_file, env=env
+                )
+                if count_first_stage and index == 1:
+                    pump_thread = threading.Thread(
+                        target=self._pump, args=(processes[0].stdout, process.stdin, counter), daemon=True
+                    )
+                    pump_thread.start()
+                elif previous_stdout is not None:
+                    previous_stdout.close()  # Чтобы SIGPIPE дошел до предыдущего процесса
+                processes.append(process)
+                previous_stdout = process.stdout
+
+            stored = self._store(processes[-1].stdout, backup_type, filename, check_exit_codes)
+        except BaseException:
+            for process in processes:
+                process.kill()
+            raise
+        finally:
+            wait_all()
+            for stderr_file in stderr_files:
+                stderr_file.close()
+
+        stored['size_original'] = counter['bytes'] if count_first_stage else None
+        return stored
+
+    # === Создание бэкапа ===
+
     def create_backup(self, backup_type: str = 'daily') -> Optional[Dict]:
         """Создание бэкапа БД"""
         if not self.enabled:
             logger.info("🚫 Создание бэкапа пропущено - система бэкапов отключена")
             return None
-            
+
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        filename = f"chatai_backup_{backup_type}_{timestamp}{ARCHIVE_SUFFIXES[self.format]}"
+        logger.info(f"Создание {backup_type} бэкапа ({self.format}): {filename}")
+
+        started = time.monotonic()
         try:
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            backup_filename = f"chatai_backup_{backup_type}_{timestamp}.sql"
-            backup_path = self.backup_dir / backup_type / backup_filename
-            
-            logger.info(f"Создание {backup_type} бэкапа: {backup_filename}")
-            
-            # Формируем команду pg_dump
-            cmd = [
-                'pg_dump',
-                '--host', self.db_host,
-                '--port', self.db_port,
-                '--username', self.db_user,
-                '--dbname', self.db_name,
-                '--no-password',  # Используем .pgpass или переменные окружения
-                '--verbose',
-                '--clean',        # Добавляем DROP команды
-                '--if-exists',    # IF EXISTS для DROP
-                '--create',       # Создание БД
-                '--format=plain', # SQL формат
-                '--file', str(backup_path)
-            ]
-            
-            # Устанавливаем переменную окружения для пароля
-            env = os.environ.copy()
-            if self.db_password:
-                env['PGPASSWORD'] = self.db_password
-            
-            # Выполняем бэкап
-            result = subprocess.run(
-                cmd,
-                env=env,
-                capture_output=True,
-                text=True,
-                timeout=3600  # 1 час максимум
-            )
-            
-            if result.returncode != 0:
-                logger.error(f"Ошибка создания бэкапа: {result.stderr}")
-                return None
-            
-            # Получаем размер файла
-            backup_size = backup_path.stat().st_size
-            
-            # Сжимаем бэкап
-            compressed_path = backup_path.with_suffix('.sql.gz')
-            with open(backup_path, 'rb') as f_in:
-                with gzip.open(compressed_path, 'wb') as f_out:
-                    shutil.copyfileobj(f_in, f_out)
-            
-            # Удаляем несжатый файл
-            backup_path.unlink()
-            
-            compressed_size = compressed_path.stat().st_size
-            compression_ratio = (1 - compressed_size / backup_size) * 100
-            
-            backup_info = {
-                'timestamp': timestamp,
-                'type': backup_type,
-                'filename': compressed_path.name,
-                'path': str(compressed_path),
-                'size_original': backup_size,
-                'size_compressed': compressed_size,
-                'compression_ratio': round(compression_ratio, 2),
-                'created_at': datetime.now().isoformat()
-            }
-            
-            logger.info(f"Бэкап создан: {compressed_path.name} "
-                       f"({self._format_size(compressed_size)}, "
-                       f"сжатие {compression_ratio:.1f}%)")
-            
-            # Загружаем в S3 если включено
-            if self.s3_enabled:
-                self._upload_to_s3(compressed_path, backup_type)
-            
-            # Сохраняем метаданные
-            self._save_backup_metadata(backup_info)
-            
-            # Очищаем старые бэкапы
-            self._cleanup_old_backups(backup_type)
-            
-            return backup_info
-            
+            if self.format == 'custom':
+                stored = self._backup_custom(backup_type, filename)
+            elif self.format == 'directory':
+                stored = self._backup_directory(backup_type, filename)
+            else:
+                stored = self._backup_plain(backup_type, filename)
         except subprocess.TimeoutExpired:
-            logger.error("Таймаут создания бэкапа (> 1 часа)")
+            logger.error(f"Таймаут создания бэкапа (> {self.timeout} с)")
             return None
         except Exception as e:
             logger.error(f"Ошибка создания бэкапа: {e}")
             return None
-    
-    def restore_backup(self, backup_path: str) -> bool:
-        """Восстановление из бэкапа"""
-        try:
-            backup_file = Path(backup_path)
-            if not backup_file.exists():
-                logger.error(f"Файл бэкапа не найден: {backup_path}")
-                return False
-            
-            logger.warning(f"ВОССТАНОВЛЕНИЕ БД из {backup_file.name}")
-            logger.warning("Это действие УДАЛИТ все текущие данные!")
-            
-            # Временный файл для распаковки
-            if backup_file.suffix == '.gz':
-                temp_sql = backup_file.with_suffix('')
-                with gzip.open(backup_file, 'rb') as f_in:
-                    with open(temp_sql, 'wb') as f_out:
-                        shutil.copyfileobj(f_in, f_out)
-                sql_file = temp_sql
-            else:
-                sql_file = backup_file
-            
-            # Команда восстановления
-            cmd = [
-                'psql',
-                '--host', self.db_host,
-                '--port', self.db_port,
-                '--username', self.db_user,
-                '--dbname', 'postgres',  # Подключаемся к postgres для создания БД
-                '--file', str(sql_file)
+
+        duration = time.monotonic() - started
+        compressed_size = stored['size']
+        original_size = stored.get('size_original')
+        # Скорость считаем по исходному объему, если он известен
+        throughput = (original_size or compressed_size) / duration if duration > 0 else 0
+        compression_ratio = (1 - compressed_size / original_size) * 100 if original_size else None
+
+        if METRICS_ENABLED:
+            BACKUP_DURATION.labels(operation='backup', format=self.format).observe(duration)
+            BACKUP_BYTES.labels(stage='stored').inc(compressed_size)
+            if original_size:
+                BACKUP_BYTES.labels(stage='dumped').inc(original_size)
+            BACKUP_THROUGHPUT.labels(operation='backup').set(throughput)
+            BACKUP_LAST_SUCCESS.set(time.time())
+
+        backup_info = {
+            'timestamp': timestamp,
+            'type': backup_type,
+            'format': self.format,
+            'filename': filename,
+            'location': stored['location'],
+            'path': stored['path'],
+            'object_key': stored['object_key'],
+            'size_original': original_size,
+            'size_compressed': compressed_size,
+            'compression_ratio': round(compression_ratio, 2) if compression_ratio is not None else None,
+            'duration_seconds': round(duration, 2),
+            'throughput_bytes_per_second': int(throughput),
+            'created_at': datetime.now().isoformat()
+        }
+
+        logger.info(f"Бэкап создан: {filename} "
+                   f"({self._format_size(compressed_size)} за {duration:.1f} с, "
+                   f"{self._format_size(int(throughput))}/с)")
+
+        # Сохраняем метаданные
+        self._save_backup_metadata(backup_info)
+
+        # Очищаем старые бэкапы
+        self._cleanup_old_backups(backup_type)
+
+        return backup_info
+
+    def _backup_custom(self, backup_type: str, filename: str) -> Dict:
+        """pg_dump custom без собственного сжатия → zstd во все ядра → хранилище"""
+        dump_cmd = ['pg_dump', *self._connection_args(), '--format=custom', '--compress=0']
+        return self._run_pipeline([dump_cmd, self._zstd_cmd()], backup_type, filename, count_first_stage=True)
+
+    def _backup_directory(self, backup_type: str, filename: str) -> Dict:
+        """pg_dump directory в N потоков (уже сжатые файлы таблиц) → tar → хранилище"""
+        with tempfile.TemporaryDirectory(dir=self.backup_dir, prefix='dump_') as work_dir:
+            dump_dir = Path(work_dir) / 'dump'
+            dump_cmd = [
+                'pg_dump', *self._connection_args(),
+                '--format=directory',
+                '--jobs', str(self.jobs),
+                '--compress', self.directory_compression,
+                '--file', str(dump_dir)
             ]
-            
-            env = os.environ.copy()
-            if self.db_password:
-                env['PGPASSWORD'] = self.db_password
-            
-            result = subprocess.run(
-                cmd,
-                env=env,
-                capture_output=True,
-                text=True,
-                timeout=3600
-            )
-            
-            # Удаляем временный файл
-            if backup_file.suffix == '.gz' and temp_sql.exists():
-                temp_sql.unlink()
-            
+            result = subprocess.run(dump_cmd, env=self._pg_env(), capture_output=True, text=True,
+                                    timeout=self.timeout)
             if result.returncode != 0:
-                logger.error(f"Ошибка восстановления: {result.stderr}")
-                return False
-            
-            logger.info(f"БД успешно восстановлена из {backup_file.name}")
-            return True
-            
-        except Exception as e:
-            logger.error(f"Ошибка восстановления БД: {e}")
+                raise RuntimeError(f"pg_dump: {result.stderr}")
+
+            size_original = sum(f.stat().st_size for f in dump_dir.iterdir())
+            stored = self._run_pipeline([['tar', '-C', str(dump_dir), '-cf', '-', '.']], backup_type, filename)
+            # В directory формате данные сжаты pg_dump, "исходный" объем - размер каталога
+            stored['size_original'] = size_original
+            return stored
+
+    def _backup_plain(self, backup_type: str, filename: str) -> Dict:
+        """Прежний формат: SQL-дамп, сжатый gzip, тоже потоком"""
+        dump_cmd = [
+            'pg_dump', *self._connection_args(),
+            '--clean',        # Добавляем DROP команды
+            '--if-exists',    # IF EXISTS для DROP
+            '--create',       # Создание БД
+            '--format=plain', # SQL формат
+        ]
+        return self._run_pipeline([dump_cmd, ['gzip', '-c']], backup_type, filename, count_first_stage=True)
+
+    # === Восстановление ===
+
+    def restore_backup(self, backup_path: str) -> bool:
+        """Восстановление из локального архива"""
+        backup_file = Path(backup_path)
+        if not backup_file.exists():
+            logger.error(f"Файл бэкапа не найден: {backup_path}")
             return False
-    
-    def _upload_to_s3(self, backup_path: Path, backup_type: str):
-        """Загрузка бэкапа в S3"""
+
+        with open(backup_file, 'rb') as source:
+            return self._restore_stream(backup_file.name, lambda target: shutil.copyfileobj(source, target,
+                                                                                           PIPE_CHUNK_SIZE))
+
+    def restore_from_s3(self, object_key: str) -> bool:
+        """Восстановление из S3: архив распаковывается потоком, без скачивания целиком"""
+        if not self.s3_service:
+            logger.error("S3 для бэкапов не настроен")
+            return False
+
+        def feed(target):
+            if self.s3_service.download_stream(object_key, target, bucket_name=self.s3_bucket) is None:
+                raise RuntimeError(f"Не удалось скачать s3://{self.s3_bucket}/{object_key}")
+
+        return self._restore_stream(Path(object_key).name, feed)
+
+    def _restore_stream(self, name: str, feed) -> bool:
+        """
+        Распаковать архив в рабочий каталог и восстановить БД
+
+        feed(target) записывает байты архива в stdin распаковщика.
+        """
+        logger.warning(f"ВОССТАНОВЛЕНИЕ БД из {name}")
+        logger.warning("Это действие УДАЛИТ все текущие данные!")
+
+        started = time.monotonic()
         try:
-            if not self.s3_client:
-                return
-            
-            s3_key = f"chatai-backups/{backup_type}/{backup_path.name}"
-            
-            self.s3_client.upload_file(
-                str(backup_path),
-                self.s3_bucket,
-                s3_key,
-                ExtraArgs={
-                    'StorageClass': 'STANDARD_IA',  # Дешевое хранение
-                    'ServerSideEncryption': 'AES256'
-                }
-            )
-            
-            logger.info(f"Бэкап загружен в S3: s3://{self.s3_bucket}/{s3_key}")
-            
+            (self.backup_dir / 'restore').mkdir(parents=True, exist_ok=True)
+            with tempfile.TemporaryDirectory(dir=self.backup_dir / 'restore') as work_dir:
+                work_dir = Path(work_dir)
+                output = None
+                if name.endswith(ARCHIVE_SUFFIXES['custom']):
+                    backup_format = 'custom'
+                    target = work_dir / 'backup.dump'
+                    unpack_cmd, output = self._zstd_cmd(decompress=True), target
+                elif name.endswith(ARCHIVE_SUFFIXES['directory']):
+                    backup_format = 'directory'
+                    target = work_dir / 'dump'
+                    target.mkdir()
+                    unpack_cmd = ['tar', '-C', str(target), '-xf', '-']
+                elif name.endswith(ARCHIVE_SUFFIXES['plain']):
+                    backup_format = 'plain'
+                    target = work_dir / 'backup.sql'
+                    unpack_cmd, output = ['gzip', '-d', '-c'], target
+                else:
+                    logger.error(f"Неизвестный формат бэкапа: {name}")
+                    return False
+
+                with open(output, 'wb') if output else open(os.devnull, 'wb') as unpack_out:
+                    unpack = subprocess.Popen(unpack_cmd, stdin=subprocess.PIPE, stdout=unpack_out,
+                                              stderr=subprocess.PIPE)
+                    try:
+                        feed(unpack.stdin)
+                    except BaseException:
+                        unpack.kill()
+                        unpack.communicate()
+                        raise
+                    # communicate закрывает stdin и дожидается распаковщика
+                    _, unpack_err = unpack.communicate(timeout=self.timeout)
+                if unpack.returncode != 0:
+                    raise RuntimeError(f"{unpack_cmd[0]}: {unpack_err.decode(errors='replace')}")
+
+                restored_bytes = (
+                    sum(f.stat().st_size for f in target.iterdir()) if target.is_dir() else target.stat().st_size
+                )
+                self._run_restore(backup_format, target)
         except Exception as e:
-            logger.error(f"Ошибка загрузки в S3: {e}")
-    
+            logger.error(f"Ошибка восстановления БД: {e}")
+            return False
+
+        duration = time.monotonic() - started
+        if METRICS_ENABLED:
+            BACKUP_DURATION.labels(operation='restore', format=backup_format).observe(duration)
+            if duration > 0:
+                BACKUP_THROUGHPUT.labels(operation='restore').set(restored_bytes / duration)
+
+        logger.info(f"БД успешно восстановлена из {name} за {duration:.1f} с")
+        return True
+
+    def _run_restore(self, backup_format: str, target: Path):
+        if backup_format == 'plain':
+            cmd = [
+                'psql',
+                *self._connection_args('postgres'),  # Подключаемся к postgres для создания БД
+                '--file', str(target)
+            ]
+        else:
+            # Для custom pg_restore -j работает и без смещений в TOC (дамп писался в pipe):
+            # начиная с PostgreSQL 12 он находит блоки сканированием файла
+            cmd = [
+                'pg_restore',
+                *self._connection_args(),
+                '--jobs', str(self.jobs),
+                '--clean',
+                '--if-exists',
+                '--no-owner',
+                str(target)
+            ]
+
+        result = subprocess.run(cmd, env=self._pg_env(), capture_output=True, text=True, timeout=self.timeout)
+        if result.returncode != 0:
+            raise RuntimeError(f"{cmd[0]}: {result.stderr}")
+
+    # === Метаданные и ротация ===
+
     def _save_backup_metadata(self, backup_info: Dict):
         """Сохранение метаданных бэкапа"""
         try:
             metadata_file = self.backup_dir / 'backup_metadata.json'
-            
+
             # Загружаем существующие метаданные
             if metadata_file.exists():
                 with open(metadata_file, 'r') as f:
                     metadata = json.load(f)
             else:
                 metadata = {'backups': []}
-            
+
             # Добавляем новый бэкап
             metadata['backups'].append(backup_info)
-            
+
             # Ограничиваем количество записей (последние 100)
             metadata['backups'] = metadata['backups'][-100:]
-            
+
             # Сохраняем
             with open(metadata_file, 'w') as f:
                 json.dump(metadata, f, indent=2)
-                
+
         except Exception as e:
             logger.error(f"Ошибка сохранения метаданных: {e}")
-    
+
+    def _retention_limit(self, backup_type: str) -> int:
+        if backup_type == 'daily':
+            return self.max_local_backups
+        elif backup_type == 'weekly':
+            return self.max_weekly_backups
+        elif backup_type == 'monthly':
+            return self.max_monthly_backups
+        return 10
+
     def _cleanup_old_backups(self, backup_type: str):
         """Очистка старых бэкапов"""
+        limit = self._retention_limit(backup_type)
         try:
             backup_folder = self.backup_dir / backup_type
-            
+
             # Получаем список файлов бэкапов
-            backup_files = list(backup_folder.glob('*.sql.gz'))
+            backup_files = [
+                f for suffix in ARCHIVE_SUFFIXES.values() for f in backup_folder.glob(f'*{suffix}')
+            ]
             backup_files.sort(key=lambda x: x.stat().st_mtime, reverse=True)
-            
-            # Определяем лимит
-            if backup_type == 'daily':
-                limit = self.max_local_backups
-            elif backup_type == 'weekly':
-                limit = self.max_weekly_backups
-            elif backup_type == 'monthly':
-                limit = self.max_monthly_backups
-            else:
-                limit = 10
-            
+
             # Удаляем старые файлы
             for old_backup in backup_files[limit:]:
                 logger.info(f"Удаление старого {backup_type} бэкапа: {old_backup.name}")
                 old_backup.unlink()
-                
+
         except Exception as e:
             logger.error(f"Ошибка очистки старых бэкапов: {e}")
-    
+
+        if self.s3_enabled:
+            self._cleanup_old_s3_backups(backup_type, limit)
+
+    def _cleanup_old_s3_backups(self, backup_type: str, limit: int):
+        try:
+            client = self.s3_service.s3_client
+            paginator = client.get_paginator('list_objects_v2')
+            objects = []
+            for page in paginator.paginate(Bucket=self.s3_bucket, Prefix=self._s3_key(backup_type, '')):
+                objects.extend(page.get('Contents', []))
+            objects.sort(key=lambda obj: obj['LastModified'], reverse=True)
+
+            for old_object in objects[limit:]:
+                logger.info(f"Удаление старого {backup_type} бэкапа из S3: {old_object['Key']}")
+                client.delete_object(Bucket=self.s3_bucket, Key=old_object['Key'])
+
+        except Exception as e:
+            logger.error(f"Ошибка очистки старых бэкапов в S3: {e}")
+
     def get_backup_list(self) -> List[Dict]:
         """Получение списка доступных бэкапов"""
+        if not self.enabled:
+            return []
+
         try:
             metadata_file = self.backup_dir / 'backup_metadata.json'
-            
+
             if not metadata_file.exists():
                 return []
-            
+
             with open(metadata_file, 'r') as f:
                 metadata = json.load(f)
-            
-            # Проверяем существование файлов
+
+            # Проверяем существование файлов (бэкапы в S3 удаляет только ротация)
             valid_backups = []
             for backup in metadata.get('backups', []):
-                backup_path = Path(backup['path'])
-                if backup_path.exists():
+                if backup.get('location') == 's3' or (backup.get('path') and Path(backup['path']).exists()):
                     backup['exists'] = True
                     backup['size_formatted'] = self._format_size(backup['size_compressed'])
                     valid_backups.append(backup)
                 else:
                     backup['exists'] = False
-            
+
             return sorted(valid_backups, key=lambda x: x['created_at'], reverse=True)
-            
+
         except Exception as e:
             logger.error(f"Ошибка получения списка бэкапов: {e}")
             return []
-    
+
     def _format_size(self, size_bytes: int) -> str:
         """Форматирование размера файла"""
         if size_bytes == 0:
             return "0 B"
-        
+
         for unit in ['B', 'KB', 'MB', 'GB']:
             if size_bytes < 1024:
                 return f"{size_bytes:.1f} {unit}"
             size_bytes /= 1024
-        
+
         return f"{size_bytes:.1f} TB"
-    
+
     def create_scheduled_backups(self):
         """Создание запланированных бэкапов (вызывается по cron)"""
         if not self.enabled:
             logger.info("🚫 Запланированные бэкапы пропущены - система бэкапов отключена")
             return True
-            
+
         now = datetime.now()
-        
+
         # Ежедневный бэкап
         daily_backup = self.create_backup('daily')
         if not daily_backup:
             logger.error("Ошибка создания ежедневного бэкапа")
             return False
-        
+
         # Еженедельный бэкап (воскресенье)
         if now.weekday() == 6:  # Воскресенье
             weekly_backup = self.create_backup('weekly')
             if not weekly_backup:
                 logger.error("Ошибка создания еженедельного бэкапа")
-        
+
         # Ежемесячный бэкап (первое число месяца)
         if now.day == 1:
             monthly_backup = self.create_backup('monthly')
             if not monthly_backup:
                 logger.error("Ошибка создания ежемесячного бэкапа")
-        
+
         return True
 
 # Глобальный экземпляр
-db_backup = DatabaseBackup()
\ No newline at end of file
+db_backup = DatabaseBackup()
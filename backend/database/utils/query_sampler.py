@@ -0,0 +1,677 @@
+"""
+📈 НЕПРЕРЫВНЫЙ СЭМПЛЕР ПРОИЗВОДИТЕЛЬНОСТИ ЗАПРОСОВ
+
+DatabaseMonitor.get_query_performance показывает pg_stat_statements только в
+момент вызова - накопленные с рестарта PostgreSQL итоги, по которым не видно,
+что стало медленнее и какой эндпоинт это вызвал. Здесь:
+
+- раз в DB_QUERY_SAMPLE_INTERVAL секунд снимаются дельты pg_stat_statements
+  (calls / время / rows по queryid) и кладутся в кольцевой буфер в Redis
+  (db:qperf:samples, последние DB_QUERY_SAMPLES_KEEP снимков, top-N запросов
+  в каждом). Снимает один воркер - лидер по Redis-локу;
+- каждый SQL-запрос приписывается маршруту FastAPI: QueryTrackingMiddleware
+  кладет контекст запроса в ContextVar, хуки before/after_cursor_execute
+  считают запросы и время БД и дописывают в текст /* route='GET /api/...' */
+  (видно в pg_stat_activity и логах медленных запросов);
+- N+1: один и тот же statement больше DB_N_PLUS_ONE_THRESHOLD раз за запрос;
+- на каждый запрос - гистограммы числа запросов и времени БД по маршруту,
+  запись db в Server-Timing (MIDDLEWARE_SERVER_TIMING) и бюджет запросов:
+  эндпоинт объявляет @query_budget(n), при DB_QUERY_BUDGET_ENFORCE=true
+  (тесты/CI) превышение роняет запрос с QueryBudgetExceeded;
+- итоги по маршрутам и запросам копятся отдельно для каждого деплоя
+  (DEPLOY_ID / APP_VERSION / git HEAD), регрессии - сравнение среднего времени
+  с предыдущим деплоем.
+
+Без Redis все хранится в памяти процесса.
+"""
+
+import asyncio
+import logging
+import os
+import pickle
+import socket
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from core.middleware_timing import SERVER_TIMING_ENABLED
+
+logger = logging.getLogger(__name__)
+
+try:
+    from prometheus_client import Counter, Histogram
+    DB_QUERIES_PER_REQUEST = Histogram(
+        'http_request_db_queries', 'SQL queries per HTTP request', ['route'],
+        buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500)
+    )
+    DB_TIME_PER_REQUEST = Histogram(
+        'http_request_db_seconds', 'SQL time per HTTP request', ['route'],
+        buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+    )
+    DB_QUERY_BUDGET_EXCEEDED = Counter(
+        'http_request_db_query_budget_exceeded_total', 'Requests over their declared query budget', ['route']
+    )
+    METRICS_ENABLED = True
+except ImportError:
+    METRICS_ENABLED = False
+
+SAMPLE_INTERVAL_SECONDS = int(os.getenv('DB_QUERY_SAMPLE_INTERVAL', '60'))
+SAMPLES_KEEP = int(os.getenv('DB_QUERY_SAMPLES_KEEP', '1440'))  # Сутки при шаге 60 с
+SAMPLE_TOP_STATEMENTS = int(os.getenv('DB_QUERY_SAMPLE_TOP', '20'))
+N_PLUS_ONE_THRESHOLD = int(os.getenv('DB_N_PLUS_ONE_THRESHOLD', '10'))
+N_PLUS_ONE_KEEP = 200
+REGRESSION_RATIO = float(os.getenv('DB_QUERY_REGRESSION_RATIO', '1.5'))
+REGRESSION_MIN_CALLS = int(os.getenv('DB_QUERY_REGRESSION_MIN_CALLS', '50'))
+ROUTE_COMMENTS_ENABLED = os.getenv('DB_QUERY_ROUTE_COMMENTS', 'true').lower() in ('true', '1', 'yes')
+QUERY_BUDGET_ENFORCED = os.getenv('DB_QUERY_BUDGET_ENFORCE', 'false').lower() in ('true', '1', 'yes')
+# Бюджет для эндпоинтов без @query_budget (0 - не проверять)
+DEFAULT_QUERY_BUDGET = int(os.getenv('DB_QUERY_BUDGET_DEFAULT', '0'))
+DEPLOYS_KEEP = 10
+DEPLOY_TTL_SECONDS = 30 * 86400
+
+SAMPLES_KEY = "db:qperf:samples"
+TEXTS_KEY = "db:qperf:texts"
+N_PLUS_ONE_KEY = "db:qperf:n_plus_one"
+LEADER_KEY = "db:qperf:leader"
+DEPLOYS_KEY = "db:qperf:deploys"
+DEPLOY_STATEMENTS_KEY = "db:qperf:deploy:{deploy}:statements"
+DEPLOY_ROUTES_KEY = "db:qperf:deploy:{deploy}:routes"
+
+UNMATCHED_ROUTE = "unmatched"
+
+STATEMENT_STATS_SQL = """
+    SELECT
+        queryid,
+        SUM(calls) AS calls,
+        SUM(total_exec_time) AS total_ms,
+        SUM(rows) AS rows,
+        MIN(LEFT(query, 500)) AS query
+    FROM pg_stat_statements
+    WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database())
+      AND queryid IS NOT NULL
+    GROUP BY queryid
+"""
+
+
+def _detect_deploy_id() -> str:
+    """Идентификатор деплоя: из окружения или текущий коммит git"""
+    for name in ('DEPLOY_ID', 'APP_VERSION', 'GIT_COMMIT'):
+        value = os.getenv(name)
+        if value:
+            return value[:40]
+    try:
+        git_dir = Path(__file__).resolve().parents[3] / '.git'
+        head = (git_dir / 'HEAD').read_text().strip()
+        if head.startswith('ref: '):
+            head = (git_dir / head[5:]).read_text().strip()
+        return head[:12]
+    except OSError:
+        return 'unknown'
+
+
+DEPLOY_ID = _detect_deploy_id()
+
+
+def _redis():
+    from cache.redis_cache import cache
+    return cache.redis_client
+
+
+# === Контекст запроса ===
+
+class RequestQueries:
+    """SQL-запросы одного HTTP-запроса"""
+
+    __slots__ = ('scope', 'count', 'db_time', 'statements')
+
+    def __init__(self, scope: Scope):
+        self.scope = scope
+        self.count = 0
+        self.db_time = 0.0
+        # statement -> [количество, время]
+        self.statements: Dict[str, List[float]] = {}
+
+    @property
+    def route(self) -> str:
+        # scope["route"] появляется после роутинга - читаем лениво
+        path = getattr(self.scope.get('route'), 'path', None)
+        if not path:
+            return UNMATCHED_ROUTE
+        return f"{self.scope.get('method', '')} {path}"
+
+    def add(self, statement: str, elapsed: float) -> None:
+        self.count += 1
+        self.db_time += elapsed
+        entry = self.statements.get(statement)
+        if entry is None:
+            self.statements[statement] = [1, elapsed]
+        else:
+            entry[0] += 1
+            entry[1] += elapsed
+
+    def repeated_statements(self, threshold: int = N_PLUS_ONE_THRESHOLD) -> List[Tuple[str, int, float]]:
+        return [(statement, int(count), elapsed)
+                for statement, (count, elapsed) in self.statements.items() if count > threshold]
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Эндпоинт выполнил больше SQL-запросов, чем объявлено в @query_budget"""
+
+
+def query_budget(max_queries: int):
+    """
+    Объявить максимум SQL-запросов на один вызов эндпоинта
+
+    Считаются все запросы запроса, включая зависимости (get_current_user).
+    Ставится под декоратором роутера:
+
+        @router.get("/dialogs")
+        @query_budget(6)
+        def get_dialogs(...):
+    """
+    def decorator(func):
+        func.__query_budget__ = max_queries
+        return func
+    return decorator
+
+
+def _budget_for(scope: Scope) -> int:
+    return getattr(scope.get('endpoint'), '__query_budget__', DEFAULT_QUERY_BUDGET)
+
+
+_current_request: ContextVar[Optional[RequestQueries]] = ContextVar('db_request_queries', default=None)
+
+
+def current_request_queries() -> Optional[RequestQueries]:
+    return _current_request.get()
+
+
+def _route_comment(stats: RequestQueries) -> str:
+    # % ломает paramstyle psycopg2, */ - комментарий
+    route = stats.route.replace('%', '').replace('*/', '').replace("'", '')
+    return f" /* route='{route}' */"
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current_request.get()
+    if stats is None:
+        return statement, parameters
+    conn.info.setdefault('query_tracking', []).append((statement, time.perf_counter()))
+    if ROUTE_COMMENTS_ENABLED:
+        statement = statement + _route_comment(stats)
+    return statement, parameters
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current_request.get()
+    if stats is None:
+        return
+    stack = conn.info.get('query_tracking')
+    if not stack:
+        return
+    original_statement, started = stack.pop()
+    stats.add(original_statement, time.perf_counter() - started)
+
+
+def _handle_error(exception_context):
+    # Запрос упал - after_cursor_execute не будет, снимаем отметку времени
+    conn = exception_context.connection
+    if conn is not None and _current_request.get() is not None:
+        stack = conn.info.get('query_tracking')
+        if stack:
+            stack.pop()
+
+
+def install_query_tracking(engine: Engine) -> None:
+    """Подключить учет SQL-запросов по маршрутам к движку"""
+    if event.contains(engine, 'before_cursor_execute', _before_cursor_execute):
+        return
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute, retval=True)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(engine, 'handle_error', _handle_error)
+
+
+class QueryTrackingMiddleware:
+    """Контекст SQL-запросов на время HTTP-запроса"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestQueries(scope)
+        token = _current_request.set(stats)
+
+        async def send_wrapper(message: Message) -> None:
+            if message["type"] == "http.response.start" and SERVER_TIMING_ENABLED:
+                # Запросы после начала ответа (стриминг) сюда уже не попадут
+                MutableHeaders(scope=message).append(
+                    "Server-Timing", f'db;dur={stats.db_time * 1000:.3f};desc="{stats.count} queries"'
+                )
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current_request.reset(token)
+            query_sampler.record_request(stats)
+        self._check_budget(scope, stats)
+
+    @staticmethod
+    def _check_budget(scope: Scope, stats: RequestQueries) -> None:
+        budget = _budget_for(scope)
+        if not budget or stats.count <= budget:
+            return
+
+        route = stats.route
+        if METRICS_ENABLED:
+            DB_QUERY_BUDGET_EXCEEDED.labels(route=route).inc()
+        repeated = sorted(stats.statements.items(), key=lambda item: item[1][0], reverse=True)[:3]
+        details = "; ".join(f"{int(count)}x {statement[:120]}" for statement, (count, _) in repeated)
+        message = f"{route}: {stats.count} SQL-запросов при бюджете {budget} ({details})"
+        if QUERY_BUDGET_ENFORCED:
+            raise QueryBudgetExceeded(message)
+        logger.warning(f"⚠️ Превышен бюджет запросов {message}")
+
+
+# === Сэмплер ===
+
+class QueryPerformanceSampler:
+    """Дельты pg_stat_statements, итоги маршрутов и N+1 с хранением в Redis"""
+
+    def __init__(self, deploy_id: str = DEPLOY_ID):
+        self.deploy_id = deploy_id
+        self.instance_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._lock = threading.Lock()
+        # Окно маршрутов до следующего сброса: route -> [requests, queries, db_ms, n_plus_one]
+        self._route_window: Dict[str, List[float]] = {}
+        self._n_plus_one_pending: List[Tuple] = []
+        self._n_plus_one_seen: set = set()
+        self._previous: Optional[Dict[int, Tuple[int, float, int]]] = None
+        self._statements_available = True
+        # Fallback без Redis
+        self._memory_samples: deque = deque(maxlen=SAMPLES_KEEP)
+        self._memory_texts: Dict[int, str] = {}
+        self._memory_n_plus_one: deque = deque(maxlen=N_PLUS_ONE_KEEP)
+        self._memory_totals: Dict[str, Dict[str, float]] = {}
+        self._memory_deploys: List[str] = []
+
+    # --- Учет запросов ---
+
+    def record_request(self, stats: RequestQueries) -> None:
+        route = stats.route
+        if METRICS_ENABLED:
+            try:
+                DB_QUERIES_PER_REQUEST.labels(route=route).observe(stats.count)
+                DB_TIME_PER_REQUEST.labels(route=route).observe(stats.db_time)
+            except Exception:
+                pass
+        repeated = stats.repeated_statements() if stats.count > N_PLUS_ONE_THRESHOLD else []
+        with self._lock:
+            window = self._route_window.setdefault(route, [0, 0, 0.0, 0])
+            window[0] += 1
+            window[1] += stats.count
+            window[2] += stats.db_time * 1000
+            window[3] += 1 if repeated else 0
+            for statement, count, elapsed in repeated:
+                self._n_plus_one_pending.append(
+                    (int(time.time()), route, statement[:300], count, round(elapsed * 1000, 2))
+                )
+                key = (route, statement)
+                if key not in self._n_plus_one_seen:
+                    self._n_plus_one_seen.add(key)
+                    logger.warning(f"🔁 N+1 в {route}: запрос выполнен {count} раз за один HTTP-запрос: "
+                                   f"{statement[:120]}")
+
+    def flush_routes(self) -> None:
+        """Перенести окно маршрутов и события N+1 в итоги деплоя"""
+        with self._lock:
+            window, self._route_window = self._route_window, {}
+            events, self._n_plus_one_pending = self._n_plus_one_pending, []
+        if not window and not events:
+            return
+
+        increments = {}
+        for route, (requests, queries, db_ms, n_plus_one) in window.items():
+            increments[f"{route}|requests"] = requests
+            increments[f"{route}|queries"] = queries
+            increments[f"{route}|db_ms"] = db_ms
+            increments[f"{route}|n_plus_one"] = n_plus_one
+        self._add_totals(DEPLOY_ROUTES_KEY.format(deploy=self.deploy_id), increments)
+
+        if events:
+            redis_client = _redis()
+            if redis_client:
+                try:
+                    pipe = redis_client.pipeline()
+                    pipe.lpush(N_PLUS_ONE_KEY, *[pickle.dumps(item) for item in events])
+                    pipe.ltrim(N_PLUS_ONE_KEY, 0, N_PLUS_ONE_KEEP - 1)
+                    pipe.execute()
+                    return
+                except Exception as e:
+                    logger.debug(f"Не удалось сохранить события N+1: {e}")
+            self._memory_n_plus_one.extendleft(events)
+
+    # --- Снимки pg_stat_statements ---
+
+    def _fetch_statements(self) -> Dict[int, Tuple[int, float, int, str]]:
+        from database.connection import engine
+        with engine.connect() as conn:
+            rows = conn.execute(text(STATEMENT_STATS_SQL)).fetchall()
+        return {row.queryid: (int(row.calls), float(row.total_ms), int(row.rows), row.query) for row in rows}
+
+    def _is_leader(self) -> bool:
+        redis_client = _redis()
+        if not redis_client:
+            return True  # Без Redis считаем, что процесс один
+        try:
+            ttl = SAMPLE_INTERVAL_SECONDS * 2
+            if redis_client.set(LEADER_KEY, self.instance_id, nx=True, ex=ttl):
+                return True
+            leader = redis_client.get(LEADER_KEY)
+            if leader and leader.decode() == self.instance_id:
+                redis_client.expire(LEADER_KEY, ttl)
+                return True
+            return False
+        except Exception as e:
+            logger.debug(f"Не удалось проверить лидера сэмплера: {e}")
+            return False
+
+    def sample_statements(self) -> Optional[Tuple]:
+        """
+        Снять дельту pg_stat_statements с прошлого вызова
+
+        Returns:
+            Снимок (timestamp, deploy, calls, total_ms, [(queryid, calls, ms, rows), ...])
+            или None для первого вызова
+        """
+        current = self._fetch_statements()
+        previous, self._previous = self._previous, {
+            queryid: values[:3] for queryid, values in current.items()
+        }
+        if previous is None:
+            return None
+
+        deltas = []
+        texts = {}
+        for queryid, (calls, total_ms, rows, query) in current.items():
+            prev_calls, prev_ms, prev_rows = previous.get(queryid, (0, 0.0, 0))
+            if calls < prev_calls:
+                prev_calls, prev_ms, prev_rows = 0, 0.0, 0  # pg_stat_statements_reset()
+            delta_calls = calls - prev_calls
+            if delta_calls <= 0:
+                continue
+            deltas.append((queryid, delta_calls, round(total_ms - prev_ms, 3), rows - prev_rows))
+            texts[queryid] = query
+
+        deltas.sort(key=lambda item: item[2], reverse=True)
+        top = deltas[:SAMPLE_TOP_STATEMENTS]
+        sample = (
+            int(time.time()),
+            self.deploy_id,
+            sum(item[1] for item in deltas),
+            round(sum(item[2] for item in deltas), 3),
+            top,
+        )
+
+        self._store_sample(sample, {queryid: texts[queryid] for queryid, *_ in top})
+        increments = {}
+        for queryid, calls, ms, _ in deltas:
+            increments[f"{queryid}|calls"] = calls
+            increments[f"{queryid}|ms"] = ms
+        self._add_totals(DEPLOY_STATEMENTS_KEY.format(deploy=self.deploy_id), increments)
+        return sample
+
+    def sample_once(self) -> None:
+        self.flush_routes()
+        if not self._statements_available or not self._is_leader():
+            return
+        try:
+            self.sample_statements()
+        except Exception as e:
+            # pg_stat_statements не установлен или нет прав - учет маршрутов продолжает работать
+            self._statements_available = False
+            logger.warning(f"⚠️ pg_stat_statements недоступен, сэмплер снимает только маршруты: {e}")
+
+    async def run(self) -> None:
+        """Фоновый цикл (запускается в lifespan)"""
+        self.register_deploy()
+        logger.info(f"📈 Сэмплер запросов запущен: деплой {self.deploy_id}, шаг {SAMPLE_INTERVAL_SECONDS} с")
+        try:
+            while True:
+                await asyncio.sleep(SAMPLE_INTERVAL_SECONDS)
+                try:
+                    await asyncio.to_thread(self.sample_once)
+                except Exception as e:
+                    logger.error(f"❌ Ошибка сэмплера запросов: {e}")
+        finally:
+            # Итоги маршрутов последнего окна не теряем
+            await asyncio.to_thread(self.flush_routes)
+
+    # --- Хранилище ---
+
+    def register_deploy(self) -> None:
+        redis_client = _redis()
+        if redis_client:
+            try:
+                latest = redis_client.lindex(DEPLOYS_KEY, 0)
+                if not latest or latest.decode() != self.deploy_id:
+                    pipe = redis_client.pipeline()
+                    pipe.lrem(DEPLOYS_KEY, 0, self.deploy_id)
+                    pipe.lpush(DEPLOYS_KEY, self.deploy_id)
+                    pipe.ltrim(DEPLOYS_KEY, 0, DEPLOYS_KEEP - 1)
+                    pipe.execute()
+                return
+            except Exception as e:
+                logger.debug(f"Не удалось зарегистрировать деплой: {e}")
+        if self.deploy_id in self._memory_deploys:
+            self._memory_deploys.remove(self.deploy_id)
+        self._memory_deploys.insert(0, self.deploy_id)
+
+    def _deploys(self) -> List[str]:
+        redis_client = _redis()
+        if redis_client:
+            try:
+                return [item.decode() for item in redis_client.lrange(DEPLOYS_KEY, 0, DEPLOYS_KEEP - 1)]
+            except Exception as e:
+                logger.debug(f"Не удалось прочитать список деплоев: {e}")
+        return list(self._memory_deploys)
+
+    def _store_sample(self, sample: Tuple, texts: Dict[int, str]) -> None:
+        redis_client = _redis()
+        if redis_client:
+            try:
+                pipe = redis_client.pipeline()
+                pipe.lpush(SAMPLES_KEY, pickle.dumps(sample))
+                pipe.ltrim(SAMPLES_KEY, 0, SAMPLES_KEEP - 1)
+                if texts:
+                    pipe.hset(TEXTS_KEY, mapping={str(queryid): query for queryid, query in texts.items()})
+                    pipe.expire(TEXTS_KEY, DEPLOY_TTL_SECONDS)
+                pipe.execute()
+                return
+            except Exception as e:
+                logger.debug(f"Не удалось сохранить снимок запросов: {e}")
+        self._memory_samples.appendleft(sample)
+        self._memory_texts.update(texts)
+
+    def _add_totals(self, key: str, increments: Dict[str, float]) -> None:
+        if not increments:
+            return
+        redis_client = _redis()
+        if redis_client:
+            try:
+                pipe = redis_client.pipeline()
+                for field, value in increments.items():
+                    pipe.hincrbyfloat(key, field, value)
+                pipe.expire(key, DEPLOY_TTL_SECONDS)
+                pipe.execute()
+                return
+            except Exception as e:
+                logger.debug(f"Не удалось обновить итоги {key}: {e}")
+        totals = self._memory_totals.setdefault(key, {})
+        for field, value in increments.items():
+            totals[field] = totals.get(field, 0) + value
+
+    def _read_totals(self, key: str) -> Dict[str, Dict[str, float]]:
+        """Итоги деплоя: {объект: {метрика: значение}}"""
+        raw = None
+        redis_client = _redis()
+        if redis_client:
+            try:
+                raw = {field.decode(): float(value) for field, value in redis_client.hgetall(key).items()}
+            except Exception as e:
+                logger.debug(f"Не удалось прочитать итоги {key}: {e}")
+        if raw is None:
+            raw = self._memory_totals.get(key, {})
+
+        result: Dict[str, Dict[str, float]] = {}
+        for field, value in raw.items():
+            name, _, metric = field.rpartition('|')
+            result.setdefault(name, {})[metric] = value
+        return result
+
+    def _read_samples(self, limit: int) -> Tuple[List[Tuple], Dict[int, str]]:
+        redis_client = _redis()
+        if redis_client:
+            try:
+                samples = [pickle.loads(item) for item in redis_client.lrange(SAMPLES_KEY, 0, limit - 1)]
+                queryids = {queryid for sample in samples for queryid, *_ in sample[4]}
+                texts = {}
+                if queryids:
+                    ordered = list(queryids)
+                    for queryid, query in zip(ordered, redis_client.hmget(TEXTS_KEY, [str(q) for q in ordered])):
+                        if query:
+                            texts[queryid] = query.decode(errors='replace')
+                return samples, texts
+            except Exception as e:
+                logger.debug(f"Не удалось прочитать снимки запросов: {e}")
+        return list(self._memory_samples)[:limit], dict(self._memory_texts)
+
+    def _read_n_plus_one(self, limit: int) -> List[Tuple]:
+        redis_client = _redis()
+        if redis_client:
+            try:
+                return [pickle.loads(item) for item in redis_client.lrange(N_PLUS_ONE_KEY, 0, limit - 1)]
+            except Exception as e:
+                logger.debug(f"Не удалось прочитать события N+1: {e}")
+        return list(self._memory_n_plus_one)[:limit]
+
+    # --- Отчет ---
+
+    @staticmethod
+    def _route_rows(totals: Dict[str, Dict[str, float]]) -> List[Dict[str, Any]]:
+        rows = []
+        for route, values in totals.items():
+            requests = values.get('requests', 0)
+            if not requests:
+                continue
+            rows.append({
+                'route': route,
+                'requests': int(requests),
+                'total_db_ms': round(values.get('db_ms', 0), 2),
+                'db_ms_per_request': round(values.get('db_ms', 0) / requests, 3),
+                'queries_per_request': round(values.get('queries', 0) / requests, 2),
+                'n_plus_one_requests': int(values.get('n_plus_one', 0)),
+            })
+        return rows
+
+    @staticmethod
+    def _find_regressions(current: Dict[str, Dict[str, float]], previous: Dict[str, Dict[str, float]],
+                          count_metric: str, time_metric: str) -> List[Dict[str, Any]]:
+        regressions = []
+        for name, values in current.items():
+            before = previous.get(name)
+            if not before:
+                continue
+            calls_now, calls_before = values.get(count_metric, 0), before.get(count_metric, 0)
+            if calls_now < REGRESSION_MIN_CALLS or calls_before < REGRESSION_MIN_CALLS:
+                continue
+            mean_now = values.get(time_metric, 0) / calls_now
+            mean_before = before.get(time_metric, 0) / calls_before
+            if mean_before > 0 and mean_now / mean_before >= REGRESSION_RATIO:
+                regressions.append({
+                    'name': name,
+                    'mean_ms_before': round(mean_before, 3),
+                    'mean_ms_now': round(mean_now, 3),
+                    'ratio': round(mean_now / mean_before, 2),
+                    'calls_now': int(calls_now),
+                })
+        return sorted(regressions, key=lambda item: item['ratio'], reverse=True)
+
+    def get_report(self, window_minutes: int = 60, limit: int = 10) -> Dict[str, Any]:
+        """Топ маршрутов по времени БД, топ запросов за окно, N+1 и регрессии к прошлому деплою"""
+        self.flush_routes()
+
+        samples_needed = max(1, window_minutes * 60 // SAMPLE_INTERVAL_SECONDS)
+        samples, texts = self._read_samples(samples_needed)
+        statements: Dict[int, List[float]] = {}
+        for sample in samples:
+            for queryid, calls, ms, rows in sample[4]:
+                entry = statements.setdefault(queryid, [0, 0.0, 0])
+                entry[0] += calls
+                entry[1] += ms
+                entry[2] += rows
+        top_statements = [
+            {
+                'queryid': queryid,
+                'query': texts.get(queryid, ''),
+                'calls': int(calls),
+                'total_ms': round(ms, 2),
+                'mean_ms': round(ms / calls, 3) if calls else 0,
+                'rows': int(rows),
+            }
+            for queryid, (calls, ms, rows) in sorted(statements.items(), key=lambda item: item[1][1], reverse=True)
+        ][:limit]
+
+        routes_now = self._read_totals(DEPLOY_ROUTES_KEY.format(deploy=self.deploy_id))
+        top_routes = sorted(self._route_rows(routes_now), key=lambda row: row['total_db_ms'], reverse=True)[:limit]
+
+        n_plus_one = [
+            {'timestamp': ts, 'route': route, 'statement': statement, 'count': count, 'db_ms': db_ms}
+            for ts, route, statement, count, db_ms in self._read_n_plus_one(limit * 5)
+        ]
+
+        regressions: Dict[str, Any] = {'previous_deploy': None, 'routes': [], 'statements': []}
+        deploys = [deploy for deploy in self._deploys() if deploy != self.deploy_id]
+        if deploys:
+            previous_deploy = deploys[0]
+            regressions['previous_deploy'] = previous_deploy
+            regressions['routes'] = self._find_regressions(
+                routes_now, self._read_totals(DEPLOY_ROUTES_KEY.format(deploy=previous_deploy)),
+                'requests', 'db_ms'
+            )[:limit]
+            statement_regressions = self._find_regressions(
+                self._read_totals(DEPLOY_STATEMENTS_KEY.format(deploy=self.deploy_id)),
+                self._read_totals(DEPLOY_STATEMENTS_KEY.format(deploy=previous_deploy)),
+                'calls', 'ms'
+            )[:limit]
+            for item in statement_regressions:
+                item['query'] = texts.get(int(item['name']), '')
+            regressions['statements'] = statement_regressions
+
+        return {
+            'deploy': self.deploy_id,
+            'sample_interval_seconds': SAMPLE_INTERVAL_SECONDS,
+            'window_minutes': window_minutes,
+            'samples': len(samples),
+            'statements_available': self._statements_available,
+            'top_statements': top_statements,
+            'top_routes': top_routes,
+            'n_plus_one': n_plus_one,
+            'regressions': regressions,
+        }
+
+
+# Глобальный экземпляр
+query_sampler = QueryPerformanceSampler()
@@ -0,0 +1,381 @@
+"""
+Исходящая очередь писем (outbox)
+
+Запросы только кладут задание в очередь (RPUSH в Redis, микросекунды); шаблоны
+рендерятся и письма отправляются фоновым потоком, который держит одно
+SMTP-соединение на пачку писем, соблюдает лимит скорости и повторяет
+неудачные отправки с экспоненциальной задержкой.
+
+Очередь хранится в Redis (переживает рестарт процесса). Задание забирается
+BLMOVE в список processing и удаляется оттуда только после отправки (или
+постановки в повтор/dead-letter): если воркер упал посреди пачки, периодический
+reaper вернет зависшие задания в очередь. Если Redis недоступен,
+задания попадают во внутрипроцессную очередь — без персистентности, но всё
+так же без блокировки запроса.
+"""
+
+import json
+import logging
+import os
+import queue
+import smtplib
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Optional, Dict, Any, List
+
+from templates.email_templates import EmailTemplates
+
+logger = logging.getLogger(__name__)
+
+try:
+    from prometheus_client import Counter
+    EMAIL_OUTBOX_SENT = Counter('email_outbox_sent_total', 'Emails delivered from outbox', ['template'])
+    EMAIL_OUTBOX_FAILED = Counter('email_outbox_failed_total', 'Email delivery failures', ['template', 'final'])
+    METRICS_ENABLED = True
+except ImportError:
+    METRICS_ENABLED = False
+
+OUTBOX_KEY = "email:outbox"
+RETRY_KEY = "email:outbox:retry"
+DEAD_KEY = "email:outbox:dead"
+PROCESSING_KEY = "email:outbox:processing"
+LEASES_KEY = "email:outbox:leases"  # payload -> время, когда задание забрал воркер
+
+BATCH_SIZE = int(os.getenv('EMAIL_OUTBOX_BATCH', '20'))
+RATE_PER_MINUTE = int(os.getenv('EMAIL_RATE_PER_MINUTE', '60'))
+MAX_ATTEMPTS = int(os.getenv('EMAIL_MAX_ATTEMPTS', '5'))
+RETRY_BASE_SECONDS = int(os.getenv('EMAIL_RETRY_BASE_SECONDS', '30'))
+DEAD_LETTER_LIMIT = 1000
+# Дольше любой пачки (BATCH_SIZE писем с учетом лимита скорости)
+PROCESSING_TIMEOUT_SECONDS = int(os.getenv('EMAIL_PROCESSING_TIMEOUT_SECONDS', '300'))
+REAP_INTERVAL_SECONDS = 60
+
+# Ошибки, при которых повторять бессмысленно
+PERMANENT_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused)
+
+RAW_TEMPLATE = "raw"
+
+
+class EmailOutbox:
+    """Очередь писем с фоновым отправителем"""
+
+    def __init__(self, redis_client=None):
+        self._redis = redis_client
+        self._redis_resolved = redis_client is not None
+        self._local_queue: "queue.Queue[str]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._start_lock = threading.Lock()
+        self._min_interval = 60.0 / RATE_PER_MINUTE if RATE_PER_MINUTE > 0 else 0.0
+        self._last_sent_at = 0.0
+        self._last_reaped_at = 0.0
+        # id задания -> исходный payload в processing (для подтверждения через LREM)
+        self._in_flight: Dict[str, Any] = {}
+
+    @property
+    def redis(self):
+        if not self._redis_resolved:
+            from cache.redis_cache import cache
+            self._redis = cache.redis_client
+            self._redis_resolved = True
+        return self._redis
+
+    # === Постановка в очередь ===
+
+    def enqueue(self, to_email: str, template: str, **params) -> bool:
+        """Поставить письмо по шаблону EmailTemplates.<template>(**params) в очередь"""
+        if template != RAW_TEMPLATE and not callable(getattr(EmailTemplates, template, None)):
+            raise ValueError(f"Неизвестный шаблон письма: {template}")
+
+        job = json.dumps({
+            "id": uuid.uuid4().hex,
+            "to": to_email,
+            "template": template,
+            "params": params,
+            "attempts": 0,
+            "enqueued_at": datetime.utcnow().isoformat(),
+        }, ensure_ascii=False, default=str)
+
+        try:
+            if self.redis:
+                self.redis.rpush(OUTBOX_KEY, job)
+            else:
+                self._local_queue.put(job)
+        except Exception as e:
+            logger.warning(f"Email outbox Redis недоступен, письмо в локальной очереди: {e}")
+            self._local_queue.put(job)
+
+        self.start()
+        return True
+
+    def enqueue_raw(self, to_email: str, subject: str, html_content: str,
+                    text_content: Optional[str] = None) -> bool:
+        """Поставить в очередь уже сформированное письмо"""
+        return self.enqueue(to_email, RAW_TEMPLATE, subject=subject, html=html_content, text=text_content)
+
+    # === Фоновый отправитель ===
+
+    def start(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="email-outbox", daemon=True)
+            self._thread.start()
+            logger.info("📧 Email outbox sender started")
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=timeout)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                if time.monotonic() - self._last_reaped_at >= REAP_INTERVAL_SECONDS:
+                    self._last_reaped_at = time.monotonic()
+                    self._reap_stale_processing()
+                self._promote_due_retries()
+                batch = self._take_batch()
+                if batch:
+                    self._send_batch(batch)
+            except Exception as e:
+                logger.error(f"❌ Ошибка в email outbox: {e}")
+                self._stop.wait(5)
+
+    def _take_batch(self) -> List[Dict[str, Any]]:
+        """Дождаться первого письма (до 5с) и добрать пачку без ожидания"""
+        raw_jobs: List = []
+        claimed: List = []
+        self._in_flight = {}
+        try:
+            raw_jobs.append(self._local_queue.get_nowait())
+        except queue.Empty:
+            pass
+
+        redis_client = self.redis
+        if redis_client:
+            try:
+                if not raw_jobs:
+                    # Задание переезжает в processing атомарно: падение воркера его не теряет
+                    item = redis_client.blmove(OUTBOX_KEY, PROCESSING_KEY, 5, "LEFT", "RIGHT")
+                    if item:
+                        claimed.append(item)
+                missing = BATCH_SIZE - len(raw_jobs) - len(claimed)
+                if (raw_jobs or claimed) and missing > 0:
+                    pipe = redis_client.pipeline(transaction=False)
+                    for _ in range(missing):
+                        pipe.lmove(OUTBOX_KEY, PROCESSING_KEY, "LEFT", "RIGHT")
+                    claimed.extend(item for item in pipe.execute() if item is not None)
+                if claimed:
+                    now = time.time()
+                    redis_client.zadd(LEASES_KEY, {item: now for item in claimed})
+            except Exception as e:
+                logger.warning(f"Email outbox Redis недоступен: {e}")
+                redis_client = None
+
+        for item in claimed:
+            job = json.loads(item)
+            self._in_flight[job["id"]] = item
+            raw_jobs.append(item)
+
+        if not redis_client and not raw_jobs:
+            try:
+                raw_jobs.append(self._local_queue.get(timeout=5))
+            except queue.Empty:
+                return []
+
+        while len(raw_jobs) < BATCH_SIZE:
+            try:
+                raw_jobs.append(self._local_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return [json.loads(job) for job in raw_jobs]
+
+    def _send_batch(self, jobs: List[Dict[str, Any]]) -> None:
+        from integrations.email_service import email_service
+
+        server = None
+        try:
+            for job in jobs:
+                if self._stop.is_set():
+                    self._requeue(job)
+                    self._ack(job)
+                    continue
+                try:
+                    message = email_service.build_message(job["to"], **self._render(job))
+                    self._throttle()
+                    if server is None:
+                        server = email_service.open_smtp()
+                    try:
+                        server.send_message(message)
+                    except smtplib.SMTPServerDisconnected:
+                        # Сервер закрыл соединение посреди пачки — переподключаемся один раз
+                        server = email_service.open_smtp()
+                        server.send_message(message)
+                    self._last_sent_at = time.monotonic()
+                    if METRICS_ENABLED:
+                        EMAIL_OUTBOX_SENT.labels(template=job["template"]).inc()
+                    logger.info(f"Email успешно отправлен на {job['to']} ({job['template']})")
+                except Exception as e:
+                    if not isinstance(e, PERMANENT_ERRORS) and server is not None:
+                        self._close(server)
+                        server = None
+                    self._handle_failure(job, e)
+                # Письмо отправлено, отложено или в dead-letter — убираем его из processing
+                self._ack(job)
+        finally:
+            if server is not None:
+                self._close(server)
+
+    def _render(self, job: Dict[str, Any]) -> Dict[str, Optional[str]]:
+        params = job["params"]
+        if job["template"] == RAW_TEMPLATE:
+            return {"subject": params["subject"], "html_content": params["html"], "text_content": params.get("text")}
+        template_data = getattr(EmailTemplates, job["template"])(**params)
+        return {
+            "subject": template_data["subject"],
+            "html_content": template_data["html"],
+            "text_content": template_data.get("text"),
+        }
+
+    def _throttle(self) -> None:
+        if not self._min_interval:
+            return
+        wait = self._last_sent_at + self._min_interval - time.monotonic()
+        if wait > 0:
+            self._stop.wait(wait)
+
+    def _handle_failure(self, job: Dict[str, Any], error: Exception) -> None:
+        job["attempts"] += 1
+        job["last_error"] = str(error)[:500]
+        final = isinstance(error, PERMANENT_ERRORS) or job["attempts"] >= MAX_ATTEMPTS
+        if METRICS_ENABLED:
+            EMAIL_OUTBOX_FAILED.labels(template=job["template"], final=str(final).lower()).inc()
+
+        if final:
+            logger.error(f"❌ Письмо на {job['to']} ({job['template']}) не отправлено после {job['attempts']} попыток: {error}")
+            self._dead_letter(job)
+            return
+
+        delay = RETRY_BASE_SECONDS * (2 ** (job["attempts"] - 1))
+        logger.warning(f"Ошибка отправки email на {job['to']}, повтор через {delay}с (попытка {job['attempts']}): {error}")
+        self._schedule_retry(job, time.time() + delay)
+
+    def _schedule_retry(self, job: Dict[str, Any], ready_at: float) -> None:
+        payload = json.dumps(job, ensure_ascii=False, default=str)
+        try:
+            if self.redis:
+                self.redis.zadd(RETRY_KEY, {payload: ready_at})
+                return
+        except Exception as e:
+            logger.warning(f"Не удалось запланировать повтор письма в Redis: {e}")
+        # Без Redis повторяем через локальный таймер
+        timer = threading.Timer(max(0.0, ready_at - time.time()), self._local_queue.put, args=(payload,))
+        timer.daemon = True
+        timer.start()
+
+    def _promote_due_retries(self) -> None:
+        redis_client = self.redis
+        if not redis_client:
+            return
+        try:
+            due = redis_client.zrangebyscore(RETRY_KEY, "-inf", time.time(), start=0, num=BATCH_SIZE)
+            for payload in due:
+                # ZREM выигрывает только один воркер — письмо не уйдет дважды
+                if redis_client.zrem(RETRY_KEY, payload):
+                    redis_client.rpush(OUTBOX_KEY, payload)
+        except Exception as e:
+            logger.debug(f"Не удалось перенести повторы писем: {e}")
+
+    def _ack(self, job: Dict[str, Any]) -> None:
+        raw = self._in_flight.pop(job["id"], None)
+        if raw is None or not self.redis:
+            return
+        try:
+            pipe = self.redis.pipeline()
+            pipe.lrem(PROCESSING_KEY, 1, raw)
+            pipe.zrem(LEASES_KEY, raw)
+            pipe.execute()
+        except Exception as e:
+            # Reaper вернет задание в очередь — письмо может уйти повторно, но не потеряется
+            logger.warning(f"Не удалось подтвердить письмо {job['id']} в outbox: {e}")
+
+    def _reap_stale_processing(self) -> int:
+        """Вернуть в очередь задания, зависшие в processing (воркер упал посреди пачки)"""
+        redis_client = self.redis
+        if not redis_client:
+            return 0
+        reaped = 0
+        try:
+            now = time.time()
+            for raw in redis_client.lrange(PROCESSING_KEY, 0, -1):
+                leased_at = redis_client.zscore(LEASES_KEY, raw)
+                if leased_at is None:
+                    # Воркер упал между BLMOVE и записью аренды — отсчитываем таймаут отсюда
+                    redis_client.zadd(LEASES_KEY, {raw: now}, nx=True)
+                    continue
+                if now - leased_at < PROCESSING_TIMEOUT_SECONDS:
+                    continue
+                # LREM выигрывает только один воркер — задание не попадет в очередь дважды
+                if redis_client.lrem(PROCESSING_KEY, 1, raw):
+                    pipe = redis_client.pipeline()
+                    pipe.rpush(OUTBOX_KEY, raw)
+                    pipe.zrem(LEASES_KEY, raw)
+                    pipe.execute()
+                    reaped += 1
+        except Exception as e:
+            logger.debug(f"Не удалось проверить зависшие письма: {e}")
+        if reaped:
+            logger.warning(f"♻️ Email outbox: {reaped} зависших писем возвращено в очередь")
+        return reaped
+
+    def _requeue(self, job: Dict[str, Any]) -> None:
+        payload = json.dumps(job, ensure_ascii=False, default=str)
+        try:
+            if self.redis:
+                self.redis.lpush(OUTBOX_KEY, payload)
+                return
+        except Exception:
+            pass
+        self._local_queue.put(payload)
+
+    def _dead_letter(self, job: Dict[str, Any]) -> None:
+        try:
+            if self.redis:
+                pipe = self.redis.pipeline()
+                pipe.lpush(DEAD_KEY, json.dumps(job, ensure_ascii=False, default=str))
+                pipe.ltrim(DEAD_KEY, 0, DEAD_LETTER_LIMIT - 1)
+                pipe.execute()
+        except Exception as e:
+            logger.debug(f"Не удалось сохранить письмо в dead-letter: {e}")
+
+    @staticmethod
+    def _close(server) -> None:
+        try:
+            server.quit()
+        except Exception:
+            pass
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = {"local_queue": self._local_queue.qsize(), "sender_alive": bool(self._thread and self._thread.is_alive())}
+        try:
+            if self.redis:
+                stats.update({
+                    "queued": self.redis.llen(OUTBOX_KEY),
+                    "processing": self.redis.llen(PROCESSING_KEY),
+                    "retrying": self.redis.zcard(RETRY_KEY),
+                    "dead": self.redis.llen(DEAD_KEY),
+                })
+        except Exception as e:
+            stats["error"] = str(e)
+        return stats
+
+
+# Глобальный экземпляр очереди
+email_outbox = EmailOutbox()
@@ -11,10 +11,10 @@ from datetime import datetime, timedelta
 from threading import Lock
 import pytz
 
-# Импортируем шаблоны
+# Импортируем очередь писем (шаблоны рендерятся в ней)
 import sys
 sys.path.append(str(Path(__file__).parent.parent))
-from templates.email_templates import EmailTemplates
+from integrations.email_outbox import email_outbox
 
 logger = logging.getLogger(__name__)
 
@@ -50,6 +50,46 @@ class EmailService:
         self._throttle_lock = Lock()
         self._handoff_cooldown_minutes = 10  # Не чаще 1 письма в 10 минут на диалог
         
+    def build_message(
+        self,
+        to_email: str,
+        subject: str,
+        html_content: str,
+        text_content: Optional[str] = None
+    ):
+        """Собирает MIME сообщение"""
+        if text_content:
+            msg = MIMEMultipart('alternative')
+            # Добавляем текстовую и HTML версии
+            msg.attach(MIMEText(text_content, 'plain', 'utf-8'))
+            msg.attach(MIMEText(html_content, 'html', 'utf-8'))
+        else:
+            # Простое HTML сообщение (как в существующей системе)
+            msg = MIMEText(html_content, "html", 'utf-8')
+        msg['Subject'] = subject
+        msg['From'] = f"{self.from_name} <{self.from_email}>" if self.from_name else self.from_email
+        msg['To'] = to_email
+        return msg
+
+    def open_smtp(self) -> smtplib.SMTP:
+        """Открывает авторизованное SMTP соединение с учетом SSL/STARTTLS"""
+        logger.debug(f"Подключение к SMTP серверу {self.smtp_server}:{self.smtp_port} (SSL={self.use_ssl}, STARTTLS={self.use_starttls})")
+        if self.use_ssl:
+            server = smtplib.SMTP_SSL(self.smtp_server, self.smtp_port, timeout=30)
+        else:
+            server = smtplib.SMTP(self.smtp_server, self.smtp_port, timeout=30)
+        try:
+            if not self.use_ssl:
+                server.ehlo()
+                if self.use_starttls:
+                    server.starttls()
+                    server.ehlo()
+            server.login(self.username, self.password)
+        except Exception:
+            server.close()
+            raise
+        return server
+
     def _send_email(
         self, 
         to_email: str, 
@@ -57,54 +97,14 @@ class EmailService:
         html_content: str, 
         text_content: Optional[str] = None
     ) -> bool:
-        """Отправляет email используя существующую инфраструктуру"""
+        """Синхронно отправляет email (для диагностики; обычные письма идут через outbox)"""
         try:
-            # Создаем сообщение (используем тот же формат что и в main.py)
-            if text_content:
-                msg = MIMEMultipart('alternative')
-                msg['Subject'] = subject
-                msg['From'] = f"{self.from_name} <{self.from_email}>" if self.from_name else self.from_email
-                msg['To'] = to_email
-                
-                # Добавляем текстовую версию
-                text_part = MIMEText(text_content, 'plain', 'utf-8')
-                msg.attach(text_part)
-                
-                # Добавляем HTML версию
-                html_part = MIMEText(html_content, 'html', 'utf-8')
-                msg.attach(html_part)
-            else:
-                # Простое HTML сообщение (как в существующей системе)
-                msg = MIMEText(html_content, "html", 'utf-8')
-                msg['Subject'] = subject
-                msg['From'] = f"{self.from_name} <{self.from_email}>" if self.from_name else self.from_email
-                msg['To'] = to_email
-            
-            # Отправляем сообщение с учетом SSL/STARTTLS и увеличенным таймаутом
-            logger.info(f"Подключение к SMTP серверу {self.smtp_server}:{self.smtp_port} (SSL={self.use_ssl}, STARTTLS={self.use_starttls})")
-            
-            if self.use_ssl:
-                with smtplib.SMTP_SSL(self.smtp_server, self.smtp_port, timeout=30) as server:
-                    server.set_debuglevel(0)  # Включаем отладку при необходимости
-                    logger.info("SSL соединение установлено")
-                    server.login(self.username, self.password)
-                    logger.info("SMTP авторизация успешна")
-                    server.send_message(msg)
-                    logger.info("Сообщение отправлено")
-            else:
-                with smtplib.SMTP(self.smtp_server, self.smtp_port, timeout=30) as server:
-                    server.set_debuglevel(0)  # Включаем отладку при необходимости
-                    logger.info("SMTP соединение установлено")
-                    server.ehlo()
-                    if self.use_starttls:
-                        logger.info("Активируем STARTTLS")
-                        server.starttls()
-                        server.ehlo()
-                        logger.info("STARTTLS активирован")
-                    server.login(self.username, self.password)
-                    logger.info("SMTP авторизация успешна")
-                    server.send_message(msg)
-                    logger.info("Сообщение отправлено")
+            msg = self.build_message(to_email, subject, html_content, text_content)
+            server = self.open_smtp()
+            try:
+                server.send_message(msg)
+            finally:
+                server.quit()
 
             logger.info(
                 f"Email успешно отправлен на {to_email} (server={self.smtp_server}:{self.smtp_port}, ssl={self.use_ssl}, starttls={self.use_starttls})"
@@ -123,28 +123,27 @@ class EmailService:
             )
             print(f"[EMAIL ERROR] Не удалось отправить письмо на {to_email}: {e}")
             return False
+
+    def queue_email(
+        self,
+        to_email: str,
+        subject: str,
+        html_content: str,
+        text_content: Optional[str] = None
+    ) -> bool:
+        """Ставит готовое письмо в очередь отправки"""
+        return email_outbox.enqueue_raw(to_email, subject, html_content, text_content)
     
-    # Методы для отправки типизированных email с использованием шаблонов
+    # Методы для отправки типизированных email с использованием шаблонов.
+    # Письма ставятся в outbox; шаблон рендерится фоновым отправителем.
     
     def send_welcome_email(self, to_email: str, user_name: str = "Пользователь") -> bool:
         """Отправляет приветственное письмо"""
-        template_data = EmailTemplates.welcome_email(user_name, BASE_URL)
-        return self._send_email(
-            to_email=to_email,
-            subject=template_data["subject"],
-            html_content=template_data["html"],
-            text_content=template_data["text"]
-        )
+        return email_outbox.enqueue(to_email, "welcome_email", user_name=user_name, base_url=BASE_URL)
     
     def send_password_reset_email(self, to_email: str, reset_link: str, user_name: str = "Пользователь") -> bool:
         """Отправляет письмо для сброса пароля"""
-        template_data = EmailTemplates.password_reset_email(reset_link, user_name)
-        return self._send_email(
-            to_email=to_email,
-            subject=template_data["subject"],
-            html_content=template_data["html"],
-            text_content=template_data["text"]
-        )
+        return email_outbox.enqueue(to_email, "password_reset_email", reset_link=reset_link, user_name=user_name)
     
     def send_payment_confirmation_email(
         self, 
@@ -155,14 +154,10 @@ class EmailService:
         bonus_amount: Optional[float] = None
     ) -> bool:
         """Отправляет подтверждение пополнения баланса"""
-        template_data = EmailTemplates.payment_confirmation_email(
-            amount, messages_count, current_balance, bonus_amount, BASE_URL
-        )
-        return self._send_email(
-            to_email=to_email,
-            subject=template_data["subject"],
-            html_content=template_data["html"],
-            text_content=template_data["text"]
+        return email_outbox.enqueue(
+            to_email, "payment_confirmation_email",
+            amount=amount, messages_count=messages_count, current_balance=current_balance,
+            bonus_amount=bonus_amount, base_url=BASE_URL
         )
 
     def send_test_email(self, to_email: str) -> Dict:
@@ -178,6 +173,7 @@ class EmailService:
             "starttls": self.use_starttls,
             "username_configured": bool(self.username),
             "from_email": self.from_email,
+            "outbox": email_outbox.get_stats(),
         }
     
     def _is_handoff_throttled(self, dialog_id: int) -> bool:
@@ -230,8 +226,9 @@ class EmailService:
             local_time = datetime.now(moscow_tz)
             timestamp = local_time.strftime("%d.%m.%Y %H:%M")
         
-        # Получаем шаблон
-        template_data = EmailTemplates.handoff_notification_email(
+        # Ставим письмо в очередь (шаблон рендерится фоновым отправителем)
+        success = email_outbox.enqueue(
+            to_email, "handoff_notification_email",
             dialog_id=dialog_id,
             reason=reason,
             user_preview=user_preview,
@@ -240,42 +237,24 @@ class EmailService:
             base_url=BASE_URL
         )
         
-        # Отправляем письмо
-        success = self._send_email(
-            to_email=to_email,
-            subject=template_data["subject"],
-            html_content=template_data["html"],
-            text_content=template_data["text"]
-        )
-        
-        # Если письмо отправлено успешно, записываем время отправки
+        # Троттлинг считаем от момента постановки в очередь
         if success:
             self._record_handoff_sent(dialog_id)
             logger.info(
-                f"Handoff email отправлен на {to_email} для диалога {dialog_id} (reason: {reason})"
+                f"Handoff email поставлен в очередь для {to_email}, диалог {dialog_id} (reason: {reason})"
             )
         
         return success
     
     def send_low_balance_warning_email(self, to_email: str, remaining_messages: int) -> bool:
         """Отправляет предупреждение о низком балансе"""
-        template_data = EmailTemplates.low_balance_warning_email(remaining_messages, BASE_URL)
-        return self._send_email(
-            to_email=to_email,
-            subject=template_data["subject"],
-            html_content=template_data["html"],
-            text_content=template_data["text"]
+        return email_outbox.enqueue(
+            to_email, "low_balance_warning_email", remaining_messages=remaining_messages, base_url=BASE_URL
         )
     
     def send_balance_depleted_email(self, to_email: str) -> bool:
         """Отправляет уведомление о том, что баланс закончился"""
-        template_data = EmailTemplates.balance_depleted_email(BASE_URL)
-        return self._send_email(
-            to_email=to_email,
-            subject=template_data["subject"],
-            html_content=template_data["html"],
-            text_content=template_data["text"]
-        )
+        return email_outbox.enqueue(to_email, "balance_depleted_email", base_url=BASE_URL)
 
     def send_new_user_admin_notification(
         self,
@@ -293,8 +272,8 @@ class EmailService:
             local_time = datetime.now(moscow_tz)
             registration_time = local_time.strftime("%d.%m.%Y %H:%M")
 
-        # Получаем шаблон
-        template_data = EmailTemplates.new_user_admin_notification(
+        success = email_outbox.enqueue(
+            admin_email, "new_user_admin_notification",
             user_email=user_email,
             user_name=user_name,
             registration_time=registration_time,
@@ -302,17 +281,9 @@ class EmailService:
             base_url=BASE_URL
         )
 
-        # Отправляем письмо
-        success = self._send_email(
-            to_email=admin_email,
-            subject=template_data["subject"],
-            html_content=template_data["html"],
-            text_content=template_data["text"]
-        )
-
         if success:
             logger.info(
-                f"New user admin notification sent to {admin_email} for user {user_email} (ID: {user_id})"
+                f"New user admin notification queued for {admin_email} for user {user_email} (ID: {user_id})"
             )
 
         return success
@@ -1,7 +1,5 @@
 from fastapi import FastAPI, Response, Request, HTTPException, status
-from fastapi.middleware.cors import CORSMiddleware
-from core.dynamic_cors_middleware import DynamicCORSMiddleware
-from core.dynamic_csp_middleware import DynamicCSPMiddleware
+from core.middleware_stack import install_middleware_stack
 from database.connection import engine, Base, SessionLocal, get_db
 from database import models
 import os
@@ -15,8 +13,7 @@ load_dotenv(dotenv_path="../.env")
 from core.app_config import (
     SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES, CORS_ORIGINS
 )
-from core.csrf_protection import get_csrf_protection, generate_csrf_token_for_response
-from core.security_headers import security_headers_middleware
+from core.csrf_protection import generate_csrf_token_for_response
 from ai.ai_assistant import router as ai_assistant_router
 from ai.training_system import router as training_router
 from monitoring.rating_system import router as rating_router
@@ -137,6 +134,83 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         logger.error(f"❌ Failed to start blog scheduler: {e}", exc_info=True)
 
+    # Присутствие операторов: истечение heartbeat и снимки в operator_presence
+    presence_task = None
+    try:
+        from services.operator_presence import run_presence_maintenance
+        import asyncio
+        presence_task = asyncio.create_task(run_presence_maintenance())
+        logger.info("✅ Operator presence maintenance started")
+    except Exception as e:
+        logger.error(f"❌ Failed to start operator presence maintenance: {e}", exc_info=True)
+
+    # Запись предавторизованных списаний в журнал (BILLING_PREAUTH_MESSAGES > 0)
+    preauth_task = None
+    try:
+        from services.billing_preauth import run_preauth_settler
+        import asyncio
+        preauth_task = asyncio.create_task(run_preauth_settler())
+    except Exception as e:
+        logger.error(f"❌ Failed to start billing preauth settler: {e}", exc_info=True)
+
+    # Фоновый отправитель писем: дочищает очередь, накопленную до рестарта
+    try:
+        from integrations.email_outbox import email_outbox
+        email_outbox.start()
+    except Exception as e:
+        logger.error(f"❌ Failed to start email outbox: {e}", exc_info=True)
+
+    # Применение webhook-событий ЮKassa (приём в /yookassa-webhook только сохраняет событие)
+    payment_webhook_task = None
+    try:
+        from services.payment_webhooks import payment_webhook_processor
+        import asyncio
+        payment_webhook_task = asyncio.create_task(payment_webhook_processor.run())
+    except Exception as e:
+        logger.error(f"❌ Failed to start payment webhook applier: {e}", exc_info=True)
+
+    # Индексация Q&A (импорт файлов и правки записей) — эмбеддинги пачками вне запросов
+    qa_import_task = None
+    try:
+        from services.qa_import import qa_import_processor
+        import asyncio
+        qa_import_task = asyncio.create_task(qa_import_processor.run())
+    except Exception as e:
+        logger.error(f"❌ Failed to start Q&A import indexer: {e}", exc_info=True)
+
+    # Сэмплер pg_stat_statements и итогов SQL по маршрутам
+    query_sampler_task = None
+    if os.getenv("DB_QUERY_SAMPLER_ENABLED", "true").lower() in ("true", "1", "yes"):
+        try:
+            from database.utils.query_sampler import query_sampler
+            import asyncio
+            query_sampler_task = asyncio.create_task(query_sampler.run())
+        except Exception as e:
+            logger.error(f"❌ Failed to start query performance sampler: {e}", exc_info=True)
+
+    # Сэмплер метрик хоста и процессов для /system/performance и /system/processes
+    host_metrics_task = None
+    if os.getenv("HOST_METRICS_ENABLED", "true").lower() in ("true", "1", "yes"):
+        try:
+            from monitoring.host_metrics import host_metrics_sampler
+            import asyncio
+            host_metrics_task = asyncio.create_task(host_metrics_sampler.run())
+        except Exception as e:
+            logger.error(f"❌ Failed to start host metrics sampler: {e}", exc_info=True)
+
+    # Канал управления ботами: без Redis команды доставляет в bot-manager по HTTP этот процесс
+    bot_control_task = None
+    try:
+        from services.bot_control import BotControlConsumer, bot_control, http_handlers
+        import asyncio
+        force_http = os.getenv("BOT_CONTROL_HTTP_CONSUMER", "false").lower() in ("true", "1", "yes")
+        if force_http or not bot_control.uses_redis:
+            bot_control_task = asyncio.create_task(
+                BotControlConsumer(bot_control, http_handlers(), name="backend-http").run()
+            )
+    except Exception as e:
+        logger.error(f"❌ Failed to start bot control consumer: {e}", exc_info=True)
+
     print("✅ Application startup completed")
     
     yield
@@ -171,6 +245,98 @@ async def lifespan(app: FastAPI):
         except Exception as e:
             logger.error(f"❌ Error stopping blog scheduler: {e}")
 
+    # Остановка обслуживания присутствия операторов (финальный снимок в БД)
+    if presence_task and not presence_task.done():
+        presence_task.cancel()
+        try:
+            await presence_task
+        except asyncio.CancelledError:
+            logger.info("✅ Operator presence maintenance stopped")
+        except Exception as e:
+            logger.error(f"❌ Error stopping operator presence maintenance: {e}")
+
+    if preauth_task and not preauth_task.done():
+        preauth_task.cancel()
+        try:
+            await preauth_task
+        except asyncio.CancelledError:
+            logger.info("✅ Billing preauth settler stopped")
+        except Exception as e:
+            logger.error(f"❌ Error stopping billing preauth settler: {e}")
+
+    if payment_webhook_task and not payment_webhook_task.done():
+        payment_webhook_task.cancel()
+        try:
+            await payment_webhook_task
+        except asyncio.CancelledError:
+            logger.info("✅ Payment webhook applier stopped")
+        except Exception as e:
+            logger.error(f"❌ Error stopping payment webhook applier: {e}")
+
+    if qa_import_task and not qa_import_task.done():
+        qa_import_task.cancel()
+        try:
+            await qa_import_task
+        except asyncio.CancelledError:
+            logger.info("✅ Q&A import indexer stopped")
+        except Exception as e:
+            logger.error(f"❌ Error stopping Q&A import indexer: {e}")
+
+    if query_sampler_task and not query_sampler_task.done():
+        query_sampler_task.cancel()
+        try:
+            await query_sampler_task
+        except asyncio.CancelledError:
+            logger.info("✅ Query performance sampler stopped")
+        except Exception as e:
+            logger.error(f"❌ Error stopping query performance sampler: {e}")
+
+    if host_metrics_task and not host_metrics_task.done():
+        host_metrics_task.cancel()
+        try:
+            await host_metrics_task
+        except asyncio.CancelledError:
+            logger.info("✅ Host metrics sampler stopped")
+        except Exception as e:
+            logger.error(f"❌ Error stopping host metrics sampler: {e}")
+
+    if bot_control_task and not bot_control_task.done():
+        bot_control_task.cancel()
+        try:
+            await bot_control_task
+        except asyncio.CancelledError:
+            logger.info("✅ Bot control consumer stopped")
+        except Exception as e:
+            logger.error(f"❌ Error stopping bot control consumer: {e}")
+
+    # Накопленные счетчики использования паттернов не должны теряться при рестарте
+    try:
+        from ai.training_system import flush_pattern_usage
+        flushed = await asyncio.to_thread(flush_pattern_usage)
+        logger.info(f"✅ Pattern usage flushed ({flushed})")
+    except Exception as e:
+        logger.error(f"❌ Error flushing pattern usage: {e}")
+
+    try:
+        from integrations.email_outbox import email_outbox
+        import asyncio
+        await asyncio.to_thread(email_outbox.stop)
+        logger.info("✅ Email outbox stopped")
+    except Exception as e:
+        logger.error(f"❌ Error stopping email outbox: {e}")
+
+    try:
+        from core.password_hashing import password_hasher
+        password_hasher.shutdown()
+    except Exception as e:
+        logger.error(f"❌ Error stopping password hashing pool: {e}")
+
+    try:
+        from database.async_connection import dispose_async_engine
+        await dispose_async_engine()
+    except Exception as e:
+        logger.error(f"❌ Error closing async DB pool: {e}")
+
     print("✅ Application shutdown completed")
 
 app = FastAPI(lifespan=lifespan, redirect_slashes=False)
@@ -262,47 +428,30 @@ main_app_origins = [origin.strip() for origin in main_app_origins if origin.stri
 print(f"🌐 Основные CORS домены: {main_app_origins}")
 print(f"🔧 Виджет эндпоинты: ['/api/validate-widget-token', '/api/widget-config']")
 
-# Добавляем DynamicCORSMiddleware вместо стандартного
-app.add_middleware(
-    DynamicCORSMiddleware,
-    main_app_origins=main_app_origins,
-    widget_endpoints=['/api/validate-widget-token', '/api/widget-config'],
-    allow_credentials=True,  # Разрешено для основного приложения
-    allow_methods=["GET", "POST", "PUT", "DELETE", "PATCH", "OPTIONS"],
-    allow_headers=["*"],
-    max_age=600,
-)
-
-# 🛡️ Динамический CSP Middleware для iframe страниц
-app.add_middleware(
-    DynamicCSPMiddleware,
-    iframe_path='/chat-iframe'
-)
-
-print("🛡️ DynamicCSPMiddleware добавлен для iframe страниц")
-
-# 🛡️ CSRF Protection Middleware
-# Включаем только в продакшене или при явном указании
+# 🛡️ CSRF Protection включаем только в продакшене или при явном указании
 enable_csrf = os.getenv('ENABLE_CSRF_PROTECTION', 'false').lower() in ('true', '1', 'yes')
 environment = os.getenv('ENVIRONMENT', 'development').lower()
 
-if enable_csrf:
-    csrf_protection = get_csrf_protection()
-    
-    @app.middleware("http")
-    async def csrf_middleware(request: Request, call_next):
-        return await csrf_protection(request, call_next)
-    
-    print("🛡️ CSRF Protection включена")
-else:
-    print("⚠️ CSRF Protection отключена (разработка)")
-
-# 🛡️ Security Headers Middleware
-@app.middleware("http")
-async def security_headers_middleware_handler(request: Request, call_next):
-    return await security_headers_middleware(request, call_next)
+# Единый стек чистых ASGI middleware: метрики -> security headers + CSP -> CSRF -> CORS -> учет SQL
+from database.utils.query_sampler import install_query_tracking
+install_query_tracking(engine)
+middleware_layers = install_middleware_stack(
+    app,
+    cors_options=dict(
+        main_app_origins=main_app_origins,
+        widget_endpoints=['/api/validate-widget-token', '/api/widget-config'],
+        allow_credentials=True,  # Разрешено для основного приложения
+        allow_methods=["GET", "POST", "PUT", "DELETE", "PATCH", "OPTIONS"],
+        allow_headers=["*"],
+        max_age=600,
+    ),
+    iframe_path='/chat-iframe',
+    enable_csrf=enable_csrf,
+)
 
-print("🛡️ Security Headers включены")
+print(f"🛡️ Middleware: {' -> '.join(middleware_layers)}")
+if not enable_csrf:
+    print("⚠️ CSRF Protection отключена (разработка)")
 
 # Функции управления ботами перенесены в services/bot_manager.py
 from services.bot_manager import (
@@ -335,12 +484,7 @@ from services.trial_service import (
 # Prometheus метрики и middleware
 # ============================
 
-HTTP_REQUEST_LATENCY = Histogram(
-    'http_request_duration_seconds', 'HTTP request latency', ['method', 'path', 'status']
-)
-HTTP_REQUEST_COUNT = Counter(
-    'http_requests_total', 'Total HTTP requests', ['method', 'path', 'status']
-)
+# HTTP_REQUEST_LATENCY / HTTP_REQUEST_COUNT пишет RequestMetricsMiddleware (core/middleware_stack.py)
 DB_POOL_CHECKED_OUT = Gauge('db_pool_checked_out', 'Checked out DB connections')
 DB_POOL_SIZE = Gauge('db_pool_size', 'DB pool size')
 DB_POOL_OVERFLOW = Gauge('db_pool_overflow', 'DB pool overflow')
@@ -353,51 +497,7 @@ WEBSOCKET_MESSAGE_QUEUE_PROCESSED = Counter('websocket_message_queue_processed_t
 WEBSOCKET_CLOSE_CODES = Counter('websocket_close_codes_total', 'WebSocket close codes', ['code', 'reason'])
 WEBSOCKET_CONNECTION_DURATION = Histogram('websocket_connection_duration_seconds', 'WebSocket connection duration')
 
-# Метрики виджет эндпоинтов для CORS безопасности
-WIDGET_CORS_REQUESTS = Counter('widget_cors_requests_total', 'Total widget CORS requests', ['endpoint', 'origin', 'status'])
-WIDGET_TOKEN_VALIDATIONS = Counter('widget_token_validations_total', 'Widget token validation attempts', ['result', 'endpoint'])
-WIDGET_BLOCKED_ORIGINS = Counter('widget_blocked_origins_total', 'Blocked widget origins', ['origin', 'reason'])
-
-
-@app.middleware("http")
-async def prometheus_middleware(request, call_next):
-    start = time.perf_counter()
-    status_code = "500"  # Дефолтное значение на случай ошибки
-    
-    try:
-        response = await call_next(request)
-        if response is not None:
-            status_code = str(response.status_code)
-        else:
-            # Если response None, создаем ошибку 500
-            from fastapi.responses import JSONResponse
-            response = JSONResponse(
-                status_code=500,
-                content={"error": "Internal server error: No response returned"}
-            )
-            status_code = "500"
-            
-    except Exception as e:
-        # Обрабатываем любые исключения в middleware chain
-        from fastapi.responses import JSONResponse
-        response = JSONResponse(
-            status_code=500,
-            content={"error": f"Internal server error: {str(e)}"}
-        )
-        status_code = "500"
-    
-    duration = time.perf_counter() - start
-    method = request.method
-    # Пытаемся получить шаблон пути, чтобы снизить кардинальность
-    route = request.scope.get('route')
-    path = getattr(route, 'path', request.url.path)
-    
-    try:
-        HTTP_REQUEST_LATENCY.labels(method=method, path=path, status=status_code).observe(duration)
-        HTTP_REQUEST_COUNT.labels(method=method, path=path, status=status_code).inc()
-    except Exception:
-        pass
-    return response
+# Метрики виджет эндпоинтов (WIDGET_*) определены в core/dynamic_cors_middleware.py
 
 
 @app.get("/metrics")
@@ -543,6 +643,8 @@ async def health_check():
             "checked_out": db_stats['checked_out'],
             "pool_size": db_stats['pool_size']
         }
+        from database.async_connection import get_async_db_stats
+        health_status["components"]["database_pool"]["async"] = get_async_db_stats()
     except Exception as e:
         health_status["components"]["database_pool"] = {"status": "unknown", "error": str(e)}
     
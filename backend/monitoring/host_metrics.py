@@ -0,0 +1,219 @@
+"""
+🖥️ ФОНОВЫЙ СЭМПЛЕР МЕТРИК ХОСТА И ПРОЦЕССОВ
+
+/system/performance вызывал psutil.cpu_percent(interval=1) прямо в async-обработчике
+и замораживал event loop воркера на секунду, а /system/processes обходил /proc
+на каждом запросе. Теперь:
+
+- раз в HOST_METRICS_INTERVAL секунд фоновая задача (в потоке) снимает CPU,
+  память, диск, сеть и процессы приложения и кладет снимок в кольцевой буфер
+  (последние HOST_METRICS_HISTORY снимков);
+- CPU считается без ожидания: psutil.cpu_percent(interval=None) и cpu_percent
+  процессов дают загрузку за время с прошлого снимка;
+- снимок экспортируется в Prometheus-гейджи;
+- эндпоинты читают последний снимок и историю — без sleep и без обхода /proc.
+
+Буфер в памяти процесса: у каждого воркера свой, метрики хоста у них общие.
+"""
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import psutil
+
+logger = logging.getLogger(__name__)
+
+try:
+    from prometheus_client import Gauge
+    HOST_CPU_PERCENT = Gauge('host_cpu_usage_percent', 'Host CPU usage since the previous sample')
+    HOST_LOAD_AVG = Gauge('host_load_average', 'Host load average', ['period'])
+    HOST_MEMORY_BYTES = Gauge('host_memory_bytes', 'Host memory', ['state'])
+    HOST_MEMORY_PERCENT = Gauge('host_memory_usage_percent', 'Host memory usage')
+    HOST_DISK_BYTES = Gauge('host_disk_bytes', 'Disk usage of HOST_METRICS_DISK_PATH', ['state'])
+    HOST_DISK_PERCENT = Gauge('host_disk_usage_percent', 'Disk usage of HOST_METRICS_DISK_PATH')
+    HOST_NETWORK_BYTES_PER_SECOND = Gauge('host_network_bytes_per_second', 'Host network throughput', ['direction'])
+    PROCESS_GROUP_CPU_PERCENT = Gauge('host_process_group_cpu_percent', 'CPU of app-related processes', ['name'])
+    PROCESS_GROUP_MEMORY_PERCENT = Gauge('host_process_group_memory_percent', 'Memory of app-related processes', ['name'])
+    PROCESS_GROUP_COUNT = Gauge('host_process_group_count', 'Number of app-related processes', ['name'])
+    METRICS_ENABLED = True
+except ImportError:
+    METRICS_ENABLED = False
+
+SAMPLE_INTERVAL_SECONDS = float(os.getenv('HOST_METRICS_INTERVAL', '10'))
+HISTORY_SIZE = int(os.getenv('HOST_METRICS_HISTORY', '360'))  # Час при шаге 10 с
+DISK_PATH = os.getenv('HOST_METRICS_DISK_PATH', '/')
+TOP_PROCESSES = 20
+PROCESS_KEYWORDS = ('python', 'postgres', 'redis', 'nginx', 'gunicorn', 'uvicorn', 'node')
+PROCESS_ATTRS = ['pid', 'name', 'cpu_percent', 'memory_percent', 'status']
+
+
+class HostMetricsSampler:
+    """Снимки метрик хоста в кольцевом буфере процесса"""
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL_SECONDS, history_size: int = HISTORY_SIZE,
+                 disk_path: str = DISK_PATH):
+        self.interval = interval
+        self.disk_path = disk_path
+        self._samples: deque = deque(maxlen=history_size)
+        self._lock = threading.Lock()
+        self._previous_network = None
+        self._process_groups: set = set()
+        # Первый вызов cpu_percent(None) задает точку отсчета
+        psutil.cpu_percent(interval=None)
+
+    # --- Снятие ---
+
+    def _network(self, now: float) -> Dict[str, Any]:
+        try:
+            counters = psutil.net_io_counters()
+        except Exception:
+            return {}
+        network = {
+            "bytes_sent": counters.bytes_sent,
+            "bytes_recv": counters.bytes_recv,
+            "packets_sent": counters.packets_sent,
+            "packets_recv": counters.packets_recv,
+        }
+        previous, self._previous_network = self._previous_network, (now, counters)
+        if previous:
+            elapsed = now - previous[0]
+            if elapsed > 0:
+                network["sent_per_second"] = max(0.0, (counters.bytes_sent - previous[1].bytes_sent) / elapsed)
+                network["recv_per_second"] = max(0.0, (counters.bytes_recv - previous[1].bytes_recv) / elapsed)
+        return network
+
+    @staticmethod
+    def _processes() -> List[Dict[str, Any]]:
+        # process_iter кэширует объекты Process, поэтому cpu_percent — за время с прошлого снимка
+        processes = []
+        for proc in psutil.process_iter(PROCESS_ATTRS):
+            try:
+                info = proc.info
+                name = (info['name'] or '').lower()
+                if not any(keyword in name for keyword in PROCESS_KEYWORDS):
+                    continue
+                processes.append({
+                    "pid": info['pid'],
+                    "name": info['name'],
+                    "cpu_percent": info['cpu_percent'] or 0,
+                    "memory_percent": round(info['memory_percent'] or 0, 2),
+                    "status": info['status'],
+                })
+            except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+                continue
+        processes.sort(key=lambda item: item['cpu_percent'], reverse=True)
+        return processes
+
+    def sample_once(self) -> Dict[str, Any]:
+        """Снять метрики (вызывается в потоке, не блокирует event loop)"""
+        now = time.time()
+        load_avg = os.getloadavg() if hasattr(os, 'getloadavg') else (0, 0, 0)
+        memory = psutil.virtual_memory()
+        disk = psutil.disk_usage(self.disk_path)
+        processes = self._processes()
+
+        sample = {
+            "cpu": {
+                "usage_percent": psutil.cpu_percent(interval=None),
+                "cores": psutil.cpu_count(),
+                "load_avg_1m": load_avg[0],
+                "load_avg_5m": load_avg[1],
+                "load_avg_15m": load_avg[2],
+            },
+            "memory": {
+                "total": memory.total,
+                "available": memory.available,
+                "used": memory.used,
+                "usage_percent": memory.percent,
+                "free": memory.free,
+            },
+            "disk": {
+                "total": disk.total,
+                "used": disk.used,
+                "free": disk.free,
+                "usage_percent": (disk.used / disk.total) * 100 if disk.total else 0,
+            },
+            "network": self._network(now),
+            "processes": processes[:TOP_PROCESSES],
+            "total_processes": len(processes),
+            "timestamp": datetime.utcfromtimestamp(now).isoformat(),
+        }
+        with self._lock:
+            self._samples.append(sample)
+        self._export(sample, processes)
+        return sample
+
+    def _export(self, sample: Dict[str, Any], processes: List[Dict[str, Any]]) -> None:
+        if not METRICS_ENABLED:
+            return
+        try:
+            cpu, memory, disk, network = sample["cpu"], sample["memory"], sample["disk"], sample["network"]
+            HOST_CPU_PERCENT.set(cpu["usage_percent"])
+            for period in ('1m', '5m', '15m'):
+                HOST_LOAD_AVG.labels(period=period).set(cpu[f"load_avg_{period}"])
+            for state in ('total', 'available', 'used', 'free'):
+                HOST_MEMORY_BYTES.labels(state=state).set(memory[state])
+            HOST_MEMORY_PERCENT.set(memory["usage_percent"])
+            for state in ('total', 'used', 'free'):
+                HOST_DISK_BYTES.labels(state=state).set(disk[state])
+            HOST_DISK_PERCENT.set(disk["usage_percent"])
+            if "sent_per_second" in network:
+                HOST_NETWORK_BYTES_PER_SECOND.labels(direction='sent').set(network["sent_per_second"])
+                HOST_NETWORK_BYTES_PER_SECOND.labels(direction='recv').set(network["recv_per_second"])
+
+            # По именам процессов, а не по pid — чтобы не плодить серии
+            groups: Dict[str, List[float]] = {}
+            for proc in processes:
+                group = groups.setdefault(proc["name"], [0.0, 0.0, 0])
+                group[0] += proc["cpu_percent"]
+                group[1] += proc["memory_percent"]
+                group[2] += 1
+            for name in self._process_groups - groups.keys():
+                PROCESS_GROUP_CPU_PERCENT.remove(name)
+                PROCESS_GROUP_MEMORY_PERCENT.remove(name)
+                PROCESS_GROUP_COUNT.remove(name)
+            for name, (cpu_percent, memory_percent, count) in groups.items():
+                PROCESS_GROUP_CPU_PERCENT.labels(name=name).set(cpu_percent)
+                PROCESS_GROUP_MEMORY_PERCENT.labels(name=name).set(memory_percent)
+                PROCESS_GROUP_COUNT.labels(name=name).set(count)
+            self._process_groups = set(groups)
+        except Exception as e:
+            logger.debug(f"Не удалось обновить метрики хоста: {e}")
+
+    # --- Чтение ---
+
+    def latest(self) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._samples[-1] if self._samples else None
+
+    def history(self, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Снимки от старых к новым, без списков процессов"""
+        with self._lock:
+            samples = list(self._samples)
+        if limit:
+            samples = samples[-limit:]
+        return [{key: value for key, value in sample.items() if key != "processes"} for sample in samples]
+
+    async def get_latest(self) -> Dict[str, Any]:
+        """Последний снимок; если сэмплер еще не успел — снять в потоке"""
+        return self.latest() or await asyncio.to_thread(self.sample_once)
+
+    async def run(self) -> None:
+        """Фоновый цикл (запускается в lifespan)"""
+        logger.info(f"🖥️ Сэмплер метрик хоста запущен: шаг {self.interval} с, история {self._samples.maxlen}")
+        while True:
+            try:
+                await asyncio.to_thread(self.sample_once)
+            except Exception as e:
+                logger.error(f"❌ Ошибка сэмплера метрик хоста: {e}")
+            await asyncio.sleep(self.interval)
+
+
+# Глобальный экземпляр
+host_metrics_sampler = HostMetricsSampler()
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+"""
+Пересчет дневных итогов ассистентов (assistant_daily_stats) из истории
+
+    python scripts/rebuild_assistant_stats.py                     # вся история
+    python scripts/rebuild_assistant_stats.py --since 2026-10-01  # только с даты
+"""
+import argparse
+import os
+import sys
+from datetime import date
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import SessionLocal  # noqa: E402
+from services.assistant_stats import rebuild_assistant_stats  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Пересчет дневных итогов ассистентов")
+    parser.add_argument('--since', type=date.fromisoformat, help="Пересчитать начиная с даты (YYYY-MM-DD)")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        rows = rebuild_assistant_stats(db, since=args.since)
+        print(f"✅ Итоги пересчитаны, строк: {rows}")
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+"""
+Пересчет счетчиков сообщений ассистента (message_quota_counters) из истории
+
+    python scripts/rebuild_message_quota.py              # все пользователи
+    python scripts/rebuild_message_quota.py --user-id 42
+"""
+import argparse
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import SessionLocal  # noqa: E402
+from services.message_quota import rebuild_counters  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Пересчет счетчиков сообщений из истории")
+    parser.add_argument('--user-id', type=int, help="Пересчитать только одного пользователя")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        users = rebuild_counters(db, user_id=args.user_id)
+        print(f"✅ Счетчики пересчитаны для пользователей: {users}")
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
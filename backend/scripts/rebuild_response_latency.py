@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+"""
+Пересчет почасовых скетчей времени ответа (response_latency_sketches) из истории
+
+    python scripts/rebuild_response_latency.py                     # вся история
+    python scripts/rebuild_response_latency.py --since 2026-10-01  # только с даты
+"""
+import argparse
+import os
+import sys
+from datetime import datetime
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import SessionLocal  # noqa: E402
+from services.response_latency import rebuild_sketches  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Пересчет скетчей времени ответа")
+    parser.add_argument('--since', type=datetime.fromisoformat, help="Пересчитать начиная с даты (ISO)")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        rows = rebuild_sketches(db, since=args.since)
+        print(f"✅ Скетчи пересчитаны, строк: {rows}")
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Повтор webhook-событий ЮKassa
+
+Возвращает сохраненные события в очередь фонового обработчика или загружает
+сырые уведомления из JSONL-файла (по одному JSON на строку, например
+выгрузка из личного кабинета ЮKassa). Повтор безопасен: баланс пополняется
+только при переходе платежа в completed.
+
+    python scripts/replay_payment_webhooks.py --status failed --since 2026-10-01
+    python scripts/replay_payment_webhooks.py --payment-id 2c9a... --status applied --apply
+    python scripts/replay_payment_webhooks.py --file notifications.jsonl --apply
+"""
+import argparse
+import json
+import os
+import sys
+from datetime import datetime
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import SessionLocal  # noqa: E402
+from services.payment_webhooks import FAILED, payment_webhook_processor  # noqa: E402
+
+
+def ingest_file(db, path: str) -> int:
+    """Загрузить уведомления из файла; уже полученные события пропускаются"""
+    stored = duplicates = 0
+    with open(path, encoding='utf-8') as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                payload = json.loads(line)
+            except json.JSONDecodeError as e:
+                print(f"⚠️  Строка {line_no}: некорректный JSON ({e})")
+                continue
+            if payment_webhook_processor.ingest(db, payload, source_ip='replay'):
+                stored += 1
+            else:
+                duplicates += 1
+    print(f"📥 Загружено событий: {stored}, уже были в БД: {duplicates}")
+    return stored
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Повтор webhook-событий ЮKassa")
+    parser.add_argument('--payment-id', help="ID платежа ЮKassa")
+    parser.add_argument('--since', type=datetime.fromisoformat, help="Только события, полученные после даты (ISO)")
+    parser.add_argument('--status', action='append',
+                        help="Статусы событий для повтора (по умолчанию failed; можно несколько раз)")
+    parser.add_argument('--event-id', type=int, action='append', help="ID события в payment_webhook_events")
+    parser.add_argument('--file', help="JSONL с сырыми уведомлениями ЮKassa")
+    parser.add_argument('--apply', action='store_true', help="Сразу применить очередь в этом процессе")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        if args.file:
+            ingest_file(db, args.file)
+        else:
+            count = payment_webhook_processor.replay(
+                db,
+                payment_id=args.payment_id,
+                since=args.since,
+                statuses=args.status or (FAILED,),
+                event_ids=args.event_id,
+            )
+            print(f"🔁 Возвращено в очередь событий: {count}")
+    finally:
+        db.close()
+
+    if args.apply:
+        total = 0
+        while True:
+            processed = payment_webhook_processor.process_batch()
+            total += processed
+            if not processed:
+                break
+        print(f"✅ Применено событий: {total}")
+
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,7 @@ from functools import lru_cache
 from sqlalchemy.orm import Session
 from sqlalchemy import func, desc, text, case
 from database import models
+from services import response_latency
 
 logger = logging.getLogger(__name__)
 
@@ -87,84 +88,26 @@ class AnalyticsService:
             }
 
     def get_real_ai_response_times(self, db: Session, period_days: int = 7) -> Dict[str, float]:
-        """Получает реальные времена ответа AI из таблицы AITokenUsage"""
+        """Времена ответа AI-провайдера из почасовых скетчей (среднее, медиана, P95)"""
         try:
             period_start = datetime.utcnow() - timedelta(days=period_days)
-            
-            # Получаем основную статистику (с проверкой существования таблицы)
-            try:
-                basic_stats = db.query(
-                    func.avg(models.AITokenUsage.response_time).label('avg_time'),
-                    func.count(models.AITokenUsage.response_time).label('count_time'),
-                    func.min(models.AITokenUsage.response_time).label('min_time'),
-                    func.max(models.AITokenUsage.response_time).label('max_time')
-                ).filter(
-                    models.AITokenUsage.created_at >= period_start,
-                    models.AITokenUsage.success == True,
-                    models.AITokenUsage.response_time > 0
-                ).first()
-            except Exception as stats_error:
-                logger.warning(f"Ошибка получения basic_stats (таблица AITokenUsage может не существовать): {stats_error}")
-                basic_stats = None
-            
-            # Если есть данные, вычисляем дополнительные метрики
-            if basic_stats and basic_stats.avg_time is not None and basic_stats.count_time > 0:
-                avg_time = round(float(basic_stats.avg_time), 2)
-                
-                # Для медианы и P95 используем простое приближение без percentile_cont
-                # Получаем отсортированные времена ответа
-                try:
-                    response_times = db.query(models.AITokenUsage.response_time).filter(
-                        models.AITokenUsage.created_at >= period_start,
-                        models.AITokenUsage.success == True,
-                        models.AITokenUsage.response_time > 0
-                    ).order_by(models.AITokenUsage.response_time).all()
-                    
-                    if response_times:
-                        times_list = [float(rt[0]) for rt in response_times]
-                        count = len(times_list)
-                        
-                        # Медиана
-                        median_idx = count // 2
-                        if count % 2 == 0:
-                            median_time = (times_list[median_idx - 1] + times_list[median_idx]) / 2
-                        else:
-                            median_time = times_list[median_idx]
-                        
-                        # P95
-                        p95_idx = int(0.95 * count)
-                        if p95_idx >= count:
-                            p95_idx = count - 1
-                        p95_time = times_list[p95_idx]
-                        
-                        return {
-                            "average_response_time": avg_time,
-                            "median_response_time": round(median_time, 2),
-                            "p95_response_time": round(p95_time, 2)
-                        }
-                        
-                except Exception as percentile_error:
-                    logger.warning(f"Не удалось вычислить медиану и P95: {percentile_error}")
-                    # Возвращаем хотя бы среднее время
-                    return {
-                        "average_response_time": avg_time,
-                        "median_response_time": avg_time,  # Используем среднее как приближение
-                        "p95_response_time": avg_time * 1.5  # Простое приближение для P95
-                    }
-                
-                return {
-                    "average_response_time": avg_time,
-                    "median_response_time": avg_time,
-                    "p95_response_time": avg_time * 1.5
-                }
-            else:
+            sketch = response_latency.get_sketch(db, response_latency.SOURCE_AI, period_start)
+
+            if not sketch.count:
                 logger.warning("Нет данных о временах ответа AI")
                 return {
                     "average_response_time": 0.0,
                     "median_response_time": 0.0,
                     "p95_response_time": 0.0
                 }
-                
+
+            summary = sketch.summary()
+            return {
+                "average_response_time": summary['average'],
+                "median_response_time": summary['p50'],
+                "p95_response_time": summary['p95']
+            }
+
         except Exception as e:
             logger.error(f"Ошибка получения AI response times: {e}")
             return {
@@ -0,0 +1,151 @@
+"""
+Дневные итоги по ассистентам для /assistants/stats и /assistants/{id}/stats
+
+Итоги (сообщения ассистента и новые диалоги за день) обновляются в транзакции
+вставки сообщения или диалога (ORM-событие after_insert, INSERT ... ON CONFLICT
+DO UPDATE), а эндпоинты отвечают одной суммой по диапазону дней вместо COUNT
+по dialog_messages — время ответа не зависит от объема переписки.
+"""
+
+import logging
+from datetime import date, datetime, timedelta
+from typing import Dict, Optional
+
+from sqlalchemy import case, delete, event, func, literal, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from database.models import Assistant, AssistantDailyStat, Dialog, DialogMessage
+from services.message_quota import COUNTED_SENDER, dialog_info
+
+logger = logging.getLogger(__name__)
+
+REBUILD_INSERT_BATCH = 1000
+
+_INSERTS = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}
+
+
+def _day(moment: Optional[datetime]) -> date:
+    return (moment or datetime.utcnow()).date()
+
+
+def increment(connection, user_id: int, assistant_id: int, day: date, messages: int = 0, dialogs: int = 0):
+    """Атомарно прибавить к дневным итогам ассистента"""
+    insert = _INSERTS.get(connection.dialect.name)
+    if insert is None:
+        return
+    # INSERT ... SELECT из assistants: если ассистент уже удален (кэш диалогов в другом
+    # процессе мог его еще помнить), строка не вставляется вместо нарушения FK,
+    # которое откатило бы вставку самого сообщения
+    source = select(
+        literal(user_id), Assistant.id, literal(day), literal(messages), literal(dialogs)
+    ).where(Assistant.id == assistant_id)
+    stmt = insert(AssistantDailyStat).from_select(
+        ['user_id', 'assistant_id', 'day', 'messages', 'dialogs'], source
+    )
+    connection.execute(stmt.on_conflict_do_update(
+        index_elements=['user_id', 'assistant_id', 'day'],
+        set_={
+            'messages': AssistantDailyStat.messages + stmt.excluded.messages,
+            'dialogs': AssistantDailyStat.dialogs + stmt.excluded.dialogs,
+        },
+    ))
+
+
+@event.listens_for(DialogMessage, "after_insert")
+def _count_message(mapper, connection, target):
+    if target.sender != COUNTED_SENDER or target.dialog_id is None:
+        return
+    user_id, assistant_id = dialog_info(connection, target)
+    if user_id is not None and assistant_id is not None:
+        increment(connection, user_id, assistant_id, _day(target.timestamp), messages=1)
+
+
+@event.listens_for(Dialog, "after_insert")
+def _count_dialog(mapper, connection, target):
+    if target.user_id is not None and target.assistant_id is not None:
+        increment(connection, target.user_id, target.assistant_id, _day(target.started_at), dialogs=1)
+
+
+def get_totals_by_assistant(db: Session, user_id: int, since: date) -> Dict[int, Dict[str, int]]:
+    """{assistant_id: {'messages', 'dialogs'}} начиная с дня since — один запрос по индексу"""
+    rows = db.execute(
+        select(
+            AssistantDailyStat.assistant_id,
+            func.sum(AssistantDailyStat.messages),
+            func.sum(AssistantDailyStat.dialogs),
+        )
+        .where(AssistantDailyStat.user_id == user_id, AssistantDailyStat.day >= since)
+        .group_by(AssistantDailyStat.assistant_id)
+    ).all()
+    return {assistant_id: {'messages': int(messages or 0), 'dialogs': int(dialogs or 0)}
+            for assistant_id, messages, dialogs in rows}
+
+
+def get_assistant_totals(db: Session, user_id: int, assistant_id: int,
+                         month_since: date, week_since: date) -> Dict[str, int]:
+    """Итоги ассистента за все время, месяц и неделю — одним запросом"""
+    def total(column, since=None):
+        value = column if since is None else case((AssistantDailyStat.day >= since, column), else_=0)
+        return func.coalesce(func.sum(value), 0)
+
+    row = db.execute(
+        select(
+            total(AssistantDailyStat.messages).label('total_messages'),
+            total(AssistantDailyStat.dialogs).label('total_dialogs'),
+            total(AssistantDailyStat.messages, month_since).label('monthly_messages'),
+            total(AssistantDailyStat.dialogs, month_since).label('monthly_dialogs'),
+            total(AssistantDailyStat.messages, week_since).label('weekly_messages'),
+            total(AssistantDailyStat.dialogs, week_since).label('weekly_dialogs'),
+        ).where(AssistantDailyStat.user_id == user_id, AssistantDailyStat.assistant_id == assistant_id)
+    ).one()
+    return {key: int(value) for key, value in row._mapping.items()}
+
+
+def days_back(days: int, now: Optional[datetime] = None) -> date:
+    """Первый день окна «последние N дней» (включая сегодняшний неполный день)"""
+    return ((now or datetime.utcnow()) - timedelta(days=days)).date()
+
+
+def rebuild_assistant_stats(db: Session, since: Optional[date] = None) -> int:
+    """Пересчитать итоги из истории (целиком или начиная с дня since); возвращает число строк"""
+    message_day = func.date(DialogMessage.timestamp)
+    dialog_day = func.date(Dialog.started_at)
+
+    messages_query = (
+        select(Dialog.user_id, Dialog.assistant_id, message_day, func.count(DialogMessage.id))
+        .join(Dialog, Dialog.id == DialogMessage.dialog_id)
+        .where(DialogMessage.sender == COUNTED_SENDER, DialogMessage.timestamp.isnot(None),
+               Dialog.user_id.isnot(None), Dialog.assistant_id.isnot(None))
+        .group_by(Dialog.user_id, Dialog.assistant_id, message_day)
+    )
+    dialogs_query = (
+        select(Dialog.user_id, Dialog.assistant_id, dialog_day, func.count(Dialog.id))
+        .where(Dialog.started_at.isnot(None), Dialog.user_id.isnot(None), Dialog.assistant_id.isnot(None))
+        .group_by(Dialog.user_id, Dialog.assistant_id, dialog_day)
+    )
+    stale = delete(AssistantDailyStat)
+    if since is not None:
+        start = datetime.combine(since, datetime.min.time())
+        messages_query = messages_query.where(DialogMessage.timestamp >= start)
+        dialogs_query = dialogs_query.where(Dialog.started_at >= start)
+        stale = stale.where(AssistantDailyStat.day >= since)
+
+    totals = {}
+    for column, query in (('messages', messages_query), ('dialogs', dialogs_query)):
+        for user_id, assistant_id, day, count in db.execute(query):
+            if isinstance(day, str):
+                day = date.fromisoformat(day)
+            row = totals.setdefault((user_id, assistant_id, day), {
+                'user_id': user_id, 'assistant_id': assistant_id, 'day': day, 'messages': 0, 'dialogs': 0
+            })
+            row[column] += count
+
+    rows = list(totals.values())
+    db.execute(stale)
+    for start_index in range(0, len(rows), REBUILD_INSERT_BATCH):
+        db.execute(AssistantDailyStat.__table__.insert(), rows[start_index:start_index + REBUILD_INSERT_BATCH])
+    db.commit()
+
+    logger.info(f"📊 Итоги ассистентов пересчитаны: строк={len(rows)}, с {since or 'начала истории'}")
+    return len(rows)
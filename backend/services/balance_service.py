@@ -1,14 +1,147 @@
 from sqlalchemy.orm import Session
-from sqlalchemy import desc
+from sqlalchemy import desc, text
 from database.models import UserBalance, BalanceTransaction, ServicePrice, User
 from database.schemas import BalanceTransactionRead, ServicePriceRead
-from typing import List, Optional
+from typing import List, Optional, Dict, Tuple
 from datetime import datetime
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
 import logging
+import os
+import threading
+import time
 from integrations.email_service import email_service
+from services import billing_preauth
 
 logger = logging.getLogger(__name__)
 
+try:
+    from prometheus_client import Counter
+    BILLING_CHARGES = Counter('billing_charges_total', 'Service charges by path', ['service_type', 'path'])
+    BILLING_DECLINED = Counter('billing_charges_declined_total', 'Charges declined for insufficient funds', ['service_type'])
+    METRICS_ENABLED = True
+except ImportError:
+    METRICS_ENABLED = False
+
+PRICE_CACHE_TTL_SECONDS = int(os.getenv('SERVICE_PRICE_CACHE_TTL', '60'))
+LOW_BALANCE_WARNING_MESSAGES = 50
+BALANCE_WARNING_KEY = "balance:warning_sent:{user_id}:{level}"
+BALANCE_WARNING_TTL_SECONDS = 90 * 24 * 3600
+DEFAULT_MESSAGE_PRICE = Decimal("5.0")
+
+# service_type -> (price, description); цены меняются редко, а читаются на каждом AI сообщении
+_price_cache: Dict[str, Tuple[Decimal, Optional[str]]] = {}
+_price_cache_loaded_at = 0.0
+_price_cache_lock = threading.Lock()
+
+# Уведомления о балансе уходят в фоне, чтобы не задерживать ответ пользователю
+_notification_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="balance-notify")
+
+# Одно выражение: условное списание + запись в журнал. Если средств не хватает, UPDATE
+# не затрагивает строк и INSERT ничего не вставляет — гонка ниже нуля невозможна.
+_CHARGE_SQL = text("""
+    WITH debit AS (
+        UPDATE user_balances
+        SET balance = balance - :amount,
+            total_spent = total_spent + :amount,
+            updated_at = :now
+        WHERE user_id = :user_id AND balance >= :amount
+        RETURNING user_id, balance + :amount AS balance_before, balance AS balance_after
+    )
+    INSERT INTO balance_transactions
+        (user_id, amount, transaction_type, description, balance_before, balance_after, related_id, created_at)
+    SELECT user_id, -:amount, :service_type, :description, balance_before, balance_after, :related_id, :now
+    FROM debit
+    RETURNING id, balance_before, balance_after
+""")
+
+# Резерв блока предавторизации: списание без строки журнала (строки по сообщениям пишутся при settle)
+_RESERVE_SQL = text("""
+    UPDATE user_balances
+    SET balance = balance - :amount,
+        total_spent = total_spent + :amount,
+        updated_at = :now
+    WHERE user_id = :user_id AND balance >= :amount
+    RETURNING balance + :amount AS balance_before
+""")
+
+
+def invalidate_price_cache():
+    """Сбросить кэш цен (после изменения service_prices)"""
+    global _price_cache_loaded_at
+    with _price_cache_lock:
+        _price_cache.clear()
+        _price_cache_loaded_at = 0.0
+
+
+def get_cached_price(db: Session, service_type: str) -> Optional[Tuple[Decimal, Optional[str]]]:
+    """Цена и описание активной услуги из кэша процесса"""
+    global _price_cache_loaded_at
+    if time.monotonic() - _price_cache_loaded_at > PRICE_CACHE_TTL_SECONDS:
+        rows = db.query(ServicePrice.service_type, ServicePrice.price, ServicePrice.description).filter(
+            ServicePrice.is_active == True
+        ).all()
+        with _price_cache_lock:
+            _price_cache.clear()
+            _price_cache.update({row.service_type: (Decimal(str(row.price)), row.description) for row in rows})
+            _price_cache_loaded_at = time.monotonic()
+    return _price_cache.get(service_type)
+
+
+def _redis():
+    try:
+        from cache.redis_cache import cache
+        return cache.redis_client
+    except Exception:
+        return None
+
+
+def _claim_balance_warning(user_id: int, messages_remaining: int) -> bool:
+    """Одно письмо на каждый порог до следующего пополнения (без Redis — как раньше)"""
+    redis_client = _redis()
+    if not redis_client:
+        return True
+    try:
+        key = BALANCE_WARNING_KEY.format(user_id=user_id, level=messages_remaining)
+        return bool(redis_client.set(key, 1, nx=True, ex=BALANCE_WARNING_TTL_SECONDS))
+    except Exception as e:
+        logger.warning(f"Balance warning dedupe unavailable: {e}")
+        return True
+
+
+def reset_balance_warnings(user_id: int):
+    """Сбросить отметки об отправленных предупреждениях (после пополнения баланса)"""
+    redis_client = _redis()
+    if not redis_client:
+        return
+    try:
+        redis_client.delete(*[
+            BALANCE_WARNING_KEY.format(user_id=user_id, level=level)
+            for level in (0, LOW_BALANCE_WARNING_MESSAGES)
+        ])
+    except Exception as e:
+        logger.warning(f"Failed to reset balance warnings for user {user_id}: {e}")
+
+
+def _send_balance_warning(user_id: int, messages_remaining: int):
+    """Отправка письма о балансе (выполняется в фоновом потоке со своей сессией)"""
+    from database.connection import SessionLocal
+    db = SessionLocal()
+    try:
+        email = db.query(User.email).filter(User.id == user_id).scalar()
+        if not email:
+            return
+        if messages_remaining == 0:
+            email_service.send_balance_depleted_email(email)
+            logger.info(f"Balance depleted email sent to {email}")
+        else:
+            email_service.send_low_balance_warning_email(email, messages_remaining)
+            logger.info(f"Low balance warning email sent to {email} (remaining: {messages_remaining})")
+    except Exception as e:
+        logger.error(f"Failed to send balance warning email for user {user_id}: {e}")
+    finally:
+        db.close()
+
 class BalanceService:
     """Сервис для работы с балансом пользователей"""
     
@@ -66,62 +199,122 @@ class BalanceService:
         self.db.commit()
         self.db.refresh(transaction)
         self.db.refresh(balance)
+        reset_balance_warnings(user_id)
         
         logger.info(f"Пополнен баланс пользователя {user_id} на {amount} руб. Новый баланс: {balance_after}")
         return transaction
     
     def charge_for_service(self, user_id: int, service_type: str, description: Optional[str] = None, related_id: Optional[int] = None) -> BalanceTransaction:
-        """Списать средства за услугу"""
-        # Получаем цену услуги
-        service_price = self.db.query(ServicePrice).filter(
-            ServicePrice.service_type == service_type,
-            ServicePrice.is_active == True
-        ).first()
-        
-        if not service_price:
+        """Списать средства за услугу
+
+        Списание и запись в журнал выполняются одним условным UPDATE ... RETURNING,
+        поэтому параллельные чаты не могут увести баланс ниже нуля.
+        """
+        price = get_cached_price(self.db, service_type)
+        if not price:
             logger.error(f"Цена для услуги {service_type} не найдена")
             raise ValueError(f"Цена для услуги {service_type} не найдена")
         
-        amount = service_price.price
-        balance = self.get_or_create_balance(user_id)
+        amount, price_description = price
+        description = description or price_description or f"Оплата за {service_type}"
         
-        # Проверяем достаточность средств
-        if balance.balance < amount:
-            logger.warning(f"Недостаточно средств у пользователя {user_id}. Баланс: {balance.balance}, требуется: {amount}")
-            raise ValueError(f"Недостаточно средств. Баланс: {balance.balance} руб., требуется: {amount} руб.")
+        if billing_preauth.is_enabled(service_type):
+            transaction = self._charge_from_preauth(user_id, service_type, amount, description, related_id)
+            if transaction:
+                return transaction
         
-        balance_before = float(balance.balance)
-        balance_after = balance_before - float(amount)
+        params = {
+            "user_id": user_id,
+            "amount": amount,
+            "service_type": service_type,
+            "description": description,
+            "related_id": related_id,
+            "now": datetime.utcnow()
+        }
+        row = self.db.execute(_CHARGE_SQL, params).first()
         
-        # Создаем транзакцию
-        transaction = BalanceTransaction(
-            user_id=user_id,
-            amount=-amount,  # Отрицательная сумма для списания
-            transaction_type=service_type,
-            description=description or service_price.description or f"Оплата за {service_type}",
-            balance_before=balance_before,
-            balance_after=balance_after,
-            related_id=related_id
-        )
+        if row is None:
+            # Условный UPDATE ничего не изменил, откатывать нечего: несохраненные
+            # изменения вызывающего кода в этой сессии остаются нетронутыми.
+            # Нет строки баланса или не хватает средств — различаем только для сообщения об ошибке
+            current_balance = self.db.query(UserBalance.balance).filter(
+                UserBalance.user_id == user_id
+            ).scalar() or 0
+            if current_balance >= amount:
+                # Баланс пополнен параллельно между UPDATE и чтением — одна повторная попытка
+                row = self.db.execute(_CHARGE_SQL, params).first()
+            if row is None:
+                if METRICS_ENABLED:
+                    BILLING_DECLINED.labels(service_type=service_type).inc()
+                logger.warning(f"Недостаточно средств у пользователя {user_id}. Баланс: {current_balance}, требуется: {amount}")
+                raise ValueError(f"Недостаточно средств. Баланс: {current_balance} руб., требуется: {amount} руб.")
         
-        # Обновляем баланс
-        balance.balance = balance_after
-        balance.total_spent = float(balance.total_spent) + float(amount)
-        balance.updated_at = datetime.utcnow()
-        
-        # Добавляем измененные объекты в сессию
-        self.db.add(balance)
-        self.db.add(transaction)
         self.db.commit()
-        self.db.refresh(transaction)
-        self.db.refresh(balance)
         
-        logger.info(f"Списано {amount} руб. с баланса пользователя {user_id} за {service_type}. Новый баланс: {balance_after}")
+        if METRICS_ENABLED:
+            BILLING_CHARGES.labels(service_type=service_type, path="atomic").inc()
+        logger.info(f"Списано {amount} руб. с баланса пользователя {user_id} за {service_type}. Новый баланс: {row.balance_after}")
         
         # Проверяем нужно ли отправить уведомление о низком балансе
-        self._check_and_send_balance_warnings(user_id, balance_after)
+        self._check_and_send_balance_warnings(user_id, float(row.balance_after))
         
-        return transaction
+        # Строка записана сырым SQL — загружаем ее в сессию (created_at, значения по умолчанию)
+        return self.db.get(BalanceTransaction, row.id)
+    
+    def _charge_from_preauth(self, user_id: int, service_type: str, amount: Decimal, description: str,
+                             related_id: Optional[int]) -> Optional[BalanceTransaction]:
+        """Списание из предавторизованной квоты в Redis; None — использовать обычный путь"""
+        preauth = billing_preauth.BillingPreauth()
+        if not preauth.available:
+            return None
+        try:
+            balance_after = preauth.consume(user_id, service_type, amount, description, related_id)
+            if balance_after is None and self._reserve_preauth_block(preauth, user_id, service_type, amount):
+                balance_after = preauth.consume(user_id, service_type, amount, description, related_id)
+        except Exception as e:
+            logger.warning(f"Предавторизация недоступна для пользователя {user_id}: {e}")
+            return None
+        
+        if balance_after is None:
+            return None
+        
+        if METRICS_ENABLED:
+            BILLING_CHARGES.labels(service_type=service_type, path="preauth").inc()
+        self._check_and_send_balance_warnings(user_id, float(balance_after))
+        
+        # Строка журнала будет записана settle_preauthorizations
+        return BalanceTransaction(
+            user_id=user_id,
+            amount=-amount,
+            transaction_type=service_type,
+            description=description,
+            balance_before=balance_after + amount,
+            balance_after=balance_after,
+            related_id=related_id
+        )
+    
+    def _reserve_preauth_block(self, preauth: "billing_preauth.BillingPreauth", user_id: int,
+                               service_type: str, amount: Decimal) -> bool:
+        """Зарезервировать на балансе новый блок сообщений"""
+        if not preauth.acquire_lock(user_id, service_type):
+            return False
+        try:
+            # Остаток прежнего блока меньше цены сообщения — возвращаем его перед новым резервом
+            billing_preauth.refund_hold(self.db, user_id, preauth.close_hold(user_id, service_type))
+            
+            block = amount * billing_preauth.PREAUTH_MESSAGES
+            row = self.db.execute(_RESERVE_SQL, {
+                "user_id": user_id, "amount": block, "now": datetime.utcnow()
+            }).first()
+            if row is None:
+                # Баланса не хватает на целый блок — списываем поштучно (UPDATE ничего не изменил)
+                return False
+            self.db.commit()
+            preauth.open_hold(user_id, service_type, row.balance_before, block)
+            logger.info(f"Предавторизовано {block} руб. ({billing_preauth.PREAUTH_MESSAGES} × {service_type}) для пользователя {user_id}")
+            return True
+        finally:
+            preauth.release_lock(user_id, service_type)
     
     def get_transactions(self, user_id: int, limit: int = 50) -> List[BalanceTransaction]:
         """Получить историю транзакций пользователя"""
@@ -155,20 +348,17 @@ class BalanceService:
         
         self.db.commit()
         self.db.refresh(service_price)
+        invalidate_price_cache()
         return service_price
     
     def check_sufficient_balance(self, user_id: int, service_type: str) -> bool:
         """Проверить достаточность средств для услуги"""
-        service_price = self.db.query(ServicePrice).filter(
-            ServicePrice.service_type == service_type,
-            ServicePrice.is_active == True
-        ).first()
-        
-        if not service_price:
+        price = get_cached_price(self.db, service_type)
+        if not price:
             return False
         
         balance = self.get_balance(user_id)
-        return balance >= service_price.price
+        return balance >= price[0]
     
     def give_welcome_bonus(self, user_id: int, amount: float = 250.0) -> Optional[BalanceTransaction]:
         """Начислить приветственный бонус новому пользователю"""
@@ -203,40 +393,27 @@ class BalanceService:
             return None
     
     def _check_and_send_balance_warnings(self, user_id: int, current_balance: float):
-        """Проверяет баланс и отправляет предупреждения при необходимости"""
+        """Проверяет баланс и ставит отправку предупреждения в фон при необходимости"""
         try:
-            # Получаем пользователя для отправки email
-            user = self.db.query(User).filter(User.id == user_id).first()
-            if not user or not user.email:
-                return
-            
             # Получаем цену одного сообщения для правильного расчета
-            service_price = self.db.query(ServicePrice).filter(
-                ServicePrice.service_type == "ai_message",
-                ServicePrice.is_active == True
-            ).first()
-            
-            if not service_price:
-                logger.warning(f"Service price for ai_message not found, using default 5.0")
-                price_per_message = 5.0
+            price = get_cached_price(self.db, "ai_message")
+            if not price:
+                logger.warning(f"Service price for ai_message not found, using default {DEFAULT_MESSAGE_PRICE}")
+                price_per_message = DEFAULT_MESSAGE_PRICE
             else:
-                price_per_message = service_price.price
+                price_per_message = price[0]
             
             # Конвертируем баланс в количество сообщений (баланс / цена_за_сообщение)
-            messages_remaining = int(current_balance / price_per_message)
+            messages_remaining = int(Decimal(str(current_balance)) / price_per_message)
             
-            # Отправляем только 2 важных уведомления БЕЗ ДУБЛИРОВАНИЯ
-            if messages_remaining == 0:
-                # Баланс закончился - критический алерт (отправляем только один раз)
-                email_service.send_balance_depleted_email(user.email)
-                logger.info(f"Balance depleted email sent to {user.email}")
-            elif messages_remaining == 50:
-                # Осталось ровно 50 сообщений - предупреждающий алерт (отправляем только один раз)
-                email_service.send_low_balance_warning_email(user.email, messages_remaining)
-                logger.info(f"Low balance warning email sent to {user.email} (remaining: {messages_remaining})")
+            # Отправляем только 2 важных уведомления БЕЗ ДУБЛИРОВАНИЯ:
+            # баланс закончился или осталось ровно 50 сообщений
+            if messages_remaining in (0, LOW_BALANCE_WARNING_MESSAGES) and \
+                    _claim_balance_warning(user_id, messages_remaining):
+                _notification_executor.submit(_send_balance_warning, user_id, messages_remaining)
                 
         except Exception as e:
-            logger.error(f"Failed to send balance warning email for user {user_id}: {e}")
+            logger.error(f"Failed to schedule balance warning email for user {user_id}: {e}")
             # Не прерываем основной процесс если email не отправился
 
 def init_default_prices(db: Session):
@@ -264,4 +441,5 @@ def init_default_prices(db: Session):
             db.add(existing)
     
     db.commit()
+    invalidate_price_cache()
     logger.info("Инициализированы и обновлены цены по умолчанию на 5.0 руб")
\ No newline at end of file
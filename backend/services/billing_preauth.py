@@ -0,0 +1,275 @@
+"""
+Предавторизованные квоты списаний в Redis для высоконагруженных виджетов
+
+Вместо UPDATE баланса на каждое сообщение с баланса один раз резервируется
+блок на BILLING_PREAUTH_MESSAGES сообщений, а дальше сообщения списываются из
+квоты в Redis атомарным Lua-скриптом. Строки журнала (balance_transactions)
+по каждому сообщению копятся в Redis и вставляются пачкой фоновым
+settle_preauthorizations; неиспользованный остаток простаивающих блоков
+возвращается на баланс.
+
+Выключено по умолчанию (BILLING_PREAUTH_MESSAGES=0).
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+from datetime import datetime
+from decimal import Decimal
+from typing import Optional, List
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger(__name__)
+
+PREAUTH_MESSAGES = int(os.getenv('BILLING_PREAUTH_MESSAGES', '0'))
+PREAUTH_SERVICES = {
+    s.strip() for s in os.getenv('BILLING_PREAUTH_SERVICES', 'widget_message').split(',') if s.strip()
+}
+PREAUTH_IDLE_SECONDS = int(os.getenv('BILLING_PREAUTH_IDLE_SECONDS', '120'))
+SETTLE_INTERVAL_SECONDS = int(os.getenv('BILLING_PREAUTH_SETTLE_SECONDS', '10'))
+SETTLE_BATCH_SIZE = 500
+
+HOLD_KEY = "billing:preauth:{user_id}:{service_type}"
+HOLD_LOCK_KEY = "billing:preauth:{user_id}:{service_type}:lock"
+HOLDS_SET_KEY = "billing:preauth:holds"
+PENDING_KEY = "billing:preauth:pending"
+
+# Списание из квоты: остаток, порядковый номер и строка журнала — одной атомарной операцией
+_CONSUME_SCRIPT = """
+local remaining = tonumber(redis.call('HGET', KEYS[1], 'remaining') or '-1')
+local price = tonumber(ARGV[1])
+if remaining < price then return -1 end
+local base = tonumber(redis.call('HGET', KEYS[1], 'base'))
+local seq = redis.call('HINCRBY', KEYS[1], 'used', 1)
+redis.call('HINCRBY', KEYS[1], 'remaining', -price)
+redis.call('HSET', KEYS[1], 'last_used', ARGV[3])
+local entry = cjson.decode(ARGV[2])
+entry['balance_before'] = base - (seq - 1) * price
+entry['balance_after'] = base - seq * price
+redis.call('RPUSH', KEYS[2], cjson.encode(entry))
+return entry['balance_after']
+"""
+
+# Закрытие блока: забираем остаток и удаляем квоту, чтобы никто не списал из нее параллельно
+_RELEASE_SCRIPT = """
+local remaining = tonumber(redis.call('HGET', KEYS[1], 'remaining') or '0')
+redis.call('DEL', KEYS[1])
+redis.call('SREM', KEYS[2], ARGV[1])
+return remaining
+"""
+
+
+def _to_kopecks(amount) -> int:
+    return int((Decimal(str(amount)) * 100).to_integral_value())
+
+
+def _from_kopecks(value: int) -> Decimal:
+    return (Decimal(value) / 100).quantize(Decimal("0.01"))
+
+
+def is_enabled(service_type: str) -> bool:
+    return PREAUTH_MESSAGES > 0 and service_type in PREAUTH_SERVICES
+
+
+class BillingPreauth:
+    """Квоты предавторизации в Redis"""
+
+    def __init__(self, redis_client=None):
+        if redis_client is None:
+            from cache.redis_cache import cache
+            redis_client = cache.redis_client
+        self.redis = redis_client
+
+    @property
+    def available(self) -> bool:
+        return self.redis is not None
+
+    def consume(self, user_id: int, service_type: str, price, description: str,
+                related_id: Optional[int] = None) -> Optional[Decimal]:
+        """
+        Списать одно сообщение из квоты
+
+        Returns:
+            Логический баланс после списания или None, если квоты нет/не хватает
+        """
+        entry = json.dumps({
+            "user_id": user_id,
+            "service_type": service_type,
+            "amount": _to_kopecks(price),
+            "description": description,
+            "related_id": related_id,
+            "created_at": datetime.utcnow().isoformat(),
+        }, ensure_ascii=False)
+        result = self.redis.eval(
+            _CONSUME_SCRIPT, 2,
+            HOLD_KEY.format(user_id=user_id, service_type=service_type), PENDING_KEY,
+            _to_kopecks(price), entry, int(time.time())
+        )
+        if int(result) < 0:
+            return None
+        return _from_kopecks(int(result))
+
+    def acquire_lock(self, user_id: int, service_type: str) -> bool:
+        return bool(self.redis.set(
+            HOLD_LOCK_KEY.format(user_id=user_id, service_type=service_type), 1, nx=True, ex=10
+        ))
+
+    def release_lock(self, user_id: int, service_type: str) -> None:
+        self.redis.delete(HOLD_LOCK_KEY.format(user_id=user_id, service_type=service_type))
+
+    def open_hold(self, user_id: int, service_type: str, balance_before, block) -> None:
+        """Зарегистрировать зарезервированный на балансе блок"""
+        key = HOLD_KEY.format(user_id=user_id, service_type=service_type)
+        pipe = self.redis.pipeline()
+        pipe.hset(key, mapping={
+            "base": _to_kopecks(balance_before),
+            "remaining": _to_kopecks(block),
+            "used": 0,
+            "last_used": int(time.time()),
+        })
+        pipe.sadd(HOLDS_SET_KEY, f"{user_id}:{service_type}")
+        pipe.execute()
+
+    def close_hold(self, user_id: int, service_type: str) -> Decimal:
+        """Закрыть блок, вернуть неиспользованный остаток (в рублях)"""
+        remaining = self.redis.eval(
+            _RELEASE_SCRIPT, 2,
+            HOLD_KEY.format(user_id=user_id, service_type=service_type), HOLDS_SET_KEY,
+            f"{user_id}:{service_type}"
+        )
+        return _from_kopecks(int(remaining or 0))
+
+    def idle_holds(self) -> List[tuple]:
+        """Блоки, из которых давно не списывали"""
+        threshold = time.time() - PREAUTH_IDLE_SECONDS
+        members = [m.decode() if isinstance(m, bytes) else m for m in self.redis.smembers(HOLDS_SET_KEY)]
+        if not members:
+            return []
+        pipe = self.redis.pipeline()
+        for member in members:
+            user_id, service_type = member.split(":", 1)
+            pipe.hget(HOLD_KEY.format(user_id=user_id, service_type=service_type), "last_used")
+        result = []
+        for member, last_used in zip(members, pipe.execute()):
+            if last_used is None or int(last_used) < threshold:
+                user_id, service_type = member.split(":", 1)
+                result.append((int(user_id), service_type))
+        return result
+
+    def pop_pending(self, count: int) -> List[dict]:
+        entries = self.redis.lpop(PENDING_KEY, count) or []
+        return [json.loads(entry) for entry in entries]
+
+    def push_back(self, entries: List[dict]) -> None:
+        if entries:
+            self.redis.lpush(PENDING_KEY, *[json.dumps(e, ensure_ascii=False) for e in reversed(entries)])
+
+
+def refund_hold(db: Session, user_id: int, amount: Decimal) -> None:
+    """Вернуть неиспользованный остаток блока на баланс"""
+    if amount <= 0:
+        return
+    try:
+        db.execute(text("""
+            UPDATE user_balances
+            SET balance = balance + :amount, total_spent = total_spent - :amount, updated_at = :now
+            WHERE user_id = :user_id
+        """), {"amount": amount, "user_id": user_id, "now": datetime.utcnow()})
+        db.commit()
+        logger.info(f"Возвращен остаток предавторизации {amount} руб. пользователю {user_id}")
+    except Exception as e:
+        db.rollback()
+        # Блок в Redis уже закрыт — без ручного возврата эти деньги потеряются
+        logger.critical(f"🚨 Не удалось вернуть остаток предавторизации {amount} руб. пользователю {user_id}: {e}")
+
+
+def settle_preauthorizations(db: Session, preauth: Optional[BillingPreauth] = None,
+                             release_idle: bool = True) -> int:
+    """
+    Записать накопленные списания в журнал и закрыть простаивающие блоки
+
+    Returns:
+        Количество записанных транзакций
+    """
+    preauth = preauth or BillingPreauth()
+    if not preauth.available:
+        return 0
+
+    written = 0
+    while True:
+        entries = preauth.pop_pending(SETTLE_BATCH_SIZE)
+        if not entries:
+            break
+        rows = [
+            {
+                "user_id": e["user_id"],
+                "amount": -_from_kopecks(e["amount"]),
+                "transaction_type": e["service_type"],
+                "description": e["description"],
+                "balance_before": _from_kopecks(e["balance_before"]),
+                "balance_after": _from_kopecks(e["balance_after"]),
+                "related_id": e.get("related_id"),
+                "created_at": datetime.fromisoformat(e["created_at"]),
+            }
+            for e in entries
+        ]
+        try:
+            db.execute(text("""
+                INSERT INTO balance_transactions
+                    (user_id, amount, transaction_type, description, balance_before, balance_after, related_id, created_at)
+                VALUES
+                    (:user_id, :amount, :transaction_type, :description, :balance_before, :balance_after, :related_id, :created_at)
+            """), rows)
+            db.commit()
+        except Exception:
+            db.rollback()
+            preauth.push_back(entries)
+            raise
+        written += len(rows)
+        if len(entries) < SETTLE_BATCH_SIZE:
+            break
+
+    if release_idle:
+        for user_id, service_type in preauth.idle_holds():
+            refund_hold(db, user_id, preauth.close_hold(user_id, service_type))
+
+    if written:
+        logger.debug(f"Записано {written} предавторизованных списаний")
+    return written
+
+
+async def run_preauth_settler() -> None:
+    """Фоновая задача: периодическая запись журнала и возврат остатков"""
+    from database.connection import SessionLocal
+
+    if PREAUTH_MESSAGES <= 0:
+        return
+    preauth = BillingPreauth()
+    if not preauth.available:
+        logger.warning("⚠️ BILLING_PREAUTH_MESSAGES задан, но Redis недоступен - предавторизация отключена")
+        return
+
+    def _settle(release_idle: bool = True):
+        db = SessionLocal()
+        try:
+            settle_preauthorizations(db, preauth, release_idle=release_idle)
+        finally:
+            db.close()
+
+    try:
+        while True:
+            await asyncio.sleep(SETTLE_INTERVAL_SECONDS)
+            try:
+                await asyncio.to_thread(_settle)
+            except Exception as e:
+                logger.error(f"❌ Ошибка записи предавторизованных списаний: {e}")
+    finally:
+        # Блоки не закрываем: другие воркеры продолжают из них списывать
+        try:
+            await asyncio.to_thread(_settle, False)
+        except Exception as e:
+            logger.error(f"❌ Ошибка финальной записи предавторизованных списаний: {e}")
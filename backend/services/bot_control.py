@@ -0,0 +1,414 @@
+"""
+Канал управления ботами (control plane)
+
+Раньше бэкенд дергал bot manager синхронными requests.post с таймаутом 1 с
+прямо в потоке запроса: ошибки молча терялись, боты продолжали работать со
+старыми знаниями, а при недоступном менеджере запрос пользователя ждал.
+
+Теперь команда (reload, clear_cache, stop, start) публикуется в Redis Stream
+bot:control:stream с порядковым номером, своим для каждого бота, и публикация
+не ждет менеджер. Потребитель (scalable_bot_manager.js, группа bot-manager)
+читает поток через XREADGROUP и подтверждает применение; неподтвержденные
+команды через BOT_CONTROL_RETRY_AFTER_MS забираются повторно (XAUTOCLAIM),
+пока не будут применены или не исчерпают BOT_CONTROL_MAX_ATTEMPTS попыток.
+Команды жизненного цикла (reload, stop, start) вытесняют друг друга: такая
+команда с номером не больше примененного lifecycle_seq пропускается — более
+новая уже определила состояние бота. clear_cache ничего не вытесняет и сама
+не пропускается: seq общий для всех команд, и успешная очистка кэша не должна
+подтверждать еще не примененный reload.
+
+Состояние по боту (выдано / применено / ожидает / ошибка) — в
+bot:control:state:{bot_id} и bot:control:pending:{bot_id}, его отдает
+GET /api/bot-instances/{bot_id}/control.
+
+Без Redis команды хранятся в памяти процесса и доставляются в менеджер по
+HTTP фоновым потребителем бэкенда — тоже с повторами, но вне потока запроса.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+RELOAD = 'reload'
+CLEAR_CACHE = 'clear_cache'
+STOP = 'stop'
+START = 'start'
+COMMANDS = (RELOAD, CLEAR_CACHE, STOP, START)
+# Команды, определяющие состояние бота: применение более новой делает старые лишними
+LIFECYCLE_COMMANDS = (RELOAD, STOP, START)
+
+STREAM_KEY = "bot:control:stream"
+CONSUMER_GROUP = "bot-manager"
+SEQ_KEY = "bot:control:seq:{bot_id}"
+STATE_KEY = "bot:control:state:{bot_id}"
+PENDING_KEY = "bot:control:pending:{bot_id}"
+
+STREAM_MAXLEN = 10000
+RETRY_AFTER_MS = int(os.getenv('BOT_CONTROL_RETRY_AFTER_MS', '15000'))
+MAX_ATTEMPTS = int(os.getenv('BOT_CONTROL_MAX_ATTEMPTS', '10'))
+READ_BLOCK_MS = 5000
+
+# Подтверждение применения одной операцией: applied_seq и lifecycle_seq только растут
+_COMPLETE_SCRIPT = """
+local current = tonumber(redis.call('HGET', KEYS[1], 'applied_seq') or '0')
+if tonumber(ARGV[1]) > current then
+    redis.call('HSET', KEYS[1], 'applied_seq', ARGV[1], 'applied_command', ARGV[2], 'applied_at', ARGV[3])
+end
+if ARGV[6] == '1' and tonumber(ARGV[1]) > tonumber(redis.call('HGET', KEYS[1], 'lifecycle_seq') or '0') then
+    redis.call('HSET', KEYS[1], 'lifecycle_seq', ARGV[1])
+end
+redis.call('HDEL', KEYS[2], ARGV[1])
+redis.call('XACK', KEYS[3], ARGV[4], ARGV[5])
+return current
+"""
+
+
+def _redis():
+    from cache.redis_cache import cache
+    return cache.redis_client
+
+
+def _now() -> str:
+    return datetime.utcnow().isoformat()
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def is_superseded(command: str, seq: int, lifecycle_seq: int) -> bool:
+    """Команда жизненного цикла, после которой уже применена более новая"""
+    return command in LIFECYCLE_COMMANDS and seq <= lifecycle_seq
+
+
+@dataclass
+class BotCommand:
+    """Команда для одного бота"""
+    bot_id: int
+    seq: int
+    command: str
+    payload: Dict[str, Any] = field(default_factory=dict)
+    message_id: Optional[str] = None
+    attempts: int = 0
+
+
+class _RedisControlStore:
+    """Команды в Redis Stream с группой потребителей"""
+
+    def __init__(self, redis_client):
+        self.redis = redis_client
+        self._group_ready = False
+        self._complete = redis_client.register_script(_COMPLETE_SCRIPT)
+
+    def _ensure_group(self):
+        if self._group_ready:
+            return
+        try:
+            self.redis.xgroup_create(STREAM_KEY, CONSUMER_GROUP, id='0', mkstream=True)
+        except Exception as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+        self._group_ready = True
+
+    def publish(self, bot_id: int, command: str, payload: Dict[str, Any]) -> int:
+        self._ensure_group()
+        seq = int(self.redis.incr(SEQ_KEY.format(bot_id=bot_id)))
+        issued_at = _now()
+        pipe = self.redis.pipeline()
+        pipe.hset(PENDING_KEY.format(bot_id=bot_id), seq, json.dumps(
+            {'command': command, 'payload': payload, 'issued_at': issued_at, 'attempts': 0}
+        ))
+        pipe.hset(STATE_KEY.format(bot_id=bot_id), mapping={'issued_seq': seq, 'issued_at': issued_at})
+        pipe.xadd(STREAM_KEY, {
+            'bot_id': bot_id, 'seq': seq, 'command': command, 'payload': json.dumps(payload)
+        }, maxlen=STREAM_MAXLEN, approximate=True)
+        pipe.execute()
+        return seq
+
+    def _to_command(self, message_id, fields) -> BotCommand:
+        fields = {_decode(key): _decode(value) for key, value in fields.items()}
+        return BotCommand(
+            bot_id=int(fields['bot_id']),
+            seq=int(fields['seq']),
+            command=fields['command'],
+            payload=json.loads(fields.get('payload') or '{}'),
+            message_id=_decode(message_id),
+        )
+
+    def claim(self, consumer: str, count: int, block_ms: int) -> List[BotCommand]:
+        self._ensure_group()
+        # Сначала - неподтвержденные дольше RETRY_AFTER_MS (упавший или не справившийся потребитель)
+        claimed = self.redis.xautoclaim(STREAM_KEY, CONSUMER_GROUP, consumer,
+                                        min_idle_time=RETRY_AFTER_MS, start_id='0-0', count=count)
+        messages = [item for item in claimed[1] if item and item[1]]
+        if len(messages) < count:
+            response = self.redis.xreadgroup(CONSUMER_GROUP, consumer, {STREAM_KEY: '>'},
+                                             count=count - len(messages), block=block_ms or None)
+            for _, stream_messages in response or []:
+                messages.extend(stream_messages)
+        return [self._to_command(message_id, fields) for message_id, fields in messages]
+
+    def lifecycle_seq(self, bot_id: int) -> int:
+        return int(self.redis.hget(STATE_KEY.format(bot_id=bot_id), 'lifecycle_seq') or 0)
+
+    def complete(self, command: BotCommand) -> None:
+        self._complete(
+            keys=[STATE_KEY.format(bot_id=command.bot_id), PENDING_KEY.format(bot_id=command.bot_id), STREAM_KEY],
+            args=[command.seq, command.command, _now(), CONSUMER_GROUP, command.message_id,
+                  int(command.command in LIFECYCLE_COMMANDS)],
+        )
+
+    def fail(self, command: BotCommand, error: str) -> bool:
+        pending_key = PENDING_KEY.format(bot_id=command.bot_id)
+        raw = self.redis.hget(pending_key, command.seq)
+        entry = json.loads(raw) if raw else {'command': command.command, 'payload': command.payload}
+        entry['attempts'] = entry.get('attempts', 0) + 1
+        entry['last_error'] = error[:500]
+        command.attempts = entry['attempts']
+
+        pipe = self.redis.pipeline()
+        pipe.hset(STATE_KEY.format(bot_id=command.bot_id), mapping={'last_error': error[:500], 'last_error_at': _now()})
+        dead = entry['attempts'] >= MAX_ATTEMPTS
+        if dead:
+            pipe.hdel(pending_key, command.seq)
+            pipe.hset(STATE_KEY.format(bot_id=command.bot_id), 'failed_seq', command.seq)
+            pipe.xack(STREAM_KEY, CONSUMER_GROUP, command.message_id)
+        else:
+            # Остается неподтвержденной - XAUTOCLAIM вернет ее после RETRY_AFTER_MS
+            pipe.hset(pending_key, command.seq, json.dumps(entry))
+        pipe.execute()
+        return dead
+
+    def state(self, bot_id: int) -> Dict[str, Any]:
+        pipe = self.redis.pipeline()
+        pipe.hgetall(STATE_KEY.format(bot_id=bot_id))
+        pipe.hgetall(PENDING_KEY.format(bot_id=bot_id))
+        state, pending = pipe.execute()
+        state = {_decode(key): _decode(value) for key, value in state.items()}
+        pending = {int(_decode(seq)): json.loads(_decode(raw)) for seq, raw in pending.items()}
+        return _format_state(bot_id, state, pending)
+
+
+class _MemoryControlStore:
+    """Те же команды в памяти процесса (без Redis)"""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._sequences: Dict[int, int] = {}
+        self._states: Dict[int, Dict[str, Any]] = {}
+        self._pending: Dict[int, Dict[int, Dict[str, Any]]] = {}
+        self._queue: List[BotCommand] = []
+        # message_id -> (команда, время выдачи потребителю)
+        self._delivered: "OrderedDict[str, tuple]" = OrderedDict()
+        self._next_id = 0
+
+    def publish(self, bot_id: int, command: str, payload: Dict[str, Any]) -> int:
+        with self._cond:
+            seq = self._sequences[bot_id] = self._sequences.get(bot_id, 0) + 1
+            self._next_id += 1
+            issued_at = _now()
+            self._pending.setdefault(bot_id, {})[seq] = {
+                'command': command, 'payload': payload, 'issued_at': issued_at, 'attempts': 0
+            }
+            self._states.setdefault(bot_id, {}).update({'issued_seq': seq, 'issued_at': issued_at})
+            self._queue.append(BotCommand(bot_id, seq, command, payload, message_id=str(self._next_id)))
+            self._cond.notify_all()
+            return seq
+
+    def claim(self, consumer: str, count: int, block_ms: int) -> List[BotCommand]:
+        deadline = time.monotonic() + block_ms / 1000
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                result = [command for command, delivered_at in self._delivered.values()
+                          if now - delivered_at >= RETRY_AFTER_MS / 1000][:count]
+                while self._queue and len(result) < count:
+                    result.append(self._queue.pop(0))
+                for command in result:
+                    self._delivered.pop(command.message_id, None)
+                    self._delivered[command.message_id] = (command, now)
+                if result or now >= deadline:
+                    return result
+                self._cond.wait(deadline - now)
+
+    def lifecycle_seq(self, bot_id: int) -> int:
+        with self._cond:
+            return int(self._states.get(bot_id, {}).get('lifecycle_seq', 0))
+
+    def complete(self, command: BotCommand) -> None:
+        with self._cond:
+            state = self._states.setdefault(command.bot_id, {})
+            if command.seq > int(state.get('applied_seq', 0)):
+                state.update({'applied_seq': command.seq, 'applied_command': command.command, 'applied_at': _now()})
+            if command.command in LIFECYCLE_COMMANDS and command.seq > int(state.get('lifecycle_seq', 0)):
+                state['lifecycle_seq'] = command.seq
+            self._pending.get(command.bot_id, {}).pop(command.seq, None)
+            self._delivered.pop(command.message_id, None)
+
+    def fail(self, command: BotCommand, error: str) -> bool:
+        with self._cond:
+            entry = self._pending.get(command.bot_id, {}).get(command.seq)
+            if entry is None:
+                entry = {'command': command.command, 'payload': command.payload, 'attempts': 0}
+            entry['attempts'] = entry.get('attempts', 0) + 1
+            entry['last_error'] = error[:500]
+            command.attempts = entry['attempts']
+            state = self._states.setdefault(command.bot_id, {})
+            state.update({'last_error': error[:500], 'last_error_at': _now()})
+            dead = entry['attempts'] >= MAX_ATTEMPTS
+            if dead:
+                self._pending.get(command.bot_id, {}).pop(command.seq, None)
+                self._delivered.pop(command.message_id, None)
+                state['failed_seq'] = command.seq
+            return dead
+
+    def state(self, bot_id: int) -> Dict[str, Any]:
+        with self._cond:
+            return _format_state(bot_id, dict(self._states.get(bot_id, {})),
+                                 {seq: dict(entry) for seq, entry in self._pending.get(bot_id, {}).items()})
+
+
+def _format_state(bot_id: int, state: Dict[str, Any], pending: Dict[int, Dict[str, Any]]) -> Dict[str, Any]:
+    return {
+        'bot_id': bot_id,
+        'issued_seq': int(state.get('issued_seq') or 0),
+        'applied_seq': int(state.get('applied_seq') or 0),
+        'applied_command': state.get('applied_command'),
+        'applied_at': state.get('applied_at'),
+        'failed_seq': int(state['failed_seq']) if state.get('failed_seq') else None,
+        'last_error': state.get('last_error'),
+        'last_error_at': state.get('last_error_at'),
+        'pending': [dict(entry, seq=seq) for seq, entry in sorted(pending.items())],
+        'in_sync': not pending,
+    }
+
+
+class BotControlChannel:
+    """Публикация команд ботам и состояние их применения"""
+
+    def __init__(self, store=None):
+        self._store = store
+        self._lock = threading.Lock()
+
+    @property
+    def store(self):
+        # Хранилище выбирается один раз: при смене посреди работы команды бы «терялись»
+        if self._store is None:
+            with self._lock:
+                if self._store is None:
+                    redis_client = _redis()
+                    self._store = _RedisControlStore(redis_client) if redis_client else _MemoryControlStore()
+                    logger.info(f"🎛️ Канал управления ботами: {'Redis Stream' if redis_client else 'память процесса'}")
+        return self._store
+
+    @property
+    def uses_redis(self) -> bool:
+        return isinstance(self.store, _RedisControlStore)
+
+    def publish(self, bot_ids: Iterable[int], command: str, payload: Optional[Dict[str, Any]] = None) -> Dict[int, int]:
+        """Опубликовать команду для ботов; возвращает {bot_id: seq}. Не ждет применения"""
+        if command not in COMMANDS:
+            raise ValueError(f"Неизвестная команда бота: {command}")
+        issued = {}
+        for bot_id in bot_ids:
+            try:
+                issued[bot_id] = self.store.publish(int(bot_id), command, payload or {})
+            except Exception as e:
+                logger.error(f"❌ Не удалось опубликовать команду {command} для бота {bot_id}: {e}")
+        if issued:
+            logger.info(f"🎛️ Команда {command} для ботов {list(issued)} (seq {list(issued.values())})")
+        return issued
+
+    def state(self, bot_id: int) -> Dict[str, Any]:
+        return self.store.state(int(bot_id))
+
+    def states(self, bot_ids: Iterable[int]) -> List[Dict[str, Any]]:
+        return [self.state(bot_id) for bot_id in bot_ids]
+
+
+class BotControlConsumer:
+    """
+    Потребитель команд: применяет обработчик и подтверждает команду
+
+    Обработчик получает BotCommand; исключение или False - команда будет
+    повторена. Тот же протокол реализует scalable_bot_manager.js.
+    """
+
+    def __init__(self, channel: BotControlChannel, handlers: Dict[str, Callable[[BotCommand], Any]],
+                 name: Optional[str] = None):
+        self.channel = channel
+        self.handlers = handlers
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}"
+
+    def process_once(self, count: int = 10, block_ms: int = 0) -> int:
+        """Обработать доступные команды; возвращает число примененных"""
+        store = self.channel.store
+        applied = 0
+        for command in store.claim(self.name, count, block_ms):
+            if is_superseded(command.command, command.seq, store.lifecycle_seq(command.bot_id)):
+                store.complete(command)  # Уже применена более новая команда жизненного цикла
+                continue
+            handler = self.handlers.get(command.command)
+            try:
+                if handler is None:
+                    raise RuntimeError(f"нет обработчика команды {command.command}")
+                if handler(command) is False:
+                    raise RuntimeError("обработчик вернул False")
+            except Exception as e:
+                if store.fail(command, str(e)):
+                    logger.error(f"❌ Команда {command.command} для бота {command.bot_id} (seq {command.seq}) "
+                                 f"не применена за {MAX_ATTEMPTS} попыток: {e}")
+                else:
+                    logger.warning(f"⚠️ Команда {command.command} для бота {command.bot_id} не применена "
+                                   f"(попытка {command.attempts}), повтор через {RETRY_AFTER_MS} мс: {e}")
+                continue
+            store.complete(command)
+            applied += 1
+        return applied
+
+    async def run(self) -> None:
+        """Фоновый цикл (запускается в lifespan)"""
+        logger.info(f"🎛️ Потребитель команд ботов запущен: {self.name}")
+        while True:
+            try:
+                await asyncio.to_thread(self.process_once, 10, READ_BLOCK_MS)
+            except Exception as e:
+                logger.error(f"❌ Ошибка потребителя команд ботов: {e}")
+                await asyncio.sleep(RETRY_AFTER_MS / 1000)
+
+
+def http_handlers(timeout: float = 10) -> Dict[str, Callable[[BotCommand], bool]]:
+    """Доставка команд в bot manager по HTTP (режим без Redis)"""
+    import requests
+    from core.app_config import BOT_SERVICE_URL
+
+    def post(path: str, body: Dict[str, Any]) -> bool:
+        response = requests.post(f"{BOT_SERVICE_URL}{path}", json=body, timeout=timeout)
+        if response.status_code != 200:
+            raise RuntimeError(f"{path}: HTTP {response.status_code}")
+        data = response.json() if response.content else {}
+        if data.get('errors') or data.get('success') is False:
+            raise RuntimeError(f"{path}: {data.get('errors') or data.get('error')}")
+        return True
+
+    return {
+        RELOAD: lambda command: post('/hot-reload-bots', {'bot_ids': [command.bot_id], 'force_reload': True,
+                                                          **command.payload}),
+        CLEAR_CACHE: lambda command: post('/clear-bot-cache', {'bot_ids': [command.bot_id], **command.payload}),
+        STOP: lambda command: post(f'/workers/{command.bot_id}/stop', command.payload),
+        START: lambda command: post('/reload-bots', {'bot_ids': [command.bot_id], **command.payload}),
+    }
+
+
+# Глобальный экземпляр
+bot_control = BotControlChannel()
@@ -67,7 +67,34 @@ class EmbeddingsService:
         except Exception as e:
             logger.error(f"Error generating embedding: {e}")
             return None
-    
+
+    def generate_embeddings_batch(self, texts: List[str], user_id: int,
+                                  batch_size: int = 100) -> List[Optional[List[float]]]:
+        """Embeddings для списка текстов: один запрос к API на batch_size текстов.
+        Порядок результата совпадает с texts; None — для текстов неудавшегося запроса."""
+        result: List[Optional[List[float]]] = []
+        for start in range(0, len(texts), batch_size):
+            batch = texts[start:start + batch_size]
+            try:
+                # input в API embeddings принимает и строку, и массив строк
+                response = ai_token_manager.make_openai_request(
+                    messages=[],
+                    model=self.embedding_model,
+                    user_id=user_id,
+                    is_embedding=True,
+                    input_text=batch
+                )
+                data = getattr(response, 'data', None) or []
+                if len(data) != len(batch):
+                    logger.error(f"Embedding batch size mismatch: sent {len(batch)}, got {len(data)}")
+                    result.extend([None] * len(batch))
+                    continue
+                result.extend(item.embedding or None for item in data)
+            except Exception as e:
+                logger.error(f"Error generating embeddings batch of {len(batch)}: {e}")
+                result.extend([None] * len(batch))
+        return result
+
     def get_cached_query_embedding(self, query: str, db: Session) -> Optional[List[float]]:
         """Получает embedding запроса из кэша или генерирует новый"""
         query_hash = hashlib.md5(query.encode()).hexdigest()
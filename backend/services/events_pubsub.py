@@ -5,12 +5,15 @@ import os
 import asyncio
 import json
 import logging
-from typing import Callable, Awaitable, Optional, Dict, Any
+from typing import AsyncIterator, Callable, Awaitable, Optional, Dict, Any
 import redis.asyncio as redis
 from datetime import datetime
 
 logger = logging.getLogger(__name__)
 
+# Канал изменений очереди handoff для операторов (публикует HandoffQueue.publish_event)
+HANDOFF_QUEUE_CHANNEL = "ws:handoff:queue"
+
 class EventsPubSub:
     """Менеджер Redis Pub/Sub для реал-тайм событий"""
     
@@ -52,6 +55,33 @@ class EventsPubSub:
         """Создает имя канала для диалога"""
         return f"ws:dialog:{dialog_id}"
     
+    async def iter_handoff_queue_events(self, idle_timeout: float = 15.0) -> AsyncIterator[Optional[Dict[str, Any]]]:
+        """
+        Подписка на изменения очереди handoff (отдельное pubsub-соединение на подписчика)
+
+        Yields:
+            Событие очереди или None, если за idle_timeout ничего не пришло
+            (подписчик может отправить keep-alive)
+        """
+        client = await self._get_client()
+        pubsub = client.pubsub()
+        await pubsub.subscribe(HANDOFF_QUEUE_CHANNEL)
+        try:
+            while True:
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=idle_timeout)
+                if message is None:
+                    yield None
+                    continue
+                if message['type'] != 'message' or not message['data']:
+                    continue
+                try:
+                    yield json.loads(message['data'])
+                except json.JSONDecodeError as e:
+                    logger.error(f"Invalid JSON in channel {HANDOFF_QUEUE_CHANNEL}: {e}")
+        finally:
+            await pubsub.unsubscribe(HANDOFF_QUEUE_CHANNEL)
+            await pubsub.aclose()
+    
     async def publish_dialog_event(self, dialog_id: int, event: Dict[str, Any]) -> bool:
         """
         Публикует событие диалога в Redis Pub/Sub
@@ -222,6 +252,10 @@ async def publish_dialog_event(dialog_id: int, event: Dict[str, Any]) -> bool:
     pubsub = get_events_pubsub()
     return await pubsub.publish_dialog_event(dialog_id, event)
 
+def iter_handoff_queue_events(idle_timeout: float = 15.0) -> AsyncIterator[Optional[Dict[str, Any]]]:
+    """Удобная функция для подписки на изменения очереди handoff"""
+    return get_events_pubsub().iter_handoff_queue_events(idle_timeout)
+
 async def start_ws_bridge_subscriber(on_event: Callable[[Dict[str, Any]], Awaitable[None]]) -> None:
     """Утилита для запуска подписчика WS моста"""
     pubsub = get_events_pubsub()
@@ -0,0 +1,222 @@
+"""Redis-backed handoff queue with O(log n) position lookups.
+
+Dialogs waiting for an operator are kept in a sorted set scored by request time,
+with a small hash per dialog holding the queue card (reason, last user text).
+The database stays the source of truth: the set is rebuilt from `dialogs`
+whenever the sync marker expires or Redis was restarted, and every method
+degrades to a single indexed query when Redis is unavailable.
+"""
+
+import calendar
+import json
+import logging
+import os
+from datetime import datetime
+from typing import Optional, List, Dict, Any
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from database import models
+from schemas.handoff import HandoffStatus
+from services.events_pubsub import HANDOFF_QUEUE_CHANNEL
+
+logger = logging.getLogger(__name__)
+
+QUEUE_KEY = "handoff:queue"
+QUEUE_ITEM_KEY = "handoff:queue:item:{dialog_id}"
+QUEUE_SYNC_MARKER_KEY = "handoff:queue:synced"
+QUEUE_RESYNC_SECONDS = int(os.getenv('HANDOFF_QUEUE_RESYNC_SECONDS', '600'))
+LAST_USER_TEXT_MAX_LENGTH = 1000
+
+
+def _to_score(moment: datetime) -> float:
+    """Convert naive UTC datetime to a sortable score."""
+    return calendar.timegm(moment.utctimetuple()) + moment.microsecond / 1_000_000
+
+
+def _from_score(score: float) -> datetime:
+    return datetime.utcfromtimestamp(score)
+
+
+class HandoffQueue:
+    """Sorted-set view of dialogs in 'requested' state."""
+
+    def __init__(self, db: Session, redis_client=None):
+        self.db = db
+        if redis_client is None:
+            from cache.redis_cache import cache
+            redis_client = cache.redis_client
+        self.redis = redis_client
+
+    def _redis_ready(self) -> bool:
+        """Return True if Redis is usable and the set is in sync with the database."""
+        if not self.redis:
+            return False
+        try:
+            if not self.redis.exists(QUEUE_SYNC_MARKER_KEY):
+                self.rebuild()
+            return True
+        except Exception as e:
+            logger.warning(f"Handoff queue Redis unavailable, falling back to DB: {e}")
+            return False
+
+    def enqueue(self, dialog_id: int, requested_at: datetime, reason: str = None,
+                last_user_text: str = None) -> None:
+        """Add dialog to queue or move it to the position of a new request time."""
+        if not self.redis:
+            return
+        try:
+            pipe = self.redis.pipeline()
+            pipe.zadd(QUEUE_KEY, {str(dialog_id): _to_score(requested_at)})
+            item = {"reason": reason or ""}
+            if last_user_text:
+                item["last_user_text"] = last_user_text[:LAST_USER_TEXT_MAX_LENGTH]
+            pipe.hset(QUEUE_ITEM_KEY.format(dialog_id=dialog_id), mapping=item)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"Failed to enqueue dialog {dialog_id} in Redis handoff queue: {e}")
+
+    def remove(self, dialog_id: int) -> None:
+        """Remove dialog from queue (takeover, cancel, reset)."""
+        if not self.redis:
+            return
+        try:
+            pipe = self.redis.pipeline()
+            pipe.zrem(QUEUE_KEY, str(dialog_id))
+            pipe.delete(QUEUE_ITEM_KEY.format(dialog_id=dialog_id))
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"Failed to remove dialog {dialog_id} from Redis handoff queue: {e}")
+
+    def publish_event(self, event: Dict[str, Any]) -> bool:
+        """Publish a queue change synchronously (handoff endpoints run in the threadpool)."""
+        if not self.redis:
+            return False
+        try:
+            payload = json.dumps({**event, "timestamp": datetime.utcnow().isoformat(), "source": "backend"},
+                                 ensure_ascii=False, default=str)
+            self.redis.publish(HANDOFF_QUEUE_CHANNEL, payload)
+            return True
+        except Exception as e:
+            logger.warning(f"Failed to publish handoff queue event {event.get('type')}: {e}")
+            return False
+
+    def update_last_user_text(self, dialog_id: int, text: str) -> None:
+        """Refresh the queue card preview if the dialog is waiting for an operator."""
+        if not self.redis or not text:
+            return
+        try:
+            if self.redis.zscore(QUEUE_KEY, str(dialog_id)) is not None:
+                self.redis.hset(
+                    QUEUE_ITEM_KEY.format(dialog_id=dialog_id),
+                    "last_user_text", text[:LAST_USER_TEXT_MAX_LENGTH]
+                )
+        except Exception as e:
+            logger.debug(f"Failed to update handoff queue preview for dialog {dialog_id}: {e}")
+
+    def position(self, dialog) -> Optional[int]:
+        """1-based queue position of a dialog in 'requested' state."""
+        if self._redis_ready():
+            rank = self.redis.zrank(QUEUE_KEY, str(dialog.id))
+            if rank is not None:
+                return rank + 1
+            # Dialog is requested in DB but missing in Redis - heal the set
+            self.enqueue(dialog.id, dialog.handoff_requested_at, dialog.handoff_reason)
+            rank = self.redis.zrank(QUEUE_KEY, str(dialog.id))
+            if rank is not None:
+                return rank + 1
+
+        earlier_requests = self.db.query(func.count(models.Dialog.id)).filter(
+            models.Dialog.handoff_status == HandoffStatus.REQUESTED,
+            models.Dialog.handoff_requested_at < dialog.handoff_requested_at
+        ).scalar()
+        return earlier_requests + 1
+
+    def size(self) -> int:
+        if self._redis_ready():
+            return self.redis.zcard(QUEUE_KEY)
+        return self.db.query(func.count(models.Dialog.id)).filter(
+            models.Dialog.handoff_status == HandoffStatus.REQUESTED
+        ).scalar()
+
+    def items(self) -> List[Dict[str, Any]]:
+        """Queue cards ordered by request time."""
+        if self._redis_ready():
+            entries = self.redis.zrange(QUEUE_KEY, 0, -1, withscores=True)
+            pipe = self.redis.pipeline()
+            for member, _ in entries:
+                pipe.hgetall(QUEUE_ITEM_KEY.format(dialog_id=int(member)))
+            cards = pipe.execute() if entries else []
+
+            result = []
+            for (member, score), card in zip(entries, cards):
+                card = {_decode(k): _decode(v) for k, v in (card or {}).items()}
+                result.append({
+                    "dialog_id": int(member),
+                    "requested_at": _from_score(score),
+                    "reason": card.get("reason") or None,
+                    "last_user_text": card.get("last_user_text"),
+                })
+            return result
+
+        return self._items_from_db()
+
+    def _items_from_db(self) -> List[Dict[str, Any]]:
+        """Queue cards straight from the database in two queries (no per-dialog lookups)."""
+        dialogs = self.db.query(
+            models.Dialog.id, models.Dialog.handoff_requested_at, models.Dialog.handoff_reason
+        ).filter(
+            models.Dialog.handoff_status == HandoffStatus.REQUESTED
+        ).order_by(models.Dialog.handoff_requested_at).all()
+
+        last_texts = self._last_user_texts([d.id for d in dialogs])
+        return [
+            {
+                "dialog_id": d.id,
+                "requested_at": d.handoff_requested_at,
+                "reason": d.handoff_reason,
+                "last_user_text": last_texts.get(d.id),
+            }
+            for d in dialogs
+        ]
+
+    def _last_user_texts(self, dialog_ids: List[int]) -> Dict[int, str]:
+        if not dialog_ids:
+            return {}
+        latest = self.db.query(
+            models.DialogMessage.dialog_id,
+            func.max(models.DialogMessage.id).label("message_id")
+        ).filter(
+            models.DialogMessage.dialog_id.in_(dialog_ids),
+            models.DialogMessage.sender == "user"
+        ).group_by(models.DialogMessage.dialog_id).subquery()
+
+        rows = self.db.query(models.DialogMessage.dialog_id, models.DialogMessage.text).join(
+            latest, models.DialogMessage.id == latest.c.message_id
+        ).all()
+        return {row.dialog_id: row.text for row in rows}
+
+    def rebuild(self) -> int:
+        """Reload the sorted set from the database."""
+        items = self._items_from_db()
+        pipe = self.redis.pipeline()
+        for member in self.redis.zrange(QUEUE_KEY, 0, -1):
+            pipe.delete(QUEUE_ITEM_KEY.format(dialog_id=int(member)))
+        pipe.delete(QUEUE_KEY)
+        for item in items:
+            if not item["requested_at"]:
+                continue
+            pipe.zadd(QUEUE_KEY, {str(item["dialog_id"]): _to_score(item["requested_at"])})
+            card = {"reason": item["reason"] or ""}
+            if item["last_user_text"]:
+                card["last_user_text"] = item["last_user_text"][:LAST_USER_TEXT_MAX_LENGTH]
+            pipe.hset(QUEUE_ITEM_KEY.format(dialog_id=item["dialog_id"]), mapping=card)
+        pipe.setex(QUEUE_SYNC_MARKER_KEY, QUEUE_RESYNC_SECONDS, datetime.utcnow().isoformat())
+        pipe.execute()
+        logger.info(f"Handoff queue rebuilt from DB: {len(items)} dialogs")
+        return len(items)
+
+
+def _decode(value):
+    return value.decode("utf-8") if isinstance(value, bytes) else value
@@ -5,6 +5,8 @@ from datetime import datetime, timedelta
 from typing import Optional, Tuple, List, Dict, Any
 from uuid import uuid4
 import asyncio
+import time
+import anyio.from_thread
 import pytz
 
 from sqlalchemy.orm import Session
@@ -15,12 +17,49 @@ from database import models
 from schemas.handoff import HandoffStatusOut, HandoffQueueItem, HandoffStatus
 from core.app_config import FRONTEND_URL
 from services.events_pubsub import publish_dialog_event
+from services.handoff_queue import HandoffQueue
+from services.operator_presence import OperatorPresenceService
 
 # Handoff configuration constants
 HANDOFF_MAX_REQUESTS_PER_MINUTE = 3
+HANDOFF_MINUTES_PER_DIALOG = 3  # Rough operator handling time for wait estimates
+MANAGER_CACHE_TTL_SECONDS = 300
+
+# manager_id -> (display name, cached_at); status polls should not hit `users` every time
+_manager_name_cache: Dict[int, Tuple[str, float]] = {}
 
 logger = logging.getLogger(__name__)
 
+# Ссылки на фоновые задачи уведомлений, чтобы их не собрал GC до завершения
+_background_tasks: set = set()
+
+
+def _run_in_app_loop(coro) -> bool:
+    """
+    Запускает корутину уведомления в event loop приложения, не дожидаясь ее.
+
+    Эндпоинты handoff — синхронные def и выполняются в threadpool, где своего
+    loop нет: задача создается в loop приложения через anyio.from_thread.
+    Вне приложения (скрипты, тесты без loop) корутина закрывается без запуска.
+    """
+    def spawn():
+        task = asyncio.ensure_future(coro)
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        try:
+            anyio.from_thread.run_sync(spawn)
+            return True
+        except RuntimeError:
+            coro.close()
+            logger.debug("Skipping async notification - no application event loop")
+            return False
+    spawn()
+    return True
+
 
 class HandoffService:
     """Service for managing handoff operations with state validation and concurrency protection."""
@@ -44,6 +83,8 @@ class HandoffService:
     def __init__(self, db: Session):
         self.db = db
         self._seq_counter = 0
+        self.queue = HandoffQueue(db)
+        self.presence = OperatorPresenceService(db)
 
     def _get_local_time(self) -> datetime:
         """Get current time in Moscow timezone instead of UTC."""
@@ -95,6 +136,9 @@ class HandoffService:
                 # Даже при idempotency обновляем timestamp для UI
                 existing_dialog.handoff_requested_at = datetime.utcnow()
                 self.db.commit()
+                if existing_dialog.handoff_status == HandoffStatus.REQUESTED:
+                    self.queue.enqueue(dialog_id, existing_dialog.handoff_requested_at,
+                                       existing_dialog.handoff_reason, last_user_text)
                 logger.info(f"Updated timestamp for idempotent request: dialog {dialog_id}")
                 return self._build_status_response(existing_dialog)
             
@@ -112,6 +156,8 @@ class HandoffService:
                 dialog.handoff_requested_at = datetime.utcnow()
                 dialog.request_id = request_id  # Обновляем request_id для идемпотентности
                 self.db.commit()
+                self.queue.enqueue(dialog_id, dialog.handoff_requested_at, dialog.handoff_reason, last_user_text)
+                self._publish_queue_event("queue:updated", dialog_id)
                 logger.info(f"Updated handoff_requested_at and request_id for dialog {dialog_id}")
                 return self._build_status_response(dialog)
             elif dialog.handoff_status == HandoffStatus.ACTIVE:
@@ -163,25 +209,19 @@ class HandoffService:
             )
             
             self.db.commit()
-            
-            # Send async notifications (non-blocking)
-            try:
-                loop = asyncio.get_event_loop()
-                if loop.is_running():
-                    asyncio.create_task(self._send_handoff_notifications(dialog, reason, last_user_text))
-                    # Отправляем системное сообщение в Telegram при запросе оператора
-                    asyncio.create_task(self._send_telegram_system_message(dialog_id, "Переключаем ваш диалог на сотрудника. Мы уже занимаемся вашим вопросом, ответим в ближайшее время", "handoff_requested"))
-                    # Отправляем событие в Redis pub/sub для всех активных клиентов
-                    asyncio.create_task(publish_dialog_event(dialog_id, {
-                        "type": "handoff_requested",
-                        "dialog_id": dialog_id,
-                        "timestamp": datetime.utcnow().isoformat()
-                    }))
-                else:
-                    logger.debug(f"Skipping async notifications for dialog {dialog_id} - no active event loop")
-            except RuntimeError:
-                # No event loop running - skip async notifications in sync context
-                logger.debug(f"Skipping async notifications for dialog {dialog_id} - no event loop")
+            self.queue.enqueue(dialog_id, dialog.handoff_requested_at, reason, last_user_text)
+            self._publish_queue_event("queue:added", dialog_id)
+            
+            # Уведомления: письмо владельцу через outbox, остальное — в event loop приложения
+            self._send_handoff_notifications(dialog, reason, last_user_text)
+            # Отправляем системное сообщение в Telegram при запросе оператора
+            self._send_telegram_system_message(dialog, "Переключаем ваш диалог на сотрудника. Мы уже занимаемся вашим вопросом, ответим в ближайшее время", "handoff_requested")
+            # Отправляем событие в Redis pub/sub для всех активных клиентов
+            _run_in_app_loop(publish_dialog_event(dialog_id, {
+                "type": "handoff_requested",
+                "dialog_id": dialog_id,
+                "timestamp": datetime.utcnow().isoformat()
+            }))
             
             logger.info(f"Handoff requested for dialog {dialog_id}, reason: {reason}")
             return self._build_status_response(dialog)
@@ -247,6 +287,9 @@ class HandoffService:
             
             logger.info(f"Operator {manager_id} status: {operator.status}, active_chats: {operator.active_chats}, max: {operator.max_active_chats_web}")
             
+            # Status and capacity come from Redis heartbeats; the table row is a periodic snapshot
+            self.presence.apply_live_state(operator)
+            
             # Validate operator status and capacity
             if operator.status != "online":
                 raise self.Conflict(f"Operator {manager_id} not online: {operator.status}")
@@ -289,25 +332,21 @@ class HandoffService:
             )
             
             self.db.commit()
-            
-            # Send WebSocket notification
-            try:
-                loop = asyncio.get_event_loop()
-                if loop.is_running():
-                    asyncio.create_task(self._send_ws_notification(dialog_id, "handoff_started", manager_id))
-                    # Отправляем системное сообщение в Telegram при подключении оператора
-                    asyncio.create_task(self._send_telegram_system_message(dialog_id, "Оператор подключился", "handoff_started"))
-                    # Отправляем событие в Redis pub/sub для всех активных клиентов
-                    asyncio.create_task(publish_dialog_event(dialog_id, {
-                        "type": "handoff_started",
-                        "dialog_id": dialog_id,
-                        "manager_id": manager_id,
-                        "timestamp": datetime.utcnow().isoformat()
-                    }))
-                else:
-                    logger.debug(f"Skipping WS notification for dialog {dialog_id} - no active event loop")
-            except RuntimeError:
-                logger.debug(f"Skipping WS notification for dialog {dialog_id} - no event loop")
+            self.queue.remove(dialog_id)
+            self.presence.sync_live_active_chats(manager_id, operator.active_chats)
+            self._publish_queue_event("queue:removed", dialog_id)
+            
+            # Send SSE notification
+            self._send_ws_notification(dialog_id, "handoff_started", manager_id)
+            # Отправляем системное сообщение в Telegram при подключении оператора
+            self._send_telegram_system_message(dialog, "Оператор подключился", "handoff_started")
+            # Отправляем событие в Redis pub/sub для всех активных клиентов
+            _run_in_app_loop(publish_dialog_event(dialog_id, {
+                "type": "handoff_started",
+                "dialog_id": dialog_id,
+                "manager_id": manager_id,
+                "timestamp": datetime.utcnow().isoformat()
+            }))
             
             logger.info(f"Handoff taken over for dialog {dialog_id} by manager {manager_id}")
             return self._build_status_response(dialog)
@@ -388,24 +427,19 @@ class HandoffService:
             )
             
             self.db.commit()
-            
-            # Send WebSocket notification (only in async context)
-            try:
-                loop = asyncio.get_event_loop()
-                if loop.is_running():
-                    asyncio.create_task(self._send_ws_notification(dialog_id, "handoff_released"))
-                    # Отправляем системное сообщение в Telegram
-                    asyncio.create_task(self._send_telegram_system_message(dialog_id, "Диалог возвращен к AI-ассистенту. Спасибо за обращение!", "handoff_released"))
-                    # Отправляем событие в Redis pub/sub для всех активных клиентов
-                    asyncio.create_task(publish_dialog_event(dialog_id, {
-                        "type": "handoff_released",
-                        "dialog_id": dialog_id,
-                        "timestamp": datetime.utcnow().isoformat()
-                    }))
-                else:
-                    logger.debug(f"Skipping WS notification for dialog {dialog_id} - no active event loop")
-            except RuntimeError:
-                logger.debug(f"Skipping WS notification for dialog {dialog_id} - no event loop")
+            if operator:
+                self.presence.sync_live_active_chats(manager_id, operator.active_chats)
+            
+            # Send SSE notification
+            self._send_ws_notification(dialog_id, "handoff_released")
+            # Отправляем системное сообщение в Telegram
+            self._send_telegram_system_message(dialog, "Диалог возвращен к AI-ассистенту. Спасибо за обращение!", "handoff_released")
+            # Отправляем событие в Redis pub/sub для всех активных клиентов
+            _run_in_app_loop(publish_dialog_event(dialog_id, {
+                "type": "handoff_released",
+                "dialog_id": dialog_id,
+                "timestamp": datetime.utcnow().isoformat()
+            }))
             
             logger.info(f"Handoff released for dialog {dialog_id} by manager {manager_id}")
             return self._build_status_response(dialog)
@@ -463,16 +497,11 @@ class HandoffService:
             )
             
             self.db.commit()
+            self.queue.remove(dialog_id)
+            self._publish_queue_event("queue:removed", dialog_id)
             
-            # Send WebSocket notification
-            try:
-                loop = asyncio.get_event_loop()
-                if loop.is_running():
-                    asyncio.create_task(self._send_ws_notification(dialog_id, "handoff_cancelled"))
-                else:
-                    logger.debug(f"Skipping WS notification for dialog {dialog_id} - no active event loop")
-            except RuntimeError:
-                logger.debug(f"Skipping WS notification for dialog {dialog_id} - no event loop")
+            # Send SSE notification
+            self._send_ws_notification(dialog_id, "handoff_cancelled")
             
             logger.info(f"Handoff cancelled for dialog {dialog_id}")
             return self._build_status_response(dialog)
@@ -492,25 +521,15 @@ class HandoffService:
 
     def get_queue(self) -> List[HandoffQueueItem]:
         """Get list of dialogs waiting for operator."""
-        dialogs = self.db.query(models.Dialog).filter(
-            models.Dialog.handoff_status == HandoffStatus.REQUESTED
-        ).order_by(models.Dialog.handoff_requested_at).all()
-        
+        now = datetime.utcnow()
         queue = []
-        for i, dialog in enumerate(dialogs):
-            wait_time = int((datetime.utcnow() - dialog.handoff_requested_at).total_seconds() / 60)
-            
-            # Get last user message
-            last_message = self.db.query(models.DialogMessage).filter(
-                models.DialogMessage.dialog_id == dialog.id,
-                models.DialogMessage.sender == "user"
-            ).order_by(models.DialogMessage.timestamp.desc()).first()
-            
+        for i, item in enumerate(self.queue.items()):
+            wait_time = int((now - item["requested_at"]).total_seconds() / 60)
             queue.append(HandoffQueueItem(
-                dialog_id=dialog.id,
-                requested_at=dialog.handoff_requested_at,
-                reason=dialog.handoff_reason,
-                last_user_text=last_message.text if last_message else None,
+                dialog_id=item["dialog_id"],
+                requested_at=item["requested_at"],
+                reason=item["reason"],
+                last_user_text=item["last_user_text"],
                 wait_time_minutes=wait_time,
                 priority=i + 1
             ))
@@ -518,30 +537,40 @@ class HandoffService:
         return queue
 
 
+    def _get_manager_name(self, manager_id: int) -> Optional[str]:
+        """Manager display name with a short in-process cache."""
+        cached = _manager_name_cache.get(manager_id)
+        if cached and time.monotonic() - cached[1] < MANAGER_CACHE_TTL_SECONDS:
+            return cached[0]
+        
+        manager = self.db.query(models.User.id, models.User.first_name).filter(
+            models.User.id == manager_id
+        ).first()
+        if not manager:
+            return None
+        
+        name = manager.first_name.strip() if manager.first_name else f"User #{manager.id}"
+        _manager_name_cache[manager_id] = (name, time.monotonic())
+        return name
+
     def _build_status_response(self, dialog) -> HandoffStatusOut:
         """Build HandoffStatusOut from dialog object."""
         assigned_manager = None
         if dialog.assigned_manager_id:
-            manager = self.db.query(models.User).filter(
-                models.User.id == dialog.assigned_manager_id
-            ).first()
-            if manager:
+            manager_name = self._get_manager_name(dialog.assigned_manager_id)
+            if manager_name:
                 assigned_manager = {
-                    "id": manager.id,
-                    "name": manager.first_name.strip() if manager.first_name else f"User #{manager.id}",
+                    "id": dialog.assigned_manager_id,
+                    "name": manager_name,
                     "avatar": None  # Add avatar URL if available
                 }
         
         # Calculate queue position if in requested state
         queue_position = None
         estimated_wait = None
-        if dialog.handoff_status == HandoffStatus.REQUESTED:
-            earlier_requests = self.db.query(models.Dialog).filter(
-                models.Dialog.handoff_status == HandoffStatus.REQUESTED,
-                models.Dialog.handoff_requested_at < dialog.handoff_requested_at
-            ).count()
-            queue_position = earlier_requests + 1
-            estimated_wait = queue_position * 3  # Assume 3 minutes per dialog
+        if dialog.handoff_status == HandoffStatus.REQUESTED and dialog.handoff_requested_at:
+            queue_position = self.queue.position(dialog)
+            estimated_wait = queue_position * HANDOFF_MINUTES_PER_DIALOG
         
         return HandoffStatusOut(
             status=dialog.handoff_status or HandoffStatus.NONE,
@@ -556,6 +585,14 @@ class HandoffService:
             sla_deadline=None
         )
 
+    def _publish_queue_event(self, event_type: str, dialog_id: int):
+        """Push queue change to operators over Redis pub/sub (sync client, works from threadpool)."""
+        self.queue.publish_event({
+            "type": event_type,
+            "dialog_id": dialog_id,
+            "queue_size": self.queue.size()
+        })
+
     def _create_audit_log(self, dialog_id: int, from_status: str, to_status: str, 
                          user_id: int = None, reason: str = None, request_id: str = None,
                          metadata: Dict[str, Any] = None):
@@ -575,8 +612,8 @@ class HandoffService:
         )
         self.db.add(audit)
 
-    async def _send_handoff_notifications(self, dialog, reason: str, last_user_text: str = None):
-        """Send email notifications to widget owner (async)."""
+    def _send_handoff_notifications(self, dialog, reason: str, last_user_text: str = None):
+        """Send email notification to widget owner (enqueued to the email outbox, non-blocking)."""
         try:
             from integrations.email_service import email_service
             
@@ -606,8 +643,8 @@ class HandoffService:
         except Exception as e:
             logger.error(f"Error sending handoff notifications: {str(e)}")
 
-    async def _send_ws_notification(self, dialog_id: int, event_type: str, manager_id: int = None):
-        """Send WebSocket notification for handoff event."""
+    def _send_ws_notification(self, dialog_id: int, event_type: str, manager_id: int = None):
+        """Send SSE notification for handoff event (data is resolved here, delivery runs in the app loop)."""
         try:
             from services.sse_manager import push_sse_event
             
@@ -620,17 +657,14 @@ class HandoffService:
             }
             
             if manager_id:
-                manager = self.db.query(models.User).filter(models.User.id == manager_id).first()
-                if manager:
-                    event_data["manager"] = {
-                        "id": manager_id,
-                        "name": manager.first_name.strip() if manager.first_name else f"User #{manager_id}"
-                    }
+                manager_name = self._get_manager_name(manager_id)
+                if manager_name:
+                    event_data["manager"] = {"id": manager_id, "name": manager_name}
             
-            await push_sse_event(dialog_id, event_data)
+            _run_in_app_loop(push_sse_event(dialog_id, event_data))
             
         except Exception as e:
-            logger.error(f"Error sending WebSocket notification: {str(e)}")
+            logger.error(f"Error sending SSE notification: {str(e)}")
 
     async def _send_sse_notification(self, dialog_id: int, event_type: str, manager_id: int = None):
         """Send SSE event notification for handoff events."""
@@ -659,27 +693,24 @@ class HandoffService:
         except Exception as e:
             logger.error(f"Error sending SSE notification: {str(e)}")
 
-    async def _send_telegram_system_message(self, dialog_id: int, text: str, system_type: str):
+    def _send_telegram_system_message(self, dialog, text: str, system_type: str):
         """Send system message to Telegram bot for dialog."""
+        if not dialog.telegram_chat_id:
+            logger.debug(f"Dialog {dialog.id} is not a Telegram dialog, skipping system message")
+            return
         try:
-            # Получаем информацию о диалоге
-            dialog = self.db.query(models.Dialog).filter(models.Dialog.id == dialog_id).first()
-            if not dialog or not dialog.telegram_chat_id:
-                logger.debug(f"Dialog {dialog_id} is not a Telegram dialog, skipping system message")
-                return
-
             # Импортируем здесь чтобы избежать циклических импортов
             from services.bot_manager import send_system_message_to_bot
             
             # Отправляем системное сообщение в Telegram бота
-            await send_system_message_to_bot({
+            _run_in_app_loop(send_system_message_to_bot({
                 'telegram_chat_id': dialog.telegram_chat_id,
                 'text': text,
                 'system_type': system_type,
-                'dialog_id': dialog_id
-            })
+                'dialog_id': dialog.id
+            }))
             
-            logger.info(f"System message sent to Telegram for dialog {dialog_id}: {text}")
+            logger.info(f"System message sent to Telegram for dialog {dialog.id}: {text}")
             
         except Exception as e:
-            logger.error(f"Error sending Telegram system message: {str(e)}")
\ No newline at end of file
+            logger.error(f"Error sending Telegram system message: {str(e)}")
@@ -0,0 +1,230 @@
+"""
+Конвейер изображений для аватаров и иконок виджетов
+
+Раньше загрузка читала файл, синхронно отправляла оригинал в S3 прямо из
+async-обработчика, а виджет на сайте клиента скачивал полноразмерный оригинал
+(до 5MB) ради кружка 32×32 на каждой загрузке страницы. Теперь:
+
+- изображение проверяется и декодируется один раз в отдельном потоке
+  (store_image вызывается через asyncio.to_thread);
+- из него строятся уменьшенные WebP (и PNG для клиентов без WebP) под размеры,
+  в которых виджет их реально показывает (DERIVATIVE_SIZES);
+- производные хранятся по ключу от sha256 содержимого
+  assets/v1/{hh}/{sha256}/{kind}-{size}.{ext} с Cache-Control immutable —
+  URL никогда не меняет содержимое, браузер и CDN кешируют его навсегда;
+  тип в имени нужен, потому что одни и те же байты аватар режет в квадрат,
+  а иконка уменьшает с сохранением пропорций;
+- одинаковые загрузки разных пользователей попадают в те же ключи:
+  уже существующие объекты повторно не кодируются и не загружаются.
+"""
+
+import hashlib
+import io
+import logging
+import re
+from typing import Any, Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Версия схемы производных: при смене размеров/кодеков ключи не пересекаются со старыми
+ASSET_PREFIX = "assets/v1"
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Размеры в пикселях под то, как виджет рисует изображения (1x/2x/3x):
+# аватар — кружок .avatar 32px в шапке чата (chat-iframe.js),
+# иконка — кнопка .replyx-widget-button 56px (32px на узких экранах, widget.js)
+DERIVATIVE_SIZES: Dict[str, Dict[str, Any]] = {
+    'avatar': {'sizes': (32, 64, 96), 'default': 64, 'crop': True},
+    'widget-icon': {'sizes': (32, 56, 112), 'default': 112, 'crop': False},
+}
+PNG_FALLBACK = True  # PNG только для размера по умолчанию
+
+ALLOWED_FORMATS = {'PNG', 'JPEG', 'WEBP'}
+MAX_PIXELS = 40_000_000  # Защита от decompression bomb: проверяем до декодирования
+WEBP_QUALITY = 85
+
+DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+# {kind}-{size}.{ext}; имена без типа ({size}.{ext}) остались от первых загрузок и только читаются
+ASSET_NAME_RE = re.compile(
+    r'^((' + '|'.join(map(re.escape, DERIVATIVE_SIZES)) + r')-\d+\.(webp|png)|\d+\.(webp|png)|original\.svg)$'
+)
+
+ASSET_CONTENT_TYPES = {
+    'webp': 'image/webp',
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+}
+
+
+class ImageValidationError(ValueError):
+    """Файл не является допустимым изображением"""
+
+
+class ImageProcessingUnavailable(RuntimeError):
+    """Pillow не установлен"""
+
+
+def content_digest(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+def asset_key(digest: str, name: str) -> str:
+    return f"{ASSET_PREFIX}/{digest[:2]}/{digest}/{name}"
+
+
+def asset_url(digest: str, name: str) -> str:
+    """Публичный URL через прокси /api/files/assets"""
+    return f"/api/files/assets/{digest}/{name}"
+
+
+def asset_content_type(name: str) -> str:
+    return ASSET_CONTENT_TYPES.get(name.rsplit('.', 1)[-1], 'application/octet-stream')
+
+
+def is_asset_name(digest: str, name: str) -> bool:
+    return bool(DIGEST_RE.match(digest) and ASSET_NAME_RE.match(name))
+
+
+def _load_pillow():
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        raise ImageProcessingUnavailable("Обработка изображений недоступна: не установлен Pillow")
+    return Image, ImageOps
+
+
+def _decode(content: bytes):
+    """Проверка формата и размеров по заголовку, затем одно полное декодирование"""
+    Image, ImageOps = _load_pillow()
+    try:
+        image = Image.open(io.BytesIO(content))
+        if image.format not in ALLOWED_FORMATS:
+            raise ImageValidationError("Поддерживаются только JPEG, PNG и WebP изображения")
+        width, height = image.size
+        if width * height > MAX_PIXELS:
+            raise ImageValidationError("Слишком большое разрешение изображения")
+        image.load()
+    except ImageValidationError:
+        raise
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError) as e:
+        raise ImageValidationError(f"Не удалось прочитать изображение: {e}")
+
+    source_format = image.format
+    image = ImageOps.exif_transpose(image)
+    has_alpha = image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info)
+    image = image.convert('RGBA' if has_alpha else 'RGB')
+    return image, source_format
+
+
+def _resize(image, size: int, crop: bool):
+    Image, ImageOps = _load_pillow()
+    # Не увеличиваем: маленький оригинал отдаем в собственном размере
+    target = min(size, max(image.size) if not crop else min(image.size))
+    if crop:
+        return ImageOps.fit(image, (target, target), Image.LANCZOS)
+    resized = image.copy()
+    resized.thumbnail((target, target), Image.LANCZOS)
+    return resized
+
+
+def _encode(image, fmt: str) -> bytes:
+    buffer = io.BytesIO()
+    if fmt == 'webp':
+        image.save(buffer, 'WEBP', quality=WEBP_QUALITY, method=4)
+    else:
+        image.save(buffer, 'PNG', optimize=True)
+    return buffer.getvalue()
+
+
+def derivative_names(kind: str) -> Tuple[List[str], str]:
+    """Имена производных для типа изображения и имя основной"""
+    spec = DERIVATIVE_SIZES[kind]
+    names = [f"{kind}-{size}.webp" for size in spec['sizes']]
+    if PNG_FALLBACK:
+        names.append(f"{kind}-{spec['default']}.png")
+    return names, f"{kind}-{spec['default']}.webp"
+
+
+def render_derivatives(image, kind: str) -> Dict[str, bytes]:
+    """{имя: байты} для всех производных уже декодированного изображения"""
+    spec = DERIVATIVE_SIZES[kind]
+    rendered = {}
+    for size in spec['sizes']:
+        resized = _resize(image, size, spec['crop'])
+        rendered[f"{kind}-{size}.webp"] = _encode(resized, 'webp')
+        if PNG_FALLBACK and size == spec['default']:
+            rendered[f"{kind}-{size}.png"] = _encode(resized, 'png')
+    return rendered
+
+
+def _validate_svg(content: bytes) -> None:
+    head = content[:1024].lstrip().lower()
+    if not (head.startswith(b'<svg') or (head.startswith(b'<?xml') and b'<svg' in content[:4096].lower())):
+        raise ImageValidationError("Файл не является SVG изображением")
+    lowered = content.lower()
+    if b'<script' in lowered or b'javascript:' in lowered:
+        raise ImageValidationError("SVG со скриптами не поддерживается")
+
+
+def store_image(
+    s3_service,
+    content: bytes,
+    kind: str,
+    allow_svg: bool = False,
+) -> Dict[str, Any]:
+    """
+    Проверяет, обрабатывает и сохраняет изображение по ключам от его содержимого.
+
+    Синхронная функция: из async-обработчиков вызывается через asyncio.to_thread.
+
+    Returns:
+        Dict с digest, url основной производной, variants {имя: url} и
+        deduplicated=True, если все объекты уже были в хранилище
+    """
+    if kind not in DERIVATIVE_SIZES:
+        raise ValueError(f"Неизвестный тип изображения: {kind}")
+    if not content:
+        raise ImageValidationError("Пустой файл")
+
+    digest = content_digest(content)
+
+    image = None
+    if allow_svg and content[:1024].lstrip()[:1] == b'<':
+        # Векторной иконке производные не нужны: храним проверенный оригинал
+        _validate_svg(content)
+        names, default_name, source_format = ['original.svg'], 'original.svg', 'SVG'
+    else:
+        # Проверяем всегда — даже если такие производные уже есть, на мусор клиент получает ошибку
+        image, source_format = _decode(content)
+        names, default_name = derivative_names(kind)
+
+    missing = [name for name in names if not s3_service.file_exists(asset_key(digest, name))]
+    if missing:
+        rendered = {'original.svg': content} if image is None else render_derivatives(image, kind)
+        for name in missing:
+            result = s3_service.upload_file(
+                file_content=rendered[name],
+                object_key=asset_key(digest, name),
+                content_type=asset_content_type(name),
+                # Объект общий для всех загрузивших: без user-id в метаданных
+                metadata={'file-type': kind, 'source-sha256': digest},
+                cache_control=IMMUTABLE_CACHE_CONTROL,
+            )
+            if not result.get('success'):
+                raise RuntimeError(f"S3 upload failed: {result.get('error')}")
+        logger.info(f"🖼️ Изображение {digest[:12]} ({kind}): загружено производных {len(missing)}")
+    else:
+        logger.info(f"♻️ Изображение {digest[:12]} ({kind}) уже в хранилище, повторная загрузка не нужна")
+
+    return {
+        'digest': digest,
+        'url': asset_url(digest, default_name),
+        'filename': default_name,
+        'object_key': asset_key(digest, default_name),
+        'variants': {name: asset_url(digest, name) for name in names},
+        'deduplicated': not missing,
+        'source_format': source_format,
+        'width': image.size[0] if image else None,
+        'height': image.size[1] if image else None,
+        'size': len(content),
+    }
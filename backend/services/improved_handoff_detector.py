@@ -4,9 +4,26 @@
 """
 
 import re
-from typing import Tuple, List, Dict
+import json
+import os
+import time
+import logging
+import threading
+from typing import Tuple, List, Dict, NamedTuple, Optional, Pattern
 from dataclasses import dataclass
 
+logger = logging.getLogger(__name__)
+
+# Настройки детектора в SystemSettings (категория 'ai'), подхватываются без рестарта
+HANDOFF_SETTINGS_CATEGORY = 'ai'
+HANDOFF_SETTINGS_KEYS = (
+    'handoff_patterns',
+    'handoff_exclusions',
+    'handoff_ai_fallback_patterns',
+    'handoff_threshold',
+)
+HANDOFF_DETECTOR_RELOAD_SECONDS = int(os.getenv('HANDOFF_DETECTOR_RELOAD_SECONDS', '60'))
+
 @dataclass
 class HandoffPattern:
     """Паттерн для определения запроса оператора"""
@@ -121,6 +138,35 @@ class ImprovedHandoffDetector:
             r'(?:don\'t|do not) (?:know|have) (?:enough|sufficient)',
             r'contact (?:support|our team)',
         ]
+        
+        # Порог суммарного веса для срабатывания
+        self.threshold = 0.5
+        
+        # Встроенные паттерны сохраняем, чтобы настройки из БД дополняли их, а не накапливались
+        self._default_handoff_patterns = list(self.handoff_patterns)
+        self._default_exclusion_patterns = list(self.exclusion_patterns)
+        self._default_ai_fallback_patterns = list(self.ai_fallback_patterns)
+        
+        self._compile()
+
+    def _compile(self) -> None:
+        self._compiled = _compile_patterns(
+            self.handoff_patterns, self.exclusion_patterns, self.ai_fallback_patterns, self.threshold
+        )
+
+    def apply_settings(self, handoff_patterns: List[HandoffPattern] = None, exclusion_patterns: List[str] = None,
+                       ai_fallback_patterns: List[str] = None, threshold: float = None) -> None:
+        """Применяет дополнительные паттерны и порог поверх встроенных и перекомпилирует детектор"""
+        handoff = self._default_handoff_patterns + list(handoff_patterns or [])
+        exclusions = self._default_exclusion_patterns + list(exclusion_patterns or [])
+        ai_fallback = self._default_ai_fallback_patterns + list(ai_fallback_patterns or [])
+        threshold = threshold if threshold is not None else 0.5
+        # Сначала компилируем всё, потом одной заменой ссылки переключаемся:
+        # при ошибке детектор остается целиком в прежнем состоянии
+        compiled = _compile_patterns(handoff, exclusions, ai_fallback, threshold)
+        self._compiled = compiled
+        self.handoff_patterns, self.exclusion_patterns, self.ai_fallback_patterns = handoff, exclusions, ai_fallback
+        self.threshold = threshold
 
     def should_request_handoff(self, user_text: str, ai_text: str = None, dialog=None) -> Tuple[bool, str, Dict]:
         """
@@ -129,26 +175,29 @@ class ImprovedHandoffDetector:
         Returns:
             Tuple[bool, str, dict]: (should_handoff, reason, details)
         """
+        compiled = self._compiled  # Один снимок на вызов: apply_settings может заменить его параллельно
         details = {
             "matched_patterns": [],
             "excluded_patterns": [],
             "total_score": 0.0,
-            "threshold": 0.5,
+            "threshold": compiled.threshold,
             "ai_fallback": False
         }
         
         # 1. Проверяем исключающие паттерны
         user_text_clean = user_text.lower()
-        for exclusion_pattern in self.exclusion_patterns:
-            if re.search(exclusion_pattern, user_text_clean):
-                details["excluded_patterns"].append(exclusion_pattern)
-                # Если есть исключающий паттерн, снижаем вероятность
-                return False, "excluded_pattern", details
+        if _gate_matches(compiled.exclusion_gate, compiled.exclusions, user_text_clean):
+            for exclusion_pattern, regex in compiled.exclusions:
+                if regex.search(user_text_clean):
+                    details["excluded_patterns"].append(exclusion_pattern)
+                    # Если есть исключающий паттерн, снижаем вероятность
+                    return False, "excluded_pattern", details
         
         # 2. Проверяем handoff паттерны
         total_score = 0.0
-        for pattern in self.handoff_patterns:
-            match = re.search(pattern.pattern, user_text_clean)
+        has_handoff_match = _gate_matches(compiled.handoff_gate, compiled.handoff, user_text_clean)
+        for pattern, regex in (compiled.handoff if has_handoff_match else ()):
+            match = regex.search(user_text_clean)
             if match:
                 details["matched_patterns"].append({
                     "pattern": pattern.pattern,
@@ -162,13 +211,9 @@ class ImprovedHandoffDetector:
         details["total_score"] = total_score
         
         # 3. Проверяем AI fallback если есть ответ AI
-        if ai_text:
-            ai_text_clean = ai_text.lower()
-            for fallback_pattern in self.ai_fallback_patterns:
-                if re.search(fallback_pattern, ai_text_clean):
-                    details["ai_fallback"] = True
-                    total_score += 0.8  # Добавляем вес за AI fallback
-                    break
+        if ai_text and _gate_matches(compiled.ai_fallback_gate, compiled.ai_fallback, ai_text.lower()):
+            details["ai_fallback"] = True
+            total_score += 0.8  # Добавляем вес за AI fallback
         
         # 4. Проверяем контекст диалога (повторные проблемы)
         if dialog and hasattr(dialog, 'fallback_count') and dialog.fallback_count >= 2:
@@ -216,6 +261,171 @@ class ImprovedHandoffDetector:
             ]
         }
 
+def _safe_compile(pattern: str) -> Optional[Pattern]:
+    """Компилирует паттерн; некорректные паттерны из настроек пропускаются с предупреждением"""
+    try:
+        return re.compile(pattern)
+    except re.error as e:
+        logger.warning(f"⚠️ Некорректный handoff паттерн {pattern!r} пропущен: {e}")
+        return None
+
+
+def _combine_patterns(patterns: List[str]) -> Optional[Pattern]:
+    """
+    Объединяет паттерны в одну альтернацию для однопроходной проверки.
+
+    Каждый паттерн по отдельности валиден, но вместе они могут не собраться
+    (повтор именованных групп, inline-флаги не в начале) — тогда фильтра нет
+    и паттерны проверяются по одному.
+    """
+    if not patterns:
+        return None
+    try:
+        return re.compile('|'.join(f'(?:{p})' for p in patterns))
+    except re.error as e:
+        logger.warning(f"⚠️ Handoff паттерны не объединяются в общий фильтр, проверка по одному: {e}")
+        return None
+
+
+class _CompiledPatterns(NamedTuple):
+    """Скомпилированное состояние детектора; заменяется целиком"""
+    handoff: List[Tuple[HandoffPattern, Pattern]]
+    exclusions: List[Tuple[str, Pattern]]
+    ai_fallback: List[Tuple[str, Pattern]]
+    handoff_gate: Optional[Pattern]
+    exclusion_gate: Optional[Pattern]
+    ai_fallback_gate: Optional[Pattern]
+    threshold: float
+
+
+def _compile_patterns(handoff_patterns: List[HandoffPattern], exclusion_patterns: List[str],
+                      ai_fallback_patterns: List[str], threshold: float) -> _CompiledPatterns:
+    """
+    Компилирует все паттерны один раз.
+
+    Для каждой группы строится общая альтернация: один проход по тексту отвечает
+    на вопрос «есть ли хоть одно совпадение». Подавляющее большинство сообщений
+    не содержит ни одного паттерна и отсекается этим проходом; отдельные
+    скомпилированные паттерны запускаются только для текстов, прошедших фильтр.
+    """
+    handoff = [(p, c) for p, c in ((p, _safe_compile(p.pattern)) for p in handoff_patterns) if c]
+    exclusions = [(p, c) for p, c in ((p, _safe_compile(p)) for p in exclusion_patterns) if c]
+    ai_fallback = [(p, c) for p, c in ((p, _safe_compile(p)) for p in ai_fallback_patterns) if c]
+    return _CompiledPatterns(
+        handoff=handoff,
+        exclusions=exclusions,
+        ai_fallback=ai_fallback,
+        handoff_gate=_combine_patterns([c.pattern for _, c in handoff]),
+        exclusion_gate=_combine_patterns([c.pattern for _, c in exclusions]),
+        ai_fallback_gate=_combine_patterns([c.pattern for _, c in ai_fallback]),
+        threshold=threshold,
+    )
+
+
+def _gate_matches(gate: Optional[Pattern], compiled: list, text: str) -> bool:
+    """Есть ли совпадение хотя бы с одним паттерном группы"""
+    if gate is not None:
+        return bool(gate.search(text))
+    return any(regex.search(text) for _, regex in compiled)
+
+
+def _parse_setting_value(setting):
+    if setting.value is None:
+        return None
+    if setting.data_type == 'float':
+        return float(setting.value)
+    return json.loads(setting.value)
+
+
+def _parse_handoff_patterns(raw) -> List[HandoffPattern]:
+    patterns = []
+    for item in raw or []:
+        if isinstance(item, str):
+            patterns.append(HandoffPattern(item, "custom", 1.0, "Паттерн из настроек"))
+        elif isinstance(item, dict) and item.get('pattern'):
+            patterns.append(HandoffPattern(
+                item['pattern'],
+                item.get('reason', 'custom'),
+                float(item.get('weight', 1.0)),
+                item.get('description', 'Паттерн из настроек')
+            ))
+    return patterns
+
+
+# Процессный синглтон детектора
+_detector: Optional[ImprovedHandoffDetector] = None
+_detector_lock = threading.Lock()
+_settings_checked_at = 0.0
+_settings_version = None
+
+
+def _reload_from_settings(detector: ImprovedHandoffDetector) -> None:
+    """Перечитывает настройки детектора из SystemSettings, если они изменились"""
+    global _settings_version
+    from database.connection import SessionLocal
+    from database import models
+    
+    db = SessionLocal()
+    try:
+        rows = db.query(models.SystemSettings).filter(
+            models.SystemSettings.category == HANDOFF_SETTINGS_CATEGORY,
+            models.SystemSettings.key.in_(HANDOFF_SETTINGS_KEYS),
+            models.SystemSettings.is_active == True
+        ).all()
+    finally:
+        db.close()
+    
+    version = tuple(sorted((row.key, str(row.updated_at)) for row in rows))
+    if version == _settings_version:
+        return
+    
+    values = {}
+    for row in rows:
+        try:
+            values[row.key] = _parse_setting_value(row)
+        except (ValueError, TypeError) as e:
+            logger.warning(f"⚠️ Некорректное значение настройки {row.category}.{row.key}: {e}")
+    
+    detector.apply_settings(
+        handoff_patterns=_parse_handoff_patterns(values.get('handoff_patterns')),
+        exclusion_patterns=values.get('handoff_exclusions') or [],
+        ai_fallback_patterns=values.get('handoff_ai_fallback_patterns') or [],
+        threshold=values.get('handoff_threshold'),
+    )
+    _settings_version = version
+    logger.info(f"🔄 Handoff детектор перекомпилирован: {len(detector.handoff_patterns)} паттернов, "
+                f"{len(detector.exclusion_patterns)} исключений, порог {detector.threshold}")
+
+
+def get_handoff_detector() -> ImprovedHandoffDetector:
+    """
+    Возвращает общий для процесса детектор с предкомпилированными паттернами.
+    Раз в HANDOFF_DETECTOR_RELOAD_SECONDS проверяет настройки в SystemSettings.
+    """
+    global _detector, _settings_checked_at
+    
+    if _detector is not None and time.monotonic() - _settings_checked_at < HANDOFF_DETECTOR_RELOAD_SECONDS:
+        return _detector
+    
+    with _detector_lock:
+        if _detector is None:
+            _detector = ImprovedHandoffDetector()
+        if time.monotonic() - _settings_checked_at >= HANDOFF_DETECTOR_RELOAD_SECONDS:
+            _settings_checked_at = time.monotonic()
+            try:
+                _reload_from_settings(_detector)
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось загрузить настройки handoff детектора: {e}")
+    
+    return _detector
+
+
+def invalidate_handoff_detector() -> None:
+    """Форсирует перечитывание настроек при следующем обращении к детектору"""
+    global _settings_checked_at
+    _settings_checked_at = 0.0
+
+
 def test_improved_detector():
     """Тестирует улучшенную систему"""
     detector = ImprovedHandoffDetector()
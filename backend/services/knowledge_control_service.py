@@ -7,16 +7,68 @@
 
 import re
 import json
-import hashlib
 from datetime import datetime
-from typing import List, Dict, Optional, Tuple
+from typing import Callable, List, Dict, Optional, Sequence, Tuple
 from sqlalchemy.orm import Session
 from database import models
+from database.models import knowledge_content_hash
 from cache.redis_cache import chatai_cache
 import logging
 
 logger = logging.getLogger(__name__)
 
+SCAN_BATCH_SIZE = 500
+
+
+class ContentMatcher:
+    """
+    Скомпилированные проверки контента за один проход по тексту
+
+    Запрещенные паттерны объединены в одно регулярное выражение: чистый
+    контент (обычный случай) проверяется одним проходом, а какие именно
+    паттерны сработали, уточняется только при совпадении. Ключевые слова -
+    одна альтернация (длинные первыми) с lookahead, поэтому находятся и
+    перекрывающиеся вхождения без копии текста в нижнем регистре.
+    """
+
+    def __init__(self, patterns: Sequence[str], keywords: Sequence[str]):
+        self.patterns = list(patterns)
+        self._compiled_patterns = [re.compile(pattern, re.IGNORECASE) for pattern in self.patterns]
+        self._any_pattern = re.compile('|'.join(f'(?:{pattern})' for pattern in self.patterns), re.IGNORECASE) \
+            if self.patterns else None
+
+        self.keywords = list(keywords)
+        ordered = sorted(set(keyword.lower() for keyword in self.keywords), key=len, reverse=True)
+        self._keyword_scan = re.compile(
+            '(?=(' + '|'.join(re.escape(keyword) for keyword in ordered) + '))', re.IGNORECASE
+        ) if ordered else None
+        # Ключевые слова, совпадающие в той же позиции: более короткие префиксы найденного
+        self._prefixes = {
+            keyword: [other for other in ordered if other != keyword and keyword.startswith(other)]
+            for keyword in ordered
+        }
+
+    def forbidden(self, content: str) -> List[str]:
+        """Сработавшие запрещенные паттерны (в порядке объявления)"""
+        if self._any_pattern is None or not self._any_pattern.search(content):
+            return []
+        return [pattern for pattern, compiled in zip(self.patterns, self._compiled_patterns)
+                if compiled.search(content)]
+
+    def suspicious(self, content: str) -> List[str]:
+        """Найденные ключевые слова (в порядке объявления)"""
+        if self._keyword_scan is None:
+            return []
+        found = set()
+        for match in self._keyword_scan.finditer(content):
+            keyword = match.group(1).lower()
+            found.add(keyword)
+            found.update(self._prefixes.get(keyword, ()))
+            if len(found) == len(self._prefixes):
+                break
+        return [keyword for keyword in self.keywords if keyword.lower() in found]
+
+
 class KnowledgeControlService:
     """Служба контроля и валидации базы знаний"""
     
@@ -40,8 +92,10 @@ class KnowledgeControlService:
     
     def __init__(self, db: Session):
         self.db = db
+        self.matcher = _matcher_for(self.FORBIDDEN_PATTERNS, self.SUSPICIOUS_KEYWORDS)
     
-    def validate_content(self, content: str, assistant_id: int, user_id: int) -> Dict:
+    def validate_content(self, content: str, assistant_id: int, user_id: int,
+                         check_duplicates: bool = True) -> Dict:
         """
         Валидация контента перед добавлением в базу знаний
         
@@ -57,10 +111,7 @@ class KnowledgeControlService:
         }
         
         # 1. Проверка на запрещенные паттерны
-        forbidden_found = []
-        for pattern in self.FORBIDDEN_PATTERNS:
-            if re.search(pattern, content, re.IGNORECASE):
-                forbidden_found.append(pattern)
+        forbidden_found = self.matcher.forbidden(content)
         
         if forbidden_found:
             result['is_valid'] = False
@@ -71,10 +122,7 @@ class KnowledgeControlService:
             })
         
         # 2. Проверка на подозрительные ключевые слова
-        suspicious_found = []
-        for keyword in self.SUSPICIOUS_KEYWORDS:
-            if keyword.lower() in content.lower():
-                suspicious_found.append(keyword)
+        suspicious_found = self.matcher.suspicious(content)
         
         if suspicious_found:
             result['warnings'].append({
@@ -84,16 +132,13 @@ class KnowledgeControlService:
             })
         
         # 3. Генерация хэша контента для контроля версий
-        result['content_hash'] = hashlib.sha256(content.encode()).hexdigest()
+        result['content_hash'] = knowledge_content_hash(content)
         
         # 4. Проверка на дубликаты
-        existing = self.check_duplicate_content(result['content_hash'], assistant_id, user_id)
-        if existing:
-            result['warnings'].append({
-                'type': 'DUPLICATE_CONTENT',
-                'message': f'Аналогичный контент уже существует (ID: {existing})',
-                'existing_id': existing
-            })
+        if check_duplicates:
+            existing = self.check_duplicate_content(result['content_hash'], assistant_id, user_id)
+            if existing:
+                result['warnings'].append(self._duplicate_warning(existing))
         
         # 5. Проверка размера контента
         if len(content) > 50000:  # 50KB лимит
@@ -105,17 +150,30 @@ class KnowledgeControlService:
         
         return result
     
-    def check_duplicate_content(self, content_hash: str, assistant_id: int, user_id: int) -> Optional[int]:
-        """Проверка на дубликаты контента"""
+    @staticmethod
+    def _duplicate_warning(existing_id: int) -> Dict:
+        return {
+            'type': 'DUPLICATE_CONTENT',
+            'message': f'Аналогичный контент уже существует (ID: {existing_id})',
+            'existing_id': existing_id
+        }
+    
+    def check_duplicate_content(self, content_hash: str, assistant_id: int, user_id: int,
+                                exclude_id: Optional[int] = None) -> Optional[int]:
+        """Проверка на дубликаты контента (поиск по индексу content_sha256)"""
         try:
-            existing = self.db.query(models.UserKnowledge).filter(
+            query = self.db.query(models.UserKnowledge.id).filter(
                 models.UserKnowledge.user_id == user_id,
                 models.UserKnowledge.assistant_id == assistant_id,
-                models.UserKnowledge.content.op('~')(f'#{content_hash}#')  # Простая проверка по хэшу
-            ).first()
+                models.UserKnowledge.content_sha256 == content_hash
+            )
+            if exclude_id is not None:
+                query = query.filter(models.UserKnowledge.id != exclude_id)
+            existing = query.order_by(models.UserKnowledge.id).first()
             
             return existing.id if existing else None
-        except:
+        except Exception as e:
+            logger.warning(f"Ошибка проверки дубликатов знаний: {e}")
             return None
     
     def add_knowledge_with_validation(
@@ -209,8 +267,13 @@ class KnowledgeControlService:
                 'message': 'Запись знаний не найдена'
             }
         
-        # Валидация нового контента
-        validation = self.validate_content(new_content, existing.assistant_id, user_id)
+        # Валидация нового контента (сама обновляемая запись дубликатом не считается)
+        validation = self.validate_content(new_content, existing.assistant_id, user_id, check_duplicates=False)
+        duplicate_id = self.check_duplicate_content(
+            validation['content_hash'], existing.assistant_id, user_id, exclude_id=knowledge_id
+        )
+        if duplicate_id:
+            validation['warnings'].append(self._duplicate_warning(duplicate_id))
         
         if not validation['is_valid']:
             logger.warning(f"Отклонено обновление knowledge_id={knowledge_id}: {validation['errors']}")
@@ -274,8 +337,19 @@ class KnowledgeControlService:
             return int(version_match.group(1)) + 1
         return 2  # Если версии нет, это будет версия 2
     
-    def scan_existing_knowledge(self, user_id: int = None) -> Dict:
-        """Сканирование существующих знаний на предмет нарушений"""
+    def scan_existing_knowledge(
+        self,
+        user_id: int = None,
+        batch_size: int = SCAN_BATCH_SIZE,
+        progress_callback: Optional[Callable[[int, int], None]] = None
+    ) -> Dict:
+        """
+        Сканирование существующих знаний на предмет нарушений
+
+        Записи читаются потоком пачками по batch_size (yield_per), дубликаты
+        ищутся одним запросом по content_sha256 на пачку. После каждой пачки
+        вызывается progress_callback(просканировано, нарушений).
+        """
         
         result = {
             'total_scanned': 0,
@@ -283,16 +357,44 @@ class KnowledgeControlService:
             'violations': []
         }
         
-        # Получаем записи для сканирования
-        query = self.db.query(models.UserKnowledge)
+        UK = models.UserKnowledge
+        query = self.db.query(
+            UK.id, UK.user_id, UK.assistant_id, UK.doc_type, UK.created_at, UK.content, UK.content_sha256
+        ).order_by(UK.id)
         if user_id:
-            query = query.filter(models.UserKnowledge.user_id == user_id)
+            query = query.filter(UK.user_id == user_id)
         
-        knowledge_records = query.all()
-        result['total_scanned'] = len(knowledge_records)
+        batch = []
+        for row in query.execution_options(yield_per=batch_size):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                self._scan_batch(batch, result)
+                batch = []
+                self._report_scan_progress(result, progress_callback)
+        if batch:
+            self._scan_batch(batch, result)
+        self._report_scan_progress(result, progress_callback)
         
-        for knowledge in knowledge_records:
-            validation = self.validate_content(knowledge.content, knowledge.assistant_id, knowledge.user_id)
+        return result
+    
+    def _scan_batch(self, batch: List, result: Dict) -> None:
+        UK = models.UserKnowledge
+        hashes = {row.content_sha256 or knowledge_content_hash(row.content) for row in batch}
+        # Первая запись с тем же хэшем у того же владельца - оригинал, остальные - дубликаты
+        first_ids = {}
+        for row in self.db.query(UK.id, UK.user_id, UK.assistant_id, UK.content_sha256).filter(
+            UK.content_sha256.in_(hashes)
+        ).order_by(UK.id):
+            first_ids.setdefault((row.user_id, row.assistant_id, row.content_sha256), row.id)
+        
+        for knowledge in batch:
+            validation = self.validate_content(
+                knowledge.content, knowledge.assistant_id, knowledge.user_id, check_duplicates=False
+            )
+            original_id = first_ids.get((knowledge.user_id, knowledge.assistant_id, validation['content_hash']))
+            if original_id is not None and original_id != knowledge.id:
+                validation['warnings'].append(self._duplicate_warning(original_id))
+            result['total_scanned'] += 1
             
             if not validation['is_valid'] or validation['warnings']:
                 result['violations_found'] += 1
@@ -301,11 +403,16 @@ class KnowledgeControlService:
                     'user_id': knowledge.user_id,
                     'assistant_id': knowledge.assistant_id,
                     'doc_type': knowledge.doc_type,
-                    'created_at': knowledge.created_at.isoformat(),
+                    'created_at': knowledge.created_at.isoformat() if knowledge.created_at else None,
                     'validation': validation
                 })
-        
-        return result
+    
+    @staticmethod
+    def _report_scan_progress(result: Dict, progress_callback: Optional[Callable[[int, int], None]]) -> None:
+        logger.info(f"🔎 Сканирование знаний: {result['total_scanned']} записей, "
+                    f"нарушений {result['violations_found']}")
+        if progress_callback:
+            progress_callback(result['total_scanned'], result['violations_found'])
     
     def cleanup_violations(self, violations: List[Dict], create_backup: bool = True) -> Dict:
         """Очистка нарушений с созданием резервной копии"""
@@ -374,6 +481,18 @@ class KnowledgeControlService:
         return result
 
 
+_matchers: Dict[Tuple, ContentMatcher] = {}
+
+
+def _matcher_for(patterns: Sequence[str], keywords: Sequence[str]) -> ContentMatcher:
+    """Матчер компилируется один раз на набор паттернов, а не на каждый экземпляр сервиса"""
+    key = (tuple(patterns), tuple(keywords))
+    matcher = _matchers.get(key)
+    if matcher is None:
+        matcher = _matchers[key] = ContentMatcher(patterns, keywords)
+    return matcher
+
+
 # Функции для интеграции с API
 
 def validate_knowledge_upload(content: str, assistant_id: int, user_id: int, db: Session) -> Dict:
@@ -0,0 +1,210 @@
+"""
+Счетчики сообщений ассистента по пользователям и периодам
+
+Лимиты (месячный по тарифу, пробный период) раньше проверялись через COUNT(*)
+по dialog_messages ⋈ dialogs на каждом сообщении — запрос рос вместе с историей.
+Теперь счетчик увеличивается в той же транзакции, что и INSERT сообщения
+ассистента (ORM-событие after_insert, INSERT ... ON CONFLICT DO UPDATE), проверка
+лимита — чтение одной строки по первичному ключу, а rebuild_counters
+пересчитывает счетчики из истории. Лимит сайта считается по гостю, поэтому для
+диалогов с guest_id отдельно ведется месячный счетчик (user_id, guest_id, период).
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import delete, event, func, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from database.models import Dialog, DialogMessage, GuestMessageCounter, MessageQuotaCounter
+
+logger = logging.getLogger(__name__)
+
+ALL_TIME = 'all'
+COUNTED_SENDER = 'assistant'
+DIALOG_CACHE_SIZE = 10000
+REBUILD_INSERT_BATCH = 1000
+
+_INSERTS = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}
+
+# dialog_id -> (user_id, assistant_id, guest_id): сообщение знает только dialog_id.
+# Владелец и гость диалога не меняются; assistant_id обнуляется при удалении
+# ассистента (crud.delete_assistant), после чего кэш сбрасывается forget_dialogs
+_dialog_info: "OrderedDict[int, Tuple[Optional[int], Optional[int], Optional[str]]]" = OrderedDict()
+_dialog_info_lock = threading.Lock()
+
+
+def period_for(moment: Optional[datetime] = None) -> str:
+    """Ключ месячного периода (UTC), например '2026-10'"""
+    return (moment or datetime.utcnow()).strftime('%Y-%m')
+
+
+def forget_dialogs() -> None:
+    """Сбросить кэш диалогов процесса (после массового изменения dialogs)"""
+    with _dialog_info_lock:
+        _dialog_info.clear()
+
+
+def dialog_info(connection, message: DialogMessage) -> Tuple[Optional[int], Optional[int]]:
+    """(user_id, assistant_id) диалога сообщения с LRU-кэшем"""
+    return _dialog_row(connection, message)[:2]
+
+
+def _dialog_row(connection, message: DialogMessage) -> Tuple[Optional[int], Optional[int], Optional[str]]:
+    dialog = message.__dict__.get('dialog')
+    if dialog is not None and dialog.user_id is not None:
+        return dialog.user_id, dialog.assistant_id, dialog.guest_id
+
+    with _dialog_info_lock:
+        info = _dialog_info.get(message.dialog_id)
+        if info is not None:
+            _dialog_info.move_to_end(message.dialog_id)
+            return info
+
+    row = connection.execute(
+        select(Dialog.user_id, Dialog.assistant_id, Dialog.guest_id).where(Dialog.id == message.dialog_id)
+    ).first()
+    if row is None:
+        return None, None, None
+    info = (row.user_id, row.assistant_id, row.guest_id)
+    with _dialog_info_lock:
+        _dialog_info[message.dialog_id] = info
+        if len(_dialog_info) > DIALOG_CACHE_SIZE:
+            _dialog_info.popitem(last=False)
+    return info
+
+
+def increment(connection, user_id: int, moment: Optional[datetime] = None, amount: int = 1) -> Dict[str, int]:
+    """Атомарно увеличить счетчики за месяц и за все время; возвращает новые значения"""
+    insert = _INSERTS.get(connection.dialect.name)
+    if insert is None:
+        return {}
+    now = datetime.utcnow()
+    stmt = insert(MessageQuotaCounter).values([
+        {'user_id': user_id, 'period': period_for(moment), 'count': amount, 'updated_at': now},
+        {'user_id': user_id, 'period': ALL_TIME, 'count': amount, 'updated_at': now},
+    ])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['user_id', 'period'],
+        set_={'count': MessageQuotaCounter.count + stmt.excluded.count, 'updated_at': now},
+    ).returning(MessageQuotaCounter.period, MessageQuotaCounter.count)
+    return {period: count for period, count in connection.execute(stmt)}
+
+
+def increment_guest(connection, user_id: int, guest_id: str, moment: Optional[datetime] = None,
+                    amount: int = 1) -> None:
+    """Атомарно увеличить месячный счетчик гостя"""
+    insert = _INSERTS.get(connection.dialect.name)
+    if insert is None:
+        return
+    now = datetime.utcnow()
+    stmt = insert(GuestMessageCounter).values(
+        user_id=user_id, guest_id=guest_id, period=period_for(moment), count=amount, updated_at=now
+    )
+    connection.execute(stmt.on_conflict_do_update(
+        index_elements=['user_id', 'guest_id', 'period'],
+        set_={'count': GuestMessageCounter.count + stmt.excluded.count, 'updated_at': now},
+    ))
+
+
+@event.listens_for(DialogMessage, "after_insert")
+def _count_assistant_message(mapper, connection, target):
+    """Счетчик меняется в транзакции сообщения: откат сообщения откатывает и его"""
+    if target.sender != COUNTED_SENDER or target.dialog_id is None:
+        return
+    user_id, _, guest_id = _dialog_row(connection, target)
+    if user_id is None:
+        return
+    increment(connection, user_id, target.timestamp)
+    if guest_id is not None:
+        increment_guest(connection, user_id, guest_id, target.timestamp)
+
+
+def get_count(db: Session, user_id: int, period: str) -> int:
+    return db.execute(
+        select(MessageQuotaCounter.count).where(
+            MessageQuotaCounter.user_id == user_id,
+            MessageQuotaCounter.period == period
+        )
+    ).scalar() or 0
+
+
+def get_monthly_count(db: Session, user_id: int, moment: Optional[datetime] = None) -> int:
+    """Сообщения ассистента пользователя за текущий (или указанный) месяц"""
+    return get_count(db, user_id, period_for(moment))
+
+
+def get_guest_monthly_count(db: Session, user_id: int, guest_id: str, moment: Optional[datetime] = None) -> int:
+    """Сообщения ассистента гостю пользователя за текущий (или указанный) месяц"""
+    return db.execute(
+        select(GuestMessageCounter.count).where(
+            GuestMessageCounter.user_id == user_id,
+            GuestMessageCounter.guest_id == guest_id,
+            GuestMessageCounter.period == period_for(moment)
+        )
+    ).scalar() or 0
+
+
+def get_total_count(db: Session, user_id: int) -> int:
+    """Сообщения ассистента пользователя за все время"""
+    return get_count(db, user_id, ALL_TIME)
+
+
+def _month_expression(dialect_name: str):
+    if dialect_name == 'sqlite':
+        return func.strftime('%Y-%m', DialogMessage.timestamp)
+    return func.to_char(DialogMessage.timestamp, 'YYYY-MM')
+
+
+def _replace_counters(db: Session, model, user_id: Optional[int], rows) -> None:
+    stale = delete(model)
+    if user_id is not None:
+        stale = stale.where(model.user_id == user_id)
+    db.execute(stale)
+    for start in range(0, len(rows), REBUILD_INSERT_BATCH):
+        db.execute(model.__table__.insert(), rows[start:start + REBUILD_INSERT_BATCH])
+
+
+def rebuild_counters(db: Session, user_id: Optional[int] = None) -> int:
+    """Пересчитать счетчики из истории сообщений (всех пользователей или одного).
+
+    Сообщения, записанные параллельно с пересчетом, могут быть учтены неточно —
+    запускать в спокойное время или повторно для конкретного пользователя.
+    Возвращает количество пользователей с ненулевыми счетчиками.
+    """
+    month = _month_expression(db.get_bind().dialect.name)
+    query = (
+        select(Dialog.user_id, Dialog.guest_id, month, func.count(DialogMessage.id))
+        .join(Dialog, Dialog.id == DialogMessage.dialog_id)
+        .where(DialogMessage.sender == COUNTED_SENDER, Dialog.user_id.isnot(None))
+        .group_by(Dialog.user_id, Dialog.guest_id, month)
+    )
+    if user_id is not None:
+        query = query.where(Dialog.user_id == user_id)
+
+    now = datetime.utcnow()
+    monthly, totals, guest_rows = {}, {}, []
+    for owner_id, guest_id, period, count in db.execute(query):
+        totals[owner_id] = totals.get(owner_id, 0) + count
+        if not period:
+            continue
+        monthly[(owner_id, period)] = monthly.get((owner_id, period), 0) + count
+        if guest_id is not None:
+            guest_rows.append({'user_id': owner_id, 'guest_id': guest_id, 'period': period,
+                               'count': count, 'updated_at': now})
+    rows = [{'user_id': owner_id, 'period': period, 'count': count, 'updated_at': now}
+            for (owner_id, period), count in monthly.items()]
+    rows.extend({'user_id': owner_id, 'period': ALL_TIME, 'count': count, 'updated_at': now}
+                for owner_id, count in totals.items())
+
+    _replace_counters(db, MessageQuotaCounter, user_id, rows)
+    _replace_counters(db, GuestMessageCounter, user_id, guest_rows)
+    db.commit()
+
+    logger.info(f"🔢 Счетчики сообщений пересчитаны: пользователей={len(totals)}, строк={len(rows)}, "
+                f"гостевых строк={len(guest_rows)}")
+    return len(totals)
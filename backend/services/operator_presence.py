@@ -1,22 +1,201 @@
-"""Operator presence service for managing operator status and availability."""
+"""Operator presence service for managing operator status and availability.
 
+Live presence is kept in Redis so heartbeats never touch Postgres:
+
+- ``operator:presence:{user_id}`` hash with status, last heartbeat and capacity
+- ``operator:alive:{user_id}`` key with a TTL; its keyspace expiry marks the operator offline
+- ``operator:capacity`` sorted set of online operators scored by free web slots
+- ``operator:heartbeats`` sorted set scored by last heartbeat (stale sweep fallback)
+- ``operator:presence:dirty`` set of operators changed since the last snapshot
+
+Changed operators are written back to ``operator_presence`` in batches by
+``flush_presence_snapshots`` for history and stats. ``active_chats`` stays
+owned by the database (it is changed transactionally on takeover/release) and
+is only mirrored into Redis. When Redis is unavailable every method falls back
+to the table as before.
+"""
+
+import asyncio
 import logging
+import os
+import time
 from datetime import datetime, timedelta
 from typing import List, Dict, Any, Optional
 from sqlalchemy.orm import Session
-from sqlalchemy import and_, or_
+from sqlalchemy import or_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 
 from database import models
 
 
 logger = logging.getLogger(__name__)
 
+HEARTBEAT_TIMEOUT_SECONDS = int(os.getenv('OPERATOR_HEARTBEAT_TIMEOUT', '90'))
+SNAPSHOT_INTERVAL_SECONDS = int(os.getenv('OPERATOR_PRESENCE_SNAPSHOT_SECONDS', '30'))
+SNAPSHOT_BATCH_SIZE = 500
+LISTENER_RETRY_SECONDS = 1
+LISTENER_MAX_BACKOFF_SECONDS = 60
+DEFAULT_MAX_CHATS_WEB = 3
+DEFAULT_MAX_CHATS_TELEGRAM = 5
+
+PRESENCE_KEY = "operator:presence:{user_id}"
+ALIVE_KEY_PREFIX = "operator:alive:"
+CAPACITY_KEY = "operator:capacity"
+HEARTBEATS_KEY = "operator:heartbeats"
+DIRTY_KEY = "operator:presence:dirty"
+
+
+def _decode(value):
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+class OperatorPresenceStore:
+    """Redis-side operator presence state."""
+
+    def __init__(self, redis_client=None):
+        if redis_client is None:
+            from cache.redis_cache import cache
+            redis_client = cache.redis_client
+        self.redis = redis_client
+
+    @property
+    def available(self) -> bool:
+        return self.redis is not None
+
+    def get(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Presence hash for operator or None if Redis has never seen them."""
+        raw = self.redis.hgetall(PRESENCE_KEY.format(user_id=user_id))
+        if not raw:
+            return None
+        data = {_decode(k): _decode(v) for k, v in raw.items()}
+        last_heartbeat = data.get("last_heartbeat")
+        return {
+            "user_id": user_id,
+            "status": data.get("status", "offline"),
+            "last_heartbeat": datetime.fromisoformat(last_heartbeat) if last_heartbeat else None,
+            "max_active_chats_web": int(data.get("max_active_chats_web", DEFAULT_MAX_CHATS_WEB)),
+            "max_active_chats_telegram": int(data.get("max_active_chats_telegram", DEFAULT_MAX_CHATS_TELEGRAM)),
+            "active_chats": int(data.get("active_chats", 0)),
+        }
+
+    def load(self, presence: Optional[models.OperatorPresence], user_id: int) -> None:
+        """Seed Redis hash from the table row (first heartbeat after Redis restart)."""
+        mapping = {
+            "status": presence.status if presence else "offline",
+            "max_active_chats_web": presence.max_active_chats_web if presence else DEFAULT_MAX_CHATS_WEB,
+            "max_active_chats_telegram": presence.max_active_chats_telegram if presence else DEFAULT_MAX_CHATS_TELEGRAM,
+            "active_chats": presence.active_chats if presence else 0,
+        }
+        if presence and presence.last_heartbeat:
+            mapping["last_heartbeat"] = presence.last_heartbeat.isoformat()
+        self.redis.hset(PRESENCE_KEY.format(user_id=user_id), mapping=mapping)
+
+    def touch(
+        self,
+        user_id: int,
+        status: str,
+        max_active_chats_web: Optional[int] = None,
+        max_active_chats_telegram: Optional[int] = None
+    ) -> Dict[str, Any]:
+        """Record heartbeat/status change and refresh capacity index."""
+        now = datetime.utcnow()
+        mapping = {"status": status, "last_heartbeat": now.isoformat()}
+        if max_active_chats_web is not None:
+            mapping["max_active_chats_web"] = max_active_chats_web
+        if max_active_chats_telegram is not None:
+            mapping["max_active_chats_telegram"] = max_active_chats_telegram
+
+        key = PRESENCE_KEY.format(user_id=user_id)
+        pipe = self.redis.pipeline()
+        pipe.hset(key, mapping=mapping)
+        if status == "offline":
+            pipe.delete(f"{ALIVE_KEY_PREFIX}{user_id}")
+            pipe.zrem(HEARTBEATS_KEY, user_id)
+        else:
+            pipe.set(f"{ALIVE_KEY_PREFIX}{user_id}", status, ex=HEARTBEAT_TIMEOUT_SECONDS)
+            pipe.zadd(HEARTBEATS_KEY, {user_id: time.time()})
+        pipe.sadd(DIRTY_KEY, user_id)
+        pipe.execute()
+
+        state = self.get(user_id)
+        self._index_capacity(state)
+        return state
+
+    def set_active_chats(self, user_id: int, active_chats: int) -> None:
+        """Mirror DB-owned active_chats counter into Redis."""
+        key = PRESENCE_KEY.format(user_id=user_id)
+        if not self.redis.exists(key):
+            return
+        self.redis.hset(key, "active_chats", active_chats)
+        self._index_capacity(self.get(user_id))
+
+    def mark_offline(self, user_id: int) -> bool:
+        """Mark operator offline (heartbeat TTL expired). Returns True if status changed."""
+        key = PRESENCE_KEY.format(user_id=user_id)
+        previous = _decode(self.redis.hget(key, "status"))
+        pipe = self.redis.pipeline()
+        pipe.zrem(CAPACITY_KEY, user_id)
+        pipe.zrem(HEARTBEATS_KEY, user_id)
+        if previous and previous != "offline":
+            pipe.hset(key, "status", "offline")
+            pipe.sadd(DIRTY_KEY, user_id)
+        pipe.execute()
+        return bool(previous and previous != "offline")
+
+    def stale_operator_ids(self) -> List[int]:
+        threshold = time.time() - HEARTBEAT_TIMEOUT_SECONDS
+        return [int(member) for member in self.redis.zrangebyscore(HEARTBEATS_KEY, "-inf", threshold)]
+
+    def available_operator_ids(self) -> List[int]:
+        """Online operators with at least one free web slot, most free first."""
+        return [int(member) for member in self.redis.zrevrangebyscore(CAPACITY_KEY, "+inf", "(0")]
+
+    def _index_capacity(self, state: Optional[Dict[str, Any]]) -> None:
+        if not state:
+            return
+        user_id = state["user_id"]
+        if state["status"] == "online":
+            free_slots = state["max_active_chats_web"] - state["active_chats"]
+            self.redis.zadd(CAPACITY_KEY, {user_id: free_slots})
+        else:
+            self.redis.zrem(CAPACITY_KEY, user_id)
+
+    def pop_dirty(self, count: int) -> List[Dict[str, Any]]:
+        """Pop up to `count` changed operators with their current state."""
+        members = self.redis.spop(DIRTY_KEY, count) or []
+        user_ids = [int(member) for member in members]
+        return [state for state in (self.get(user_id) for user_id in user_ids) if state]
+
 
 class OperatorPresenceService:
     """Service for managing operator presence, heartbeat, and availability."""
     
-    def __init__(self, db: Session):
+    def __init__(self, db: Session, store: Optional[OperatorPresenceStore] = None):
         self.db = db
+        self.store = store or OperatorPresenceStore()
+
+    def _get_row(self, user_id: int) -> Optional[models.OperatorPresence]:
+        return self.db.query(models.OperatorPresence).filter(
+            models.OperatorPresence.user_id == user_id
+        ).first()
+
+    def _touch(
+        self,
+        user_id: int,
+        status: str,
+        max_active_chats_web: Optional[int] = None,
+        max_active_chats_telegram: Optional[int] = None
+    ) -> Optional[Dict[str, Any]]:
+        """Update presence in Redis; None means Redis is unavailable and the caller should use the table."""
+        if not self.store.available:
+            return None
+        try:
+            if not self.store.redis.exists(PRESENCE_KEY.format(user_id=user_id)):
+                self.store.load(self._get_row(user_id), user_id)
+            return self.store.touch(user_id, status, max_active_chats_web, max_active_chats_telegram)
+        except Exception as e:
+            logger.warning(f"Operator presence Redis unavailable, writing to DB: {e}")
+            return None
 
     def update_heartbeat(
         self, 
@@ -37,19 +216,22 @@ class OperatorPresenceService:
         Returns:
             Dict with updated operator presence info
         """
+        state = self._touch(user_id, status, max_active_chats_web, max_active_chats_telegram)
+        if state:
+            logger.debug(f"Updated heartbeat for operator {user_id}, status: {status}")
+            return {**state, "updated_at": state["last_heartbeat"]}
+
         try:
             # Get or create operator presence
-            presence = self.db.query(models.OperatorPresence).filter(
-                models.OperatorPresence.user_id == user_id
-            ).first()
+            presence = self._get_row(user_id)
             
             if not presence:
                 presence = models.OperatorPresence(
                     user_id=user_id,
                     status=status,
                     last_heartbeat=datetime.utcnow(),
-                    max_active_chats_web=max_active_chats_web or 3,
-                    max_active_chats_telegram=max_active_chats_telegram or 5,
+                    max_active_chats_web=max_active_chats_web or DEFAULT_MAX_CHATS_WEB,
+                    max_active_chats_telegram=max_active_chats_telegram or DEFAULT_MAX_CHATS_TELEGRAM,
                     active_chats=0
                 )
                 self.db.add(presence)
@@ -93,10 +275,18 @@ class OperatorPresenceService:
         Returns:
             Dict with updated operator presence info
         """
+        state = self._touch(user_id, status)
+        if state:
+            logger.info(f"Set status for operator {user_id}: {status}")
+            return {
+                "user_id": user_id,
+                "status": state["status"],
+                "last_heartbeat": state["last_heartbeat"],
+                "active_chats": state["active_chats"]
+            }
+
         try:
-            presence = self.db.query(models.OperatorPresence).filter(
-                models.OperatorPresence.user_id == user_id
-            ).first()
+            presence = self._get_row(user_id)
             
             if not presence:
                 presence = models.OperatorPresence(
@@ -126,6 +316,41 @@ class OperatorPresenceService:
             logger.error(f"Error setting status for operator {user_id}: {str(e)}")
             raise
 
+    def get_live_state(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Current operator presence from Redis, None if unknown there."""
+        if not self.store.available:
+            return None
+        try:
+            return self.store.get(user_id)
+        except Exception as e:
+            logger.debug(f"Failed to read live state for operator {user_id}: {e}")
+            return None
+
+    def apply_live_state(self, presence: models.OperatorPresence) -> None:
+        """
+        Overlay status, heartbeat and capacity from Redis onto a (locked) table row.
+
+        Heartbeats only reach the table with the next snapshot, so checks made
+        against the row alone would see a stale status and capacity limit.
+        active_chats is owned by the table and is left as is.
+        """
+        state = self.get_live_state(presence.user_id)
+        if not state:
+            return
+        presence.status = state["status"]
+        presence.last_heartbeat = state["last_heartbeat"] or presence.last_heartbeat
+        presence.max_active_chats_web = state["max_active_chats_web"]
+        presence.max_active_chats_telegram = state["max_active_chats_telegram"]
+
+    def sync_live_active_chats(self, user_id: int, active_chats: int) -> None:
+        """Mirror committed active_chats counter into the Redis capacity index."""
+        if not self.store.available:
+            return
+        try:
+            self.store.set_active_chats(user_id, active_chats)
+        except Exception as e:
+            logger.debug(f"Failed to mirror active chats for operator {user_id}: {e}")
+
     def get_available_operators(self) -> List[models.User]:
         """
         Get list of operators available to take new chats.
@@ -134,6 +359,20 @@ class OperatorPresenceService:
             List of User objects for available operators
         """
         try:
+            if self.store.available:
+                try:
+                    operator_ids = self.store.available_operator_ids()
+                    if not operator_ids:
+                        return []
+                    users = self.db.query(models.User).filter(models.User.id.in_(operator_ids)).all()
+                    # Preserve capacity order (most free slots first)
+                    order = {user_id: i for i, user_id in enumerate(operator_ids)}
+                    users.sort(key=lambda u: order[u.id])
+                    logger.debug(f"Found {len(users)} available operators")
+                    return users
+                except Exception as e:
+                    logger.warning(f"Operator capacity index unavailable, querying DB: {e}")
+
             # Get operators who are online and not at capacity
             available_operators = self.db.query(models.User).join(
                 models.OperatorPresence,
@@ -141,7 +380,7 @@ class OperatorPresenceService:
             ).filter(
                 models.OperatorPresence.status == "online",
                 models.OperatorPresence.active_chats < models.OperatorPresence.max_active_chats_web,
-                models.OperatorPresence.last_heartbeat > datetime.utcnow() - timedelta(seconds=90)
+                models.OperatorPresence.last_heartbeat > datetime.utcnow() - timedelta(seconds=HEARTBEAT_TIMEOUT_SECONDS)
             ).all()
             
             logger.info(f"Found {len(available_operators)} available operators")
@@ -155,11 +394,23 @@ class OperatorPresenceService:
         """
         Automatically mark operators as offline if they haven't sent heartbeat recently.
         
+        With Redis this is a sweep over the heartbeat sorted set that backs up
+        keyspace expiry notifications (they are fire-and-forget and may be missed).
+
         Returns:
             Number of operators marked as offline
         """
+        if self.store.available:
+            try:
+                count = sum(1 for user_id in self.store.stale_operator_ids() if self.store.mark_offline(user_id))
+                if count > 0:
+                    logger.info(f"Marked {count} stale operators as offline")
+                return count
+            except Exception as e:
+                logger.warning(f"Stale operator sweep in Redis failed, using DB: {e}")
+
         try:
-            threshold = datetime.utcnow() - timedelta(seconds=90)  # 90 seconds threshold
+            threshold = datetime.utcnow() - timedelta(seconds=HEARTBEAT_TIMEOUT_SECONDS)
             
             # Find operators who should be marked offline
             stale_operators = self.db.query(models.OperatorPresence).filter(
@@ -186,6 +437,23 @@ class OperatorPresenceService:
             logger.error(f"Error auto-offlining stale operators: {str(e)}")
             return 0
 
+    def _overlay_live_state(self, user_id: int, status: str, last_heartbeat: Optional[datetime]):
+        """Prefer fresher status/heartbeat from Redis over the last snapshot."""
+        state = self.get_live_state(user_id)
+        if not state:
+            return status, last_heartbeat
+        return state["status"], state["last_heartbeat"]
+
+    @staticmethod
+    def _is_available(status: str, active_chats: int, max_active_chats_web: int,
+                      last_heartbeat: Optional[datetime]) -> bool:
+        return bool(
+            status == "online" and
+            active_chats < max_active_chats_web and
+            last_heartbeat and
+            last_heartbeat > datetime.utcnow() - timedelta(seconds=HEARTBEAT_TIMEOUT_SECONDS)
+        )
+
     def get_operator_stats(self, user_id: int) -> Dict[str, Any]:
         """
         Get operator statistics and current status.
@@ -197,17 +465,15 @@ class OperatorPresenceService:
             Dict with operator statistics
         """
         try:
-            presence = self.db.query(models.OperatorPresence).filter(
-                models.OperatorPresence.user_id == user_id
-            ).first()
+            presence = self._get_row(user_id)
             
             if not presence:
                 return {
                     "user_id": user_id,
                     "status": "offline",
                     "active_chats": 0,
-                    "capacity_web": 3,
-                    "capacity_telegram": 5,
+                    "capacity_web": DEFAULT_MAX_CHATS_WEB,
+                    "capacity_telegram": DEFAULT_MAX_CHATS_TELEGRAM,
                     "last_heartbeat": None
                 }
             
@@ -221,19 +487,18 @@ class OperatorPresenceService:
             if presence.active_chats != active_dialogs:
                 presence.active_chats = active_dialogs
                 self.db.commit()
+                self.sync_live_active_chats(user_id, active_dialogs)
             
+            status, last_heartbeat = self._overlay_live_state(user_id, presence.status, presence.last_heartbeat)
             return {
                 "user_id": user_id,
-                "status": presence.status,
+                "status": status,
                 "active_chats": presence.active_chats,
                 "capacity_web": presence.max_active_chats_web,
                 "capacity_telegram": presence.max_active_chats_telegram,
-                "last_heartbeat": presence.last_heartbeat,
-                "is_available": (
-                    presence.status == "online" and 
-                    presence.active_chats < presence.max_active_chats_web and
-                    presence.last_heartbeat and 
-                    presence.last_heartbeat > datetime.utcnow() - timedelta(seconds=90)
+                "last_heartbeat": last_heartbeat,
+                "is_available": self._is_available(
+                    status, presence.active_chats, presence.max_active_chats_web, last_heartbeat
                 )
             }
             
@@ -254,29 +519,27 @@ class OperatorPresenceService:
             List of operator status dicts
         """
         try:
-            operators = self.db.query(models.OperatorPresence).join(
+            rows = self.db.query(models.OperatorPresence, models.User).join(
                 models.User,
                 models.User.id == models.OperatorPresence.user_id
             ).all()
             
             result = []
-            for operator in operators:
-                user = self.db.query(models.User).filter(models.User.id == operator.user_id).first()
-                
+            for operator, user in rows:
+                status, last_heartbeat = self._overlay_live_state(
+                    operator.user_id, operator.status, operator.last_heartbeat
+                )
                 result.append({
                     "user_id": operator.user_id,
-                    "name": f"{user.first_name} {user.last_name}".strip() if user else f"User #{operator.user_id}",
-                    "email": user.email if user else None,
-                    "status": operator.status,
-                    "last_heartbeat": operator.last_heartbeat,
+                    "name": f"{user.first_name or ''} {user.last_name or ''}".strip() or f"User #{operator.user_id}",
+                    "email": user.email,
+                    "status": status,
+                    "last_heartbeat": last_heartbeat,
                     "active_chats": operator.active_chats,
                     "capacity_web": operator.max_active_chats_web,
                     "capacity_telegram": operator.max_active_chats_telegram,
-                    "is_available": (
-                        operator.status == "online" and 
-                        operator.active_chats < operator.max_active_chats_web and
-                        operator.last_heartbeat and 
-                        operator.last_heartbeat > datetime.utcnow() - timedelta(seconds=90)
+                    "is_available": self._is_available(
+                        status, operator.active_chats, operator.max_active_chats_web, last_heartbeat
                     )
                 })
             
@@ -304,13 +567,12 @@ class OperatorPresenceService:
             ).count()
             
             # Update presence record
-            presence = self.db.query(models.OperatorPresence).filter(
-                models.OperatorPresence.user_id == user_id
-            ).first()
+            presence = self._get_row(user_id)
             
             if presence:
                 presence.active_chats = actual_count
                 self.db.commit()
+                self.sync_live_active_chats(user_id, actual_count)
                 logger.info(f"Synced active chats for operator {user_id}: {actual_count}")
             
             return actual_count
@@ -318,4 +580,182 @@ class OperatorPresenceService:
         except Exception as e:
             self.db.rollback()
             logger.error(f"Error syncing active chats for operator {user_id}: {str(e)}")
-            return 0
\ No newline at end of file
+            return 0
+
+
+def flush_presence_snapshots(db: Session, store: Optional[OperatorPresenceStore] = None) -> int:
+    """
+    Write presence of operators changed since the last flush to `operator_presence`.
+
+    One multi-row upsert per batch; active_chats is left untouched because the
+    table owns it.
+
+    Returns:
+        Number of operators written
+    """
+    store = store or OperatorPresenceStore()
+    if not store.available:
+        return 0
+
+    written = 0
+    while True:
+        states = store.pop_dirty(SNAPSHOT_BATCH_SIZE)
+        if not states:
+            break
+
+        now = datetime.utcnow()
+        rows = [
+            {
+                "user_id": state["user_id"],
+                "status": state["status"],
+                "last_heartbeat": state["last_heartbeat"],
+                "max_active_chats_web": state["max_active_chats_web"],
+                "max_active_chats_telegram": state["max_active_chats_telegram"],
+                "active_chats": state["active_chats"],
+                "updated_at": now,
+            }
+            for state in states
+        ]
+        stmt = pg_insert(models.OperatorPresence.__table__).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["user_id"],
+            set_={
+                "status": stmt.excluded.status,
+                "last_heartbeat": stmt.excluded.last_heartbeat,
+                "max_active_chats_web": stmt.excluded.max_active_chats_web,
+                "max_active_chats_telegram": stmt.excluded.max_active_chats_telegram,
+                "updated_at": stmt.excluded.updated_at,
+            }
+        )
+        try:
+            db.execute(stmt)
+            db.commit()
+        except Exception:
+            db.rollback()
+            # Put operators back so the next flush retries them
+            store.redis.sadd(DIRTY_KEY, *[state["user_id"] for state in states])
+            raise
+        written += len(rows)
+
+        if len(states) < SNAPSHOT_BATCH_SIZE:
+            break
+
+    if written:
+        logger.debug(f"Operator presence snapshot: {written} operators written")
+    return written
+
+
+def merge_keyspace_flags(current: str) -> str:
+    """
+    notify-keyspace-events with keyevent expiry notifications (Ex) added.
+
+    The setting is server-wide and may already be used by other clients, so
+    existing flags are kept; "A" is an alias that already includes "x".
+    """
+    flags = current or ""
+    if "E" not in flags:
+        flags += "E"
+    if "x" not in flags and "A" not in flags:
+        flags += "x"
+    return flags
+
+
+async def _ensure_expiry_notifications(client) -> None:
+    try:
+        current = (await client.config_get("notify-keyspace-events")).get("notify-keyspace-events", "")
+        required = merge_keyspace_flags(current)
+        if required != current:
+            await client.config_set("notify-keyspace-events", required)
+            logger.info(f"🔔 notify-keyspace-events: '{current}' -> '{required}'")
+    except Exception as e:
+        # Managed Redis may forbid CONFIG; then the periodic sweep does the work
+        logger.warning(f"⚠️ Не удалось включить keyspace notifications (нужен флаг Ex): {e}")
+
+
+async def _listen_heartbeat_expiry(store: OperatorPresenceStore) -> None:
+    """Mark operators offline as soon as their heartbeat key expires."""
+    import redis.asyncio as aioredis
+
+    redis_url = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+    client = aioredis.from_url(redis_url, decode_responses=True)
+    try:
+        await _ensure_expiry_notifications(client)
+
+        pubsub = client.pubsub()
+        await pubsub.psubscribe("__keyevent@*__:expired")
+        async for message in pubsub.listen():
+            if message.get("type") != "pmessage":
+                continue
+            key = message.get("data") or ""
+            if not key.startswith(ALIVE_KEY_PREFIX):
+                continue
+            try:
+                user_id = int(key[len(ALIVE_KEY_PREFIX):])
+                if await asyncio.to_thread(store.mark_offline, user_id):
+                    logger.info(f"Operator {user_id} marked offline (heartbeat expired)")
+            except Exception as e:
+                logger.error(f"❌ Ошибка обработки истечения heartbeat {key}: {e}")
+    finally:
+        await client.close()
+
+
+async def _supervise_expiry_listener(store: OperatorPresenceStore) -> None:
+    """Keep the expiry listener running: restart it with backoff after Redis errors."""
+    delay = LISTENER_RETRY_SECONDS
+    while True:
+        started = time.monotonic()
+        try:
+            await _listen_heartbeat_expiry(store)
+            logger.warning("⚠️ Слушатель истечения heartbeat завершился, перезапуск")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ Слушатель истечения heartbeat упал: {e}")
+        # Долго проработавший слушатель перезапускаем с минимальной задержкой
+        if time.monotonic() - started > LISTENER_MAX_BACKOFF_SECONDS:
+            delay = LISTENER_RETRY_SECONDS
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, LISTENER_MAX_BACKOFF_SECONDS)
+
+
+async def run_presence_maintenance() -> None:
+    """Background loop: expiry listener plus periodic stale sweep and DB snapshots."""
+    from database.connection import SessionLocal
+
+    store = OperatorPresenceStore()
+    if not store.available:
+        logger.info("Operator presence maintenance disabled: Redis unavailable")
+        return
+
+    listener = asyncio.create_task(_supervise_expiry_listener(store))
+    try:
+        while True:
+            await asyncio.sleep(SNAPSHOT_INTERVAL_SECONDS)
+
+            def _maintain():
+                db = SessionLocal()
+                try:
+                    OperatorPresenceService(db, store).auto_offline_stale_operators()
+                    flush_presence_snapshots(db, store)
+                finally:
+                    db.close()
+
+            try:
+                await asyncio.to_thread(_maintain)
+            except Exception as e:
+                logger.error(f"❌ Ошибка сохранения снимка присутствия операторов: {e}")
+    finally:
+        listener.cancel()
+
+        # Last snapshot on shutdown so history is not lost
+        def _final_flush():
+            db = SessionLocal()
+            try:
+                flush_presence_snapshots(db, store)
+            finally:
+                db.close()
+
+        try:
+            await asyncio.to_thread(_final_flush)
+        except Exception as e:
+            logger.error(f"❌ Ошибка финального снимка присутствия операторов: {e}")
@@ -0,0 +1,353 @@
+"""
+Приём и применение webhook-уведомлений ЮKassa
+
+Webhook только сохраняет сырое событие под уникальным ключом (payment_id, event)
+и сразу отвечает 200 — повторные доставки отбрасываются на уровне БД.
+Фоновый обработчик забирает события через SELECT ... FOR UPDATE SKIP LOCKED и
+в одной транзакции применяет переход статуса платежа и пополнение баланса.
+Письма и сброс предупреждений о балансе выполняются только после коммита.
+"""
+
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Callable, Iterable, List, Optional, Tuple
+
+from sqlalchemy import select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from database.models import BalanceTransaction, Payment, PaymentWebhookEvent, User, UserBalance
+
+logger = logging.getLogger(__name__)
+
+try:
+    from prometheus_client import Counter, Histogram
+    WEBHOOK_EVENTS = Counter('payment_webhook_events_total', 'YooKassa webhook events by outcome', ['outcome'])
+    WEBHOOK_APPLY_LAG = Histogram(
+        'payment_webhook_apply_lag_seconds', 'Delay between webhook receipt and its application',
+        buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+    )
+    METRICS_ENABLED = True
+except ImportError:
+    METRICS_ENABLED = False
+
+APPLY_INTERVAL_SECONDS = float(os.getenv('PAYMENT_WEBHOOK_APPLY_SECONDS', '2'))
+APPLY_BATCH_SIZE = int(os.getenv('PAYMENT_WEBHOOK_BATCH', '50'))
+MAX_ATTEMPTS = int(os.getenv('PAYMENT_WEBHOOK_MAX_ATTEMPTS', '10'))
+RETRY_BASE_SECONDS = int(os.getenv('PAYMENT_WEBHOOK_RETRY_BASE_SECONDS', '15'))
+
+# Маппинг статусов ЮKassa в наши статусы
+STATUS_MAPPING = {
+    'pending': 'pending',
+    'waiting_for_capture': 'processing',
+    'succeeded': 'completed',
+    'canceled': 'cancelled'
+}
+# Из финальных статусов платеж не выводится запоздавшими событиями
+FINAL_STATUSES = {'completed', 'cancelled'}
+
+PENDING, APPLIED, IGNORED, FAILED = 'pending', 'applied', 'ignored', 'failed'
+
+_INSERTS = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}
+
+
+class RetryableWebhookError(Exception):
+    """Событие пока нельзя применить (например, платеж еще не записан в БД)"""
+
+
+def _count(outcome: str):
+    if METRICS_ENABLED:
+        WEBHOOK_EVENTS.labels(outcome=outcome).inc()
+
+
+def event_key(payload: dict) -> Tuple[Optional[str], str]:
+    """(payment_id, event) — ключ идемпотентности события"""
+    payment = payload.get('object') or {}
+    event = payload.get('event') or f"payment.{payment.get('status', 'unknown')}"
+    return payment.get('id'), event
+
+
+def build_store_statement(dialect_name: str, payload: dict, source_ip: Optional[str] = None):
+    """INSERT ... ON CONFLICT DO NOTHING RETURNING id: id нового события или None для повтора"""
+    payment_id, event = event_key(payload)
+    now = datetime.utcnow()
+    return (
+        _INSERTS[dialect_name](PaymentWebhookEvent)
+        .values(
+            payment_id=payment_id,
+            event=event,
+            payload=json.dumps(payload, ensure_ascii=False),
+            source_ip=source_ip,
+            status=PENDING,
+            attempts=0,
+            received_at=now,
+            available_at=now,
+        )
+        .on_conflict_do_nothing(index_elements=['payment_id', 'event'])
+        .returning(PaymentWebhookEvent.id)
+    )
+
+
+class PaymentWebhookProcessor:
+    """Хранилище событий и фоновый применитель"""
+
+    def __init__(self, session_factory: Optional[Callable[[], Session]] = None):
+        self._session_factory = session_factory
+        self._wakeup: Optional[asyncio.Event] = None
+
+    def _session(self) -> Session:
+        if self._session_factory is None:
+            from database.connection import SessionLocal
+            self._session_factory = SessionLocal
+        return self._session_factory()
+
+    # === Приём ===
+
+    async def store(self, db, payload: dict, source_ip: Optional[str] = None) -> bool:
+        """Сохранить событие (AsyncSession). False — такое событие уже было получено"""
+        stmt = build_store_statement(db.get_bind().dialect.name, payload, source_ip)
+        event_id = (await db.execute(stmt)).scalar_one_or_none()
+        await db.commit()
+
+        if event_id is None:
+            _count('duplicate')
+            return False
+        _count('stored')
+        self.notify()
+        return True
+
+    def notify(self):
+        """Разбудить применитель этого воркера, не дожидаясь интервала опроса"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    # === Применение ===
+
+    def _claim_next(self, db: Session) -> Optional[PaymentWebhookEvent]:
+        """Следующее готовое событие, заблокированное для этого обработчика"""
+        while True:
+            event = db.execute(
+                select(PaymentWebhookEvent)
+                .where(PaymentWebhookEvent.status == PENDING, PaymentWebhookEvent.available_at <= datetime.utcnow())
+                .order_by(PaymentWebhookEvent.id)
+                .limit(1)
+                .with_for_update(skip_locked=True)
+            ).scalars().first()
+            if event is None:
+                return None
+
+            # Условный UPDATE — вторая линия защиты: событие применит только тот, кто
+            # засчитал попытку, пока оно еще pending (важно для БД без SKIP LOCKED)
+            claimed = db.execute(
+                update(PaymentWebhookEvent)
+                .where(PaymentWebhookEvent.id == event.id, PaymentWebhookEvent.status == PENDING)
+                .values(attempts=PaymentWebhookEvent.attempts + 1)
+                .execution_options(synchronize_session=False)
+            ).rowcount
+            if claimed:
+                db.refresh(event)
+                return event
+            # Событие уже применено параллельным обработчиком — берем следующее
+            db.rollback()
+
+    def _apply(self, db: Session, event: PaymentWebhookEvent) -> List[tuple]:
+        """Переход статуса платежа и пополнение баланса. Возвращает побочные эффекты после коммита"""
+        payment_data = json.loads(event.payload).get('object') or {}
+        yookassa_status = payment_data.get('status')
+        paid = payment_data.get('paid', False)
+
+        payment = db.execute(
+            select(Payment).where(Payment.yookassa_payment_id == event.payment_id).with_for_update()
+        ).scalars().first()
+        if not payment:
+            # Webhook может прийти раньше, чем create-payment сохранит ID платежа
+            raise RetryableWebhookError(f"Платеж с ЮKassa ID {event.payment_id} не найден в БД")
+
+        old_status = payment.status
+        new_status = STATUS_MAPPING.get(yookassa_status, yookassa_status)
+        now = datetime.utcnow()
+        effects = []
+
+        if old_status in FINAL_STATUSES and new_status != old_status:
+            logger.info(f"↩️ Платеж {payment.order_id} уже {old_status}, событие {event.event} пропущено")
+            event.status = IGNORED
+        else:
+            payment.yookassa_status = yookassa_status
+            payment.status = new_status
+            event.status = APPLIED
+
+            if yookassa_status == 'succeeded' and paid and old_status != 'completed':
+                effects.extend(self._credit_balance(db, payment, now))
+
+        payment.webhook_processed_at = now
+        payment.updated_at = now
+        event.processed_at = now
+        event.last_error = None
+        logger.info(f"✅ Платеж {payment.order_id} обновлен: {old_status} → {payment.status} ({event.event})")
+        return effects
+
+    def _credit_balance(self, db: Session, payment: Payment, now: datetime) -> List[tuple]:
+        amount = Decimal(str(payment.amount))
+        user = db.get(User, payment.user_id)
+        if not user:
+            logger.error(f"Пользователь {payment.user_id} не найден для пополнения баланса")
+            return []
+
+        balance = db.execute(
+            select(UserBalance).where(UserBalance.user_id == user.id).with_for_update()
+        ).scalars().first()
+        if not balance:
+            balance = UserBalance(user_id=user.id, balance=0, total_spent=0, total_topped_up=0)
+            db.add(balance)
+            db.flush()
+
+        old_balance = Decimal(str(balance.balance or 0))
+        new_balance = old_balance + amount
+        balance.balance = new_balance
+        balance.total_topped_up = Decimal(str(balance.total_topped_up or 0)) + amount
+        balance.updated_at = now
+
+        db.add(BalanceTransaction(
+            user_id=user.id,
+            amount=amount,
+            transaction_type='topup',
+            description=f"Пополнение через ЮKassa: {payment.order_id}",
+            balance_before=old_balance,
+            balance_after=new_balance,
+            related_id=payment.id,
+            created_at=now
+        ))
+        payment.completed_at = payment.completed_at or now
+
+        logger.info(f"💰 Пополнен баланс пользователя {user.id}: {old_balance} + {amount} = {new_balance} руб.")
+        return [
+            ('payment_email', user.email, float(amount), float(new_balance)),
+            ('reset_balance_warnings', user.id),
+        ]
+
+    def _run_side_effects(self, effects: Iterable[tuple]):
+        """Побочные эффекты после коммита: их сбой не откатывает зачисление"""
+        for effect in effects:
+            try:
+                if effect[0] == 'payment_email':
+                    _, email, amount, new_balance = effect
+                    from integrations.email_service import email_service
+                    email_service.send_payment_confirmation_email(
+                        to_email=email,
+                        amount=amount,
+                        messages_count=int(amount / 5),
+                        current_balance=int(new_balance / 5),
+                        bonus_amount=None
+                    )
+                elif effect[0] == 'reset_balance_warnings':
+                    from services.balance_service import reset_balance_warnings
+                    reset_balance_warnings(effect[1])
+            except Exception as e:
+                logger.error(f"❌ Ошибка побочного эффекта webhook {effect[0]}: {e}")
+
+    def _mark_retry(self, db: Session, event_id: int, error: str):
+        # Попытка, учтенная в _claim_next, откатилась вместе с транзакцией — считаем заново
+        db.rollback()
+        event = db.get(PaymentWebhookEvent, event_id)
+        if event is None or event.status != PENDING:
+            db.rollback()
+            return
+        event.attempts += 1
+        event.last_error = error[:2000]
+        if event.attempts >= MAX_ATTEMPTS:
+            event.status = FAILED
+            _count('failed')
+            logger.error(f"❌ Webhook {event.event} платежа {event.payment_id} не применен: {error}")
+        else:
+            event.available_at = datetime.utcnow() + timedelta(seconds=RETRY_BASE_SECONDS * 2 ** (event.attempts - 1))
+            _count('retry')
+            logger.warning(f"⚠️ Webhook {event.event} платежа {event.payment_id}, попытка {event.attempts}: {error}")
+        db.commit()
+
+    def apply_next(self, db: Session) -> bool:
+        """Применить одно событие в собственной транзакции. False — очередь пуста"""
+        event = self._claim_next(db)
+        if event is None:
+            db.rollback()
+            return False
+
+        event_id, received_at = event.id, event.received_at
+        try:
+            effects = self._apply(db, event)
+            outcome = event.status
+            db.commit()
+        except Exception as e:
+            self._mark_retry(db, event_id, str(e))
+            return True
+
+        _count(outcome)
+        if METRICS_ENABLED and received_at:
+            WEBHOOK_APPLY_LAG.observe((datetime.utcnow() - received_at).total_seconds())
+        self._run_side_effects(effects)
+        return True
+
+    def process_batch(self, limit: int = APPLY_BATCH_SIZE) -> int:
+        """Применить до limit событий; возвращает количество обработанных"""
+        db = self._session()
+        try:
+            processed = 0
+            while processed < limit and self.apply_next(db):
+                processed += 1
+            return processed
+        finally:
+            db.close()
+
+    async def run(self):
+        """Фоновая задача: опрос очереди и пробуждение сразу после приёма события"""
+        self._wakeup = asyncio.Event()
+        logger.info("💳 Payment webhook applier started")
+        try:
+            while True:
+                try:
+                    processed = await asyncio.to_thread(self.process_batch)
+                except Exception as e:
+                    logger.error(f"❌ Ошибка применения webhook-событий: {e}")
+                    processed = 0
+                if processed >= APPLY_BATCH_SIZE:
+                    continue
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=APPLY_INTERVAL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+        finally:
+            self._wakeup = None
+
+    # === Повтор ===
+
+    def replay(self, db: Session, payment_id: Optional[str] = None, since: Optional[datetime] = None,
+               statuses: Iterable[str] = (FAILED,), event_ids: Optional[List[int]] = None) -> int:
+        """Вернуть события в очередь. Безопасно: зачисление защищено статусом платежа"""
+        stmt = update(PaymentWebhookEvent).where(PaymentWebhookEvent.status.in_(list(statuses)))
+        if payment_id:
+            stmt = stmt.where(PaymentWebhookEvent.payment_id == payment_id)
+        if since:
+            stmt = stmt.where(PaymentWebhookEvent.received_at >= since)
+        if event_ids:
+            stmt = stmt.where(PaymentWebhookEvent.id.in_(event_ids))
+        count = db.execute(
+            stmt.values(status=PENDING, attempts=0, last_error=None, available_at=datetime.utcnow())
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.commit()
+        return count
+
+    def ingest(self, db: Session, payload: dict, source_ip: Optional[str] = None) -> bool:
+        """Сохранить событие синхронно (повтор из файла, тесты)"""
+        stmt = build_store_statement(db.get_bind().dialect.name, payload, source_ip)
+        event_id = db.execute(stmt).scalar_one_or_none()
+        db.commit()
+        return event_id is not None
+
+
+# Глобальный экземпляр
+payment_webhook_processor = PaymentWebhookProcessor()
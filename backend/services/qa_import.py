@@ -0,0 +1,463 @@
+"""
+Массовый импорт Q&A и индексация эмбеддингов в фоне
+
+Раньше create/update Q&A в обработчике запроса делали два запроса к OpenAI
+(вопрос и ответ), дважды поднимали knowledge_version и коммитили лишний раз —
+импорт нескольких сотен FAQ означал сотни последовательных запросов.
+Теперь:
+
+- файл CSV, JSONL или XLSX разбирается в запросе, строки проверяются и
+  дедуплицируются по хэшу нормализованного вопроса (внутри файла и с уже
+  сохраненными записями), вставляются пачками по INSERT_BATCH;
+- создается задача qa_import_jobs, эмбеддинги считает фоновый обработчик
+  (SELECT ... FOR UPDATE SKIP LOCKED, как у webhook-событий): по
+  EMBED_ROWS_BATCH записей за один запрос к API embeddings, вне event loop;
+- прогресс (вставлено, дубликаты, проиндексировано) пишется в задачу после
+  каждой пачки, knowledge_version поднимается один раз — по завершении;
+- одиночные create/update ставят такую же задачу на одну запись.
+"""
+
+import asyncio
+import csv
+import io
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import delete, func, insert, or_, select, update
+from sqlalchemy.orm import Session
+
+from database.models import Assistant, KnowledgeEmbedding, QAImportJob, QAKnowledge, qa_question_hash
+
+logger = logging.getLogger(__name__)
+
+MAX_FILE_BYTES = int(os.getenv('QA_IMPORT_MAX_BYTES', str(5 * 1024 * 1024)))
+MAX_ROWS = int(os.getenv('QA_IMPORT_MAX_ROWS', '10000'))
+INSERT_BATCH = 500
+EMBED_ROWS_BATCH = int(os.getenv('QA_IMPORT_EMBED_BATCH', '50'))  # 2 текста на запись — 100 в запросе
+APPLY_INTERVAL_SECONDS = float(os.getenv('QA_IMPORT_POLL_SECONDS', '2'))
+MAX_ATTEMPTS = int(os.getenv('QA_IMPORT_MAX_ATTEMPTS', '5'))
+RETRY_BASE_SECONDS = int(os.getenv('QA_IMPORT_RETRY_BASE_SECONDS', '30'))
+STALE_SECONDS = 300  # Задача без heartbeat дольше — обработчик упал, забираем снова
+MAX_ROW_ERRORS = 50
+
+PENDING, RUNNING, COMPLETED, FAILED = 'pending', 'running', 'completed', 'failed'
+KIND_FILE, KIND_EDIT = 'file', 'edit'
+
+# Заголовки колонок файла (регистр не важен)
+COLUMN_ALIASES = {
+    'question': ('question', 'вопрос', 'q'),
+    'answer': ('answer', 'ответ', 'a'),
+    'category': ('category', 'категория'),
+    'keywords': ('keywords', 'ключевые слова', 'теги', 'tags'),
+    'importance': ('importance', 'важность'),
+}
+_ALIAS_TO_FIELD = {alias: field for field, aliases in COLUMN_ALIASES.items() for alias in aliases}
+
+
+class RetryableImportError(Exception):
+    """Пачку сейчас нельзя проиндексировать (например, API embeddings недоступен)"""
+
+
+# === Разбор файла ===
+
+def _decode_text(content: bytes) -> str:
+    # Excel в русской локали сохраняет CSV в cp1251
+    for encoding in ('utf-8-sig', 'cp1251'):
+        try:
+            return content.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    raise ValueError("Не удалось определить кодировку файла (ожидается UTF-8 или Windows-1251)")
+
+
+def _normalize_keys(row: Dict[Any, Any]) -> Dict[str, Any]:
+    result = {}
+    for key, value in row.items():
+        field = _ALIAS_TO_FIELD.get(str(key or '').strip().lower())
+        if field and field not in result:
+            result[field] = value
+    return result
+
+
+def _parse_csv(content: bytes) -> List[Dict[str, Any]]:
+    text = _decode_text(content)
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+    return [_normalize_keys(row) for row in csv.DictReader(io.StringIO(text), dialect=dialect)]
+
+
+def _parse_jsonl(content: bytes) -> List[Dict[str, Any]]:
+    rows = []
+    for line_number, line in enumerate(_decode_text(content).splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Строка {line_number}: некорректный JSON ({e.msg})")
+        rows.append(_normalize_keys(item) if isinstance(item, dict) else {})
+    return rows
+
+
+def _parse_xlsx(content: bytes) -> List[Dict[str, Any]]:
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise ValueError("Импорт XLSX недоступен: не установлен openpyxl")
+    workbook = load_workbook(io.BytesIO(content), read_only=True, data_only=True)
+    try:
+        sheet_rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = next(sheet_rows, None)
+        if not header:
+            return []
+        return [_normalize_keys(dict(zip(header, values))) for values in sheet_rows
+                if any(value not in (None, '') for value in values)]
+    finally:
+        workbook.close()
+
+
+PARSERS = {
+    '.csv': _parse_csv,
+    '.tsv': _parse_csv,
+    '.txt': _parse_csv,
+    '.jsonl': _parse_jsonl,
+    '.ndjson': _parse_jsonl,
+    '.xlsx': _parse_xlsx,
+}
+
+
+def parse_file(filename: str, content: bytes) -> List[Dict[str, Any]]:
+    """Строки файла как словари с полями question/answer/category/keywords/importance"""
+    extension = os.path.splitext(filename or '')[1].lower()
+    parser = PARSERS.get(extension)
+    if parser is None:
+        raise ValueError(f"Неподдерживаемый формат {extension or 'без расширения'}: нужен CSV, JSONL или XLSX")
+    rows = parser(content)
+    if len(rows) > MAX_ROWS:
+        raise ValueError(f"Слишком много строк: {len(rows)} (максимум {MAX_ROWS})")
+    return rows
+
+
+def _clean(value) -> Optional[str]:
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+def build_records(rows: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], int, List[Dict[str, Any]]]:
+    """(записи, дубликаты внутри файла, ошибки строк). Номер строки — с 1, без заголовка"""
+    records, errors, seen = [], [], set()
+    duplicates = 0
+    for row_number, row in enumerate(rows, start=1):
+        question, answer = _clean(row.get('question')), _clean(row.get('answer'))
+        if not question or not answer:
+            errors.append({'row': row_number, 'error': 'нужны непустые вопрос и ответ'})
+            continue
+        question_hash = qa_question_hash(question)
+        if question_hash in seen:
+            duplicates += 1
+            continue
+        seen.add(question_hash)
+        try:
+            importance = min(10, max(1, int(float(row.get('importance') or 10))))
+        except (TypeError, ValueError):
+            importance = 10
+        records.append({
+            'question': question,
+            'answer': answer,
+            'category': _clean(row.get('category')),
+            'keywords': _clean(row.get('keywords')),
+            'importance': importance,
+            'question_hash': question_hash,
+        })
+    return records, duplicates, errors
+
+
+def _owner_filter(user_id: int, assistant_id: Optional[int]):
+    assistant = QAKnowledge.assistant_id.is_(None) if assistant_id is None else QAKnowledge.assistant_id == assistant_id
+    return [QAKnowledge.user_id == user_id, assistant, QAKnowledge.is_active == True]  # noqa: E712
+
+
+def existing_question_hashes(db: Session, user_id: int, assistant_id: Optional[int], hashes: List[str]) -> set:
+    """Хэши вопросов, которые у владельца уже есть (по индексу ix_qa_knowledge_owner_question_hash)"""
+    found = set()
+    for start in range(0, len(hashes), INSERT_BATCH):
+        found.update(db.execute(
+            select(QAKnowledge.question_hash).where(
+                *_owner_filter(user_id, assistant_id),
+                QAKnowledge.question_hash.in_(hashes[start:start + INSERT_BATCH])
+            )
+        ).scalars())
+    return found
+
+
+def job_progress(job: QAImportJob) -> Dict[str, Any]:
+    done = job.embedded + job.embed_failed
+    return {
+        'id': job.id,
+        'kind': job.kind,
+        'filename': job.filename,
+        'assistant_id': job.assistant_id,
+        'status': job.status,
+        'total_rows': job.total_rows,
+        'inserted': job.inserted,
+        'duplicates': job.duplicates,
+        'invalid': job.invalid,
+        'to_embed': job.to_embed,
+        'embedded': job.embedded,
+        'embed_failed': job.embed_failed,
+        'progress_percent': 100 if job.status == COMPLETED else (
+            round(done * 100 / job.to_embed) if job.to_embed else 0),
+        'row_errors': json.loads(job.row_errors) if job.row_errors else [],
+        'last_error': job.last_error,
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+
+class QAImportProcessor:
+    """Постановка задач индексации Q&A и фоновый обработчик"""
+
+    def __init__(self, session_factory: Optional[Callable[[], Session]] = None):
+        self._session_factory = session_factory
+        self._wakeup: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _session(self) -> Session:
+        if self._session_factory is None:
+            from database.connection import SessionLocal
+            self._session_factory = SessionLocal
+        return self._session_factory()
+
+    # === Постановка ===
+
+    def create_import(self, db: Session, user_id: int, assistant_id: Optional[int],
+                      filename: str, content: bytes) -> QAImportJob:
+        """Разобрать файл, вставить новые записи пачками и поставить задачу индексации.
+        ValueError — файл нельзя импортировать целиком"""
+        rows = parse_file(filename, content)
+        records, duplicates, errors = build_records(rows)
+        existing = existing_question_hashes(db, user_id, assistant_id, [r['question_hash'] for r in records])
+        new_records = [r for r in records if r['question_hash'] not in existing]
+        duplicates += len(records) - len(new_records)
+
+        now = datetime.utcnow()
+        job = QAImportJob(
+            user_id=user_id, assistant_id=assistant_id, kind=KIND_FILE, filename=filename,
+            status=PENDING if new_records else COMPLETED,
+            total_rows=len(rows), inserted=len(new_records), duplicates=duplicates, invalid=len(errors),
+            to_embed=len(new_records), embedded=0, embed_failed=0, cursor_qa_id=0, attempts=0,
+            row_errors=json.dumps(errors[:MAX_ROW_ERRORS], ensure_ascii=False) if errors else None,
+            created_at=now, available_at=now, finished_at=None if new_records else now,
+        )
+        db.add(job)
+        db.flush()
+
+        for start in range(0, len(new_records), INSERT_BATCH):
+            db.execute(insert(QAKnowledge), [
+                dict(record, user_id=user_id, assistant_id=assistant_id, index_job_id=job.id,
+                     usage_count=0, is_active=True, created_at=now, updated_at=now)
+                for record in new_records[start:start + INSERT_BATCH]
+            ])
+        db.commit()
+
+        logger.info(f"📥 Импорт Q&A {filename}: строк={len(rows)}, новых={len(new_records)}, "
+                    f"дубликатов={duplicates}, с ошибками={len(errors)} (задача {job.id})")
+        self.notify()
+        return job
+
+    def enqueue_reindex(self, db: Session, qa: QAKnowledge) -> QAImportJob:
+        """Поставить переиндексацию одной записи (после create/update) и закоммитить"""
+        now = datetime.utcnow()
+        job = QAImportJob(
+            user_id=qa.user_id, assistant_id=qa.assistant_id, kind=KIND_EDIT, status=PENDING,
+            total_rows=1, inserted=0, duplicates=0, invalid=0, to_embed=1, embedded=0, embed_failed=0,
+            cursor_qa_id=0, attempts=0, created_at=now, available_at=now,
+        )
+        db.add(job)
+        db.flush()
+        qa.index_job_id = job.id
+        db.commit()
+        self.notify()
+        return job
+
+    def notify(self):
+        """Разбудить обработчик этого воркера (потокобезопасно: create_import идет в threadpool)"""
+        if self._wakeup is not None and self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    # === Обработка ===
+
+    def _claim_next(self, db: Session) -> Optional[QAImportJob]:
+        now = datetime.utcnow()
+        job = db.execute(
+            select(QAImportJob)
+            .where(or_(
+                (QAImportJob.status == PENDING) & (QAImportJob.available_at <= now),
+                (QAImportJob.status == RUNNING) & (QAImportJob.heartbeat_at < now - timedelta(seconds=STALE_SECONDS)),
+            ))
+            .order_by(QAImportJob.id)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+        ).scalars().first()
+        if job is None:
+            return None
+        job.status = RUNNING
+        job.heartbeat_at = now
+        db.commit()
+        return job
+
+    def _embed_batch(self, db: Session, job: QAImportJob, rows: List[QAKnowledge]) -> Tuple[int, int]:
+        """Эмбеддинги пачки одним запросом к API; (проиндексировано, не удалось)"""
+        from services.embeddings_service import embeddings_service
+
+        active = [row for row in rows if row.is_active]
+        ids = [row.id for row in rows]
+        # Старые эмбеддинги заменяются в той же транзакции: поиск не видит запись без индекса
+        db.execute(delete(KnowledgeEmbedding).where(KnowledgeEmbedding.qa_id.in_(ids))
+                   .execution_options(synchronize_session=False))
+        if not active:
+            return 0, 0
+
+        texts = [text for row in active for text in (row.question, row.answer)]
+        embeddings = embeddings_service.generate_embeddings_batch(texts, job.user_id)
+        if all(embedding is None for embedding in embeddings):
+            raise RetryableImportError("API embeddings не вернул ни одного вектора")
+
+        embedded = failed = 0
+        for index, row in enumerate(active):
+            question_embedding, answer_embedding = embeddings[2 * index], embeddings[2 * index + 1]
+            if question_embedding is None or answer_embedding is None:
+                failed += 1
+                continue
+            for chunk_index, (chunk_text, embedding, doc_type) in enumerate((
+                (row.question, question_embedding, 'qa_question'),
+                (row.answer, answer_embedding, 'qa_answer'),
+            )):
+                embeddings_service.upsert_embedding_chunk(
+                    user_id=row.user_id, assistant_id=row.assistant_id, doc_id=0, chunk_index=chunk_index,
+                    chunk_text=chunk_text, embedding=embedding, doc_type=doc_type,
+                    importance=row.importance or 10, token_count=embeddings_service.estimate_tokens(chunk_text),
+                    source='qa_knowledge', qa_id=row.id, db=db,
+                )
+            embedded += 1
+        return embedded, failed
+
+    def _finish(self, db: Session, job: QAImportJob):
+        """Один подъем knowledge_version на всю задачу — ассистенты перечитают знания один раз"""
+        if job.embedded or job.kind == KIND_EDIT:
+            bump = update(Assistant).values(knowledge_version=func.coalesce(Assistant.knowledge_version, 0) + 1)
+            if job.assistant_id:
+                bump = bump.where(Assistant.id == job.assistant_id)
+            else:
+                bump = bump.where(Assistant.user_id == job.user_id)
+            db.execute(bump.execution_options(synchronize_session=False))
+        job.status = COMPLETED
+        job.finished_at = datetime.utcnow()
+        job.last_error = None
+        db.commit()
+        logger.info(f"✅ Задача индексации Q&A {job.id} завершена: проиндексировано {job.embedded}, "
+                    f"ошибок {job.embed_failed}")
+
+    def _mark_retry(self, db: Session, job_id: int, error: str):
+        db.rollback()
+        job = db.get(QAImportJob, job_id)
+        if job is None:
+            return
+        job.attempts += 1
+        job.last_error = error[:2000]
+        if job.attempts >= MAX_ATTEMPTS:
+            job.status = FAILED
+            job.finished_at = datetime.utcnow()
+            logger.error(f"❌ Задача индексации Q&A {job_id} не выполнена: {error}")
+        else:
+            # Курсор сохранен — повтор продолжит с неиндексированной пачки
+            job.status = PENDING
+            job.available_at = datetime.utcnow() + timedelta(seconds=RETRY_BASE_SECONDS * 2 ** (job.attempts - 1))
+            logger.warning(f"⚠️ Задача индексации Q&A {job_id}, попытка {job.attempts}: {error}")
+        db.commit()
+
+    def process_job(self, db: Session, job: QAImportJob) -> int:
+        """Проиндексировать оставшиеся записи задачи пачками; возвращает число обработанных записей"""
+        processed = 0
+        try:
+            while True:
+                rows = db.execute(
+                    select(QAKnowledge)
+                    .where(QAKnowledge.index_job_id == job.id, QAKnowledge.id > job.cursor_qa_id)
+                    .order_by(QAKnowledge.id)
+                    .limit(EMBED_ROWS_BATCH)
+                ).scalars().all()
+                if not rows:
+                    self._finish(db, job)
+                    return processed
+                embedded, failed = self._embed_batch(db, job, rows)
+                job.embedded += embedded
+                job.embed_failed += failed
+                job.cursor_qa_id = rows[-1].id
+                job.heartbeat_at = datetime.utcnow()
+                db.commit()
+                processed += len(rows)
+        except Exception as e:
+            self._mark_retry(db, job.id, str(e))
+            return processed
+
+    def process_batch(self) -> int:
+        """Взять одну готовую задачу и выполнить ее; 0 — очередь пуста"""
+        db = self._session()
+        try:
+            job = self._claim_next(db)
+            if job is None:
+                db.rollback()
+                return 0
+            return max(1, self.process_job(db, job))
+        finally:
+            db.close()
+
+    async def run(self):
+        """Фоновая задача: опрос очереди и пробуждение сразу после постановки задачи"""
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        logger.info("📥 Q&A import indexer started")
+        try:
+            while True:
+                try:
+                    processed = await asyncio.to_thread(self.process_batch)
+                except Exception as e:
+                    logger.error(f"❌ Ошибка индексации Q&A: {e}")
+                    processed = 0
+                if processed:
+                    continue
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=APPLY_INTERVAL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+        finally:
+            self._wakeup = None
+            self._loop = None
+
+    # === Чтение ===
+
+    def get_job(self, db: Session, job_id: int, user_id: int) -> Optional[QAImportJob]:
+        return db.execute(
+            select(QAImportJob).where(QAImportJob.id == job_id, QAImportJob.user_id == user_id)
+        ).scalars().first()
+
+    def list_jobs(self, db: Session, user_id: int, limit: int = 20) -> List[QAImportJob]:
+        return db.execute(
+            select(QAImportJob)
+            .where(QAImportJob.user_id == user_id, QAImportJob.kind == KIND_FILE)
+            .order_by(QAImportJob.created_at.desc())
+            .limit(limit)
+        ).scalars().all()
+
+
+# Глобальный экземпляр
+qa_import_processor = QAImportProcessor()
@@ -0,0 +1,232 @@
+"""
+Время ответа: фиксация при записи и почасовые скетчи перцентилей
+
+Раньше /metrics на каждое сообщение ассистента за период искал предыдущее
+сообщение пользователя отдельным запросом, а аналитика админки выгружала все
+времена AI-запросов в Python ради медианы и P95. Теперь:
+
+- время ответа записывается в DialogMessage.response_time_ms при вставке
+  ответа ассистента (виджет и бот передают его сами, иначе — один запрос
+  по индексу dialog_id+timestamp);
+- каждое значение попадает в почасовой лог-гистограммный скетч
+  (response_latency_sketches) в той же транзакции;
+- среднее, P50 и P95 за любой период — сумма корзин скетчей в одном запросе.
+
+Корзины логарифмические с шагом SKETCH_GAMMA (относительная погрешность
+перцентиля ~1%), скетчи складываются сложением счетчиков корзин.
+"""
+
+import logging
+import math
+from datetime import datetime
+from typing import Dict, Optional
+
+from sqlalchemy import event, func, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from database.models import AITokenUsage, Dialog, DialogMessage, ResponseLatencySketch
+from services.message_quota import COUNTED_SENDER, dialog_info
+
+logger = logging.getLogger(__name__)
+
+SOURCE_DIALOG = 'dialog'
+SOURCE_AI = 'ai'
+NO_USER = 0
+
+SKETCH_GAMMA = 1.02
+MAX_RESPONSE_TIME_MS = 60 * 60 * 1000  # Ответы позже часа — уже не «время ответа»
+REBUILD_INSERT_BATCH = 1000
+
+_LOG_GAMMA = math.log(SKETCH_GAMMA)
+_INSERTS = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}
+
+
+def bucket_for(value_ms: float) -> int:
+    """Номер корзины: значения (gamma^(i-1), gamma^i] попадают в корзину i; <=1 мс — в 0"""
+    if value_ms <= 1:
+        return 0
+    return math.ceil(math.log(value_ms) / _LOG_GAMMA)
+
+
+def bucket_value(bucket: int) -> float:
+    """Представитель корзины с минимальной относительной ошибкой"""
+    if bucket <= 0:
+        return 1.0
+    return 2 * SKETCH_GAMMA ** bucket / (SKETCH_GAMMA + 1)
+
+
+def hour_of(moment: Optional[datetime]) -> datetime:
+    return (moment or datetime.utcnow()).replace(minute=0, second=0, microsecond=0)
+
+
+class LatencySketch:
+    """Слияемый скетч: {корзина: количество} плюс точная сумма для среднего"""
+
+    def __init__(self):
+        self.buckets: Dict[int, int] = {}
+        self.count = 0
+        self.total_ms = 0
+
+    def add(self, value_ms: float, count: int = 1):
+        self.add_bucket(bucket_for(value_ms), count, round(value_ms) * count)
+
+    def add_bucket(self, bucket: int, count: int, total_ms: int):
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += count
+        self.total_ms += total_ms
+
+    def merge(self, other: 'LatencySketch') -> 'LatencySketch':
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += other.count
+        self.total_ms += other.total_ms
+        return self
+
+    def quantile(self, q: float) -> float:
+        """Приближенный q-перцентиль в мс (ранг как у ближайшего значения)"""
+        if not self.count:
+            return 0.0
+        rank = min(int(q * self.count), self.count - 1)
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen > rank:
+                return bucket_value(bucket)
+        return bucket_value(max(self.buckets))
+
+    def mean(self) -> float:
+        return self.total_ms / self.count if self.count else 0.0
+
+    def summary(self) -> Dict[str, float]:
+        """Среднее, медиана и P95 в секундах"""
+        return {
+            'count': self.count,
+            'average': round(self.mean() / 1000, 2),
+            'p50': round(self.quantile(0.5) / 1000, 2),
+            'p95': round(self.quantile(0.95) / 1000, 2),
+        }
+
+
+def record(connection, source: str, user_id: Optional[int], moment: Optional[datetime], value_ms: float):
+    """Добавить значение в часовой скетч (атомарно, в транзакции вызывающего)"""
+    insert = _INSERTS.get(connection.dialect.name)
+    if insert is None or value_ms is None or value_ms < 0:
+        return
+    value_ms = round(value_ms)
+    stmt = insert(ResponseLatencySketch).values(
+        source=source, user_id=user_id or NO_USER, hour=hour_of(moment),
+        bucket=bucket_for(value_ms), count=1, total_ms=value_ms,
+    )
+    connection.execute(stmt.on_conflict_do_update(
+        index_elements=['source', 'user_id', 'hour', 'bucket'],
+        set_={
+            'count': ResponseLatencySketch.count + stmt.excluded.count,
+            'total_ms': ResponseLatencySketch.total_ms + stmt.excluded.total_ms,
+        },
+    ))
+
+
+def response_time_ms(reply_at: Optional[datetime], question_at: Optional[datetime]) -> Optional[int]:
+    """Время ответа в мс или None, если его нельзя посчитать осмысленно"""
+    if reply_at is None or question_at is None:
+        return None
+    value = round((reply_at - question_at).total_seconds() * 1000)
+    if value < 0 or value > MAX_RESPONSE_TIME_MS:
+        return None
+    return value
+
+
+@event.listens_for(DialogMessage, "before_insert")
+def _fill_response_time(mapper, connection, target):
+    """Если путь записи не передал время ответа — берем последнее сообщение пользователя"""
+    if target.sender != COUNTED_SENDER or target.response_time_ms is not None or target.dialog_id is None:
+        return
+    if target.timestamp is None:
+        target.timestamp = datetime.utcnow()
+    question_at = connection.execute(
+        select(func.max(DialogMessage.timestamp)).where(
+            DialogMessage.dialog_id == target.dialog_id,
+            DialogMessage.sender == 'user',
+            DialogMessage.timestamp <= target.timestamp,
+        )
+    ).scalar()
+    target.response_time_ms = response_time_ms(target.timestamp, question_at)
+
+
+@event.listens_for(DialogMessage, "after_insert")
+def _record_dialog_response(mapper, connection, target):
+    if target.sender != COUNTED_SENDER or target.response_time_ms is None:
+        return
+    user_id, _ = dialog_info(connection, target)
+    if user_id is not None:
+        record(connection, SOURCE_DIALOG, user_id, target.timestamp, target.response_time_ms)
+
+
+@event.listens_for(AITokenUsage, "after_insert")
+def _record_ai_response(mapper, connection, target):
+    if target.success is False or not target.response_time or target.response_time <= 0:
+        return
+    record(connection, SOURCE_AI, target.user_id, target.created_at, target.response_time * 1000)
+
+
+def get_sketch(db: Session, source: str, since: datetime, until: Optional[datetime] = None,
+               user_id: Optional[int] = None) -> LatencySketch:
+    """Слить часовые скетчи за период (по всем пользователям, если user_id не задан)"""
+    query = (
+        select(ResponseLatencySketch.bucket,
+               func.sum(ResponseLatencySketch.count),
+               func.sum(ResponseLatencySketch.total_ms))
+        .where(ResponseLatencySketch.source == source, ResponseLatencySketch.hour >= hour_of(since))
+        .group_by(ResponseLatencySketch.bucket)
+    )
+    if until is not None:
+        query = query.where(ResponseLatencySketch.hour < until)
+    if user_id is not None:
+        query = query.where(ResponseLatencySketch.user_id == user_id)
+
+    sketch = LatencySketch()
+    for bucket, count, total_ms in db.execute(query):
+        sketch.add_bucket(bucket, int(count or 0), int(total_ms or 0))
+    return sketch
+
+
+def rebuild_sketches(db: Session, since: Optional[datetime] = None) -> int:
+    """Пересчитать скетчи из dialog_messages.response_time_ms и ai_token_usage; возвращает число строк"""
+    dialog_query = (
+        select(Dialog.user_id, DialogMessage.timestamp, DialogMessage.response_time_ms)
+        .join(Dialog, Dialog.id == DialogMessage.dialog_id)
+        .where(DialogMessage.sender == COUNTED_SENDER, DialogMessage.response_time_ms.isnot(None),
+               DialogMessage.timestamp.isnot(None), Dialog.user_id.isnot(None))
+    )
+    ai_query = (
+        select(AITokenUsage.user_id, AITokenUsage.created_at, AITokenUsage.response_time * 1000)
+        .where(AITokenUsage.success.isnot(False), AITokenUsage.response_time > 0,
+               AITokenUsage.created_at.isnot(None))
+    )
+    stale = ResponseLatencySketch.__table__.delete()
+    if since is not None:
+        since = hour_of(since)
+        dialog_query = dialog_query.where(DialogMessage.timestamp >= since)
+        ai_query = ai_query.where(AITokenUsage.created_at >= since)
+        stale = stale.where(ResponseLatencySketch.hour >= since)
+
+    totals = {}
+    for source, query in ((SOURCE_DIALOG, dialog_query), (SOURCE_AI, ai_query)):
+        for user_id, moment, value_ms in db.execute(query.execution_options(yield_per=REBUILD_INSERT_BATCH)):
+            value_ms = round(value_ms)
+            key = (source, user_id or NO_USER, hour_of(moment), bucket_for(value_ms))
+            row = totals.setdefault(key, {
+                'source': key[0], 'user_id': key[1], 'hour': key[2], 'bucket': key[3], 'count': 0, 'total_ms': 0
+            })
+            row['count'] += 1
+            row['total_ms'] += value_ms
+
+    rows = list(totals.values())
+    db.execute(stale)
+    for start in range(0, len(rows), REBUILD_INSERT_BATCH):
+        db.execute(ResponseLatencySketch.__table__.insert(), rows[start:start + REBUILD_INSERT_BATCH])
+    db.commit()
+
+    logger.info(f"⏱️ Скетчи времени ответа пересчитаны: строк={len(rows)}, с {since or 'начала истории'}")
+    return len(rows)
@@ -7,7 +7,7 @@ import boto3
 import logging
 from botocore.exceptions import ClientError, NoCredentialsError
 from botocore.config import Config
-from typing import Optional, BinaryIO, Dict, Any
+from typing import Optional, BinaryIO, Callable, Dict, Any
 from pathlib import Path
 import os
 import mimetypes
@@ -17,6 +17,17 @@ import hashlib
 logger = logging.getLogger(__name__)
 
 
+def _read_exactly(stream: BinaryIO, size: int) -> bytes:
+    """Читает size байт из потока (pipe может отдавать данные кусками меньше)"""
+    buffer = bytearray()
+    while len(buffer) < size:
+        chunk = stream.read(size - len(buffer))
+        if not chunk:
+            break
+        buffer.extend(chunk)
+    return bytes(buffer)
+
+
 class S3StorageService:
     """Сервис для работы с S3-совместимым объектным хранилищем"""
 
@@ -120,7 +131,8 @@ class S3StorageService:
         file_content: bytes,
         object_key: str,
         content_type: Optional[str] = None,
-        metadata: Optional[Dict[str, str]] = None
+        metadata: Optional[Dict[str, str]] = None,
+        cache_control: Optional[str] = None
     ) -> Dict[str, Any]:
         """
         Загружает файл в S3
@@ -130,6 +142,7 @@ class S3StorageService:
             object_key: Ключ объекта в S3 (путь к файлу)
             content_type: MIME тип файла
             metadata: Дополнительные метаданные
+            cache_control: Заголовок Cache-Control, который хранилище отдаст с объектом
 
         Returns:
             Dict с информацией о загруженном файле
@@ -153,6 +166,9 @@ class S3StorageService:
             if metadata:
                 put_args['Metadata'] = metadata
 
+            if cache_control:
+                put_args['CacheControl'] = cache_control
+
             # Загружаем файл через put_object как в примере Timeweb
             self.s3_client.put_object(**put_args)
 
@@ -206,6 +222,127 @@ class S3StorageService:
                 logger.error(f"Failed to download file {object_key}: {e}")
             return None
 
+    def upload_stream(
+        self,
+        stream: BinaryIO,
+        object_key: str,
+        part_size: int = 64 * 1024 * 1024,
+        content_type: str = 'application/octet-stream',
+        metadata: Optional[Dict[str, str]] = None,
+        bucket_name: Optional[str] = None,
+        extra_args: Optional[Dict[str, Any]] = None,
+        before_complete: Optional[Callable[[], None]] = None
+    ) -> Dict[str, Any]:
+        """
+        Загружает поток неизвестной длины через multipart upload
+
+        В памяти держится одна часть (part_size, минимум 5 МБ по протоколу S3),
+        поэтому можно передавать stdout процесса без временного файла.
+
+        Args:
+            stream: Поток с методом read(n)
+            object_key: Ключ объекта в S3
+            part_size: Размер части multipart upload
+            content_type: MIME тип объекта
+            metadata: Дополнительные метаданные
+            bucket_name: Бакет, если отличается от основного
+            extra_args: Дополнительные аргументы create_multipart_upload
+                (StorageClass, ServerSideEncryption)
+            before_complete: Вызывается после загрузки всех частей до фиксации объекта;
+                исключение в нем отменяет multipart upload (объект не появится)
+
+        Returns:
+            Dict с информацией о загруженном объекте
+        """
+        bucket = bucket_name or self.bucket_name
+        part_size = max(part_size, 5 * 1024 * 1024)
+
+        create_args = {'Bucket': bucket, 'Key': object_key, 'ContentType': content_type}
+        if metadata:
+            create_args['Metadata'] = metadata
+        if extra_args:
+            create_args.update(extra_args)
+
+        upload_id = None
+        try:
+            upload_id = self.s3_client.create_multipart_upload(**create_args)['UploadId']
+            parts = []
+            total = 0
+
+            while True:
+                chunk = _read_exactly(stream, part_size)
+                # Пустая часть допустима только если объект пустой
+                if not chunk and parts:
+                    break
+                response = self.s3_client.upload_part(
+                    Bucket=bucket,
+                    Key=object_key,
+                    UploadId=upload_id,
+                    PartNumber=len(parts) + 1,
+                    Body=chunk
+                )
+                parts.append({'PartNumber': len(parts) + 1, 'ETag': response['ETag']})
+                total += len(chunk)
+                if len(chunk) < part_size:
+                    break
+
+            if before_complete:
+                before_complete()
+
+            self.s3_client.complete_multipart_upload(
+                Bucket=bucket,
+                Key=object_key,
+                UploadId=upload_id,
+                MultipartUpload={'Parts': parts}
+            )
+
+            logger.info(f"Stream uploaded successfully: {object_key} ({total} bytes, {len(parts)} parts)")
+            return {
+                'success': True,
+                'object_key': object_key,
+                'size': total,
+                'parts': len(parts),
+                'bucket': bucket
+            }
+
+        except Exception as e:
+            logger.error(f"Failed to upload stream {object_key}: {e}")
+            if upload_id:
+                try:
+                    self.s3_client.abort_multipart_upload(Bucket=bucket, Key=object_key, UploadId=upload_id)
+                except ClientError as abort_error:
+                    logger.error(f"Failed to abort multipart upload {object_key}: {abort_error}")
+            return {
+                'success': False,
+                'error': str(e)
+            }
+
+    def download_stream(
+        self,
+        object_key: str,
+        destination: BinaryIO,
+        bucket_name: Optional[str] = None,
+        chunk_size: int = 8 * 1024 * 1024
+    ) -> Optional[int]:
+        """
+        Скачивает объект в поток по частям, не загружая его целиком в память
+
+        Returns:
+            Количество записанных байт или None при ошибке
+        """
+        try:
+            response = self.s3_client.get_object(Bucket=bucket_name or self.bucket_name, Key=object_key)
+            total = 0
+            for chunk in response['Body'].iter_chunks(chunk_size):
+                destination.write(chunk)
+                total += len(chunk)
+            logger.info(f"Stream downloaded successfully: {object_key} ({total} bytes)")
+            return total
+
+        except (ClientError, OSError) as e:
+            logger.error(f"Failed to download stream {object_key}: {e}")
+            return None
+
     def delete_file(self, object_key: str) -> bool:
         """
         Удаляет файл из S3
@@ -14,14 +14,13 @@ from fastapi.responses import StreamingResponse
 import redis.asyncio as aioredis
 
 import os
-import jwt
 
 # Local auth helpers (migrated from websocket_manager)
 def _is_domain_allowed_by_token(origin: str, token: str, parent_origin: str = None) -> bool:
     """Check if domain is allowed by token"""
     try:
-        from core.app_config import SITE_SECRET
-        payload = jwt.decode(token, SITE_SECRET, algorithms=['HS256'], options={"verify_exp": False})
+        from cache.widget_auth_cache import widget_auth_cache
+        payload = widget_auth_cache.decode(token)
         allowed_domains = payload.get('allowed_domains', '')
         
         # Simple domain check
@@ -544,8 +543,8 @@ async def validate_sse_auth(
             
             # If no origin, validate token structure only (SSE-friendly)
             try:
-                from core.app_config import SITE_SECRET
-                payload = jwt.decode(site_token, SITE_SECRET, algorithms=['HS256'], options={"verify_exp": False})
+                from cache.widget_auth_cache import widget_auth_cache
+                payload = widget_auth_cache.decode(site_token)
                 if payload.get('type') == 'site' and payload.get('user_id'):
                     return True, "site"
             except Exception:
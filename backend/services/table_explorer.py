@@ -0,0 +1,283 @@
+"""
+Просмотр таблиц БД из админки без нагрузки на боевой трафик
+
+Раньше /admin/database/tables/{table}/data делал query.count() и OFFSET-пагинацию
+с ILIKE '%term%' по всем текстовым колонкам (dialog_messages — полный скан
+на каждую страницу), а /admin/database/stats — SELECT count(*) по каждой таблице
+подряд. Теперь:
+
+- количество строк — оценка из pg_class.reltuples / pg_stat_user_tables одним
+  запросом; точный COUNT только для выборки с фильтром и не дальше COUNT_LIMIT;
+- пагинация keyset: курсор хранит (значение сортировки, первичный ключ)
+  последней строки, следующая страница — поиск по индексу, а не OFFSET;
+- поиск только по колонкам из SEARCH_COLUMNS, для них есть GIN-индексы pg_trgm
+  (миграция 2a9c4f7e1b35);
+- каждый запрос обозревателя выполняется с statement_timeout
+  ADMIN_EXPLORER_STATEMENT_TIMEOUT_MS — тяжелый запрос отменяется, а не
+  держит соединения и I/O.
+"""
+
+import base64
+import json
+import logging
+import os
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import Boolean, Float, Integer, Numeric, and_, func, inspect, or_, select, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger(__name__)
+
+STATEMENT_TIMEOUT_MS = int(os.getenv('ADMIN_EXPLORER_STATEMENT_TIMEOUT_MS', '5000'))
+MAX_LIMIT = 1000
+MAX_OFFSET = 10000  # OFFSET только для перехода по номеру страницы без курсора
+COUNT_LIMIT = 10000
+MIN_SEARCH_LENGTH = 3  # Короче триграммы индекс pg_trgm не используется
+
+# Колонки, по которым разрешен поиск; для каждой есть триграммный индекс
+# ix_<table>_<column>_trgm (миграция 2a9c4f7e1b35)
+SEARCH_COLUMNS: Dict[str, Tuple[str, ...]] = {
+    'users': ('email', 'first_name'),
+    'assistants': ('name',),
+    'dialogs': ('telegram_username', 'first_name', 'last_name', 'guest_id'),
+    'dialog_messages': ('text',),
+    'documents': ('filename',),
+    'qa_knowledge': ('question', 'answer'),
+    'balance_transactions': ('description',),
+    'training_examples': ('user_message',),
+}
+
+QUERY_CANCELED = '57014'
+
+
+def is_postgres(db: Session) -> bool:
+    return db.get_bind().dialect.name == 'postgresql'
+
+
+def apply_statement_timeout(db: Session, timeout_ms: int = STATEMENT_TIMEOUT_MS) -> None:
+    """Ограничить время запросов до конца текущей транзакции (SET LOCAL)"""
+    if is_postgres(db):
+        db.execute(text("SELECT set_config('statement_timeout', :value, true)"), {'value': str(timeout_ms)})
+
+
+def is_statement_timeout(error: Exception) -> bool:
+    return isinstance(error, OperationalError) and getattr(error.orig, 'pgcode', None) == QUERY_CANCELED
+
+
+def timeout_error() -> HTTPException:
+    return HTTPException(
+        status_code=504,
+        detail=f"Запрос отменен: дольше {STATEMENT_TIMEOUT_MS} мс. Уточните фильтр или поиск."
+    )
+
+
+# --- Оценка количества строк ---
+
+def estimate_row_counts(db: Session, table_names: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+    """{table: {'rows', 'size_bytes', 'estimated'}} — из статистики Postgres одним запросом"""
+    table_names = list(table_names)
+    if not is_postgres(db):
+        # SQLite (разработка и тесты): таблицы маленькие, считаем точно
+        result = {}
+        for name in table_names:
+            rows = db.execute(text(f'SELECT count(*) FROM "{name}"')).scalar()
+            result[name] = {'rows': int(rows or 0), 'size_bytes': None, 'estimated': False}
+        return result
+
+    rows = db.execute(text("""
+        SELECT c.relname,
+               COALESCE(s.n_live_tup, GREATEST(c.reltuples, 0))::bigint AS rows,
+               pg_total_relation_size(c.oid) AS size_bytes
+        FROM pg_class c
+        LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+        WHERE c.relkind IN ('r', 'p')
+          AND c.relnamespace = current_schema()::regnamespace
+          AND c.relname = ANY(:names)
+    """), {'names': table_names}).all()
+    result = {name: {'rows': 0, 'size_bytes': None, 'estimated': True} for name in table_names}
+    for name, count, size_bytes in rows:
+        result[name] = {'rows': int(count), 'size_bytes': int(size_bytes), 'estimated': True}
+    return result
+
+
+def _bounded_count(db: Session, query, pk) -> Tuple[int, bool]:
+    """Точное количество до COUNT_LIMIT; (count, обрезано ли)"""
+    limited = query.with_only_columns(pk).limit(COUNT_LIMIT + 1).subquery()
+    count = db.execute(select(func.count()).select_from(limited)).scalar()
+    return min(count, COUNT_LIMIT), count > COUNT_LIMIT
+
+
+# --- Курсор ---
+
+def encode_cursor(values: List[Any]) -> str:
+    payload = [value.isoformat() if isinstance(value, (datetime, date)) else value for value in values]
+    # Decimal (NUMERIC) и прочие значения вне JSON — строкой; тип восстанавливает _from_json
+    return base64.urlsafe_b64encode(json.dumps(payload, default=str).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str, columns) -> List[Any]:
+    try:
+        raw = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if not isinstance(raw, list) or len(raw) != len(columns):
+            raise ValueError("cursor shape")
+        return [_from_json(value, column) for value, column in zip(raw, columns)]
+    except (ValueError, TypeError, InvalidOperation) as e:
+        raise HTTPException(status_code=400, detail=f"Некорректный курсор: {e}")
+
+
+def _from_json(value, column):
+    if value is None:
+        return None
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return value
+    if python_type is datetime:
+        return datetime.fromisoformat(value)
+    if python_type is date:
+        return date.fromisoformat(value)
+    if python_type is Decimal:
+        return Decimal(str(value))
+    return value
+
+
+def _after(column, pk, value, pk_value, descending: bool):
+    """Строки строго после (value, pk_value) в порядке ORDER BY column NULLS LAST, pk"""
+    pk_after = pk < pk_value if descending else pk > pk_value
+    if column is pk:
+        return pk_after
+    if value is None:
+        return and_(column.is_(None), pk_after)
+    column_after = column < value if descending else column > value
+    return or_(column_after, and_(column == value, pk_after), column.is_(None))
+
+
+# --- Фильтр и поиск ---
+
+def _escape_like(term: str) -> str:
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def search_condition(table_name: str, model_class, term: str):
+    columns = SEARCH_COLUMNS.get(table_name)
+    if not columns:
+        raise HTTPException(status_code=400, detail=f"Поиск по таблице {table_name} не поддерживается")
+    term = term.strip()
+    if len(term) < MIN_SEARCH_LENGTH:
+        raise HTTPException(status_code=400, detail=f"Для поиска нужно минимум {MIN_SEARCH_LENGTH} символа")
+    pattern = f"%{_escape_like(term)}%"
+    return or_(*(getattr(model_class, name).ilike(pattern, escape='\\') for name in columns))
+
+
+def filter_condition(table_name: str, model_class, field: str, value: str):
+    """Равенство по значению колонки; подстрока — только для колонок поиска"""
+    column = inspect(model_class).columns.get(field)
+    if column is None:
+        raise HTTPException(status_code=400, detail=f"Колонка {field} не найдена")
+    attribute = getattr(model_class, column.key)
+    try:
+        if isinstance(column.type, Integer):
+            return attribute == int(value)
+        if isinstance(column.type, (Float, Numeric)):
+            return attribute == float(value)
+        if isinstance(column.type, Boolean):
+            return attribute == (value.strip().lower() in ('true', '1', 'yes'))
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Некорректное значение для {field}: {value}")
+    if field in SEARCH_COLUMNS.get(table_name, ()):
+        return attribute.ilike(f"%{_escape_like(value)}%", escape='\\')
+    return attribute == value
+
+
+# --- Страница ---
+
+def fetch_page(
+    db: Session,
+    table_name: str,
+    model_class,
+    limit: int = 20,
+    cursor: Optional[str] = None,
+    page: int = 1,
+    search: Optional[str] = None,
+    filter_field: Optional[str] = None,
+    filter_value: Optional[str] = None,
+    sort_field: Optional[str] = None,
+    sort_order: Optional[str] = "asc",
+) -> Tuple[list, Dict[str, Any]]:
+    """Страница записей и описание пагинации (с next_cursor для следующей страницы)"""
+    limit = max(1, min(limit, MAX_LIMIT))
+    page = max(1, page)
+    mapper = inspect(model_class)
+    if len(mapper.primary_key) != 1:
+        raise HTTPException(status_code=400, detail=f"Таблица {table_name} без простого первичного ключа")
+    pk = getattr(model_class, mapper.primary_key[0].key)
+
+    sort_column = pk
+    if sort_field and sort_field != pk.key:
+        if mapper.columns.get(sort_field) is None:
+            raise HTTPException(status_code=400, detail=f"Колонка {sort_field} не найдена")
+        sort_column = getattr(model_class, sort_field)
+    descending = sort_order == "desc"
+
+    apply_statement_timeout(db)
+    query = select(model_class)
+    filtered = False
+    if search:
+        query = query.where(search_condition(table_name, model_class, search))
+        filtered = True
+    if filter_field and filter_value:
+        query = query.where(filter_condition(table_name, model_class, filter_field, filter_value))
+        filtered = True
+
+    order = [sort_column.desc().nullslast() if descending else sort_column.asc().nullslast()]
+    if sort_column is not pk:
+        order.append(pk.desc() if descending else pk.asc())
+    page_query = query.order_by(*order)
+
+    if cursor:
+        values = decode_cursor(cursor, [sort_column, pk] if sort_column is not pk else [pk])
+        value, pk_value = (values[0], values[-1])
+        page_query = page_query.where(_after(sort_column, pk, value, pk_value, descending))
+    elif page > 1:
+        offset = (page - 1) * limit
+        if offset > MAX_OFFSET:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Переход дальше {MAX_OFFSET} строк — только по курсору (next_cursor)"
+            )
+        page_query = page_query.offset(offset)
+
+    records = db.execute(page_query.limit(limit + 1)).scalars().all()
+    has_more = len(records) > limit
+    records = records[:limit]
+
+    if filtered:
+        total, capped = _bounded_count(db, query, pk)
+    else:
+        total = estimate_row_counts(db, [model_class.__tablename__])[model_class.__tablename__]['rows']
+        capped = is_postgres(db)
+    # Оценка может отставать от реальности: последняя страница определяется по has_more
+    total = max(total, (page - 1) * limit + len(records) + (1 if has_more else 0))
+
+    next_cursor = None
+    if has_more and records:
+        last = records[-1]
+        next_cursor = encode_cursor(
+            [getattr(last, sort_column.key), getattr(last, pk.key)] if sort_column is not pk
+            else [getattr(last, pk.key)]
+        )
+
+    return records, {
+        "page": page,
+        "limit": limit,
+        "total": total,
+        "total_is_estimate": capped,
+        "pages": max(page + (1 if has_more else 0), (total + limit - 1) // limit),
+        "has_more": has_more,
+        "next_cursor": next_cursor,
+        "search_columns": list(SEARCH_COLUMNS.get(table_name, ())),
+    }
@@ -3,9 +3,8 @@
 """
 from datetime import datetime, timedelta
 from sqlalchemy.orm import Session
-from sqlalchemy import func
 from database import SessionLocal, models
-from database.connection import get_db
+from services import message_quota
 
 from core.app_config import TRIAL_DURATION_DAYS, TRIAL_MESSAGE_LIMIT
 
@@ -17,16 +16,8 @@ def is_trial_period_active(user: models.User) -> bool:
 
 def get_trial_messages_used(user: models.User, db: Session) -> int:
     """Возвращает количество сообщений, использованных в пробном периоде"""
-    # Считаем сообщения только за период с момента регистрации
-    message_count = db.query(func.count(models.DialogMessage.id)).join(
-        models.Dialog
-    ).filter(
-        models.Dialog.user_id == user.id,
-        models.DialogMessage.sender == 'assistant',
-        models.DialogMessage.timestamp >= user.created_at
-    ).scalar() or 0
-    
-    return message_count
+    # Пробный период начинается с регистрации, поэтому это счетчик за все время
+    return message_quota.get_total_count(db, user.id)
 
 def get_trial_days_left(user: models.User) -> int:
     """Возвращает количество дней, оставшихся в пробном периоде"""
@@ -53,8 +44,11 @@ def check_user_access(user: models.User) -> dict:
     is_blocked = is_user_blocked(user)
     is_trial = is_trial_period_active(user)
     trial_days_left = get_trial_days_left(user)
-    with get_db() as db:
+    db = SessionLocal()
+    try:
         trial_messages_used = get_trial_messages_used(user, db)
+    finally:
+        db.close()
     
     # Если пользователь заблокирован, останавливаем всех его ботов
     if is_blocked:
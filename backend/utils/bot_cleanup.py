@@ -4,9 +4,8 @@
 
 from database import models
 from sqlalchemy.orm import Session
-import requests
 import logging
-from core.app_config import BOT_SERVICE_URL
+from services.bot_control import CLEAR_CACHE, RELOAD, bot_control
 
 logger = logging.getLogger(__name__)
 
@@ -77,22 +76,10 @@ def full_bot_cleanup(user_id: int, assistant_id: int = None, db: Session = None)
         if bot_instances:
             bot_ids = [bot.id for bot in bot_instances]
             
-            try:
-                # Очищаем кэш bot manager (не блокируем долго)
-                requests.post(
-                    f"{BOT_SERVICE_URL}/clear-cache",
-                    json={'bot_ids': bot_ids},
-                    timeout=1
-                )
-                # Перезагружаем ботов (короткий таймаут)
-                requests.post(
-                    f"{BOT_SERVICE_URL}/hot-reload-bots",
-                    json={'bot_ids': bot_ids},
-                    timeout=1
-                )
-                logger.info(f"✅ Перезагружено {len(bot_ids)} ботов (async, короткий таймаут)")
-            except Exception as e:
-                logger.warning(f"⚠️  Ошибка перезагрузки ботов (пропущено): {e}")
+            # Очистка кэша и перезагрузка применяются менеджером с подтверждением и повторами
+            bot_control.publish(bot_ids, CLEAR_CACHE)
+            bot_control.publish(bot_ids, RELOAD)
+            logger.info(f"✅ Запрошена перезагрузка {len(bot_ids)} ботов")
         
         logger.info("✅ Полная очистка завершена")
         
@@ -213,20 +200,9 @@ def enhanced_document_deletion(doc_id: int, user_id: int, db: Session):
         if bot_instances:
             bot_ids = [bot.id for bot in bot_instances]
             
-            try:
-                requests.post(
-                    f"{BOT_SERVICE_URL}/clear-cache",
-                    json={'bot_ids': bot_ids},
-                    timeout=1
-                )
-                requests.post(
-                    f"{BOT_SERVICE_URL}/hot-reload-bots",
-                    json={'bot_ids': bot_ids},
-                    timeout=1
-                )
-                logger.info(f"Перезагружено {len(bot_ids)} ботов (async, короткий таймаут)")
-            except Exception as e:
-                logger.warning(f"Ошибка перезагрузки ботов (пропущено): {e}")
+            bot_control.publish(bot_ids, CLEAR_CACHE)
+            bot_control.publish(bot_ids, RELOAD)
+            logger.info(f"Запрошена перезагрузка {len(bot_ids)} ботов")
         
         # 9. Удаляем файл с диска (используем PROJECT_ROOT/uploads)
         import os
@@ -355,15 +331,8 @@ def enhanced_knowledge_deletion(knowledge_id: int, user_id: int, db: Session):
         if bot_instances:
             bot_ids = [bot.id for bot in bot_instances]
             
-            try:
-                requests.post(
-                    f"{BOT_SERVICE_URL}/hot-reload-bots",
-                    json={'bot_ids': bot_ids},
-                    timeout=1
-                )
-                logger.info(f"Перезагружено {len(bot_ids)} ботов (async, короткий таймаут)")
-            except Exception as e:
-                logger.warning(f"Ошибка перезагрузки ботов (пропущено): {e}")
+            bot_control.publish(bot_ids, RELOAD)
+            logger.info(f"Запрошена перезагрузка {len(bot_ids)} ботов")
         
         db.commit()
         logger.info("✅ Знание полностью удалено")
@@ -1,4 +1,4 @@
-import { useState, useEffect } from 'react';
+import { useState, useEffect, useRef } from 'react';
 import { motion } from 'framer-motion';
 import { API_URL } from '../../config/api';
 import { 
@@ -42,6 +42,10 @@ const DataTable = ({
   // Состояние для выбранных записей
   const [selectedRows, setSelectedRows] = useState(new Set());
 
+  // Курсоры keyset-пагинации: номер страницы -> next_cursor предыдущей страницы.
+  // Сбрасываются при смене таблицы, поиска, фильтра или сортировки
+  const cursorsRef = useRef({ key: '', pages: {} });
+
   const fetchData = async () => {
     if (!tableName) return;
 
@@ -54,9 +58,15 @@ const DataTable = ({
         throw new Error('Токен авторизации не найден');
       }
 
+      const queryKey = JSON.stringify([tableName, pagination.limit, searchTerm, filterField, filterValue, sortField, sortOrder]);
+      if (cursorsRef.current.key !== queryKey) {
+        cursorsRef.current = { key: queryKey, pages: {} };
+      }
+
       const requestBody = {
         page: pagination.page,
         limit: pagination.limit,
+        cursor: cursorsRef.current.pages[pagination.page] || null,
         search: searchTerm || null,
         filter_field: filterField || null,
         filter_value: filterValue || null,
@@ -79,8 +89,12 @@ const DataTable = ({
       }
 
       const result = await response.json();
+      const nextPagination = result.pagination || {};
+      if (nextPagination.next_cursor) {
+        cursorsRef.current.pages[nextPagination.page + 1] = nextPagination.next_cursor;
+      }
       setData(result.data || []);
-      setPagination(result.pagination || {});
+      setPagination(nextPagination);
 
     } catch (err) {
       setError(err.message);
@@ -432,7 +446,7 @@ const DataTable = ({
       {pagination.pages > 1 && (
         <div className="px-6 py-4 border-t border-gray-200 flex items-center justify-between">
           <div className="text-sm text-gray-600">
-            Показано {((pagination.page - 1) * pagination.limit) + 1}-{Math.min(pagination.page * pagination.limit, pagination.total)} из {pagination.total} записей
+            Показано {((pagination.page - 1) * pagination.limit) + 1}-{Math.min(pagination.page * pagination.limit, pagination.total)} из {pagination.total_is_estimate ? '~' : ''}{pagination.total} записей
           </div>
           <div className="flex items-center gap-2">
             <button
@@ -450,7 +464,7 @@ const DataTable = ({
 
             <button
               onClick={() => handlePageChange(pagination.page + 1)}
-              disabled={pagination.page >= pagination.pages}
+              disabled={!pagination.has_more}
               className="flex items-center gap-1 px-3 py-2 text-sm border border-gray-300 rounded-lg hover:bg-gray-50 disabled:opacity-50 disabled:cursor-not-allowed"
             >
               Далее
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Микро-бенчмарк детектора handoff: стоимость проверки одного сообщения
+
+Сравнивает прежний путь (новый ImprovedHandoffDetector на каждое сообщение +
+отдельный re.search по каждому паттерну) с процессным синглтоном,
+в котором все паттерны скомпилированы один раз.
+
+Использование:
+    python scripts/benchmark_handoff_detector.py                   # встроенный корпус
+    python scripts/benchmark_handoff_detector.py --corpus msgs.txt # по сообщению на строку
+    python scripts/benchmark_handoff_detector.py --from-db 5000    # последние N сообщений пользователей из БД
+"""
+
+import argparse
+import re
+import sys
+import time
+from pathlib import Path
+
+# Добавляем путь к backend модулям
+backend_path = Path(__file__).parent.parent / "backend"
+sys.path.append(str(backend_path))
+
+from services.improved_handoff_detector import ImprovedHandoffDetector  # noqa: E402
+
+DEFAULT_CORPUS = [
+    "Здравствуйте! Сколько стоит доставка в Казань?",
+    "а можно оплатить картой при получении",
+    "нужен оператор",
+    "Подскажите, пожалуйста, режим работы в выходные",
+    "хочу поговорить с живым человеком",
+    "У вас есть скидки для постоянных клиентов?",
+    "не могу решить проблему с оплатой, уже третий раз пытаюсь",
+    "что такое логический оператор в python",
+    "Спасибо, всё понятно",
+    "где мой заказ 48213? жду уже неделю",
+    "need to speak with a human agent please",
+    "What are your opening hours?",
+    "подать жалобу на сервис",
+    "ок",
+    "Добрый день. Интересует тариф для команды из 10 человек, есть ли годовая оплата и можно ли "
+    "подключить интеграцию с CRM? Также хотелось бы понять условия техподдержки.",
+]
+
+
+class LegacyDetector(ImprovedHandoffDetector):
+    """Детектор без предкомпиляции — как до перехода на синглтон"""
+
+    def _compile(self):
+        pass
+
+
+def legacy_should_request_handoff(user_text, ai_text=None):
+    """Прежний алгоритм: новый детектор на каждое сообщение и re.search по каждому паттерну"""
+    detector = LegacyDetector()
+    text = user_text.lower()
+    for exclusion in detector.exclusion_patterns:
+        if re.search(exclusion, text):
+            return False
+    score = sum(p.weight for p in detector.handoff_patterns if re.search(p.pattern, text))
+    if ai_text:
+        ai_clean = ai_text.lower()
+        if any(re.search(p, ai_clean) for p in detector.ai_fallback_patterns):
+            score += 0.8
+    return score >= 0.5
+
+
+def load_corpus(args):
+    if args.corpus:
+        return [line.strip() for line in Path(args.corpus).read_text(encoding='utf-8').splitlines() if line.strip()]
+    if args.from_db:
+        from database.connection import SessionLocal
+        from database import models
+        db = SessionLocal()
+        try:
+            rows = db.query(models.DialogMessage.text).filter(
+                models.DialogMessage.sender == 'user'
+            ).order_by(models.DialogMessage.id.desc()).limit(args.from_db).all()
+            return [row.text for row in rows if row.text]
+        finally:
+            db.close()
+    return DEFAULT_CORPUS
+
+
+def bench(label, func, corpus, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        for message in corpus:
+            func(message)
+    elapsed = time.perf_counter() - started
+    per_message_us = elapsed / (iterations * len(corpus)) * 1_000_000
+    print(f"{label:<32} {per_message_us:>10.1f} µs/сообщение  ({elapsed:.2f}s всего)")
+    return per_message_us
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк handoff детектора")
+    parser.add_argument('--corpus', help="Файл с сообщениями, по одному на строку")
+    parser.add_argument('--from-db', type=int, default=0, help="Взять N последних сообщений пользователей из БД")
+    parser.add_argument('--iterations', type=int, default=200)
+    args = parser.parse_args()
+
+    corpus = load_corpus(args)
+    print(f"📊 Корпус: {len(corpus)} сообщений × {args.iterations} итераций")
+
+    detector = ImprovedHandoffDetector()
+
+    # Проверяем, что решения совпадают
+    mismatches = [m for m in corpus if legacy_should_request_handoff(m) != detector.should_request_handoff(m)[0]]
+    if mismatches:
+        print(f"❌ Расхождение решений на {len(mismatches)} сообщениях: {mismatches[:5]}")
+
+    legacy = bench("legacy (новый детектор + re.search)", legacy_should_request_handoff, corpus, args.iterations)
+    compiled = bench("compiled singleton", lambda m: detector.should_request_handoff(m), corpus, args.iterations)
+    print(f"⚡ Ускорение: ×{legacy / compiled:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Tests for shared deadline budgeting and provider racing in AIProvidersManager
+"""
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../..', 'backend'))
+
+import httpx  # noqa: E402
+
+from ai.ai_providers import (  # noqa: E402
+    AIDeadlineExceeded, AIProvider, AIProvidersManager, BaseAIProvider, CircuitBreaker, RequestDeadline
+)
+
+
+class FakeProvider(BaseAIProvider):
+    def __init__(self, name, delay=0.0, fail=False):
+        super().__init__(name)
+        self.delay = delay
+        self.fail = fail
+        self.calls = 0
+
+    async def get_completion(self, messages, model=None, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError(f"{self.name} failed")
+        return {"content": self.name, "usage": {}, "model": model}
+
+
+def make_manager(**providers):
+    manager = AIProvidersManager.__new__(AIProvidersManager)
+    manager.providers = {}
+    manager.breakers = {}
+    manager.deadline_exhausted = {}
+    for key, provider in providers.items():
+        provider_type = AIProvider(key)
+        manager.providers[provider_type] = provider
+        manager.breakers[provider_type] = CircuitBreaker(failure_threshold=100)
+    return manager
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setenv('AI_RETRY_BASE_DELAY', '0.01')
+    monkeypatch.setenv('AI_RETRY_MAX_ATTEMPTS', '3')
+    monkeypatch.delenv('AI_RACE_ENABLED', raising=False)
+
+
+def test_request_deadline_caps_timeout():
+    deadline = RequestDeadline(0.5)
+    assert deadline.timeout_for(120) <= 0.5
+    assert deadline.timeout_for(0.1) == pytest.approx(0.1)
+    assert not deadline.expired()
+
+    clipped = deadline.clip_httpx_timeout(httpx.Timeout(connect=5, read=30, write=5, pool=None))
+    assert max(clipped.connect, clipped.read, clipped.write, clipped.pool) <= 0.5
+    assert deadline.clip_httpx_timeout(0.1).read == pytest.approx(0.1)
+
+
+@pytest.mark.asyncio
+async def test_retries_and_fallback_share_one_budget():
+    slow = FakeProvider("openai", delay=5)
+    backup = FakeProvider("claude")
+    manager = make_manager(openai=slow, claude=backup)
+
+    started = asyncio.get_running_loop().time()
+    with pytest.raises(Exception):
+        await manager.get_completion([{"role": "user", "content": "hi"}], deadline_seconds=0.3)
+    elapsed = asyncio.get_running_loop().time() - started
+
+    assert elapsed < 1.0
+    assert backup.calls == 0
+    assert manager.deadline_exhausted.get("openai", 0) >= 1
+
+
+@pytest.mark.asyncio
+async def test_fallback_used_within_budget():
+    manager = make_manager(openai=FakeProvider("openai", fail=True), claude=FakeProvider("claude"))
+
+    result = await manager.get_completion([{"role": "user", "content": "hi"}], deadline_seconds=5)
+
+    assert result["provider_used"] == "claude"
+
+
+@pytest.mark.asyncio
+async def test_race_starts_fallback_after_ttfb_threshold(monkeypatch):
+    monkeypatch.setenv('AI_RACE_ENABLED', 'true')
+    monkeypatch.setenv('AI_RACE_TTFB_THRESHOLD', '0.05')
+    primary = FakeProvider("openai", delay=2)
+    backup = FakeProvider("claude", delay=0.01)
+    manager = make_manager(openai=primary, claude=backup)
+
+    result = await manager.get_completion([{"role": "user", "content": "hi"}], deadline_seconds=5)
+
+    assert result["provider_used"] == "claude"
+    assert primary.calls == 1
+
+
+class ExhaustingProvider(FakeProvider):
+    async def get_completion(self, messages, model=None, **kwargs):
+        self.calls += 1
+        raise AIDeadlineExceeded("budget spent inside provider")
+
+
+@pytest.mark.asyncio
+async def test_deadline_exhausted_inside_provider_is_recorded():
+    manager = make_manager(openai=ExhaustingProvider("openai"))
+
+    with pytest.raises(Exception):
+        await manager.get_completion([{"role": "user", "content": "hi"}], deadline_seconds=5)
+
+    assert manager.deadline_exhausted == {"openai": 1}
@@ -0,0 +1,168 @@
+"""
+Integration tests for the atomic balance charge (UPDATE ... RETURNING in a CTE).
+
+Needs PostgreSQL: set TEST_DATABASE_URL to a disposable database, otherwise
+the module is skipped.
+"""
+import os
+import sys
+import threading
+import uuid
+from decimal import Decimal
+
+import pytest
+
+os.environ.setdefault('SECRET_KEY', 'test-secret-key')
+os.environ.setdefault('SITE_SECRET', 'test-site-secret')
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../..', 'backend'))
+
+from sqlalchemy import create_engine, text  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+from database import models  # noqa: E402
+from services import balance_service as balance_module  # noqa: E402
+from services.balance_service import BalanceService  # noqa: E402
+
+TEST_DATABASE_URL = os.getenv('TEST_DATABASE_URL', '')
+PRICE = Decimal("5.00")
+
+pytestmark = pytest.mark.skipif(
+    not TEST_DATABASE_URL.startswith('postgresql'),
+    reason="TEST_DATABASE_URL with PostgreSQL is required"
+)
+
+
+@pytest.fixture(scope="module")
+def session_factory():
+    engine = create_engine(TEST_DATABASE_URL)
+    tables = [model.__table__ for model in (
+        models.User, models.UserBalance, models.BalanceTransaction, models.ServicePrice
+    )]
+    models.Base.metadata.create_all(engine, tables=tables, checkfirst=True)
+    yield sessionmaker(bind=engine)
+    engine.dispose()
+
+
+@pytest.fixture
+def account(session_factory, monkeypatch):
+    """Пользователь с балансом на одно списание и тестовая услуга"""
+    monkeypatch.setattr(BalanceService, "_check_and_send_balance_warnings", lambda *args: None)
+    service_type = f"test_charge_{uuid.uuid4().hex[:8]}"
+
+    db = session_factory()
+    user = models.User(email=f"{service_type}@example.com", hashed_password="x")
+    db.add(user)
+    db.add(models.ServicePrice(service_type=service_type, price=PRICE))
+    db.flush()
+    db.add(models.UserBalance(user_id=user.id, balance=PRICE * Decimal("1.5"), total_spent=0, total_topped_up=0))
+    db.commit()
+    user_id = user.id
+    db.close()
+    balance_module.invalidate_price_cache()
+
+    yield user_id, service_type
+
+    db = session_factory()
+    db.execute(text("DELETE FROM balance_transactions WHERE user_id = :id"), {"id": user_id})
+    db.execute(text("DELETE FROM user_balances WHERE user_id = :id"), {"id": user_id})
+    db.execute(text("DELETE FROM service_prices WHERE service_type = :s"), {"s": service_type})
+    db.execute(text("DELETE FROM users WHERE id = :id"), {"id": user_id})
+    db.commit()
+    db.close()
+
+
+def balance_of(session_factory, user_id):
+    db = session_factory()
+    try:
+        return db.query(models.UserBalance.balance).filter(models.UserBalance.user_id == user_id).scalar()
+    finally:
+        db.close()
+
+
+def test_concurrent_double_charge_debits_once(session_factory, account):
+    user_id, service_type = account
+    barrier = threading.Barrier(2)
+    results = []
+
+    def charge():
+        db = session_factory()
+        try:
+            barrier.wait()
+            results.append(BalanceService(db).charge_for_service(user_id, service_type).balance_after)
+        except ValueError:
+            results.append("declined")
+        finally:
+            db.close()
+
+    threads = [threading.Thread(target=charge) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(results, key=str) == [PRICE / 2, "declined"]
+    assert balance_of(session_factory, user_id) == PRICE / 2
+
+    db = session_factory()
+    assert db.query(models.BalanceTransaction).filter_by(user_id=user_id).count() == 1
+    db.close()
+
+
+def test_charge_returns_persisted_transaction(session_factory, account):
+    user_id, service_type = account
+    db = session_factory()
+    transaction = BalanceService(db).charge_for_service(user_id, service_type, related_id=42)
+
+    assert transaction in db
+    assert transaction.id and transaction.created_at is not None
+    assert transaction.amount == -PRICE and transaction.related_id == 42
+    db.close()
+
+
+def test_decline_keeps_callers_pending_work(session_factory, account):
+    user_id, service_type = account
+    db = session_factory()
+    service = BalanceService(db)
+    service.charge_for_service(user_id, service_type)
+
+    user = db.get(models.User, user_id)
+    user.first_name = "Pending"
+    with pytest.raises(ValueError):
+        service.charge_for_service(user_id, service_type)
+
+    assert user.first_name == "Pending"
+    db.commit()
+    db.close()
+
+    db = session_factory()
+    assert db.get(models.User, user_id).first_name == "Pending"
+    db.close()
+    assert balance_of(session_factory, user_id) == PRICE / 2
+
+
+def test_retry_after_concurrent_top_up(session_factory, account):
+    user_id, service_type = account
+    db = session_factory()
+    service = BalanceService(db)
+    service.charge_for_service(user_id, service_type)
+
+    real_execute = db.execute
+    charge_attempts = []
+
+    def execute_with_top_up(statement, *args, **kwargs):
+        result = real_execute(statement, *args, **kwargs)
+        if statement is balance_module._CHARGE_SQL:
+            charge_attempts.append(1)
+            if len(charge_attempts) == 1:
+                # Пополнение в другой сессии между неудачным UPDATE и чтением баланса
+                other = session_factory()
+                BalanceService(other).top_up_balance(user_id, float(PRICE))
+                other.close()
+        return result
+
+    db.execute = execute_with_top_up
+    transaction = service.charge_for_service(user_id, service_type)
+
+    assert len(charge_attempts) == 2
+    assert transaction.balance_after == PRICE / 2
+    db.close()
@@ -0,0 +1,117 @@
+"""
+Benchmark: sync psycopg2 session inside async endpoints vs AsyncSession (asyncpg)
+
+Runs the same query through two in-process FastAPI endpoints and measures
+throughput, latency and event-loop lag (a trivial /ping endpoint hit in
+parallel). Needs a reachable Postgres configured via the usual DB_* env vars
+(set DB_PGBOUNCER=true to go through PgBouncer).
+
+    cd backend && SECRET_KEY=x SITE_SECRET=y \\
+        python ../tests/backend/performance/benchmark_async_db.py --concurrency 50 --duration 10
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../..', 'backend'))
+
+import httpx  # noqa: E402
+from fastapi import Depends, FastAPI  # noqa: E402
+from sqlalchemy import text  # noqa: E402
+from sqlalchemy.ext.asyncio import AsyncSession  # noqa: E402
+from sqlalchemy.orm import Session  # noqa: E402
+
+from database.connection import get_db  # noqa: E402
+from database.async_connection import dispose_async_engine, get_async_db  # noqa: E402
+
+# pg_sleep имитирует сетевую задержку и время выполнения типичного запроса
+QUERY = text("SELECT pg_sleep(:delay), 1")
+
+
+def build_app(delay):
+    app = FastAPI()
+
+    @app.get("/sync")
+    async def sync_route(db: Session = Depends(get_db)):
+        # Как было: блокирующий вызов прямо в event loop
+        return {"value": db.execute(QUERY, {"delay": delay}).scalar()}
+
+    @app.get("/async")
+    async def async_route(db: AsyncSession = Depends(get_async_db)):
+        return {"value": (await db.execute(QUERY, {"delay": delay})).scalar()}
+
+    @app.get("/ping")
+    async def ping():
+        return {"ok": True}
+
+    return app
+
+
+async def run(client, path, concurrency, duration):
+    latencies, ping_latencies, errors = [], [], 0
+    deadline = time.perf_counter() + duration
+
+    async def worker():
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            response = await client.get(path)
+            if response.status_code != 200:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    async def pinger():
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            await client.get("/ping")
+            ping_latencies.append(time.perf_counter() - started)
+            await asyncio.sleep(0.05)
+
+    started = time.perf_counter()
+    await asyncio.gather(pinger(), *(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    def pct(values, q):
+        return sorted(values)[int(len(values) * q) - 1] * 1000 if values else 0.0
+
+    return {
+        "path": path,
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": len(latencies) / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000 if latencies else 0.0,
+        "p95_ms": pct(latencies, 0.95),
+        "loop_lag_p95_ms": pct(ping_latencies, 0.95),
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--delay", type=float, default=0.005, help="pg_sleep per query, seconds")
+    args = parser.parse_args()
+
+    transport = httpx.ASGITransport(app=build_app(args.delay))
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        # Прогрев пулов
+        await client.get("/sync")
+        await client.get("/async")
+
+        results = [await run(client, path, args.concurrency, args.duration) for path in ("/sync", "/async")]
+
+    await dispose_async_engine()
+
+    print(f"{'endpoint':<8} {'req':>7} {'err':>5} {'rps':>9} {'p50 ms':>8} {'p95 ms':>8} {'loop lag p95':>13}")
+    for r in results:
+        print(f"{r['path']:<8} {r['requests']:>7} {r['errors']:>5} {r['rps']:>9.1f} "
+              f"{r['p50_ms']:>8.1f} {r['p95_ms']:>8.1f} {r['loop_lag_p95_ms']:>13.1f}")
+    if results[0]["rps"]:
+        print(f"\nasync/sync throughput: x{results[1]['rps'] / results[0]['rps']:.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,89 @@
+"""
+Unit tests for per-assistant daily statistics rollups
+"""
+import os
+import sys
+from datetime import datetime, timedelta
+
+os.environ.setdefault('SECRET_KEY', 'test-secret-key')
+os.environ.setdefault('SITE_SECRET', 'test-site-secret')
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../..', 'backend'))
+
+from sqlalchemy import create_engine, event  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+from database import crud  # noqa: E402
+from database.models import (  # noqa: E402
+    AITokenPool, AITokenUsage, Assistant, AssistantDailyStat, BotInstance, Dialog, DialogMessage, Document,
+    KnowledgeEmbedding, MessageQuotaCounter, QAKnowledge, ResponseLatencySketch, User, UserKnowledge
+)
+from services import assistant_stats, message_quota  # noqa: E402
+
+
+def test_rollups_follow_inserts_and_rebuild_matches_history():
+    message_quota._dialog_info.clear()
+    engine = create_engine("sqlite://")
+    for model in (User, Assistant, Dialog, DialogMessage, MessageQuotaCounter, AssistantDailyStat,
+                  ResponseLatencySketch):
+        model.__table__.create(engine)
+    db = sessionmaker(bind=engine)()
+
+    now = datetime.utcnow()
+    old = now - timedelta(days=20)
+    db.add(User(id=1, email="a@example.com", hashed_password="x"))
+    db.add_all([Assistant(id=7, user_id=1), Assistant(id=8, user_id=1)])
+    db.add_all([Dialog(id=1, user_id=1, assistant_id=7, started_at=now),
+                Dialog(id=2, user_id=1, assistant_id=7, started_at=old),
+                Dialog(id=3, user_id=1, assistant_id=8, started_at=now)])
+    db.flush()
+    db.add_all([DialogMessage(dialog_id=1, sender="assistant", text="a", timestamp=now),
+                DialogMessage(dialog_id=1, sender="user", text="b", timestamp=now),
+                DialogMessage(dialog_id=2, sender="assistant", text="c", timestamp=old),
+                DialogMessage(dialog_id=3, sender="assistant", text="d", timestamp=now)])
+    db.commit()
+
+    week, month = assistant_stats.days_back(7, now), assistant_stats.days_back(30, now)
+    totals = assistant_stats.get_assistant_totals(db, 1, 7, month_since=month, week_since=week)
+    assert totals == {"total_messages": 2, "total_dialogs": 2, "monthly_messages": 2,
+                      "monthly_dialogs": 2, "weekly_messages": 1, "weekly_dialogs": 1}
+    assert assistant_stats.get_totals_by_assistant(db, 1, week) == {
+        7: {"messages": 1, "dialogs": 1}, 8: {"messages": 1, "dialogs": 1}}
+
+    incremental = sorted((r.assistant_id, r.day, r.messages, r.dialogs) for r in db.query(AssistantDailyStat))
+    db.query(AssistantDailyStat).delete()
+    db.commit()
+    assert assistant_stats.rebuild_assistant_stats(db) == 3
+    assert sorted((r.assistant_id, r.day, r.messages, r.dialogs) for r in db.query(AssistantDailyStat)) == incremental
+
+
+def test_message_after_assistant_deletion_is_kept():
+    message_quota._dialog_info.clear()
+    engine = create_engine("sqlite://")
+    event.listen(engine, "connect", lambda connection, _: connection.execute("PRAGMA foreign_keys=ON"))
+    for model in (User, Assistant, AITokenPool, AITokenUsage, Document, QAKnowledge, KnowledgeEmbedding,
+                  UserKnowledge, BotInstance, Dialog, DialogMessage, MessageQuotaCounter, AssistantDailyStat,
+                  ResponseLatencySketch):
+        model.__table__.create(engine)
+    db = sessionmaker(bind=engine)()
+
+    db.add(User(id=1, email="a@example.com", hashed_password="x"))
+    db.add(Assistant(id=7, user_id=1))
+    db.add_all([Dialog(id=1, user_id=1, assistant_id=7), Dialog(id=2, user_id=1, assistant_id=7)])
+    db.flush()
+    db.add_all([DialogMessage(dialog_id=1, sender="assistant", text="a"),
+                DialogMessage(dialog_id=2, sender="assistant", text="b")])
+    db.commit()
+    db.expunge_all()  # Дальше assistant_id диалога берется из кэша процесса
+
+    crud.delete_assistant(db, 7)
+    db.add(DialogMessage(dialog_id=1, sender="assistant", text="after delete"))
+    db.commit()
+
+    # Другой процесс еще помнит удаленного ассистента в своем кэше
+    message_quota._dialog_info[2] = (1, 7, None)
+    db.add(DialogMessage(dialog_id=2, sender="assistant", text="stale cache"))
+    db.commit()
+
+    assert db.query(DialogMessage).count() == 4
+    assert db.query(AssistantDailyStat).count() == 0
+    assert message_quota.get_total_count(db, 1) == 4
@@ -0,0 +1,125 @@
+"""
+Unit tests for the bot control channel (per-bot sequences, ack, retry, state)
+"""
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault('SECRET_KEY', 'test-secret-key')
+os.environ.setdefault('SITE_SECRET', 'test-site-secret')
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../..', 'backend'))
+
+from services import bot_control  # noqa: E402
+from services.bot_control import (  # noqa: E402
+    CLEAR_CACHE, RELOAD, STOP, BotControlChannel, BotControlConsumer, _MemoryControlStore
+)
+
+
+class FakeBotManager:
+    """In-process stand-in for scalable_bot_manager.js: records applied commands, can fail on demand"""
+
+    def __init__(self, failures=0):
+        self.applied = []
+        self.failures = failures
+
+    def handle(self, command):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("bot manager is down")
+        self.applied.append((command.bot_id, command.seq, command.command))
+
+    def handlers(self):
+        return {name: self.handle for name in (RELOAD, CLEAR_CACHE, STOP)}
+
+
+@pytest.fixture
+def channel(monkeypatch):
+    monkeypatch.setattr(bot_control, 'RETRY_AFTER_MS', 0)
+    return BotControlChannel(store=_MemoryControlStore())
+
+
+def test_sequences_are_per_bot_and_state_tracks_application(channel):
+    assert channel.publish([1, 2], CLEAR_CACHE) == {1: 1, 2: 1}
+    assert channel.publish([1], RELOAD, {'assistant_id': 7}) == {1: 2}
+
+    state = channel.state(1)
+    assert state['issued_seq'] == 2 and state['applied_seq'] == 0 and not state['in_sync']
+    assert [entry['seq'] for entry in state['pending']] == [1, 2]
+    assert state['pending'][1]['payload'] == {'assistant_id': 7}
+
+    manager = FakeBotManager()
+    assert BotControlConsumer(channel, manager.handlers(), name='test').process_once() == 3
+    assert manager.applied == [(1, 1, CLEAR_CACHE), (2, 1, CLEAR_CACHE), (1, 2, RELOAD)]
+
+    state = channel.state(1)
+    assert state['applied_seq'] == 2 and state['applied_command'] == RELOAD
+    assert state['in_sync'] and state['pending'] == []
+
+    with pytest.raises(ValueError):
+        channel.publish([1], 'reboot')
+
+
+def test_failed_command_is_retried_until_applied(channel):
+    channel.publish([5], RELOAD)
+    manager = FakeBotManager(failures=2)
+    consumer = BotControlConsumer(channel, manager.handlers(), name='test')
+
+    assert consumer.process_once() == 0
+    state = channel.state(5)
+    assert state['pending'][0]['attempts'] == 1 and 'down' in state['last_error']
+
+    assert consumer.process_once() == 0
+    assert consumer.process_once() == 1
+    assert manager.applied == [(5, 1, RELOAD)]
+    assert channel.state(5)['in_sync'] and channel.state(5)['failed_seq'] is None
+
+
+def test_redelivered_stale_command_is_skipped(channel):
+    store = channel.store
+    channel.publish([3], RELOAD)
+    old = store.claim('test', 10, 0)[0]  # Delivered, then the consumer crashed before ack
+    channel.publish([3], STOP)
+
+    manager = FakeBotManager()
+    consumer = BotControlConsumer(channel, manager.handlers(), name='test')
+    # Process the newer command first, then let the stale one be redelivered
+    store._delivered.pop(old.message_id)
+    assert consumer.process_once() == 1
+    store._queue.append(old)
+    assert consumer.process_once() == 0
+
+    assert manager.applied == [(3, 2, STOP)]
+    assert channel.state(3)['in_sync']
+
+
+def test_clear_cache_does_not_supersede_failed_reload(channel):
+    channel.publish([4], RELOAD)
+    channel.publish([4], CLEAR_CACHE)
+    reload_manager, cache_manager = FakeBotManager(failures=1), FakeBotManager()
+    handlers = {RELOAD: reload_manager.handle, CLEAR_CACHE: cache_manager.handle}
+    consumer = BotControlConsumer(channel, handlers, name='test')
+
+    # reload (seq 1) падает, clear_cache (seq 2) применяется
+    assert consumer.process_once() == 1
+    assert channel.state(4)['applied_seq'] == 2
+
+    # Повтор reload выполняется, а не подтверждается как вытесненный
+    assert consumer.process_once() == 1
+    assert reload_manager.applied == [(4, 1, RELOAD)]
+    assert cache_manager.applied == [(4, 2, CLEAR_CACHE)]
+    assert channel.state(4)['in_sync']
+
+
+def test_command_is_dropped_after_max_attempts(channel, monkeypatch):
+    monkeypatch.setattr(bot_control, 'MAX_ATTEMPTS', 2)
+    channel.publish([9], RELOAD)
+    consumer = BotControlConsumer(channel, FakeBotManager(failures=10).handlers(), name='test')
+
+    consumer.process_once()
+    consumer.process_once()
+    assert consumer.process_once() == 0
+
+    state = channel.state(9)
+    assert state['failed_seq'] == 1 and state['applied_seq'] == 0
+    assert state['pending'] == [] and state['last_error']
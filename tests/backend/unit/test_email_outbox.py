@@ -0,0 +1,206 @@
+"""
+Unit tests for the email outbox sender
+"""
+import os
+import smtplib
+import sys
+import time
+
+os.environ.setdefault('SECRET_KEY', 'test-secret-key')
+os.environ.setdefault('SITE_SECRET', 'test-site-secret')
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../..', 'backend'))
+
+import pytest  # noqa: E402
+
+from integrations import email_outbox as outbox_module  # noqa: E402
+from integrations.email_service import email_service  # noqa: E402
+
+
+class FakeSMTP:
+    def __init__(self, fail_for=()):
+        self.sent = []
+        self.fail_for = set(fail_for)
+
+    def send_message(self, message):
+        if message['To'] in self.fail_for:
+            raise smtplib.SMTPDataError(451, b"try later")
+        self.sent.append(message['To'])
+
+    def quit(self):
+        pass
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis, self.calls = redis, []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.calls.append((name, args, kwargs))
+
+    def execute(self):
+        return [getattr(self.redis, name)(*args, **kwargs) for name, args, kwargs in self.calls]
+
+
+class FakeRedis:
+    """Lists and sorted sets — то, что использует EmailOutbox"""
+
+    def __init__(self):
+        self.lists, self.zsets = {}, {}
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def rpush(self, key, *values):
+        self.lists.setdefault(key, []).extend(values)
+
+    def lpush(self, key, *values):
+        for value in values:
+            self.lists.setdefault(key, []).insert(0, value)
+
+    def lmove(self, source, destination, src="LEFT", dest="RIGHT"):
+        items = self.lists.get(source)
+        if not items:
+            return None
+        item = items.pop(0)
+        self.lists.setdefault(destination, []).append(item)
+        return item
+
+    def blmove(self, source, destination, timeout, src="LEFT", dest="RIGHT"):
+        return self.lmove(source, destination, src, dest)
+
+    def lrem(self, key, count, value):
+        items = self.lists.get(key, [])
+        if value in items:
+            items.remove(value)
+            return 1
+        return 0
+
+    def lrange(self, key, start, end):
+        return list(self.lists.get(key, []))
+
+    def llen(self, key):
+        return len(self.lists.get(key, []))
+
+    def zadd(self, key, mapping, nx=False):
+        zset = self.zsets.setdefault(key, {})
+        for member, score in mapping.items():
+            if not (nx and member in zset):
+                zset[member] = score
+
+    def zscore(self, key, member):
+        return self.zsets.get(key, {}).get(member)
+
+    def zrem(self, key, member):
+        return int(self.zsets.get(key, {}).pop(member, None) is not None)
+
+    def zrangebyscore(self, key, low, high, start=0, num=None):
+        return [m for m, score in self.zsets.get(key, {}).items() if score <= high]
+
+    def zcard(self, key):
+        return len(self.zsets.get(key, {}))
+
+
+@pytest.fixture
+def outbox(monkeypatch):
+    box = outbox_module.EmailOutbox()
+    box._redis, box._redis_resolved = None, True
+    box._min_interval = 0
+    monkeypatch.setattr(box, "start", lambda: None)
+    return box
+
+
+def test_batch_reuses_one_connection(outbox, monkeypatch):
+    connections = []
+
+    def open_smtp():
+        server = FakeSMTP()
+        connections.append(server)
+        return server
+
+    monkeypatch.setattr(email_service, "open_smtp", open_smtp)
+    for i in range(3):
+        outbox.enqueue(f"user{i}@example.com", "balance_depleted_email", base_url="https://example.com")
+
+    outbox._send_batch(outbox._take_batch())
+
+    assert len(connections) == 1
+    assert connections[0].sent == ["user0@example.com", "user1@example.com", "user2@example.com"]
+
+
+def test_failed_send_is_scheduled_for_retry(outbox, monkeypatch):
+    monkeypatch.setattr(email_service, "open_smtp", lambda: FakeSMTP(fail_for={"bad@example.com"}))
+    retries = []
+    monkeypatch.setattr(outbox, "_schedule_retry", lambda job, ready_at: retries.append(job))
+
+    outbox.enqueue("bad@example.com", "low_balance_warning_email", remaining_messages=50)
+    outbox._send_batch(outbox._take_batch())
+
+    assert len(retries) == 1
+    assert retries[0]["attempts"] == 1
+
+
+def test_unknown_template_is_rejected(outbox):
+    with pytest.raises(ValueError):
+        outbox.enqueue("user@example.com", "no_such_template")
+
+
+@pytest.fixture
+def redis_outbox(monkeypatch):
+    redis = FakeRedis()
+    box = outbox_module.EmailOutbox(redis_client=redis)
+    box._min_interval = 0
+    monkeypatch.setattr(box, "start", lambda: None)
+    return box, redis
+
+
+def test_redis_job_stays_in_processing_until_sent(redis_outbox, monkeypatch):
+    box, redis = redis_outbox
+    server = FakeSMTP()
+    monkeypatch.setattr(email_service, "open_smtp", lambda: server)
+    box.enqueue("user@example.com", "balance_depleted_email", base_url="https://example.com")
+
+    batch = box._take_batch()
+    assert redis.llen(outbox_module.OUTBOX_KEY) == 0
+    assert redis.llen(outbox_module.PROCESSING_KEY) == 1
+    assert redis.zcard(outbox_module.LEASES_KEY) == 1
+
+    box._send_batch(batch)
+    assert server.sent == ["user@example.com"]
+    assert redis.llen(outbox_module.PROCESSING_KEY) == 0
+    assert redis.zcard(outbox_module.LEASES_KEY) == 0
+
+
+def test_jobs_of_crashed_worker_are_reaped_and_sent(redis_outbox, monkeypatch):
+    box, redis = redis_outbox
+
+    class CrashingSMTP(FakeSMTP):
+        def send_message(self, message):
+            raise SystemExit("worker killed")
+
+    monkeypatch.setattr(email_service, "open_smtp", CrashingSMTP)
+    box.enqueue("user@example.com", "balance_depleted_email", base_url="https://example.com")
+    with pytest.raises(SystemExit):
+        box._send_batch(box._take_batch())
+    assert redis.llen(outbox_module.PROCESSING_KEY) == 1
+
+    # Другой воркер: свежую аренду не трогает, просроченную возвращает в очередь
+    worker = outbox_module.EmailOutbox(redis_client=redis)
+    worker._min_interval = 0
+    assert worker._reap_stale_processing() == 0
+    raw = redis.lists[outbox_module.PROCESSING_KEY][0]
+    redis.zsets[outbox_module.LEASES_KEY][raw] = time.time() - outbox_module.PROCESSING_TIMEOUT_SECONDS - 1
+    assert worker._reap_stale_processing() == 1
+    assert redis.llen(outbox_module.PROCESSING_KEY) == 0
+
+    server = FakeSMTP()
+    monkeypatch.setattr(email_service, "open_smtp", lambda: server)
+    worker._send_batch(worker._take_batch())
+    assert server.sent == ["user@example.com"]
+
+
+def test_processing_entry_without_lease_gets_one(redis_outbox):
+    box, redis = redis_outbox
+    redis.rpush(outbox_module.PROCESSING_KEY, '{"id": "orphan"}')
+
+    assert box._reap_stale_processing() == 0
+    assert redis.zscore(outbox_module.LEASES_KEY, '{"id": "orphan"}') is not None
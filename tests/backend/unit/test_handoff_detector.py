@@ -0,0 +1,87 @@
+"""
+Unit tests for the compiled ImprovedHandoffDetector
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../..', 'backend'))
+
+from services.improved_handoff_detector import HandoffPattern, ImprovedHandoffDetector  # noqa: E402
+
+
+def test_detector_decisions():
+    detector = ImprovedHandoffDetector()
+
+    assert detector.should_request_handoff("нужен оператор")[0] is True
+    assert detector.should_request_handoff("need human operator")[0] is True
+    assert detector.should_request_handoff("что такое логический оператор")[1] == "excluded_pattern"
+    assert detector.should_request_handoff("Сколько стоит доставка?")[0] is False
+
+
+def test_ai_fallback_adds_weight():
+    detector = ImprovedHandoffDetector()
+
+    should_handoff, reason, details = detector.should_request_handoff(
+        "сколько стоит доставка", ai_text="Не могу ответить на этот вопрос"
+    )
+
+    assert should_handoff is True
+    assert reason == "fallback"
+    assert details["ai_fallback"] is True
+
+
+def test_apply_settings_extends_defaults_and_skips_invalid_patterns():
+    detector = ImprovedHandoffDetector()
+    default_count = len(detector.handoff_patterns)
+
+    detector.apply_settings(
+        handoff_patterns=[
+            HandoffPattern(r'позвоните мне', "callback", 1.0, "Просьба перезвонить"),
+            HandoffPattern(r'(незакрытая', "broken", 1.0, "Некорректный паттерн"),
+        ],
+        exclusion_patterns=[r'позвоните мне завтра'],
+        threshold=0.9,
+    )
+
+    assert len(detector.handoff_patterns) == default_count + 2
+    assert detector.should_request_handoff("позвоните мне пожалуйста")[0] is True
+    assert detector.should_request_handoff("позвоните мне завтра")[1] == "excluded_pattern"
+    assert detector.should_request_handoff("позвоните мне")[2]["threshold"] == 0.9
+
+    detector.apply_settings()
+    assert len(detector.handoff_patterns) == default_count
+    assert detector.should_request_handoff("позвоните мне")[0] is False
+
+
+def test_uncombinable_patterns_fall_back_to_individual_checks():
+    detector = ImprovedHandoffDetector()
+
+    # По отдельности валидны, в одной альтернации — повтор имени группы
+    detector.apply_settings(handoff_patterns=[
+        HandoffPattern(r'(?P<who>менеджер) срочно', "urgent", 1.0, "Срочно менеджер"),
+        HandoffPattern(r'(?P<who>директор) срочно', "urgent", 1.0, "Срочно директор"),
+    ])
+
+    assert detector._compiled.handoff_gate is None
+    assert detector.should_request_handoff("директор срочно")[0] is True
+    assert detector.should_request_handoff("Сколько стоит доставка?")[0] is False
+
+
+def test_failed_apply_settings_keeps_previous_state(monkeypatch):
+    from services import improved_handoff_detector
+
+    detector = ImprovedHandoffDetector()
+    before = (detector._compiled, list(detector.handoff_patterns), detector.threshold)
+
+    def broken(*args, **kwargs):
+        raise RuntimeError("compile failed")
+
+    monkeypatch.setattr(improved_handoff_detector, '_compile_patterns', broken)
+    with pytest.raises(RuntimeError):
+        detector.apply_settings(
+            handoff_patterns=[HandoffPattern(r'позвоните мне', "callback", 1.0, "Перезвонить")], threshold=0.9
+        )
+
+    assert (detector._compiled, detector.handoff_patterns, detector.threshold) == before
@@ -0,0 +1,179 @@
+"""
+Unit tests for the Redis-backed handoff queue: enqueue/takeover/release ordering and queue events
+"""
+import json
+import os
+import sys
+import time
+
+import anyio
+import pytest
+
+os.environ.setdefault('SECRET_KEY', 'test-secret-key')
+os.environ.setdefault('SITE_SECRET', 'test-site-secret')
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../..', 'backend'))
+
+from sqlalchemy import create_engine  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+from sqlalchemy.pool import StaticPool  # noqa: E402
+
+from database import models  # noqa: E402
+from services import handoff_service as handoff_module  # noqa: E402
+from services.handoff_queue import HandoffQueue  # noqa: E402
+from services.handoff_service import HandoffService  # noqa: E402
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis, self.calls = redis, []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.calls.append((name, args, kwargs))
+
+    def execute(self):
+        return [getattr(self.redis, name)(*args, **kwargs) for name, args, kwargs in self.calls]
+
+
+class FakeRedis:
+    """Sorted sets, hashes and publish — то, что использует HandoffQueue"""
+
+    def __init__(self):
+        self.zsets, self.hashes, self.strings, self.published = {}, {}, {}, []
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    def exists(self, key):
+        return int(key in self.zsets or key in self.hashes or key in self.strings)
+
+    def setex(self, key, ttl, value):
+        self.strings[key] = value
+
+    def delete(self, *keys):
+        for key in keys:
+            self.zsets.pop(key, None)
+            self.hashes.pop(key, None)
+            self.strings.pop(key, None)
+
+    def zadd(self, key, mapping):
+        self.zsets.setdefault(key, {}).update(mapping)
+
+    def zrem(self, key, member):
+        self.zsets.get(key, {}).pop(member, None)
+
+    def _ordered(self, key):
+        return sorted(self.zsets.get(key, {}).items(), key=lambda item: (item[1], item[0]))
+
+    def zrank(self, key, member):
+        members = [m for m, _ in self._ordered(key)]
+        return members.index(member) if member in members else None
+
+    def zscore(self, key, member):
+        return self.zsets.get(key, {}).get(member)
+
+    def zcard(self, key):
+        return len(self.zsets.get(key, {}))
+
+    def zrange(self, key, start, end, withscores=False):
+        entries = self._ordered(key)
+        return entries if withscores else [m for m, _ in entries]
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        self.hashes.setdefault(key, {}).update(mapping or {field: value})
+
+    def hgetall(self, key):
+        return dict(self.hashes.get(key, {}))
+
+    def publish(self, channel, payload):
+        self.published.append((channel, json.loads(payload)))
+        return 1
+
+
+@pytest.fixture
+def session_factory():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    for model in (models.User, models.Dialog, models.DialogMessage, models.HandoffAudit, models.OperatorPresence):
+        model.__table__.create(engine)
+    factory = sessionmaker(bind=engine)
+    db = factory()
+    db.add(models.User(id=1, email="owner@example.com", hashed_password="x"))
+    db.add(models.User(id=2, email="operator@example.com", hashed_password="x", first_name="Анна"))
+    for dialog_id in (10, 11, 12):
+        db.add(models.Dialog(id=dialog_id, user_id=1))
+    db.commit()
+    db.close()
+    return factory
+
+
+@pytest.fixture
+def service(session_factory, monkeypatch):
+    redis = FakeRedis()
+    monkeypatch.setattr(handoff_module.HandoffService, "_send_handoff_notifications", lambda *args: None)
+    db = session_factory()
+    service = HandoffService(db)
+    service.queue = HandoffQueue(db, redis_client=redis)
+    yield service
+    db.close()
+
+
+def queue_order(service):
+    return [item["dialog_id"] for item in service.queue.items()]
+
+
+def test_enqueue_takeover_release_keep_request_order(service):
+    for dialog_id in (10, 11, 12):
+        service.request_handoff(dialog_id, reason="keyword")
+        time.sleep(0.002)  # Разные handoff_requested_at
+
+    assert queue_order(service) == [10, 11, 12]
+    assert service.get_status(12).queue_position == 3
+
+    service.takeover_handoff(11, manager_id=2)
+    assert queue_order(service) == [10, 12]
+    assert service.get_status(12).queue_position == 2
+
+    service.release_handoff(11, manager_id=2)
+    assert queue_order(service) == [10, 12]
+
+    # Повторный запрос после release встает в конец очереди
+    service.request_handoff(11, reason="manual")
+    assert queue_order(service) == [10, 12, 11]
+    assert [item.dialog_id for item in service.get_queue()] == [10, 12, 11]
+
+    events = [event["type"] for channel, event in service.queue.redis.published if channel == "ws:handoff:queue"]
+    assert events == ["queue:added"] * 3 + ["queue:removed", "queue:added"]
+
+
+def test_queue_falls_back_to_database_without_redis(service):
+    for dialog_id in (12, 10):
+        service.request_handoff(dialog_id)
+        time.sleep(0.002)
+    service.queue.redis = None
+
+    assert queue_order(service) == [12, 10]
+    assert service.queue.size() == 2
+
+
+@pytest.mark.asyncio
+async def test_notifications_from_threadpool_reach_the_app_loop(service, monkeypatch):
+    from services import sse_manager
+
+    pushed = []
+
+    async def fake_push(dialog_id, event):
+        pushed.append((dialog_id, event["type"], event.get("manager", {}).get("name")))
+
+    async def fake_publish(dialog_id, event):
+        pushed.append((dialog_id, event["type"], None))
+
+    monkeypatch.setattr(sse_manager, "push_sse_event", fake_push)
+    monkeypatch.setattr(handoff_module, "publish_dialog_event", fake_publish)
+
+    # Эндпоинты handoff — sync def, FastAPI выполняет их в threadpool
+    await anyio.to_thread.run_sync(service.request_handoff, 10)
+    await anyio.to_thread.run_sync(service.takeover_handoff, 10, 2)
+    for _ in range(5):
+        await anyio.sleep(0)
+
+    assert (10, "handoff_requested", None) in pushed
+    assert (10, "handoff_started", "Анна") in pushed
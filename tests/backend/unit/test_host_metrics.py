@@ -0,0 +1,28 @@
+"""
+Unit tests for the background host metrics sampler
+"""
+import asyncio
+import os
+import sys
+
+os.environ.setdefault('SECRET_KEY', 'test-secret-key')
+os.environ.setdefault('SITE_SECRET', 'test-site-secret')
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../..', 'backend'))
+
+from monitoring.host_metrics import HostMetricsSampler  # noqa: E402
+
+
+def test_samples_are_kept_in_bounded_ring_buffer():
+    sampler = HostMetricsSampler(interval=0.01, history_size=3)
+    assert asyncio.run(sampler.get_latest())["cpu"]["cores"] >= 1
+
+    for _ in range(4):
+        sampler.sample_once()
+
+    latest = sampler.latest()
+    assert latest["total_processes"] >= len(latest["processes"])
+    assert "recv_per_second" in latest["network"] or latest["network"] == {}
+    history = sampler.history()
+    assert len(history) == 3 and history[-1]["timestamp"] == latest["timestamp"]
+    assert all("processes" not in sample for sample in history)
+    assert len(sampler.history(limit=2)) == 2
@@ -0,0 +1,107 @@
+"""
+Unit tests for the image pipeline: content-hash keys, derivatives at widget sizes, cross-user deduplication
+"""
+import io
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault('SECRET_KEY', 'test-secret-key')
+os.environ.setdefault('SITE_SECRET', 'test-site-secret')
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../..', 'backend'))
+
+from services import image_pipeline  # noqa: E402
+from services.image_pipeline import ImageValidationError, store_image  # noqa: E402
+
+Image = pytest.importorskip("PIL.Image")
+
+
+class MemoryS3:
+    def __init__(self):
+        self.objects = {}
+        self.uploads = []
+
+    def file_exists(self, object_key):
+        return object_key in self.objects
+
+    def upload_file(self, file_content, object_key, content_type=None, metadata=None, cache_control=None):
+        self.objects[object_key] = (file_content, content_type, cache_control)
+        self.uploads.append(object_key)
+        return {'success': True, 'object_key': object_key}
+
+
+def make_png(size=(300, 200), mode='RGBA'):
+    buffer = io.BytesIO()
+    Image.new(mode, size, (200, 30, 30, 128) if mode == 'RGBA' else (200, 30, 30)).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def test_avatar_derivatives_use_content_hash_keys_and_immutable_cache():
+    s3 = MemoryS3()
+    content = make_png()
+    stored = store_image(s3, content, 'avatar')
+
+    digest = image_pipeline.content_digest(content)
+    assert stored['digest'] == digest and not stored['deduplicated']
+    assert stored['url'] == f"/api/files/assets/{digest}/avatar-64.webp"
+    assert set(stored['variants']) == {'avatar-32.webp', 'avatar-64.webp', 'avatar-96.webp', 'avatar-64.png'}
+
+    for name in stored['variants']:
+        body, content_type, cache_control = s3.objects[image_pipeline.asset_key(digest, name)]
+        assert cache_control == image_pipeline.IMMUTABLE_CACHE_CONTROL
+        assert content_type == image_pipeline.asset_content_type(name)
+        derivative = Image.open(io.BytesIO(body))
+        size = int(name.split('.')[0].rsplit('-', 1)[1])
+        # Аватар — квадрат под кружок, прозрачность сохраняется
+        assert derivative.size == (size, size) and derivative.mode == 'RGBA'
+
+
+def test_identical_uploads_are_deduplicated_and_small_sources_not_upscaled():
+    s3 = MemoryS3()
+    content = make_png((40, 20), mode='RGB')
+    first = store_image(s3, content, 'widget-icon')
+    uploads = len(s3.uploads)
+    second = store_image(s3, content, 'widget-icon')
+
+    assert second['deduplicated'] and second['variants'] == first['variants']
+    assert len(s3.uploads) == uploads == 4
+
+    body, _, _ = s3.objects[image_pipeline.asset_key(first['digest'], 'widget-icon-112.webp')]
+    assert Image.open(io.BytesIO(body)).size == (40, 20)
+
+
+def test_same_bytes_as_avatar_and_icon_get_separate_derivatives():
+    s3 = MemoryS3()
+    content = make_png((200, 100), mode='RGB')
+    icon = store_image(s3, content, 'widget-icon')
+    avatar = store_image(s3, content, 'avatar')
+
+    assert not avatar['deduplicated'] and not set(avatar['variants']) & set(icon['variants'])
+    sizes = {name: Image.open(io.BytesIO(s3.objects[image_pipeline.asset_key(icon['digest'], name)][0])).size
+             for name in ('widget-icon-32.webp', 'avatar-32.webp')}
+    # Иконка сохраняет пропорции, аватар — квадратный кроп
+    assert sizes == {'widget-icon-32.webp': (32, 16), 'avatar-32.webp': (32, 32)}
+    assert image_pipeline.is_asset_name(icon['digest'], 'avatar-32.webp')
+    assert image_pipeline.is_asset_name(icon['digest'], '64.webp')  # Ключи первых загрузок
+    assert not image_pipeline.is_asset_name(icon['digest'], 'banner-32.webp')
+
+
+def test_invalid_uploads_are_rejected_before_storage():
+    s3 = MemoryS3()
+    with pytest.raises(ImageValidationError):
+        store_image(s3, b'not an image', 'avatar')
+    with pytest.raises(ImageValidationError):
+        store_image(s3, b'<svg xmlns="http://www.w3.org/2000/svg"><script>alert(1)</script></svg>',
+                    'widget-icon', allow_svg=True)
+
+    gif = io.BytesIO()
+    Image.new('RGB', (10, 10)).save(gif, 'GIF')
+    with pytest.raises(ImageValidationError):
+        store_image(s3, gif.getvalue(), 'avatar')
+    assert s3.uploads == []
+
+    svg = store_image(s3, b'<svg xmlns="http://www.w3.org/2000/svg"/>', 'widget-icon', allow_svg=True)
+    assert svg['filename'] == 'original.svg' and list(svg['variants']) == ['original.svg']
+    assert image_pipeline.is_asset_name(svg['digest'], 'original.svg')
+    assert not image_pipeline.is_asset_name(svg['digest'], '../secret.webp')
@@ -0,0 +1,54 @@
+"""
+Unit tests for KnowledgeControlService content-hash duplicates, compiled matcher and streaming scan
+"""
+import os
+import re
+import sys
+
+os.environ.setdefault('SECRET_KEY', 'test-secret-key')
+os.environ.setdefault('SITE_SECRET', 'test-site-secret')
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../..', 'backend'))
+
+from sqlalchemy import create_engine  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+from database.models import User, UserKnowledge  # noqa: E402
+from services.knowledge_control_service import ContentMatcher, KnowledgeControlService  # noqa: E402
+
+
+def test_matcher_agrees_with_per_pattern_checks():
+    patterns = KnowledgeControlService.FORBIDDEN_PATTERNS
+    keywords = KnowledgeControlService.SUSPICIOUS_KEYWORDS + ['компания', 'компания альфасфера']
+    matcher = ContentMatcher(patterns, keywords)
+    samples = [
+        "Обычный текст о доставке и оплате " * 2000,
+        'Наша КОМПАНИЯ АЛЬФАСФЕРА и ООО "альфасфера" — услуги АльфаСфера',
+        "alfasfera и AlfaSfera", "", "компания",
+    ]
+    for text in samples:
+        assert matcher.forbidden(text) == [p for p in patterns if re.search(p, text, re.IGNORECASE)]
+        assert matcher.suspicious(text) == [k for k in keywords if k.lower() in text.lower()]
+
+
+def test_duplicates_use_content_hash_and_scan_streams_in_batches():
+    engine = create_engine("sqlite://")
+    for model in (User, UserKnowledge):
+        model.__table__.create(engine)
+    db = sessionmaker(bind=engine)()
+    db.add(User(id=1, email="a@example.com", hashed_password="x"))
+    db.commit()
+
+    service = KnowledgeControlService(db)
+    first = service.add_knowledge_with_validation(1, 5, "Доставка по России 3-5 дней")
+    assert first['success'] and first['validation']['warnings'] == []
+    second = service.add_knowledge_with_validation(1, 5, "Доставка по России 3-5 дней")
+    assert second['validation']['warnings'][0]['existing_id'] == first['knowledge_id']
+    db.add(UserKnowledge(user_id=1, assistant_id=5, content="Мы — компания АльфаСфера"))
+    db.add_all(UserKnowledge(user_id=1, assistant_id=6, content=f"Факт {i}") for i in range(5))
+    db.commit()
+
+    progress = []
+    report = service.scan_existing_knowledge(batch_size=3, progress_callback=lambda *p: progress.append(p))
+    assert report['total_scanned'] == 8
+    assert sorted(v['knowledge_id'] for v in report['violations']) == [second['knowledge_id'], 3]
+    assert [scanned for scanned, _ in progress] == [3, 6, 8]
@@ -0,0 +1,89 @@
+"""
+Unit tests for incremental assistant message quota counters
+"""
+import os
+import sys
+from datetime import datetime
+
+os.environ.setdefault('SECRET_KEY', 'test-secret-key')
+os.environ.setdefault('SITE_SECRET', 'test-site-secret')
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../..', 'backend'))
+
+import pytest  # noqa: E402
+from sqlalchemy import create_engine  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+from database.models import (  # noqa: E402
+    Dialog, DialogMessage, GuestMessageCounter, MessageQuotaCounter, ResponseLatencySketch, User
+)
+from services import message_quota  # noqa: E402
+
+
+@pytest.fixture
+def db():
+    # Каждый тест — новая БД с теми же id диалогов: кэш процесса сбрасываем
+    message_quota._dialog_info.clear()
+    engine = create_engine("sqlite://")
+    for model in (User, Dialog, DialogMessage, MessageQuotaCounter, GuestMessageCounter, ResponseLatencySketch):
+        model.__table__.create(engine)
+    session = sessionmaker(bind=engine)()
+    session.add_all([User(id=1, email="a@example.com", hashed_password="x"),
+                     Dialog(id=1, user_id=1), Dialog(id=2, user_id=1)])
+    session.commit()
+    yield session
+    session.close()
+
+
+def add_messages(db, *messages):
+    db.add_all(DialogMessage(dialog_id=dialog_id, sender=sender, text="hi", timestamp=ts)
+               for dialog_id, sender, ts in messages)
+    db.commit()
+
+
+def test_assistant_messages_increment_monthly_and_total_counters(db):
+    now = datetime.utcnow()
+    add_messages(db, (1, "assistant", now), (2, "assistant", now), (1, "user", now),
+                 (1, "assistant", datetime(2020, 1, 15)))
+
+    assert message_quota.get_monthly_count(db, 1) == 2
+    assert message_quota.get_count(db, 1, "2020-01") == 1
+    assert message_quota.get_total_count(db, 1) == 3
+
+    # Откат транзакции откатывает и счетчик
+    db.add(DialogMessage(dialog_id=1, sender="assistant", text="lost"))
+    db.flush()
+    db.rollback()
+    assert message_quota.get_total_count(db, 1) == 3
+
+
+def test_rebuild_restores_counters_from_history(db):
+    now = datetime.utcnow()
+    add_messages(db, (1, "assistant", now), (2, "assistant", datetime(2020, 1, 15)))
+    db.query(MessageQuotaCounter).update({"count": 999})
+    db.add(MessageQuotaCounter(user_id=1, period="1999-12", count=5))
+    db.commit()
+
+    assert message_quota.rebuild_counters(db) == 1
+
+    counters = {c.period: c.count for c in db.query(MessageQuotaCounter).all()}
+    assert counters == {message_quota.period_for(now): 1, "2020-01": 1, message_quota.ALL_TIME: 2}
+
+
+def test_site_guests_have_own_monthly_counters(db):
+    db.get(Dialog, 1).guest_id = "guest-a"
+    db.get(Dialog, 2).guest_id = "guest-b"
+    db.add(Dialog(id=3, user_id=1, guest_id="guest-a"))
+    now = datetime.utcnow()
+    add_messages(db, (1, "assistant", now), (3, "assistant", now), (2, "assistant", now),
+                 (1, "user", now), (1, "assistant", datetime(2020, 1, 15)))
+
+    assert message_quota.get_guest_monthly_count(db, 1, "guest-a") == 2
+    assert message_quota.get_guest_monthly_count(db, 1, "guest-b") == 1
+    assert message_quota.get_guest_monthly_count(db, 1, "guest-a", datetime(2020, 1, 1)) == 1
+    assert message_quota.get_monthly_count(db, 1) == 3
+
+    db.query(GuestMessageCounter).delete()
+    db.commit()
+    message_quota.rebuild_counters(db)
+    assert message_quota.get_guest_monthly_count(db, 1, "guest-a") == 2
+    assert message_quota.get_guest_monthly_count(db, 1, "guest-a", datetime(2020, 1, 1)) == 1
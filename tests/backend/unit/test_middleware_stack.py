@@ -0,0 +1,82 @@
+"""
+Unit tests for the ASGI middleware stack
+"""
+import os
+import sys
+
+os.environ.setdefault('SECRET_KEY', 'test-secret-key')
+os.environ.setdefault('SITE_SECRET', 'test-site-secret')
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../..', 'backend'))
+
+import pytest  # noqa: E402
+from fastapi import FastAPI  # noqa: E402
+from fastapi.responses import StreamingResponse  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+from core import middleware_stack  # noqa: E402
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(middleware_stack, "SERVER_TIMING_ENABLED", True)
+    app = FastAPI()
+
+    @app.get("/api/items/{item_id}")
+    def get_item(item_id: int):
+        return {"id": item_id}
+
+    @app.get("/api/stream")
+    def stream():
+        return StreamingResponse(iter([b"data: 1\n\n", b"data: 2\n\n"]), media_type="text/event-stream")
+
+    @app.get("/api/boom")
+    def boom():
+        raise RuntimeError("boom")
+
+    middleware_stack.install_middleware_stack(
+        app,
+        cors_options=dict(main_app_origins=["https://replyx.ru"], widget_endpoints=["/api/widget-config"]),
+    )
+    return TestClient(app, raise_server_exceptions=False)
+
+
+def test_cors_and_security_headers(client):
+    response = client.get("/api/items/1", headers={"Origin": "https://replyx.ru"})
+
+    assert response.json() == {"id": 1}
+    assert response.headers["access-control-allow-origin"] == "https://replyx.ru"
+    assert response.headers["access-control-allow-credentials"] == "true"
+    assert response.headers["x-content-type-options"] == "nosniff"
+    assert "mw-cors" in response.headers["server-timing"]
+
+
+def test_preflight_rejected_for_unknown_origin(client):
+    response = client.options("/api/items/1", headers={
+        "Origin": "https://evil.example", "Access-Control-Request-Method": "GET"
+    })
+
+    assert response.status_code == 403
+
+
+def test_widget_preflight_allowed_without_credentials(client):
+    response = client.options("/api/widget-config", headers={
+        "Origin": "https://customer.example", "Access-Control-Request-Method": "POST"
+    })
+
+    assert response.status_code == 200
+    assert response.headers["access-control-allow-origin"] == "https://customer.example"
+    assert "access-control-allow-credentials" not in response.headers
+
+
+def test_streaming_response_passes_through(client):
+    response = client.get("/api/stream")
+
+    assert response.text == "data: 1\n\ndata: 2\n\n"
+    assert response.headers["x-frame-options"] == "SAMEORIGIN"
+
+
+def test_unhandled_error_returns_json_500(client):
+    response = client.get("/api/boom")
+
+    assert response.status_code == 500
+    assert response.json() == {"error": "Internal server error: boom"}
@@ -0,0 +1,197 @@
+"""
+Unit tests for Redis-backed operator presence: heartbeats, capacity index, takeover limits, expiry listener
+"""
+import asyncio
+import os
+import sys
+import time
+
+import pytest
+
+os.environ.setdefault('SECRET_KEY', 'test-secret-key')
+os.environ.setdefault('SITE_SECRET', 'test-site-secret')
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../..', 'backend'))
+
+from sqlalchemy import create_engine  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+from sqlalchemy.pool import StaticPool  # noqa: E402
+
+from database import models  # noqa: E402
+from services import operator_presence  # noqa: E402
+from services.handoff_service import HandoffService  # noqa: E402
+from services.operator_presence import (  # noqa: E402
+    OperatorPresenceService,
+    OperatorPresenceStore,
+    merge_keyspace_flags,
+)
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis, self.calls = redis, []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.calls.append((name, args, kwargs))
+
+    def execute(self):
+        return [getattr(self.redis, name)(*args, **kwargs) for name, args, kwargs in self.calls]
+
+
+def _score_bound(value):
+    if value in ("-inf", "+inf"):
+        return float(value), False
+    text = str(value)
+    return (float(text[1:]), True) if text.startswith("(") else (float(text), False)
+
+
+class FakeRedis:
+    """Hashes, strings, sets and sorted sets — то, что использует OperatorPresenceStore"""
+
+    def __init__(self):
+        self.hashes, self.strings, self.sets, self.zsets = {}, {}, {}, {}
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    def exists(self, key):
+        return int(key in self.hashes or key in self.strings)
+
+    def set(self, key, value, ex=None):
+        self.strings[key] = value
+
+    def delete(self, *keys):
+        for key in keys:
+            self.hashes.pop(key, None)
+            self.strings.pop(key, None)
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        self.hashes.setdefault(key, {}).update({k: str(v) for k, v in (mapping or {field: value}).items()})
+
+    def hget(self, key, field):
+        return self.hashes.get(key, {}).get(field)
+
+    def hgetall(self, key):
+        return dict(self.hashes.get(key, {}))
+
+    def sadd(self, key, *members):
+        self.sets.setdefault(key, set()).update(str(m) for m in members)
+
+    def spop(self, key, count):
+        members = self.sets.get(key, set())
+        popped = [members.pop() for _ in range(min(count, len(members)))]
+        return popped
+
+    def zadd(self, key, mapping):
+        self.zsets.setdefault(key, {}).update({str(k): v for k, v in mapping.items()})
+
+    def zrem(self, key, member):
+        self.zsets.get(key, {}).pop(str(member), None)
+
+    def _range(self, key, low, high):
+        (lo, lo_open), (hi, hi_open) = _score_bound(low), _score_bound(high)
+        return [
+            (member, score) for member, score in self.zsets.get(key, {}).items()
+            if (score > lo if lo_open else score >= lo) and (score < hi if hi_open else score <= hi)
+        ]
+
+    def zrangebyscore(self, key, low, high):
+        return [m for m, _ in sorted(self._range(key, low, high), key=lambda item: item[1])]
+
+    def zrevrangebyscore(self, key, high, low):
+        return [m for m, _ in sorted(self._range(key, low, high), key=lambda item: -item[1])]
+
+
+@pytest.fixture
+def db():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    for model in (models.User, models.Dialog, models.DialogMessage, models.HandoffAudit, models.OperatorPresence):
+        model.__table__.create(engine)
+    session = sessionmaker(bind=engine)()
+    session.add(models.User(id=1, email="owner@example.com", hashed_password="x"))
+    for user_id in (2, 3):
+        session.add(models.User(id=user_id, email=f"op{user_id}@example.com", hashed_password="x"))
+    session.commit()
+    yield session
+    session.close()
+
+
+@pytest.fixture
+def store():
+    return OperatorPresenceStore(redis_client=FakeRedis())
+
+
+def test_heartbeats_stay_in_redis_and_feed_capacity_index(db, store):
+    service = OperatorPresenceService(db, store)
+    service.update_heartbeat(2, max_active_chats_web=1)
+    service.update_heartbeat(3, max_active_chats_web=4)
+
+    assert db.query(models.OperatorPresence).count() == 0
+    assert [user.id for user in service.get_available_operators()] == [3, 2]
+
+    service.sync_live_active_chats(2, 1)
+    assert [user.id for user in service.get_available_operators()] == [3]
+
+    service.set_status(3, "away")
+    assert service.get_available_operators() == []
+    assert sorted(int(m) for m in store.redis.sets[operator_presence.DIRTY_KEY]) == [2, 3]
+
+
+def test_stale_sweep_marks_operators_offline(db, store):
+    service = OperatorPresenceService(db, store)
+    service.update_heartbeat(2)
+    store.redis.zadd(operator_presence.HEARTBEATS_KEY, {2: time.time() - operator_presence.HEARTBEAT_TIMEOUT_SECONDS - 1})
+
+    assert service.auto_offline_stale_operators() == 1
+    assert service.get_live_state(2)["status"] == "offline"
+    assert service.get_available_operators() == []
+
+
+def test_takeover_checks_capacity_from_live_heartbeat(db, store, monkeypatch):
+    # Снимок в таблице устарел: offline и лимит 3; последний heartbeat — online с лимитом 1
+    db.add(models.OperatorPresence(user_id=2, status="offline", max_active_chats_web=3, active_chats=0))
+    for dialog_id in (10, 11):
+        db.add(models.Dialog(id=dialog_id, user_id=1, handoff_status="requested"))
+    db.commit()
+    OperatorPresenceService(db, store).update_heartbeat(2, max_active_chats_web=1)
+
+    monkeypatch.setattr(HandoffService, "_send_handoff_notifications", lambda *args: None)
+    monkeypatch.setattr(HandoffService, "_publish_queue_event", lambda *args: None)
+    handoff = HandoffService(db)
+    handoff.presence = OperatorPresenceService(db, store)
+
+    handoff.takeover_handoff(10, manager_id=2)
+    with pytest.raises(HandoffService.Conflict):
+        handoff.takeover_handoff(11, manager_id=2)
+
+    assert store.get(2)["active_chats"] == 1
+    assert db.get(models.Dialog, 11).handoff_status == "requested"
+
+
+def test_keyspace_flags_are_merged_not_overwritten():
+    assert merge_keyspace_flags("") == "Ex"
+    assert merge_keyspace_flags("Kl") == "KlEx"
+    assert merge_keyspace_flags("KEA") == "KEA"
+    assert merge_keyspace_flags("Egx") == "Egx"
+
+
+@pytest.mark.asyncio
+async def test_expiry_listener_is_restarted_after_failure(store, monkeypatch):
+    calls = []
+    restarted = asyncio.Event()
+
+    async def flaky_listener(_store):
+        calls.append(1)
+        if len(calls) == 1:
+            raise ConnectionError("redis went away")
+        restarted.set()
+        await asyncio.Event().wait()
+
+    monkeypatch.setattr(operator_presence, "_listen_heartbeat_expiry", flaky_listener)
+    monkeypatch.setattr(operator_presence, "LISTENER_RETRY_SECONDS", 0)
+
+    task = asyncio.create_task(operator_presence._supervise_expiry_listener(store))
+    await asyncio.wait_for(restarted.wait(), timeout=1)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert len(calls) == 2
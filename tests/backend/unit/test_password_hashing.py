@@ -0,0 +1,53 @@
+"""
+Unit tests for the bounded password hashing pool
+"""
+import os
+import sys
+import threading
+
+os.environ.setdefault('SECRET_KEY', 'test-secret-key')
+os.environ.setdefault('SITE_SECRET', 'test-site-secret')
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../..', 'backend'))
+
+import pytest  # noqa: E402
+from passlib.context import CryptContext  # noqa: E402
+
+from core.password_hashing import PasswordHasher, PasswordHasherBusy  # noqa: E402
+
+
+def make_context(rounds):
+    return CryptContext(schemes=["sha256_crypt"], sha256_crypt__rounds=rounds, sha256_crypt__min_rounds=rounds)
+
+
+def test_weak_hash_is_upgraded_on_verify():
+    old_hash = PasswordHasher(make_context(1000)).hash("secret123")
+    hasher = PasswordHasher(make_context(5000))
+
+    valid, new_hash = hasher.verify_and_update("secret123", old_hash)
+
+    assert valid
+    assert new_hash and hasher.verify("secret123", new_hash)
+    assert hasher.verify_and_update("secret123", new_hash) == (True, None)
+
+
+def test_full_queue_rejects_immediately():
+    hasher = PasswordHasher(make_context(1000), workers=1, max_queue=0)
+    release = threading.Event()
+    started = threading.Event()
+
+    def slow_hash(password):
+        started.set()
+        release.wait(5)
+        return "hash"
+
+    worker = threading.Thread(target=hasher._run, args=("hash", slow_hash, "x"))
+    worker.start()
+    started.wait(5)
+    try:
+        with pytest.raises(PasswordHasherBusy):
+            hasher.hash("secret123")
+    finally:
+        release.set()
+        worker.join()
+
+    assert hasher.hash("secret123")
@@ -0,0 +1,99 @@
+"""
+Unit tests for idempotent YooKassa webhook storage and exactly-once application
+"""
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+os.environ.setdefault('SECRET_KEY', 'test-secret-key')
+os.environ.setdefault('SITE_SECRET', 'test-site-secret')
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../..', 'backend'))
+
+import pytest  # noqa: E402
+from sqlalchemy import create_engine  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+from database.models import (  # noqa: E402
+    BalanceTransaction, Payment, PaymentWebhookEvent, User, UserBalance
+)
+from services import payment_webhooks as pw  # noqa: E402
+
+TABLES = [User.__table__, UserBalance.__table__, BalanceTransaction.__table__,
+          Payment.__table__, PaymentWebhookEvent.__table__]
+
+
+def notification(event, status, paid):
+    return {"type": "notification", "event": event,
+            "object": {"id": "yk-1", "status": status, "paid": paid, "amount": {"value": "500.00"}}}
+
+
+@pytest.fixture
+def session_factory(tmp_path):
+    # Файловая SQLite: у каждого потока свое соединение, запись сериализуется блокировкой БД
+    engine = create_engine(f"sqlite:///{tmp_path / 'payments.db'}", connect_args={"timeout": 30})
+    for table in TABLES:
+        table.create(engine)
+    factory = sessionmaker(bind=engine, autoflush=False)
+    with factory() as db:
+        db.add(User(id=1, email="user@example.com", hashed_password="x"))
+        db.add(Payment(id=10, user_id=1, order_id="order-1", amount=Decimal("500.00"),
+                       status="pending", yookassa_payment_id="yk-1"))
+        db.commit()
+    yield factory
+    engine.dispose()
+
+
+def test_parallel_duplicate_webhooks_credit_balance_once(session_factory, monkeypatch):
+    processor = pw.PaymentWebhookProcessor(session_factory=session_factory)
+    effects = []
+    monkeypatch.setattr(processor, "_run_side_effects", lambda batch: effects.extend(batch))
+
+    deliveries = [notification("payment.succeeded", "succeeded", True)] * 20 + \
+                 [notification("payment.waiting_for_capture", "waiting_for_capture", False)] * 5
+
+    def deliver(payload):
+        with session_factory() as db:
+            return processor.ingest(db, payload, source_ip="127.0.0.1")
+
+    with ThreadPoolExecutor(max_workers=10) as pool:
+        stored = list(pool.map(deliver, deliveries))
+    assert sum(stored) == 2
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        processed = list(pool.map(lambda _: processor.process_batch(), range(4)))
+    assert sum(processed) == 2
+
+    with session_factory() as db:
+        balance = db.query(UserBalance).filter_by(user_id=1).one()
+        assert balance.balance == Decimal("500.00")
+        assert db.query(BalanceTransaction).count() == 1
+        assert db.get(Payment, 10).status == "completed"
+        statuses = sorted(e.status for e in db.query(PaymentWebhookEvent).all())
+    # waiting_for_capture пришел раньше — применен; если позже — отброшен как устаревший
+    assert statuses in (["applied", "applied"], ["applied", "ignored"])
+    assert [e[0] for e in effects] == ["payment_email", "reset_balance_warnings"]
+
+    # Повтор уже примененных событий не пополняет баланс второй раз
+    with session_factory() as db:
+        assert processor.replay(db, payment_id="yk-1", statuses=("applied", "ignored")) == 2
+    processor.process_batch()
+    with session_factory() as db:
+        assert db.query(UserBalance).filter_by(user_id=1).one().balance == Decimal("500.00")
+        assert db.query(BalanceTransaction).count() == 1
+
+
+def test_unknown_payment_is_retried_with_backoff(session_factory):
+    processor = pw.PaymentWebhookProcessor(session_factory=session_factory)
+    payload = notification("payment.succeeded", "succeeded", True)
+    payload["object"]["id"] = "yk-missing"
+
+    with session_factory() as db:
+        processor.ingest(db, payload)
+    assert processor.process_batch() == 1
+
+    with session_factory() as db:
+        event = db.query(PaymentWebhookEvent).one()
+        assert event.status == "pending" and event.attempts == 1
+        assert "yk-missing" in event.last_error
+        assert event.available_at > event.received_at
@@ -0,0 +1,138 @@
+"""
+Unit tests for the authenticated user cache and token revocation
+"""
+import os
+import sys
+
+os.environ.setdefault('SECRET_KEY', 'test-secret-key')
+os.environ.setdefault('SITE_SECRET', 'test-site-secret')
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../..', 'backend'))
+
+import pytest  # noqa: E402
+from sqlalchemy import create_engine, event  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+from database import models  # noqa: E402
+from core import auth, principal_cache  # noqa: E402
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis, self.calls = redis, []
+
+    def __getattr__(self, name):
+        return lambda *args: self.calls.append((name, args))
+
+    def execute(self):
+        return [getattr(self.redis, name)(*args) for name, args in self.calls]
+
+
+class FakeRedis:
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def mget(self, *keys):
+        return [self.data.get(key) for key in keys]
+
+    def setex(self, key, ttl, value):
+        self.data[key] = value if isinstance(value, bytes) else str(value).encode()
+
+    def delete(self, key):
+        return self.data.pop(key, None) is not None
+
+    def exists(self, key):
+        return int(key in self.data)
+
+    def incr(self, key):
+        self.data[key] = str(int(self.data.get(key, 0)) + 1).encode()
+        return int(self.data[key])
+
+    def expire(self, key, ttl):
+        return True
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    fake = FakeRedis()
+    monkeypatch.setattr(principal_cache, "_redis", lambda: fake)
+    return fake
+
+
+@pytest.fixture
+def session_factory():
+    engine = create_engine("sqlite://")
+    models.User.__table__.create(engine)
+    factory = sessionmaker(bind=engine)
+    db = factory()
+    db.add(models.User(id=1, email="user@example.com", hashed_password="x", status="active", role="user"))
+    db.commit()
+    db.close()
+    return factory
+
+
+def test_cached_user_is_attached_without_query(redis, session_factory):
+    token = auth.create_access_token({"sub": "1", "email": "user@example.com"})
+
+    first = session_factory()
+    assert auth.get_current_user(token, first).email == "user@example.com"
+    first.close()
+
+    second = session_factory()
+    queries = []
+    event.listen(second.get_bind(), "before_cursor_execute", lambda *a: queries.append(a[2]))
+    user = auth.get_current_user(token, second)
+    user.first_name = "Ivan"
+    second.commit()
+
+    assert [q for q in queries if q.lstrip().upper().startswith("SELECT")] == []
+    assert session_factory().get(models.User, 1).first_name == "Ivan"
+
+
+def test_password_change_revokes_issued_tokens(redis, session_factory):
+    token = auth.create_access_token({"sub": "1", "email": "user@example.com"})
+
+    db = session_factory()
+    user = auth.get_current_user(token, db)
+    user.hashed_password = "changed"
+    db.commit()
+
+    with pytest.raises(auth.HTTPException) as exc:
+        auth.get_current_user(token, session_factory())
+    assert exc.value.status_code == 401
+
+    fresh = auth.create_access_token({"sub": "1", "email": "user@example.com"})
+    assert auth.get_current_user(fresh, session_factory()).id == 1
+
+
+def test_rehash_on_login_keeps_issued_tokens(redis, session_factory):
+    token = auth.create_access_token({"sub": "1", "email": "user@example.com"})
+
+    db = session_factory()
+    user = auth.get_current_user(token, db)
+    user.hashed_password = "rehashed"
+    principal_cache.mark_password_rehash(db, user.id)
+    db.commit()
+
+    assert auth.get_current_user(token, session_factory()).hashed_password == "rehashed"
+
+    # Пометка действует только на свою транзакцию
+    db = session_factory()
+    user = db.get(models.User, 1)
+    user.hashed_password = "changed"
+    db.commit()
+    with pytest.raises(auth.HTTPException):
+        auth.get_current_user(token, session_factory())
+
+
+def test_revoked_token_is_rejected(redis, session_factory):
+    token = auth.create_access_token({"sub": "1", "email": "user@example.com"})
+
+    assert auth.revoke_token(token)
+    with pytest.raises(auth.HTTPException):
+        auth.get_current_user(token, session_factory())
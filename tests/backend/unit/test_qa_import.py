@@ -0,0 +1,106 @@
+"""
+Unit tests for bulk Q&A import: parsing, question-hash deduplication and batched background embedding
+"""
+import json
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault('SECRET_KEY', 'test-secret-key')
+os.environ.setdefault('SITE_SECRET', 'test-site-secret')
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../..', 'backend'))
+
+from sqlalchemy import create_engine  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+from database.models import (  # noqa: E402
+    Assistant, KnowledgeEmbedding, QAImportJob, QAKnowledge, User, qa_question_hash
+)
+from services import qa_import  # noqa: E402
+from services.embeddings_service import embeddings_service  # noqa: E402
+from services.qa_import import QAImportProcessor  # noqa: E402
+
+
+@pytest.fixture
+def session_factory():
+    engine = create_engine("sqlite://")
+    for model in (User, Assistant, QAImportJob, QAKnowledge, KnowledgeEmbedding):
+        model.__table__.create(engine)
+    factory = sessionmaker(bind=engine, expire_on_commit=False)
+    db = factory()
+    db.add(User(id=1, email="owner@example.com", hashed_password="x"))
+    db.add(Assistant(id=7, user_id=1, name="FAQ", knowledge_version=3))
+    db.add(QAKnowledge(user_id=1, assistant_id=7, question="Как  оплатить?", answer="Картой"))
+    db.commit()
+    db.close()
+    return factory
+
+
+@pytest.fixture
+def embed_calls(monkeypatch):
+    calls = []
+
+    def fake_batch(texts, user_id, batch_size=100):
+        calls.append(list(texts))
+        return [None if text == 'сбой' else [0.01] * 1536 for text in texts]
+
+    monkeypatch.setattr(embeddings_service, 'generate_embeddings_batch', fake_batch)
+    return calls
+
+
+def test_parsers_map_headers_and_report_bad_rows():
+    csv_rows = qa_import.parse_file('faq.csv', "Вопрос;Ответ;Категория\nГде офис?;В Москве;контакты\n".encode('cp1251'))
+    assert csv_rows == [{'question': 'Где офис?', 'answer': 'В Москве', 'category': 'контакты'}]
+
+    jsonl = b'{"question": "A?", "answer": "1", "importance": "42"}\n\n{"q": "a?", "a": "2"}\n{"answer": "no question"}\n'
+    records, duplicates, errors = qa_import.build_records(qa_import.parse_file('faq.jsonl', jsonl))
+    assert [r['question'] for r in records] == ['A?'] and records[0]['importance'] == 10
+    assert duplicates == 1 and errors == [{'row': 3, 'error': 'нужны непустые вопрос и ответ'}]
+
+    with pytest.raises(ValueError):
+        qa_import.parse_file('faq.pdf', b'')
+    assert qa_question_hash(" Как оплатить? ") == qa_question_hash("как   ОПЛАТИТЬ?")
+
+
+def test_import_deduplicates_embeds_in_batches_and_bumps_version_once(session_factory, embed_calls, monkeypatch):
+    monkeypatch.setattr(qa_import, 'EMBED_ROWS_BATCH', 2)
+    lines = [{"question": "как оплатить?", "answer": "дубликат существующей"}]
+    lines += [{"question": f"Вопрос {i}", "answer": "сбой" if i == 4 else f"Ответ {i}"} for i in range(5)]
+    lines.append({"question": "вопрос 1", "answer": "дубликат в файле"})
+    content = "\n".join(json.dumps(line, ensure_ascii=False) for line in lines).encode()
+
+    processor = QAImportProcessor(session_factory)
+    db = session_factory()
+    job = processor.create_import(db, 1, 7, 'faq.jsonl', content)
+    assert (job.total_rows, job.inserted, job.duplicates, job.status) == (7, 5, 2, 'pending')
+    assert db.query(QAKnowledge).filter(QAKnowledge.index_job_id == job.id).count() == 5
+
+    assert processor.process_batch() == 5
+    assert processor.process_batch() == 0
+    # 5 записей по 2 на пачку — 3 запроса к API, по 2 текста на запись
+    assert [len(call) for call in embed_calls] == [4, 4, 2]
+
+    db.expire_all()
+    job = db.get(QAImportJob, job.id)
+    progress = qa_import.job_progress(job)
+    assert progress['status'] == 'completed' and progress['progress_percent'] == 100
+    assert (job.embedded, job.embed_failed) == (4, 1)
+    assert db.query(KnowledgeEmbedding).count() == 8
+    assert db.get(Assistant, 7).knowledge_version == 4
+
+
+def test_edit_reindex_replaces_embeddings(session_factory, embed_calls):
+    processor = QAImportProcessor(session_factory)
+    db = session_factory()
+    qa = db.query(QAKnowledge).first()
+    processor.enqueue_reindex(db, qa)
+    processor.process_batch()
+    assert db.query(KnowledgeEmbedding).filter(KnowledgeEmbedding.qa_id == qa.id).count() == 2
+
+    qa.answer = "Картой или счетом"
+    processor.enqueue_reindex(db, qa)
+    processor.process_batch()
+    chunks = db.query(KnowledgeEmbedding.chunk_text).filter(KnowledgeEmbedding.qa_id == qa.id).all()
+    assert sorted(text for text, in chunks) == ["Как  оплатить?", "Картой или счетом"]
+    assert db.get(Assistant, 7).knowledge_version == 5
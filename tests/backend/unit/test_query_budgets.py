@@ -0,0 +1,148 @@
+"""
+Route-level tests for @query_budget: real routers, seeded data, DB_QUERY_BUDGET_ENFORCE on
+"""
+import os
+import sys
+from datetime import datetime, timedelta
+
+os.environ.setdefault('SECRET_KEY', 'test-secret-key')
+os.environ.setdefault('SITE_SECRET', 'test-site-secret')
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../..', 'backend'))
+
+import pytest  # noqa: E402
+
+pytest.importorskip("aiosqlite")
+
+from fastapi import FastAPI  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+from sqlalchemy import create_engine  # noqa: E402
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+from api.admin import router as admin_router  # noqa: E402
+from api.balance import router as balance_router  # noqa: E402
+from api.dialogs import router as dialogs_router  # noqa: E402
+from api.handoff import operator_router  # noqa: E402
+from cache.redis_cache import cache  # noqa: E402
+from core import auth, principal_cache  # noqa: E402
+from database import models  # noqa: E402
+from database.async_connection import get_async_db  # noqa: E402
+from database.connection import get_db  # noqa: E402
+from database.utils import query_sampler as qs  # noqa: E402
+
+ROWS = 30  # Больше порога N+1: запрос на строку сразу превысит бюджет
+TABLES = (
+    models.User, models.Assistant, models.BotInstance, models.Dialog, models.DialogMessage,
+    models.Document, models.UserBalance, models.BalanceTransaction, models.OperatorPresence,
+    models.MessageQuotaCounter, models.GuestMessageCounter, models.AssistantDailyStat,
+)
+
+
+def seed(db):
+    now = datetime.utcnow()
+    db.add(models.User(id=1, email="admin@example.com", hashed_password="x", role="admin", status="active"))
+    for assistant_id in range(1, 4):
+        db.add(models.Assistant(id=assistant_id, user_id=1, name=f"Bot {assistant_id}"))
+        db.add(models.BotInstance(id=assistant_id, user_id=1, assistant_id=assistant_id,
+                                  platform="telegram", bot_token=f"token-{assistant_id}-0123456789"))
+    for i in range(1, ROWS + 1):
+        db.add(models.Dialog(id=i, user_id=1, assistant_id=i % 3 + 1, guest_id=f"guest-{i}",
+                             started_at=now - timedelta(minutes=i),
+                             handoff_status="requested", handoff_reason="keyword",
+                             handoff_requested_at=now - timedelta(minutes=i)))
+        db.add(models.DialogMessage(id=i, dialog_id=i, sender="assistant", text=f"answer {i}",
+                                    timestamp=now - timedelta(minutes=i)))
+        db.add(models.Document(id=i, user_id=1, filename=f"doc-{i}.pdf", size=10))
+        db.add(models.BalanceTransaction(
+            user_id=1, amount=-5, transaction_type="ai_message" if i % 2 else "document_upload",
+            description="charge", balance_before=1000, balance_after=995, related_id=i,
+            created_at=now - timedelta(minutes=i)
+        ))
+    db.add(models.UserBalance(user_id=1, balance=850, total_spent=150, total_topped_up=1000))
+    db.commit()
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(qs, "QUERY_BUDGET_ENFORCED", True)
+    monkeypatch.setattr(qs, "query_sampler", qs.QueryPerformanceSampler(deploy_id="test"))
+    monkeypatch.setattr(qs, "_redis", lambda: None)
+    monkeypatch.setattr(principal_cache, "_redis", lambda: None)
+    monkeypatch.setattr(cache, "redis_client", None)
+    # Мониторинг ботов опрашивает bot manager по HTTP — в тесте он недоступен
+    monkeypatch.setattr("requests.get", lambda *a, **kw: (_ for _ in ()).throw(ConnectionError("no bot manager")))
+
+    db_path = tmp_path / "budget.db"
+    engine = create_engine(f"sqlite:///{db_path}")
+    for model in TABLES:
+        model.__table__.create(engine)
+    qs.install_query_tracking(engine)
+    SessionLocal = sessionmaker(bind=engine)
+    db = SessionLocal()
+    seed(db)
+    db.close()
+
+    async_engine = create_async_engine(f"sqlite+aiosqlite:///{db_path}")
+    qs.install_query_tracking(async_engine.sync_engine)
+    AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
+
+    def override_get_db():
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    async def override_get_async_db():
+        async with AsyncSessionLocal() as db:
+            yield db
+
+    app = FastAPI()
+    app.add_middleware(qs.QueryTrackingMiddleware)
+    app.include_router(dialogs_router, prefix="/api")
+    app.include_router(admin_router, prefix="/api")
+    app.include_router(balance_router)
+    app.include_router(operator_router, prefix="/api/handoff")
+    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_async_db] = override_get_async_db
+
+    token = auth.create_access_token({"sub": "1", "email": "admin@example.com"})
+    with TestClient(app, headers={"Authorization": f"Bearer {token}"}) as test_client:
+        yield test_client
+    engine.dispose()
+
+
+def budget_of(client, method, path):
+    for route in client.app.routes:
+        if getattr(route, "path", None) == path and method in route.methods:
+            return route.endpoint.__query_budget__
+    raise AssertionError(f"route {method} {path} not found")
+
+
+@pytest.mark.parametrize("path, route_path, min_items", [
+    ("/api/dialogs?limit=50", "/api/dialogs", ROWS),
+    ("/api/admin/bots-monitoring", "/api/admin/bots-monitoring", 3),
+    ("/api/handoff/operator/queue", "/api/handoff/operator/queue", ROWS),
+    ("/api/balance/transactions/detailed?limit=100", "/api/balance/transactions/detailed", ROWS),
+    ("/api/balance/transactions/detailed/paged?limit=100", "/api/balance/transactions/detailed/paged", ROWS),
+])
+def test_annotated_endpoints_stay_within_budget(client, path, route_path, min_items):
+    assert budget_of(client, "GET", route_path) > 0
+
+    response = client.get(path)
+
+    assert response.status_code == 200, response.text
+    body = response.json()
+    items = body if isinstance(body, list) else next(
+        value for key, value in body.items() if isinstance(value, list)
+    )
+    assert len(items) >= min_items
+
+
+def test_budget_violation_fails_the_request(client, monkeypatch):
+    endpoint = next(route.endpoint for route in client.app.routes
+                    if getattr(route, "path", None) == "/api/dialogs")
+    monkeypatch.setattr(endpoint, "__query_budget__", 1)
+
+    with pytest.raises(qs.QueryBudgetExceeded, match="GET /api/dialogs"):
+        client.get("/api/dialogs")
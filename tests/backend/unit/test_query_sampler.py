@@ -0,0 +1,99 @@
+"""
+Unit tests for per-route SQL attribution and the pg_stat_statements sampler
+"""
+import os
+import sys
+from types import SimpleNamespace
+
+os.environ.setdefault('SECRET_KEY', 'test-secret-key')
+os.environ.setdefault('SITE_SECRET', 'test-site-secret')
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../..', 'backend'))
+
+import pytest  # noqa: E402
+from fastapi import FastAPI  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+from sqlalchemy import create_engine, event, text  # noqa: E402
+
+from database.utils import query_sampler as qs  # noqa: E402
+
+
+@pytest.fixture
+def sampler(monkeypatch):
+    monkeypatch.setattr(qs, "_redis", lambda: None)
+    return qs.QueryPerformanceSampler(deploy_id="v2")
+
+
+def run_request(engine, path, queries):
+    stats = qs.RequestQueries({"type": "http", "method": "GET", "route": SimpleNamespace(path=path)})
+    token = qs._current_request.set(stats)
+    try:
+        with engine.connect() as conn:
+            for value in range(queries):
+                conn.execute(text("SELECT :value"), {"value": value})
+    finally:
+        qs._current_request.reset(token)
+    return stats
+
+
+def test_queries_are_attributed_to_route_and_n_plus_one_detected(sampler):
+    engine = create_engine("sqlite://")
+    qs.install_query_tracking(engine)
+    executed = []
+    event.listen(engine, "before_cursor_execute", lambda *a: executed.append(a[2]))
+
+    stats = run_request(engine, "/api/dialogs", qs.N_PLUS_ONE_THRESHOLD + 1)
+    sampler.record_request(stats)
+    report = sampler.get_report()
+
+    assert stats.count == qs.N_PLUS_ONE_THRESHOLD + 1
+    assert executed[0].endswith("/* route='GET /api/dialogs' */")
+    route = report["top_routes"][0]
+    assert route["route"] == "GET /api/dialogs" and route["n_plus_one_requests"] == 1
+    assert report["n_plus_one"][0]["statement"] == "SELECT ?"
+
+
+def test_statement_deltas_and_deploy_regressions(sampler, monkeypatch):
+    snapshots = iter([
+        {1: (100, 100.0, 100, "SELECT a"), 2: (10, 50.0, 10, "SELECT b")},
+        {1: (200, 500.0, 200, "SELECT a"), 2: (10, 50.0, 10, "SELECT b")},
+    ])
+    monkeypatch.setattr(sampler, "_fetch_statements", lambda: next(snapshots))
+    sampler._memory_deploys = ["v1"]
+    sampler._add_totals(qs.DEPLOY_STATEMENTS_KEY.format(deploy="v1"), {"1|calls": 100, "1|ms": 100.0})
+
+    assert sampler.sample_statements() is None
+    sample = sampler.sample_statements()
+    report = sampler.get_report()
+
+    assert sample[4] == [(1, 100, 400.0, 100)]
+    assert report["top_statements"][0]["mean_ms"] == 4.0
+    regression = report["regressions"]["statements"][0]
+    assert regression["name"] == "1" and regression["ratio"] == 4.0
+    assert report["regressions"]["previous_deploy"] == "v1"
+
+
+def test_query_budget_is_enforced_and_reported_in_server_timing(sampler, monkeypatch):
+    monkeypatch.setattr(qs, "query_sampler", sampler)
+    monkeypatch.setattr(qs, "QUERY_BUDGET_ENFORCED", True)
+    monkeypatch.setattr(qs, "SERVER_TIMING_ENABLED", True)
+    engine = create_engine("sqlite://")
+    qs.install_query_tracking(engine)
+
+    app = FastAPI()
+    app.add_middleware(qs.QueryTrackingMiddleware)
+
+    @app.get("/items/{count}")
+    @qs.query_budget(2)
+    def items(count: int):
+        with engine.connect() as conn:
+            for _ in range(count):
+                conn.execute(text("SELECT 1"))
+        return {"ok": True}
+
+    client = TestClient(app)
+    response = client.get("/items/2")
+    assert response.headers["server-timing"].startswith("db;dur=")
+    assert 'desc="2 queries"' in response.headers["server-timing"]
+
+    with pytest.raises(qs.QueryBudgetExceeded, match="GET /items/{count}: 3"):
+        client.get("/items/3")
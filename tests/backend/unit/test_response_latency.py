@@ -0,0 +1,77 @@
+"""
+Unit tests for write-time response latency capture and hourly percentile sketches
+"""
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+
+os.environ.setdefault('SECRET_KEY', 'test-secret-key')
+os.environ.setdefault('SITE_SECRET', 'test-site-secret')
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../..', 'backend'))
+
+from sqlalchemy import create_engine  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+from database.models import (  # noqa: E402
+    AITokenUsage, Dialog, DialogMessage, MessageQuotaCounter, ResponseLatencySketch, User
+)
+from services import message_quota, response_latency  # noqa: E402
+
+
+def test_merged_sketch_percentiles_stay_within_relative_error():
+    rng = random.Random(42)
+    values = [rng.lognormvariate(7, 1) for _ in range(20000)]
+    merged = response_latency.LatencySketch()
+    for start in range(0, len(values), 1000):  # «часовые» скетчи, слитые в один
+        part = response_latency.LatencySketch()
+        for value in values[start:start + 1000]:
+            part.add(value)
+        merged.merge(part)
+
+    ordered = sorted(values)
+    for q in (0.5, 0.95):
+        exact = ordered[int(q * len(ordered))]
+        assert abs(merged.quantile(q) - exact) / exact < 0.02
+    assert merged.count == len(values)
+    assert abs(merged.mean() - sum(values) / len(values)) < 1
+
+
+def test_response_times_are_captured_on_write_and_rebuild_matches():
+    message_quota._dialog_info.clear()
+    engine = create_engine("sqlite://")
+    for model in (User, Dialog, DialogMessage, MessageQuotaCounter, ResponseLatencySketch, AITokenUsage):
+        model.__table__.create(engine)
+    db = sessionmaker(bind=engine)()
+
+    now = datetime.utcnow().replace(minute=30)
+    db.add(User(id=1, email="a@example.com", hashed_password="x"))
+    db.add(Dialog(id=1, user_id=1))
+    db.flush()
+    db.add(DialogMessage(dialog_id=1, sender="user", text="q", timestamp=now))
+    db.flush()
+    # Путь записи не знает время вопроса — берется последнее сообщение пользователя
+    computed = DialogMessage(dialog_id=1, sender="assistant", text="a", timestamp=now + timedelta(seconds=2))
+    # Путь записи передал время сам
+    explicit = DialogMessage(dialog_id=1, sender="assistant", text="b", timestamp=now + timedelta(seconds=3),
+                             response_time_ms=4000)
+    db.add_all([computed, explicit])
+    db.add(AITokenUsage(user_id=1, model_used="gpt-4o-mini", response_time=1.5, created_at=now))
+    db.add(AITokenUsage(user_id=None, model_used="gpt-4o-mini", response_time=0.5, created_at=now))
+    db.add(AITokenUsage(user_id=1, model_used="gpt-4o-mini", response_time=9.0, success=False, created_at=now))
+    db.commit()
+    assert computed.response_time_ms == 2000
+
+    since = now - timedelta(hours=1)
+    dialog = response_latency.get_sketch(db, response_latency.SOURCE_DIALOG, since, user_id=1)
+    assert dialog.count == 2 and dialog.mean() == 3000
+    ai = response_latency.get_sketch(db, response_latency.SOURCE_AI, since).summary()
+    assert ai['count'] == 2 and ai['average'] == 1.0
+
+    incremental = sorted((r.source, r.user_id, r.hour, r.bucket, r.count, r.total_ms)
+                         for r in db.query(ResponseLatencySketch))
+    db.query(ResponseLatencySketch).delete()
+    db.commit()
+    response_latency.rebuild_sketches(db)
+    assert sorted((r.source, r.user_id, r.hour, r.bucket, r.count, r.total_ms)
+                  for r in db.query(ResponseLatencySketch)) == incremental
@@ -0,0 +1,125 @@
+"""
+Unit tests for streaming multipart upload used by database backups
+"""
+import io
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault('SECRET_KEY', 'test-secret-key')
+os.environ.setdefault('SITE_SECRET', 'test-site-secret')
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../..', 'backend'))
+
+from database.utils.backup import DatabaseBackup  # noqa: E402
+from services.s3_storage_service import S3StorageService  # noqa: E402
+
+MB = 1024 * 1024
+
+
+class TrickleStream(io.RawIOBase):
+    """Pipe-like stream that returns at most 1 MB per read"""
+
+    def __init__(self, data):
+        self.data = io.BytesIO(data)
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        return self.data.read(min(size, MB))
+
+
+class FakeS3Client:
+    def __init__(self, fail_on_part=None):
+        self.parts, self.completed, self.aborted = [], None, False
+        self.fail_on_part = fail_on_part
+
+    def create_multipart_upload(self, **kwargs):
+        self.create_args = kwargs
+        return {'UploadId': 'upload-1'}
+
+    def upload_part(self, PartNumber, Body, **kwargs):
+        if PartNumber == self.fail_on_part:
+            raise RuntimeError("connection reset")
+        self.parts.append(Body)
+        return {'ETag': f'etag-{PartNumber}'}
+
+    def complete_multipart_upload(self, MultipartUpload, **kwargs):
+        self.completed = MultipartUpload['Parts']
+
+    def abort_multipart_upload(self, **kwargs):
+        self.aborted = True
+
+
+def make_service(client):
+    service = object.__new__(S3StorageService)
+    service.bucket_name, service.s3_client = 'main-bucket', client
+    return service
+
+
+def test_stream_is_split_into_full_parts():
+    client = FakeS3Client()
+    data = os.urandom(12 * MB)
+
+    result = make_service(client).upload_stream(TrickleStream(data), 'backups/a.dump.zst',
+                                                part_size=5 * MB, bucket_name='backup-bucket')
+
+    assert result['success'] and result['size'] == len(data)
+    assert [len(part) for part in client.parts] == [5 * MB, 5 * MB, 2 * MB]
+    assert b''.join(client.parts) == data
+    assert [p['PartNumber'] for p in client.completed] == [1, 2, 3]
+    assert client.create_args['Bucket'] == 'backup-bucket'
+
+
+def test_failed_part_aborts_upload():
+    client = FakeS3Client(fail_on_part=2)
+
+    result = make_service(client).upload_stream(TrickleStream(os.urandom(11 * MB)), 'a', part_size=5 * MB)
+
+    assert not result['success']
+    assert client.aborted and client.completed is None
+
+
+def make_backup(tmp_path, s3_client=None):
+    backup = object.__new__(DatabaseBackup)
+    backup.db_password, backup.timeout = '', 30
+    backup.backup_dir = tmp_path
+    (tmp_path / 'daily').mkdir()
+    backup.s3_enabled = s3_client is not None
+    backup.s3_service = make_service(s3_client) if s3_client else None
+    backup.s3_bucket, backup.s3_storage_class, backup.s3_part_size = 'backup-bucket', None, 5 * MB
+    return backup
+
+
+# pg_dump, упавший после того как успел выдать часть дампа
+FAILING_DUMP = ['sh', '-c', 'head -c 300000 /dev/urandom; echo "connection lost" >&2; exit 1']
+
+
+def test_failed_dump_leaves_no_local_archive(tmp_path):
+    backup = make_backup(tmp_path)
+
+    with pytest.raises(RuntimeError, match="connection lost"):
+        backup._run_pipeline([FAILING_DUMP, ['gzip', '-c']], 'daily', 'a.sql.gz', count_first_stage=True)
+
+    assert list((tmp_path / 'daily').iterdir()) == []
+
+
+def test_failed_dump_aborts_multipart_upload(tmp_path):
+    client = FakeS3Client()
+    backup = make_backup(tmp_path, client)
+
+    with pytest.raises(RuntimeError, match="connection lost"):
+        backup._run_pipeline([FAILING_DUMP, ['gzip', '-c']], 'daily', 'a.sql.gz', count_first_stage=True)
+
+    assert client.aborted and client.completed is None
+
+
+def test_successful_pipeline_is_stored(tmp_path):
+    backup = make_backup(tmp_path)
+
+    stored = backup._run_pipeline([['sh', '-c', 'echo dump'], ['gzip', '-c']], 'daily', 'a.sql.gz',
+                                  count_first_stage=True)
+
+    assert [p.name for p in (tmp_path / 'daily').iterdir()] == ['a.sql.gz']
+    assert stored['size_original'] == 5 and stored['path'].endswith('a.sql.gz')
@@ -0,0 +1,114 @@
+"""
+Unit tests for the admin table explorer: keyset pagination, declared search columns, bounded counts
+"""
+import os
+import sys
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import pytest
+
+os.environ.setdefault('SECRET_KEY', 'test-secret-key')
+os.environ.setdefault('SITE_SECRET', 'test-site-secret')
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../..', 'backend'))
+
+from fastapi import HTTPException  # noqa: E402
+from sqlalchemy import create_engine  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+from database.models import BalanceTransaction, QAKnowledge  # noqa: E402
+from services import table_explorer  # noqa: E402
+
+
+@pytest.fixture
+def db():
+    engine = create_engine("sqlite://")
+    QAKnowledge.__table__.create(engine)
+    session = sessionmaker(bind=engine)()
+    start = datetime(2026, 1, 1)
+    for i in range(1, 26):
+        session.add(QAKnowledge(
+            id=i, user_id=1 + i % 2, question=f"Вопрос {i} о доставке" if i % 5 == 0 else f"Вопрос {i}",
+            answer="Ответ", category="faq",
+            # Повторяющиеся значения и NULL в колонке сортировки
+            last_used=None if i % 7 == 0 else start + timedelta(days=i // 3),
+        ))
+    session.commit()
+    yield session
+    session.close()
+
+
+def walk(db, table='qa_knowledge', model=QAKnowledge, **kwargs):
+    ids, cursor, pages = [], None, 0
+    while True:
+        records, pagination = table_explorer.fetch_page(db, table, model, limit=4, cursor=cursor,
+                                                        page=pages + 1, **kwargs)
+        ids.extend(record.id for record in records)
+        pages += 1
+        if not pagination['has_more']:
+            assert pagination['next_cursor'] is None
+            return ids, pages, pagination
+        cursor = pagination['next_cursor']
+
+
+@pytest.mark.parametrize("sort_field", [None, 'last_used'])
+@pytest.mark.parametrize("sort_order", ['asc', 'desc'])
+def test_keyset_pages_match_full_ordering(db, sort_field, sort_order):
+    ids, pages, _ = walk(db, sort_field=sort_field, sort_order=sort_order)
+
+    rows = db.query(QAKnowledge).all()
+    descending = sort_order == 'desc'
+    if sort_field is None:
+        expected = sorted((row.id for row in rows), reverse=descending)
+    else:
+        # NULLS LAST в обоих направлениях, при равенстве — по первичному ключу
+        with_value = sorted((row for row in rows if row.last_used is not None),
+                            key=lambda row: (row.last_used, row.id), reverse=descending)
+        without_value = sorted((row for row in rows if row.last_used is None), key=lambda row: row.id,
+                               reverse=descending)
+        expected = [row.id for row in with_value + without_value]
+    assert ids == expected and pages == 7
+
+
+@pytest.mark.parametrize("sort_order", ['asc', 'desc'])
+def test_keyset_pages_over_numeric_sort_column(db, sort_order):
+    BalanceTransaction.__table__.create(db.get_bind())
+    for i in range(1, 11):
+        db.add(BalanceTransaction(id=i, user_id=1, amount=Decimal("-5.50") if i % 3 else Decimal("100.25"),
+                                  transaction_type="ai_message", balance_before=0, balance_after=0))
+    db.commit()
+
+    ids, pages, _ = walk(db, 'balance_transactions', BalanceTransaction, sort_field='amount', sort_order=sort_order)
+
+    rows = db.query(BalanceTransaction).all()
+    expected = sorted(rows, key=lambda row: (row.amount, row.id), reverse=sort_order == 'desc')
+    assert ids == [row.id for row in expected] and pages == 3
+
+    with pytest.raises(HTTPException):
+        table_explorer.decode_cursor(table_explorer.encode_cursor(["x", 1]),
+                                     [BalanceTransaction.amount, BalanceTransaction.id])
+
+
+def test_search_is_limited_to_declared_columns_and_counts_are_bounded(db, monkeypatch):
+    monkeypatch.setattr(table_explorer, 'COUNT_LIMIT', 3)
+    ids, _, pagination = walk(db, search='доставке')
+    assert ids == [5, 10, 15, 20, 25]
+    assert pagination['search_columns'] == ['question', 'answer']
+    assert pagination['total'] == 5 and pagination['total_is_estimate']
+
+    records, pagination = table_explorer.fetch_page(db, 'qa_knowledge', QAKnowledge, filter_field='user_id',
+                                                    filter_value='2')
+    assert {record.user_id for record in records} == {2} and pagination['total'] == 13
+
+    with pytest.raises(HTTPException):
+        table_explorer.fetch_page(db, 'qa_knowledge', QAKnowledge, search='до')
+    with pytest.raises(HTTPException):
+        table_explorer.fetch_page(db, 'ai_token_pool', QAKnowledge, search='token')
+    with pytest.raises(HTTPException):
+        table_explorer.fetch_page(db, 'qa_knowledge', QAKnowledge, cursor='not-a-cursor')
+
+
+def test_unfiltered_total_comes_from_table_estimate(db):
+    _, pagination = table_explorer.fetch_page(db, 'qa_knowledge', QAKnowledge, limit=10, page=2)
+    assert pagination['total'] == 25 and pagination['pages'] == 3 and pagination['has_more']
+    assert table_explorer.estimate_row_counts(db, ['qa_knowledge'])['qa_knowledge']['rows'] == 25
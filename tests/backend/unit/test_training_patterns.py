@@ -0,0 +1,45 @@
+"""
+Unit tests for the conversation pattern index
+"""
+import os
+import sys
+
+os.environ.setdefault('SECRET_KEY', 'test-secret-key')
+os.environ.setdefault('SITE_SECRET', 'test-site-secret')
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../..', 'backend'))
+
+from ai.training_system import PatternIndex  # noqa: E402
+
+
+def test_pattern_index_prefers_highest_ranked_match():
+    index = PatternIndex([
+        ("сроки доставки", "ответ про сроки", 10),
+        ("оплата картой", "ответ про оплату", 11),
+        ("доставки", "общий ответ про доставку", 12),
+    ])
+
+    assert index.match("Какие у вас сроки?") == (10, "ответ про сроки")
+    assert index.match("стоимость доставки") == (10, "ответ про сроки")
+    assert index.match("ОПЛАТА наличными") == (11, "ответ про оплату")
+    assert index.match("привет") is None
+
+
+def test_pattern_index_scales_to_thousands_of_patterns():
+    rows = [(f"ключ{i} слово{i}", f"ответ {i}", i) for i in range(5000)]
+    index = PatternIndex(rows)
+
+    assert index.match("вопрос про слово4321") == (4321, "ответ 4321")
+    assert index.match("ничего общего") is None
+
+
+def test_admin_record_changes_drop_cached_pattern_index():
+    from ai import training_system
+    from api.database_admin import _invalidate_record_caches
+    from database.models import ConversationPattern, Document
+
+    training_system._pattern_indexes[42] = PatternIndex([("доставка", "ответ", 1)])
+    _invalidate_record_caches(Document, Document(user_id=42))
+    assert 42 in training_system._pattern_indexes
+
+    _invalidate_record_caches(ConversationPattern, ConversationPattern(user_id=42))
+    assert 42 not in training_system._pattern_indexes
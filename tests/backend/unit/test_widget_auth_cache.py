@@ -0,0 +1,81 @@
+"""
+Unit tests for the widget auth cache
+"""
+import os
+import sys
+from types import SimpleNamespace
+
+os.environ.setdefault('SECRET_KEY', 'test-secret-key')
+os.environ.setdefault('SITE_SECRET', 'test-site-secret')
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../..', 'backend'))
+
+import jwt  # noqa: E402
+import pytest  # noqa: E402
+
+from cache import widget_auth_cache as cache_module  # noqa: E402
+from core.app_config import SITE_SECRET  # noqa: E402
+
+
+class FakeRedis:
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def setex(self, key, ttl, value):
+        self.data[key] = value
+
+    def delete(self, key):
+        return self.data.pop(key, None) is not None
+
+
+@pytest.fixture
+def widget_cache(monkeypatch):
+    loads = []
+
+    def load_assistant(assistant_id, db=None):
+        loads.append(assistant_id)
+        return cache_module.AssistantSnapshot.from_model(SimpleNamespace(
+            id=assistant_id, user_id=7, name="Bot", allowed_domains="example.com",
+            is_active=True, widget_version=1, updated_at=None,
+        ))
+
+    monkeypatch.setattr(cache_module.WidgetAuthCache, "_load_assistant", staticmethod(load_assistant))
+    instance = cache_module.WidgetAuthCache(redis_client=FakeRedis())
+    instance.loads = loads
+    return instance
+
+
+def test_warm_resolve_skips_database(widget_cache):
+    token = jwt.encode({'assistant_id': 3, 'type': 'site', 'user_id': 7}, SITE_SECRET, algorithm='HS256')
+
+    widget_cache.resolve(token)
+    claims, snapshot = widget_cache.resolve(token)
+
+    assert claims['assistant_id'] == 3
+    assert snapshot.allowed_domains == "example.com"
+    assert widget_cache.loads == [3]
+
+
+def test_invalidate_reloads_snapshot(widget_cache):
+    widget_cache.get_assistant(3)
+    widget_cache.invalidate_assistant(3)
+    widget_cache.get_assistant(3)
+
+    assert widget_cache.loads == [3, 3]
+
+
+def test_invalid_signature_is_rejected(widget_cache):
+    token = jwt.encode({'assistant_id': 3}, 'other-secret', algorithm='HS256')
+
+    with pytest.raises(jwt.InvalidTokenError):
+        widget_cache.decode(token)
+
+
+def test_decoded_claims_are_copies(widget_cache):
+    token = jwt.encode({'assistant_id': 3}, SITE_SECRET, algorithm='HS256')
+
+    widget_cache.decode(token)['assistant_id'] = 999
+
+    assert widget_cache.decode(token)['assistant_id'] == 3
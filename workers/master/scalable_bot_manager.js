@@ -6,6 +6,7 @@ const axios = require('axios');
 const fs = require('fs');
 const TelegramBot = require('node-telegram-bot-api');
 const WebhookServer = require('../services/webhook_server');
+const BotControlConsumer = require('../services/bot_control_consumer');
 const webhookConfig = require('../config/webhook');
 
 // Backend API URL configuration
@@ -64,6 +65,7 @@ class ScalableBotManager {
             this.startAPI();
             this.startMonitoring();
             this.startProcessTracking(); // 🔥 ЗАПУСК ОТСЛЕЖИВАНИЯ ПРОЦЕССОВ
+            this.startControlConsumer(); // 🎛️ Команды бэкенда из Redis Stream
             
             console.log(`🧠 Мастер-процесс запущен (PID: ${process.pid})`);
             console.log(`📊 Максимум воркеров: ${this.config.maxTotalWorkers}`);
@@ -2709,6 +2711,47 @@ class ScalableBotManager {
         }
     }
     
+    /**
+     * 🎛️ ПОТРЕБИТЕЛЬ КОМАНД БЭКЕНДА (reload / clear_cache / stop / start)
+     * Без Redis (BOT_CONTROL_REDIS=false) команды приходят по HTTP от бэкенда
+     */
+    startControlConsumer() {
+        if (process.env.BOT_CONTROL_REDIS === 'false') {
+            console.log('🎛️ Канал управления через Redis отключен, команды принимаются по HTTP');
+            return;
+        }
+
+        this.controlConsumer = new BotControlConsumer({
+            reload: async (botId, payload) => {
+                // Горячая перезагрузка возможна только у запущенного воркера
+                if (!payload.restart && this.workers.has(botId) && await this.hotReloadBotSettings(botId)) {
+                    return true;
+                }
+                await this.restartBotWorker(botId);
+                return true;
+            },
+            clear_cache: async (botId) => {
+                const workerStats = this.workerStats.get(botId);
+                if (workerStats) {
+                    this.workerStats.set(botId, { ...workerStats, lastAssistantData: null, lastCacheUpdate: Date.now() });
+                }
+                return true;
+            },
+            stop: async (botId) => {
+                await this.stopBotWorker(botId);
+                return true;
+            },
+            start: async (botId) => {
+                await this.restartBotWorker(botId);
+                return true;
+            }
+        });
+
+        this.controlConsumer.start().catch((error) => {
+            console.error('❌ Не удалось запустить потребителя команд ботов:', error.message);
+        });
+    }
+
     /**
      * Запуск менеджера
      */
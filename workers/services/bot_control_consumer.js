@@ -0,0 +1,171 @@
+/**
+ * 🎛️ ПОТРЕБИТЕЛЬ КАНАЛА УПРАВЛЕНИЯ БОТАМИ
+ * Читает команды бэкенда из Redis Stream bot:control:stream (группа bot-manager)
+ * и подтверждает их применение. Протокол — backend/services/bot_control.py:
+ *  - у каждого бота свой возрастающий seq; reload/stop/start с seq <= lifecycle_seq пропускаются,
+ *    clear_cache ничего не вытесняет и выполняется всегда;
+ *  - неподтвержденные команды через BOT_CONTROL_RETRY_AFTER_MS забираются повторно (XAUTOCLAIM);
+ *  - после BOT_CONTROL_MAX_ATTEMPTS неудач команда снимается и записывается в failed_seq.
+ */
+
+const os = require('os');
+const { createClient } = require('redis');
+
+const STREAM_KEY = 'bot:control:stream';
+const CONSUMER_GROUP = 'bot-manager';
+const STATE_KEY = (botId) => `bot:control:state:${botId}`;
+const PENDING_KEY = (botId) => `bot:control:pending:${botId}`;
+
+const RETRY_AFTER_MS = parseInt(process.env.BOT_CONTROL_RETRY_AFTER_MS || '15000', 10);
+const MAX_ATTEMPTS = parseInt(process.env.BOT_CONTROL_MAX_ATTEMPTS || '10', 10);
+const READ_BLOCK_MS = 5000;
+const BATCH_SIZE = 10;
+// Команды, определяющие состояние бота: применение более новой делает старые лишними
+const LIFECYCLE_COMMANDS = ['reload', 'stop', 'start'];
+
+// Тот же скрипт, что и в bot_control.py: applied_seq и lifecycle_seq только растут
+const COMPLETE_SCRIPT = `
+local current = tonumber(redis.call('HGET', KEYS[1], 'applied_seq') or '0')
+if tonumber(ARGV[1]) > current then
+    redis.call('HSET', KEYS[1], 'applied_seq', ARGV[1], 'applied_command', ARGV[2], 'applied_at', ARGV[3])
+end
+if ARGV[6] == '1' and tonumber(ARGV[1]) > tonumber(redis.call('HGET', KEYS[1], 'lifecycle_seq') or '0') then
+    redis.call('HSET', KEYS[1], 'lifecycle_seq', ARGV[1])
+end
+redis.call('HDEL', KEYS[2], ARGV[1])
+redis.call('XACK', KEYS[3], ARGV[4], ARGV[5])
+return current
+`;
+
+const now = () => new Date().toISOString().replace('Z', '');
+
+class BotControlConsumer {
+    /**
+     * @param {Object} handlers - { reload, clear_cache, stop, start }: async (botId, payload) => boolean
+     */
+    constructor(handlers, redisUrl = process.env.REDIS_URL || 'redis://localhost:6379') {
+        this.handlers = handlers;
+        this.redisUrl = redisUrl;
+        this.name = `${os.hostname()}:${process.pid}`;
+        this.client = null;
+        this.running = false;
+    }
+
+    async start() {
+        this.client = createClient({ url: this.redisUrl });
+        this.client.on('error', (error) => console.error('❌ Redis (канал управления ботами):', error.message));
+        await this.client.connect();
+        try {
+            await this.client.xGroupCreate(STREAM_KEY, CONSUMER_GROUP, '0', { MKSTREAM: true });
+        } catch (error) {
+            if (!String(error.message).includes('BUSYGROUP')) throw error;
+        }
+        this.running = true;
+        console.log(`🎛️ Потребитель команд ботов запущен: ${this.name}`);
+        this.loop();
+    }
+
+    async stop() {
+        this.running = false;
+        if (this.client) {
+            await this.client.quit().catch(() => {});
+        }
+    }
+
+    async loop() {
+        while (this.running) {
+            try {
+                await this.processOnce();
+            } catch (error) {
+                console.error('❌ Ошибка потребителя команд ботов:', error.message);
+                await new Promise((resolve) => setTimeout(resolve, RETRY_AFTER_MS));
+            }
+        }
+    }
+
+    async claim() {
+        // Сначала — неподтвержденные дольше RETRY_AFTER_MS
+        const claimed = await this.client.xAutoClaim(
+            STREAM_KEY, CONSUMER_GROUP, this.name, RETRY_AFTER_MS, '0-0', { COUNT: BATCH_SIZE }
+        );
+        const messages = claimed.messages.filter((message) => message && message.message);
+        if (messages.length < BATCH_SIZE) {
+            const response = await this.client.xReadGroup(
+                CONSUMER_GROUP, this.name, { key: STREAM_KEY, id: '>' },
+                { COUNT: BATCH_SIZE - messages.length, BLOCK: READ_BLOCK_MS }
+            );
+            for (const stream of response || []) {
+                messages.push(...stream.messages);
+            }
+        }
+        return messages.map(({ id, message }) => ({
+            messageId: id,
+            botId: parseInt(message.bot_id, 10),
+            seq: parseInt(message.seq, 10),
+            command: message.command,
+            payload: JSON.parse(message.payload || '{}')
+        }));
+    }
+
+    async processOnce() {
+        for (const command of await this.claim()) {
+            if (LIFECYCLE_COMMANDS.includes(command.command)) {
+                const lifecycleSeq = parseInt(
+                    await this.client.hGet(STATE_KEY(command.botId), 'lifecycle_seq') || '0', 10
+                );
+                if (command.seq <= lifecycleSeq) {
+                    await this.complete(command); // Уже применена более новая команда жизненного цикла
+                    continue;
+                }
+            }
+            try {
+                const handler = this.handlers[command.command];
+                if (!handler) throw new Error(`нет обработчика команды ${command.command}`);
+                if (await handler(command.botId, command.payload) === false) {
+                    throw new Error('обработчик вернул false');
+                }
+            } catch (error) {
+                await this.fail(command, error.message);
+                continue;
+            }
+            await this.complete(command);
+            console.log(`✅ Команда ${command.command} применена для бота ${command.botId} (seq ${command.seq})`);
+        }
+    }
+
+    async complete(command) {
+        await this.client.eval(COMPLETE_SCRIPT, {
+            keys: [STATE_KEY(command.botId), PENDING_KEY(command.botId), STREAM_KEY],
+            arguments: [
+                String(command.seq), command.command, now(), CONSUMER_GROUP, command.messageId,
+                LIFECYCLE_COMMANDS.includes(command.command) ? '1' : '0'
+            ]
+        });
+    }
+
+    async fail(command, error) {
+        const pendingKey = PENDING_KEY(command.botId);
+        const raw = await this.client.hGet(pendingKey, String(command.seq));
+        const entry = raw ? JSON.parse(raw) : { command: command.command, payload: command.payload };
+        entry.attempts = (entry.attempts || 0) + 1;
+        entry.last_error = String(error).slice(0, 500);
+
+        const multi = this.client.multi()
+            .hSet(STATE_KEY(command.botId), { last_error: entry.last_error, last_error_at: now() });
+        if (entry.attempts >= MAX_ATTEMPTS) {
+            multi.hDel(pendingKey, String(command.seq))
+                .hSet(STATE_KEY(command.botId), 'failed_seq', String(command.seq))
+                .xAck(STREAM_KEY, CONSUMER_GROUP, command.messageId);
+            console.error(`❌ Команда ${command.command} для бота ${command.botId} (seq ${command.seq}) ` +
+                          `не применена за ${MAX_ATTEMPTS} попыток: ${error}`);
+        } else {
+            // Остается неподтвержденной — XAUTOCLAIM вернет ее после RETRY_AFTER_MS
+            multi.hSet(pendingKey, String(command.seq), JSON.stringify(entry));
+            console.warn(`⚠️ Команда ${command.command} для бота ${command.botId} не применена ` +
+                         `(попытка ${entry.attempts}), повтор через ${RETRY_AFTER_MS} мс: ${error}`);
+        }
+        await multi.exec();
+    }
+}
+
+module.exports = BotControlConsumer;
@@ -520,7 +520,8 @@ class BotWorker {
             // Получаем или создаем диалог с информацией о пользователе
             const dialog = await this.getOrCreateDialog(userId, chatId, this.assistant.id, userInfo);
             
-            // Сохраняем сообщение пользователя
+            // Сохраняем сообщение пользователя (время получения — для времени ответа)
+            const receivedAt = Date.now();
             await this.saveMessage(dialog.id, 'user', text);
             
             // 🔥 ПОЛУЧАЕМ АКТУАЛЬНЫЙ СТАТУС ДИАЛОГА ИЗ БД
@@ -561,7 +562,7 @@ class BotWorker {
             }
             
             // Сохраняем ответ ассистента
-            await this.saveMessage(dialog.id, 'assistant', aiResponse);
+            await this.saveMessage(dialog.id, 'assistant', aiResponse, { response_time_ms: Date.now() - receivedAt });
             
             // Конвертируем markdown для Telegram и отправляем ответ пользователю
             const telegramResponse = this.convertMarkdownForTelegram(aiResponse);
@@ -640,11 +641,12 @@ class BotWorker {
     /**
      * Сохранение сообщения
      */
-    async saveMessage(dialogId, sender, text) {
+    async saveMessage(dialogId, sender, text, extra = {}) {
         try {
             await axios.post(`${BACKEND_API_URL}/api/bot/dialogs/${dialogId}/messages`, {
                 sender: sender,
-                text: text
+                text: text,
+                ...extra
             }, {
                 timeout: 10000  // 10 секунд
             });